@@ -0,0 +1,297 @@
+"""
+异步(asyncio)适配器接口
+
+AsyncBaseAdapter与BaseAdapter的方法一致，方法是协程；
+没有原生异步实现的适配器通过SyncAdapterWrapper在线程池中执行；
+同步代码(如django视图)通过run_coroutine()/run_concurrently()在后台事件循环中并发执行多个协程
+"""
+import asyncio
+import atexit
+import json
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+try:
+    import aiohttp
+except ImportError:     # 可选依赖
+    aiohttp = None
+
+from django.conf import settings
+
+from . import inputs
+from . import outputs
+from . import exceptions
+from .base import BaseAdapter
+from .deadline import Deadline
+
+
+class AsyncBaseAdapter:
+    """
+    异步适配器的基类，方法和参数同BaseAdapter
+    """
+    adapter_name = 'async adapter'
+    default_connect_timeout = BaseAdapter.default_connect_timeout
+    default_read_timeout = BaseAdapter.default_read_timeout
+
+    __init__ = BaseAdapter.__init__
+    __str__ = BaseAdapter.__str__
+    get_timeout = BaseAdapter.get_timeout
+    check_deadline = staticmethod(BaseAdapter.check_deadline)
+
+    async def authenticate(self, params: inputs.AuthenticateInput, **kwargs):
+        """
+        :return:
+            outputs.AuthenticateOutput()
+        """
+        raise NotImplementedError('`authenticate()` must be implemented.')
+
+    async def server_status(self, params: inputs.ServerStatusInput, **kwargs):
+        """
+        :return:
+            outputs.ServerStatusOutput()
+        """
+        raise NotImplementedError('`server_status()` must be implemented.')
+
+    async def server_status_batch(self, params: inputs.ServerStatusBatchInput, **kwargs):
+        """
+        默认并发查询每个server的状态
+
+        :return:
+            outputs.ServerStatusBatchOutput()
+        """
+        server_ids = list(params.server_ids)
+        rs = await asyncio.gather(*[
+            self.server_status(inputs.ServerStatusInput(server_id=i), **kwargs) for i in server_ids])
+        return outputs.ServerStatusBatchOutput(statuses=dict(zip(server_ids, rs)))
+
+    async def server_detail(self, params: inputs.ServerDetailInput, **kwargs):
+        """
+        :return:
+            outputs.ServerDetailOutput()
+        """
+        raise NotImplementedError('`server_detail()` must be implemented.')
+
+    async def list_images(self, params: inputs.ListImageInput, **kwargs):
+        """
+        :return:
+            outputs.ListImageOutput()
+        """
+        raise NotImplementedError('`list_images()` must be implemented.')
+
+    async def list_networks(self, params: inputs.ListNetworkInput, **kwargs):
+        """
+        :return:
+            outputs.ListNetworkOutput()
+        """
+        raise NotImplementedError('`list_networks()` must be implemented.')
+
+    async def network_detail(self, params: inputs.NetworkDetailInput, **kwargs):
+        """
+        :return:
+            outputs.NetworkDetailOutput()
+        """
+        raise NotImplementedError('`network_detail()` must be implemented.')
+
+
+_executor = ThreadPoolExecutor(max_workers=16)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    在线程池中执行同步函数，等待返回结果
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_executor, lambda: func(*args, **kwargs))
+
+
+class SyncAdapterWrapper(AsyncBaseAdapter):
+    """
+    在线程池中执行同步适配器的方法
+    """
+
+    def __init__(self, adapter: BaseAdapter):
+        self.adapter = adapter
+
+    def __str__(self):
+        return str(self.adapter)
+
+    @property
+    def auth(self):
+        return self.adapter.auth
+
+    async def _run(self, method: str, *args, **kwargs):
+        return await run_in_executor(getattr(self.adapter, method), *args, **kwargs)
+
+    async def authenticate(self, *args, **kwargs):
+        return await self._run('authenticate', *args, **kwargs)
+
+    async def server_status(self, *args, **kwargs):
+        return await self._run('server_status', *args, **kwargs)
+
+    async def server_status_batch(self, *args, **kwargs):
+        return await self._run('server_status_batch', *args, **kwargs)
+
+    async def server_detail(self, *args, **kwargs):
+        return await self._run('server_detail', *args, **kwargs)
+
+    async def list_images(self, *args, **kwargs):
+        return await self._run('list_images', *args, **kwargs)
+
+    async def list_networks(self, *args, **kwargs):
+        return await self._run('list_networks', *args, **kwargs)
+
+    async def network_detail(self, *args, **kwargs):
+        return await self._run('network_detail', *args, **kwargs)
+
+
+class AsyncResponse:
+    """
+    异步http请求的响应，已读取响应体
+    """
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class AsyncHTTPClient:
+    """
+    一个事件循环内共用的aiohttp会话，连接池复用长连接
+    """
+    def __init__(self, limit: int = 100, limit_per_host: int = 8, keepalive_timeout: int = 60):
+        if aiohttp is None:
+            raise exceptions.Error(message='aiohttp is not installed')
+
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        return self._session
+
+    async def request(self, method: str, url: str, timeout=None, **kwargs) -> AsyncResponse:
+        """
+        :param timeout: (connect_timeout, read_timeout)
+        :raises: ServiceTimeout, aiohttp.ClientError
+        """
+        if timeout is not None:
+            connect_timeout, read_timeout = timeout
+            kwargs['timeout'] = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        try:
+            async with self.get_session().request(method, url, **kwargs) as r:
+                content = await r.read()
+                return AsyncResponse(status_code=r.status, content=content)
+        except asyncio.TimeoutError as e:
+            raise exceptions.ServiceTimeout(extend_msg=str(e))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client() -> AsyncHTTPClient:
+    """
+    当前事件循环的异步http客户端
+    """
+    loop = asyncio.get_event_loop()
+    cli = _http_clients.get(loop)
+    if cli is None:
+        config = getattr(settings, 'ADAPTER_HTTP_POOL', {})
+        cli = AsyncHTTPClient(limit_per_host=config.get('POOL_MAXSIZE', 8))
+        _http_clients[loop] = cli
+
+    return cli
+
+
+class AsyncRunner:
+    """
+    后台线程中运行的事件循环，同步代码在其中执行协程
+    """
+    def __init__(self):
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                t = threading.Thread(target=loop.run_forever, name='gosc-async-runner', daemon=True)
+                t.start()
+                self.loop = loop
+                atexit.register(self.close)
+
+        return self.loop
+
+    def close(self):
+        """
+        关闭事件循环的http客户端，停止事件循环
+        """
+        loop = self.loop
+        if loop is None:
+            return
+
+        cli = _http_clients.get(loop)
+        if cli is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(cli.close(), loop).result(5)
+            except Exception:
+                pass
+
+        loop.call_soon_threadsafe(loop.stop)
+        self.loop = None
+
+    def run(self, coro, timeout: float = None):
+        """
+        执行协程，等待返回结果
+
+        :raises: 协程抛出的错误，ServiceTimeout
+        """
+        loop = self.loop or self._start()
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise exceptions.ServiceTimeout()
+
+
+_runner = AsyncRunner()
+
+
+def run_coroutine(coro, deadline: Deadline = None):
+    """
+    同步代码中执行协程
+
+    :param deadline: 等待的截止时间，默认一直等待
+    :raises: 协程抛出的错误，ServiceTimeout
+    """
+    return _runner.run(coro, timeout=deadline.remaining() if deadline is not None else None)
+
+
+async def _gather(coros):
+    return await asyncio.gather(*coros, return_exceptions=True)
+
+
+def run_concurrently(coros, deadline: Deadline = None) -> list:
+    """
+    同步代码中并发执行多个协程
+
+    :return:
+        [返回值或抛出的错误, ]，顺序同coros
+    :raises: ServiceTimeout
+    """
+    return run_coroutine(_gather(list(coros)), deadline=deadline)
@@ -3,13 +3,18 @@
 """
 from . import inputs
 from . import outputs
+from .deadline import Deadline
 
 
 class BaseAdapter:
     """
     不同类型的服务平台的api适配器的基类
+
+    适配器方法可通过kwargs参数"deadline"(Deadline)传入请求截止时间，请求后端服务的超时时间不超过剩余时间
     """
     adapter_name = 'adapter'
+    default_connect_timeout = 5     # 连接超时时间，单位秒
+    default_read_timeout = 30       # 读取超时时间，单位秒
 
     def __str__(self):
         return self.adapter_name
@@ -20,9 +25,38 @@ class BaseAdapter:
                  auth: outputs.AuthenticateOutput = None,
                  *args, **kwargs
                  ):
+        """
+        :param timeout: 可选，(connect_timeout, read_timeout)，未指定使用适配器默认超时时间
+        """
         self.endpoint_url = endpoint_url.rstrip('/')
         self.auth = auth
         self.api_version = api_version
+        connect_timeout, read_timeout = kwargs.get('timeout', None) or (None, None)
+        self.connect_timeout = connect_timeout if connect_timeout else self.default_connect_timeout
+        self.read_timeout = read_timeout if read_timeout else self.default_read_timeout
+
+    def get_timeout(self, deadline: Deadline = None):
+        """
+        本次请求的连接和读取超时时间，指定deadline时不超过剩余时间
+
+        :return:
+            (connect_timeout, read_timeout)
+        :raises: ServiceTimeout
+        """
+        if deadline is None:
+            return self.connect_timeout, self.read_timeout
+
+        return deadline.limit(self.connect_timeout, self.read_timeout)
+
+    @staticmethod
+    def check_deadline(deadline: Deadline = None):
+        """
+        已过请求截止时间时抛出错误
+
+        :raises: ServiceTimeout
+        """
+        if deadline is not None:
+            deadline.check()
 
     def authenticate(self, params: inputs.AuthenticateInput, **kwargs):
         """
@@ -65,6 +99,20 @@ class BaseAdapter:
         """
         raise NotImplementedError('`server_status()` must be implemented.')
 
+    def server_status_batch(self, params: inputs.ServerStatusBatchInput, **kwargs):
+        """
+        批量查询server状态，适配器应通过一次后端请求实现，默认逐个查询
+
+        :return:
+            outputs.ServerStatusBatchOutput()
+        """
+        statuses = {}
+        for server_id in params.server_ids:
+            self.check_deadline(kwargs.get('deadline'))
+            statuses[server_id] = self.server_status(inputs.ServerStatusInput(server_id=server_id), **kwargs)
+
+        return outputs.ServerStatusBatchOutput(statuses=statuses)
+
     def server_vnc(self, params: inputs.ServerVNCInput, **kwargs):
         """
         :return:
@@ -79,6 +127,22 @@ class BaseAdapter:
         """
         raise NotImplementedError('`server_detail()` must be implemented.')
 
+    def list_servers(self, params: inputs.ListServerInput, **kwargs):
+        """
+        列举云服务器的详细信息，适配器应通过一次(或分页)后端请求实现，默认逐个查询params.server_ids，忽略查询失败的
+
+        :return:
+            outputs.ListServerOutput()
+        """
+        servers = []
+        for server_id in params.server_ids or []:
+            self.check_deadline(kwargs.get('deadline'))
+            r = self.server_detail(inputs.ServerDetailInput(server_id=server_id), **kwargs)
+            if r.ok:
+                servers.append(r.server)
+
+        return outputs.ListServerOutput(servers=servers)
+
     def list_images(self, params: inputs.ListImageInput, **kwargs):
         """
         列举镜像
@@ -3,7 +3,9 @@ from service.models import ServiceConfig
 from .evcloud.adapter import EVCloudAdapter
 from .openstack.adapter import OpenStackAdapter
 from .vmware.adapter import VmwareAdapter
+from .evcloud.aio import AsyncEVCloudAdapter
 from .exceptions import UnsupportedServiceType, MethodNotSupportInService
+from . import aio
 
 
 SERVICE_TYPE_EVCLOUD = 'evcloud'
@@ -19,7 +21,7 @@ def get_service_client(service: ServiceConfig, **kwargs):
         style = SERVICE_TYPE_VMWARE
 
     return OneServiceClient(style=style, endpoint_url=service.endpoint_url, api_version=service.api_version,
-                            auth=kwargs.get('auth'))
+                            auth=kwargs.get('auth'), timeout=service.adapter_timeout())
 
 
 def get_service_vpn_client(service: ServiceConfig, **kwargs):
@@ -28,7 +30,23 @@ def get_service_vpn_client(service: ServiceConfig, **kwargs):
     else:
         endpoint_url = service.vpn_endpoint_url
 
-    return VPNClient(endpoint_url=endpoint_url, api_version=service.vpn_api_version, auth=kwargs.get('auth'))
+    return VPNClient(endpoint_url=endpoint_url, api_version=service.vpn_api_version, auth=kwargs.get('auth'),
+                     timeout=service.adapter_timeout())
+
+
+def get_async_service_adapter(service: ServiceConfig, **kwargs):
+    """
+    服务的异步适配器，没有原生异步实现(或未安装aiohttp)时在线程池中执行同步适配器
+
+    :return:
+        subclass of aio.AsyncBaseAdapter
+    """
+    if service.service_type == service.ServiceType.EVCLOUD and aio.aiohttp is not None:
+        return AsyncEVCloudAdapter(endpoint_url=service.endpoint_url, api_version=service.api_version,
+                                   auth=kwargs.get('auth'), timeout=service.adapter_timeout())
+
+    cli = get_service_client(service=service, **kwargs)
+    return aio.SyncAdapterWrapper(cli.adapter)
 
 
 def get_adapter_class(style: str = 'evcloud'):
@@ -52,14 +70,15 @@ def get_adapter_class(style: str = 'evcloud'):
 
 
 class OneServiceClient:
-    def __init__(self, style, endpoint_url, api_version, auth=None):
+    def __init__(self, style, endpoint_url, api_version, auth=None, timeout=None):
         """
         :param style: style in ['evcloud', 'openstack']
         :param endpoint_url:
         :param api_version:
+        :param timeout: (connect_timeout, read_timeout)
         """
         adapter_class = get_adapter_class(style)
-        self.adapter = adapter_class(endpoint_url=endpoint_url, api_version=api_version, auth=auth)
+        self.adapter = adapter_class(endpoint_url=endpoint_url, api_version=api_version, auth=auth, timeout=timeout)
 
     def __getattr__(self, attr):
         try:
@@ -82,12 +101,18 @@ class OneServiceClient:
     def server_status(self, *args, **kwargs):
         return self.adapter.server_status(*args, **kwargs)
 
+    def server_status_batch(self, *args, **kwargs):
+        return self.adapter.server_status_batch(*args, **kwargs)
+
     def server_vnc(self, *args, **kwargs):
         return self.adapter.server_vnc(*args, **kwargs)
 
     def server_detail(self, *args, **kwargs):
         return self.adapter.server_detail(*args, **kwargs)
 
+    def list_servers(self, *args, **kwargs):
+        return self.adapter.list_servers(*args, **kwargs)
+
     def list_images(self, *args, **kwargs):
         return self.adapter.list_images(*args, **kwargs)
 
@@ -99,13 +124,14 @@ class OneServiceClient:
 
 
 class VPNClient:
-    def __init__(self, endpoint_url, api_version='v3', auth=None):
+    def __init__(self, endpoint_url, api_version='v3', auth=None, timeout=None):
         """
         :param endpoint_url: vpn service url
         :param api_version:
+        :param timeout: (connect_timeout, read_timeout)
         """
         adapter_class = get_adapter_class(style='evcloud')
-        self.adapter = adapter_class(endpoint_url=endpoint_url, api_version=api_version, auth=auth)
+        self.adapter = adapter_class(endpoint_url=endpoint_url, api_version=api_version, auth=auth, timeout=timeout)
 
     def __getattr__(self, attr):
         try:
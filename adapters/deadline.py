@@ -0,0 +1,56 @@
+"""
+请求截止时间(deadline)
+
+一个API请求创建一个Deadline对象，随请求传递到适配器的每个方法，重试和子请求只能使用剩余的时间
+"""
+import time
+
+from . import exceptions
+
+
+class Deadline:
+    """
+    请求的截止时间
+    """
+    def __init__(self, timeout: float):
+        """
+        :param timeout: 从现在开始的可用时间，单位秒
+        """
+        self.timeout = timeout
+        self.expire_at = time.monotonic() + timeout
+
+    def __repr__(self):
+        return f'Deadline(timeout={self.timeout}, remaining={self.remaining():.3f})'
+
+    def remaining(self) -> float:
+        """
+        剩余可用时间，单位秒，已过期返回0
+        """
+        return max(self.expire_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expire_at
+
+    def check(self, message: str = ''):
+        """
+        检查是否已过截止时间
+
+        :raises: ServiceTimeout
+        """
+        if self.expired:
+            raise exceptions.ServiceTimeout(message=message) if message else exceptions.ServiceTimeout()
+
+    def limit(self, connect_timeout: float, read_timeout: float):
+        """
+        以剩余时间限制连接和读取超时时间
+
+        :return:
+            (connect_timeout, read_timeout)
+        :raises: ServiceTimeout
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise exceptions.ServiceTimeout()
+
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
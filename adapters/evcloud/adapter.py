@@ -4,12 +4,17 @@ import requests
 from adapters.base import BaseAdapter
 from adapters import inputs
 from adapters import outputs
+from adapters.sessions import get_http_pool
 from .builders import APIBuilder
 from . import exceptions
 from .validators import InputValidator
 from .converters import OutputConverter
 
 
+# 不支持按uuid过滤列举云主机的服务(endpoint_url)，列举时一次分页列举全部云主机
+_no_uuids_filter_endpoints = set()
+
+
 def get_failed_msg(response, msg_key='code_text'):
     """
     请求失败错误信息
@@ -26,6 +31,113 @@ def get_failed_msg(response, msg_key='code_text'):
         return ''
 
 
+# 以下响应解析函数同步和异步适配器共用，response是requests.Response()或adapters.aio.AsyncResponse()
+
+def check_response(response, ok_status_codes=(200,)):
+    """
+    :return:
+        response    # 状态码表示请求成功
+    :raises: AuthenticationFailed, APIError
+    """
+    if not isinstance(ok_status_codes, (list, tuple)):
+        ok_status_codes = [ok_status_codes]
+
+    if response.status_code in ok_status_codes:
+        return response
+
+    if response.status_code == 401:
+        raise exceptions.AuthenticationFailed()
+
+    msg = get_failed_msg(response)
+    raise exceptions.APIError(msg, status_code=response.status_code)
+
+
+def auth_header(auth: outputs.AuthenticateOutput):
+    """
+    :return: {}
+
+    :raises: Error
+    """
+    if not auth.ok:
+        if isinstance(auth.error, exceptions.Error):
+            raise auth.error
+
+    h = auth.header
+    return {h.header_name: h.header_value}
+
+
+def parse_authenticate_response(response, username: str, password: str, style: str):
+    """
+    :param style: 'jwt' or 'token'
+    :return:
+        outputs.AuthenticateOutput()
+    """
+    if response.status_code == 200:
+        data = response.json()
+        if style == 'jwt':
+            return OutputConverter.to_authenticate_output_jwt(
+                token=data['access'], username=username, password=password)
+
+        return OutputConverter.to_authenticate_output_token(
+            token=data['token']['key'], username=username, password=password)
+
+    err = exceptions.AuthenticationFailed(status_code=response.status_code)
+    return OutputConverter().to_authenticate_output_error(error=err, style=style)
+
+
+def parse_server_status_response(response):
+    """
+    :return:
+        outputs.ServerStatusOutput()
+    """
+    rj = response.json()
+    if response.status_code == 200:
+        status_code = rj['status']['status_code']
+        return OutputConverter.to_server_status_output(status_code)
+
+    err_code = rj.get('err_code')
+    if err_code and err_code == "VmNotExist":
+        return OutputConverter.to_server_status_output(outputs.ServerStatus.MISS)
+
+    msg = get_failed_msg(response)
+    error = exceptions.APIError(message=msg, status_code=response.status_code)
+    return OutputConverter.to_server_status_output_error(error=error)
+
+
+def parse_server_statuses(response, server_ids: list):
+    """
+    按uuid过滤的列举云主机响应中的云主机状态
+
+    :return:
+        {server_id: outputs.ServerStatusOutput()}
+    :raises: ValueError, AttributeError
+    """
+    statuses = {}
+    for vm in response.json().get('results', []):
+        status = vm.get('status')
+        if vm.get('uuid') in server_ids and isinstance(status, dict) and 'status_code' in status:
+            statuses[vm['uuid']] = OutputConverter.to_server_status_output(status['status_code'])
+
+    return statuses
+
+
+def parse_server_detail_response(response):
+    """
+    :return:
+        outputs.ServerDetailOutput()
+    """
+    rj = response.json()
+    if response.status_code == 200:
+        return OutputConverter().to_server_detail_output(vm=rj['vm'])
+
+    if rj.get('err_code') == 'VmNotExist':
+        err = exceptions.ServerNotExistError(status_code=404)
+    else:
+        msg = get_failed_msg(response)
+        err = exceptions.APIError(message=msg, status_code=response.status_code)
+    return OutputConverter().to_server_detail_output_error(error=err)
+
+
 class EVCloudAdapter(BaseAdapter):
     """
     EVCloud服务API适配器
@@ -35,11 +147,12 @@ class EVCloudAdapter(BaseAdapter):
     def __init__(self,
                  endpoint_url: str,
                  auth: outputs.AuthenticateOutput = None,
-                 api_version: str = 'v3'
+                 api_version: str = 'v3',
+                 **kwargs
                  ):
         api_version = api_version.lower()
         api_version = api_version if api_version in ['v3'] else 'v3'
-        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth)
+        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth, **kwargs)
         self.api_builder = APIBuilder(endpoint_url=self.endpoint_url, api_version=self.api_version)
 
     def get_auth_header(self):
@@ -56,41 +169,29 @@ class EVCloudAdapter(BaseAdapter):
             params = inputs.AuthenticateInput(username=auth.username, password=auth.password)
             auth = self.authenticate(params=params)
 
-        if not auth.ok:
-            if isinstance(auth.error, exceptions.Error):
-                raise auth.error
-
-        h = auth.header
-        return {h.header_name: h.header_value}
+        return auth_header(auth)
 
-    @staticmethod
-    def do_request(method: str, url: str, ok_status_codes=(200,), headers=None, **kwargs):
+    def do_request(self, method: str, url: str, ok_status_codes=(200,), headers=None, deadline=None, **kwargs):
         """
         :param method: 'get', 'post, 'put', 'delete', 'patch', ..
         :param ok_status_codes: 表示请求成功的状态码列表，返回响应体，其他抛出Error
         :param url:
         :param headers:
+        :param deadline: 请求截止时间，超时时间不超过剩余时间
         :param kwargs:
         :return:
             requests.Response()
-        :raises: Error, AuthenticationFailed, APIError
+        :raises: Error, AuthenticationFailed, APIError, ServiceTimeout
         """
+        kwargs['timeout'] = self.get_timeout(deadline)
         try:
-            r = requests.request(method=method, url=url, headers=headers, **kwargs)
+            r = get_http_pool().request(method=method, url=url, headers=headers, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise exceptions.ServiceTimeout(extend_msg=str(e))
         except Exception as e:
             raise exceptions.Error(str(e))
 
-        if not isinstance(ok_status_codes, (list, tuple)):
-            ok_status_codes = [ok_status_codes]
-
-        if r.status_code in ok_status_codes:
-            return r
-
-        if r.status_code == 401:
-            raise exceptions.AuthenticationFailed()
-
-        msg = get_failed_msg(r)
-        raise exceptions.APIError(msg, status_code=r.status_code)
+        return check_response(r, ok_status_codes=ok_status_codes)
 
     def authenticate(self, params: inputs.AuthenticateInput, **kwargs):
         """
@@ -99,43 +200,43 @@ class EVCloudAdapter(BaseAdapter):
         :return:
             outputs.AuthenticateOutput()
         """
-        try:
-            auth = self.authenticate_jwt(username=params.username, password=params.password)
-        except exceptions.Error:
-            auth = self.authenticate_token(username=params.username, password=params.password)
+        timeout = self.get_timeout(kwargs.get('deadline'))
+        auth = self.authenticate_jwt(username=params.username, password=params.password, timeout=timeout)
+        if not auth.ok and not isinstance(auth.error, exceptions.ServiceTimeout):
+            auth = self.authenticate_token(username=params.username, password=params.password, timeout=timeout)
 
         self.auth = auth
         return auth
 
-    def authenticate_jwt(self, username, password):
+    def authenticate_jwt(self, username, password, timeout=None):
         url = self.api_builder.jwt_base_url()
+        if timeout is None:
+            timeout = self.get_timeout()
         try:
-            r = requests.post(url, data={'username': username, 'password': password})
+            r = get_http_pool().request('post', url, data={'username': username, 'password': password},
+                                        timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            err = exceptions.ServiceTimeout(extend_msg=str(e))
+            return OutputConverter().to_authenticate_output_error(error=err, style='jwt')
         except Exception as e:
             return OutputConverter().to_authenticate_output_error(error=exceptions.Error(str(e)), style='jwt')
 
-        if r.status_code == 200:
-            data = r.json()
-            token = data['access']
-            return OutputConverter.to_authenticate_output_jwt(token=token, username=username, password=password)
-
-        err = exceptions.AuthenticationFailed(status_code=r.status_code)
-        return OutputConverter().to_authenticate_output_error(error=err, style='jwt')
+        return parse_authenticate_response(r, username=username, password=password, style='jwt')
 
-    def authenticate_token(self, username, password):
+    def authenticate_token(self, username, password, timeout=None):
         url = self.api_builder.token_base_url()
+        if timeout is None:
+            timeout = self.get_timeout()
         try:
-            r = requests.post(url, data={'username': username, 'password': password})
+            r = get_http_pool().request('post', url, data={'username': username, 'password': password},
+                                        timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            err = exceptions.ServiceTimeout(extend_msg=str(e))
+            return OutputConverter().to_authenticate_output_error(error=err, style='token')
         except Exception as e:
             return OutputConverter().to_authenticate_output_error(error=exceptions.Error(str(e)), style='token')
 
-        if r.status_code == 200:
-            data = r.json()
-            token = data['token']['key']
-            return OutputConverter.to_authenticate_output_token(token=token, username=username, password=password)
-
-        err = exceptions.AuthenticationFailed(status_code=r.status_code)
-        return OutputConverter().to_authenticate_output_error(error=err, style='token')
+        return parse_authenticate_response(r, username=username, password=password, style='token')
 
     def server_create(self, params: inputs.ServerCreateInput, **kwargs):
         """
@@ -147,7 +248,8 @@ class EVCloudAdapter(BaseAdapter):
         try:
             data = InputValidator.create_server_validate(params)
             headers = self.get_auth_header()
-            r = self.do_request(method='post', url=url, data=data, ok_status_codes=[201], headers=headers)
+            r = self.do_request(method='post', url=url, data=data, ok_status_codes=[201], headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter.to_server_create_output_error(error=e)
 
@@ -161,7 +263,8 @@ class EVCloudAdapter(BaseAdapter):
         url = self.api_builder.vm_detail_url(vm_uuid=params.server_id, query=query)
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='delete', url=url, ok_status_codes=[204, 400, 404], headers=headers)
+            r = self.do_request(method='delete', url=url, ok_status_codes=[204, 400, 404], headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return outputs.ServerDeleteOutput(ok=False, error=e)
 
@@ -190,7 +293,7 @@ class EVCloudAdapter(BaseAdapter):
             params = inputs.ServerDeleteInput(server_id=params.server_id)
             if action == inputs.ServerAction.DELETE_FORCE:
                 params.force = True
-            r = self.server_delete(params=params)
+            r = self.server_delete(params=params, **kwargs)
             if r.ok:
                 return outputs.ServerActionOutput()
 
@@ -199,7 +302,8 @@ class EVCloudAdapter(BaseAdapter):
         try:
             url = self.api_builder.vm_action_url(vm_uuid=params.server_id)
             headers = self.get_auth_header()
-            r = self.do_request(method='patch', url=url, data={'op': action}, headers=headers)
+            r = self.do_request(method='patch', url=url, data={'op': action}, headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return outputs.ServerActionOutput(ok=False, error=e)
 
@@ -209,28 +313,49 @@ class EVCloudAdapter(BaseAdapter):
         url = self.api_builder.vm_status_url(vm_uuid=params.server_id)
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='get', url=url, ok_status_codes=[200, 400, 404], headers=headers)
+            r = self.do_request(method='get', url=url, ok_status_codes=[200, 400, 404], headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter.to_server_status_output_error(error=e)
 
-        rj = r.json()
-        if r.status_code == 200:
-            status_code = rj['status']['status_code']
-            return OutputConverter.to_server_status_output(status_code)
+        return parse_server_status_response(r)
 
-        err_code = rj.get('err_code')
-        if err_code and err_code == "VmNotExist":
-            return OutputConverter.to_server_status_output(outputs.ServerStatus.MISS)
+    def server_status_batch(self, params: inputs.ServerStatusBatchInput, **kwargs):
+        """
+        一次列举云主机请求(按uuid过滤)查询多个云主机的状态；
+        列表中没有状态信息的云主机(后端不支持按uuid过滤等)逐个查询
 
-        msg = get_failed_msg(r)
-        error = exceptions.APIError(message=msg, status_code=r.status_code)
-        return OutputConverter.to_server_status_output_error(error=error)
+        :return:
+            outputs.ServerStatusBatchOutput()
+        """
+        server_ids = list(params.server_ids)
+        statuses = {}
+        if not server_ids:
+            return outputs.ServerStatusBatchOutput(statuses=statuses)
+
+        url = self.api_builder.vm_base_url(query={'uuids': ','.join(server_ids), 'page_size': len(server_ids)})
+        try:
+            headers = self.get_auth_header()
+            r = self.do_request(method='get', url=url, headers=headers, deadline=kwargs.get('deadline'))
+            statuses.update(parse_server_statuses(r, server_ids=server_ids))
+        except exceptions.ServiceTimeout as e:
+            return outputs.ServerStatusBatchOutput(ok=False, error=e, statuses=statuses)
+        except (exceptions.Error, ValueError, AttributeError):
+            pass
+
+        missing = [i for i in server_ids if i not in statuses]
+        if missing:
+            r = super().server_status_batch(inputs.ServerStatusBatchInput(server_ids=missing), **kwargs)
+            statuses.update(r.statuses)
+
+        return outputs.ServerStatusBatchOutput(statuses=statuses)
 
     def server_vnc(self, params: inputs.ServerVNCInput, **kwargs):
         url = self.api_builder.vm_vnc_url(vm_uuid=params.server_id)
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='post', url=url, headers=headers)
+            r = self.do_request(method='post', url=url, headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter().to_server_vnc_output_error(error=e)
 
@@ -245,20 +370,73 @@ class EVCloudAdapter(BaseAdapter):
         url = self.api_builder.vm_detail_url(vm_uuid=params.server_id)
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='get', ok_status_codes=[200, 404], url=url, headers=headers)
+            r = self.do_request(method='get', ok_status_codes=[200, 404], url=url, headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter().to_server_detail_output_error(error=e)
 
-        rj = r.json()
-        if r.status_code == 200:
-            return OutputConverter().to_server_detail_output(vm=rj['vm'])
+        return parse_server_detail_response(r)
+
+    def list_servers(self, params: inputs.ListServerInput, **kwargs):
+        """
+        分页列举云主机(按uuid过滤)，列表中没有的云主机在服务中不存在，不再逐个查询；
+        后端不支持按uuid过滤时(返回了未请求的云主机或有下一页)，标记服务，改为一次分页列举全部云主机
+
+        :return:
+            outputs.ListServerOutput()
+        """
+        server_ids = params.server_ids
+        page_size = 100
+        deadline = kwargs.get('deadline')
+        servers = {}
+        try:
+            headers = self.get_auth_header()
+            if server_ids is None:
+                servers = self._list_all_servers(headers=headers, page_size=page_size, deadline=deadline)
+                return outputs.ListServerOutput(servers=list(servers.values()))
+
+            if self.endpoint_url not in _no_uuids_filter_endpoints:
+                for i in range(0, len(server_ids), page_size):
+                    ids = server_ids[i:i + page_size]
+                    url = self.api_builder.vm_base_url(query={'uuids': ','.join(ids), 'page_size': len(ids)})
+                    r = self.do_request(method='get', url=url, headers=headers, deadline=deadline)
+                    rj = r.json()
+                    results = rj.get('results', [])
+                    if rj.get('next') or any(vm.get('uuid') not in ids for vm in results):
+                        _no_uuids_filter_endpoints.add(self.endpoint_url)
+                        break
+
+                    for vm in results:
+                        servers[vm['uuid']] = OutputConverter._server_detail_output_server(vm)
+                else:
+                    return outputs.ListServerOutput(servers=list(servers.values()))
+
+            all_servers = self._list_all_servers(headers=headers, page_size=page_size, deadline=deadline)
+        except exceptions.Error as e:
+            return outputs.ListServerOutput(ok=False, error=e, servers=[])
+        except (ValueError, KeyError, AttributeError) as e:
+            return outputs.ListServerOutput(ok=False, error=exceptions.Error(str(e)), servers=[])
+
+        return outputs.ListServerOutput(servers=[all_servers[i] for i in server_ids if i in all_servers])
+
+    def _list_all_servers(self, headers: dict, page_size: int, deadline=None):
+        """
+        分页列举全部云主机
+
+        :return:
+            {uuid: outputs.ServerDetailOutputServer()}
+        :raises: Error, ValueError, KeyError, AttributeError
+        """
+        servers = {}
+        url = self.api_builder.vm_base_url(query={'page_size': page_size})
+        while url:
+            r = self.do_request(method='get', url=url, headers=headers, deadline=deadline)
+            rj = r.json()
+            for vm in rj.get('results', []):
+                servers[vm['uuid']] = OutputConverter._server_detail_output_server(vm)
+            url = rj.get('next')
 
-        if rj.get('err_code') == 'VmNotExist':
-            err = exceptions.ServerNotExistError(status_code=404)
-        else:
-            msg = get_failed_msg(r)
-            err = exceptions.APIError(message=msg, status_code=r.status_code)
-        return OutputConverter().to_server_detail_output_error(error=err)
+        return servers
 
     def list_images(self, params: inputs.ListImageInput, **kwargs):
         """
@@ -270,7 +448,8 @@ class EVCloudAdapter(BaseAdapter):
         url = self.api_builder.image_base_url(query={'center_id': center_id, 'tag': 1})
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='get', url=url, headers=headers)
+            r = self.do_request(method='get', url=url, headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter().to_list_image_output_error(error=e)
         rj = r.json()
@@ -291,7 +470,8 @@ class EVCloudAdapter(BaseAdapter):
         url = self.api_builder.vlan_base_url(query=query)
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='get', url=url, headers=headers)
+            r = self.do_request(method='get', url=url, headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter().to_list_network_output_error(error=e)
 
@@ -309,7 +489,8 @@ class EVCloudAdapter(BaseAdapter):
 
         try:
             headers = self.get_auth_header()
-            r = self.do_request(method='get', url=url, headers=headers)
+            r = self.do_request(method='get', url=url, headers=headers,
+                                deadline=kwargs.get('deadline'))
         except exceptions.Error as e:
             return OutputConverter().to_network_detail_output_error(error=e)
 
@@ -329,40 +510,44 @@ class EVCloudAdapter(BaseAdapter):
         r = self.do_request(method='get', url=url, headers=headers)
         return r.json()
 
-    def get_vpn(self, username: str):
+    def get_vpn(self, username: str, **kwargs):
         url = self.api_builder.vpn_detail_url(username=username)
         headers = self.get_auth_header()
-        r = self.do_request(method='get', url=url, ok_status_codes=[200], headers=headers)
+        r = self.do_request(method='get', url=url, ok_status_codes=[200], headers=headers,
+                            deadline=kwargs.get('deadline'))
         return r.json()
 
-    def create_vpn(self, username: str, password: str = None):
+    def create_vpn(self, username: str, password: str = None, **kwargs):
         data = {'username': username}
         if password:
             data['password'] = password
 
         url = self.api_builder.vpn_base_url()
         headers = self.get_auth_header()
-        r = self.do_request(method='post', url=url, data=data, ok_status_codes=[201], headers=headers)
+        r = self.do_request(method='post', url=url, data=data, ok_status_codes=[201], headers=headers,
+                            deadline=kwargs.get('deadline'))
         return r.json()
 
-    def get_vpn_or_create(self, username: str):
+    def get_vpn_or_create(self, username: str, **kwargs):
         url = self.api_builder.vpn_detail_url(username=username)
         headers = self.get_auth_header()
-        r = self.do_request(method='get', url=url, ok_status_codes=[200, 404], headers=headers)
+        r = self.do_request(method='get', url=url, ok_status_codes=[200, 404], headers=headers,
+                            deadline=kwargs.get('deadline'))
         d = r.json()
         if r.status_code == 200:
             return d
 
         if 'err_code' in d and d['err_code'] == 'NoSuchVPN':
-            return self.create_vpn(username=username)
+            return self.create_vpn(username=username, **kwargs)
 
         msg = get_failed_msg(r)
         raise exceptions.APIError(msg, status_code=r.status_code)
 
-    def vpn_change_password(self, username: str, password: str):
+    def vpn_change_password(self, username: str, password: str, **kwargs):
         url = self.api_builder.vpn_detail_url(username=username, query={'password': password})
         headers = self.get_auth_header()
-        r = self.do_request(method='patch', url=url, headers=headers)
+        r = self.do_request(method='patch', url=url, headers=headers,
+                            deadline=kwargs.get('deadline'))
         return r.json()
 
     def get_vpn_config_file_url(self, **kwargs):
@@ -0,0 +1,219 @@
+"""
+EVCloud服务异步API适配器
+"""
+from datetime import datetime
+
+from adapters.aio import AsyncBaseAdapter, get_async_http_client
+from adapters import inputs
+from adapters import outputs
+from .adapter import (
+    check_response, auth_header, parse_authenticate_response, parse_server_status_response,
+    parse_server_statuses, parse_server_detail_response
+)
+from .builders import APIBuilder
+from . import exceptions
+from .converters import OutputConverter
+
+
+class AsyncEVCloudAdapter(AsyncBaseAdapter):
+    """
+    EVCloud服务异步API适配器，方法同EVCloudAdapter
+    """
+    adapter_name = 'EVCloud async adapter'
+
+    def __init__(self,
+                 endpoint_url: str,
+                 auth: outputs.AuthenticateOutput = None,
+                 api_version: str = 'v3',
+                 **kwargs
+                 ):
+        api_version = api_version.lower()
+        api_version = api_version if api_version in ['v3'] else 'v3'
+        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth, **kwargs)
+        self.api_builder = APIBuilder(endpoint_url=self.endpoint_url, api_version=self.api_version)
+
+    async def get_auth_header(self):
+        """
+        :return: {}
+
+        :raises: NotAuthenticated, AuthenticationFailed, Error
+        """
+        auth = self.auth
+        now = datetime.utcnow().timestamp()
+        if auth is None:
+            raise exceptions.NotAuthenticated()
+        elif now >= auth.expire:
+            params = inputs.AuthenticateInput(username=auth.username, password=auth.password)
+            auth = await self.authenticate(params=params)
+
+        return auth_header(auth)
+
+    async def do_request(self, method: str, url: str, ok_status_codes=(200,), headers=None, deadline=None,
+                         **kwargs):
+        """
+        :param method: 'get', 'post, 'put', 'delete', 'patch', ..
+        :param ok_status_codes: 表示请求成功的状态码列表，返回响应体，其他抛出Error
+        :param url:
+        :param headers:
+        :param deadline: 请求截止时间，超时时间不超过剩余时间
+        :param kwargs:
+        :return:
+            adapters.aio.AsyncResponse()
+        :raises: Error, AuthenticationFailed, APIError, ServiceTimeout
+        """
+        kwargs['timeout'] = self.get_timeout(deadline)
+        try:
+            r = await get_async_http_client().request(method=method, url=url, headers=headers, **kwargs)
+        except exceptions.Error:
+            raise
+        except Exception as e:
+            raise exceptions.Error(str(e))
+
+        return check_response(r, ok_status_codes=ok_status_codes)
+
+    async def authenticate(self, params: inputs.AuthenticateInput, **kwargs):
+        """
+        认证获取 Token
+
+        :return:
+            outputs.AuthenticateOutput()
+        """
+        timeout = self.get_timeout(kwargs.get('deadline'))
+        auth = await self._authenticate(url=self.api_builder.jwt_base_url(), username=params.username,
+                                        password=params.password, timeout=timeout, style='jwt')
+        if not auth.ok and not isinstance(auth.error, exceptions.ServiceTimeout):
+            auth = await self._authenticate(url=self.api_builder.token_base_url(), username=params.username,
+                                            password=params.password, timeout=timeout, style='token')
+
+        self.auth = auth
+        return auth
+
+    @staticmethod
+    async def _authenticate(url: str, username: str, password: str, timeout, style: str):
+        """
+        :param style: 'jwt' or 'token'
+        """
+        try:
+            r = await get_async_http_client().request('post', url, data={'username': username, 'password': password},
+                                                      timeout=timeout)
+        except exceptions.Error as e:
+            return OutputConverter().to_authenticate_output_error(error=e, style=style)
+        except Exception as e:
+            return OutputConverter().to_authenticate_output_error(error=exceptions.Error(str(e)), style=style)
+
+        return parse_authenticate_response(r, username=username, password=password, style=style)
+
+    async def server_status(self, params: inputs.ServerStatusInput, **kwargs):
+        url = self.api_builder.vm_status_url(vm_uuid=params.server_id)
+        try:
+            headers = await self.get_auth_header()
+            r = await self.do_request(method='get', url=url, ok_status_codes=[200, 400, 404], headers=headers,
+                                      deadline=kwargs.get('deadline'))
+        except exceptions.Error as e:
+            return OutputConverter.to_server_status_output_error(error=e)
+
+        return parse_server_status_response(r)
+
+    async def server_status_batch(self, params: inputs.ServerStatusBatchInput, **kwargs):
+        """
+        一次列举云主机请求(按uuid过滤)查询多个云主机的状态；
+        列表中没有状态信息的云主机并发逐个查询
+
+        :return:
+            outputs.ServerStatusBatchOutput()
+        """
+        server_ids = list(params.server_ids)
+        statuses = {}
+        if not server_ids:
+            return outputs.ServerStatusBatchOutput(statuses=statuses)
+
+        url = self.api_builder.vm_base_url(query={'uuids': ','.join(server_ids), 'page_size': len(server_ids)})
+        try:
+            headers = await self.get_auth_header()
+            r = await self.do_request(method='get', url=url, headers=headers, deadline=kwargs.get('deadline'))
+            statuses.update(parse_server_statuses(r, server_ids=server_ids))
+        except exceptions.ServiceTimeout as e:
+            return outputs.ServerStatusBatchOutput(ok=False, error=e, statuses=statuses)
+        except (exceptions.Error, ValueError, AttributeError):
+            pass
+
+        missing = [i for i in server_ids if i not in statuses]
+        if missing:
+            r = await super().server_status_batch(inputs.ServerStatusBatchInput(server_ids=missing), **kwargs)
+            statuses.update(r.statuses)
+
+        return outputs.ServerStatusBatchOutput(statuses=statuses)
+
+    async def server_detail(self, params: inputs.ServerDetailInput, **kwargs):
+        """
+        :return:
+            outputs.ServerDetailOutput()
+        """
+        url = self.api_builder.vm_detail_url(vm_uuid=params.server_id)
+        try:
+            headers = await self.get_auth_header()
+            r = await self.do_request(method='get', ok_status_codes=[200, 404], url=url, headers=headers,
+                                      deadline=kwargs.get('deadline'))
+        except exceptions.Error as e:
+            return OutputConverter().to_server_detail_output_error(error=e)
+
+        return parse_server_detail_response(r)
+
+    async def list_images(self, params: inputs.ListImageInput, **kwargs):
+        """
+        列举镜像
+        :return:
+            outputs.ListImageOutput()
+        """
+        center_id = int(params.region_id)
+        url = self.api_builder.image_base_url(query={'center_id': center_id, 'tag': 1})
+        try:
+            headers = await self.get_auth_header()
+            r = await self.do_request(method='get', url=url, headers=headers,
+                                      deadline=kwargs.get('deadline'))
+        except exceptions.Error as e:
+            return OutputConverter().to_list_image_output_error(error=e)
+        rj = r.json()
+        return OutputConverter().to_list_image_output(rj['results'])
+
+    async def list_networks(self, params: inputs.ListNetworkInput, **kwargs):
+        """
+        列举子网
+        :return:    outputs.ListNetworkOutput()
+        """
+        center_id = int(params.region_id)
+        public = params.public
+
+        query = {'center_id': center_id, 'available': 'true'}
+        if public is not None:
+            query['public'] = str(public).lower()
+
+        url = self.api_builder.vlan_base_url(query=query)
+        try:
+            headers = await self.get_auth_header()
+            r = await self.do_request(method='get', url=url, headers=headers,
+                                      deadline=kwargs.get('deadline'))
+        except exceptions.Error as e:
+            return OutputConverter().to_list_network_output_error(error=e)
+
+        rj = r.json()
+        return OutputConverter().to_list_network_output(networks=rj['results'])
+
+    async def network_detail(self, params: inputs.NetworkDetailInput, **kwargs):
+        """
+        查询子网网络信息
+
+        :return:
+            outputs.NetworkDetailOutput()
+        """
+        url = self.api_builder.vlan_detail_url(pk=params.network_id)
+
+        try:
+            headers = await self.get_auth_header()
+            r = await self.do_request(method='get', url=url, headers=headers,
+                                      deadline=kwargs.get('deadline'))
+        except exceptions.Error as e:
+            return OutputConverter().to_network_detail_output_error(error=e)
+
+        rj = r.json()
+        return OutputConverter().to_network_detail_output(net=rj)
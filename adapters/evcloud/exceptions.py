@@ -1,5 +1,5 @@
 from ..exceptions import (Error, APIError, AuthenticationFailed as AuthF, NotAuthenticated as NotAuth,
-                          ServerNotExist)
+                          ServerNotExist, ServiceTimeout)
 
 
 class AuthenticationFailed(AuthF):
@@ -37,6 +37,7 @@ class AuthenticationError(Error):
 class APIInvalidParam(APIError):
     default_message = 'invalid param'
     default_code = 'APIInvalidParam'
+    default_status_code = 400
 
 
 class OutputConvertError(Error):
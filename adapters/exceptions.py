@@ -74,3 +74,9 @@ class MethodNotSupportInService(Error):
     default_message = 'This method or business is not supported by this service center.'
     default_code = 'MethodNotSupportInService'
     status_code = 405
+
+
+class ServiceTimeout(Error):
+    default_message = 'The request to the service timed out.'
+    default_code = 'ServiceTimeout'
+    default_status_code = 504
@@ -80,6 +80,15 @@ class ServerStatusInput(InputBase):
         super().__init__(**kwargs)
 
 
+class ServerStatusBatchInput(InputBase):
+    def __init__(self, server_ids: list, **kwargs):
+        """
+        :param server_ids: 云服务器实例id列表
+        """
+        self.server_ids = server_ids
+        super().__init__(**kwargs)
+
+
 class ServerDeleteInput(InputBase):
     def __init__(self, server_id: str, force: bool = False, **kwargs):
         """
@@ -109,6 +118,17 @@ class ServerDetailInput(InputBase):
         super().__init__(**kwargs)
 
 
+class ListServerInput(InputBase):
+    def __init__(self, region_id: str, server_ids: list = None, **kwargs):
+        """
+        :param region_id: 区域/分中心id
+        :param server_ids: 只列举这些云服务器实例id，默认None列举所有
+        """
+        self.region_id = region_id
+        self.server_ids = server_ids
+        super().__init__(**kwargs)
+
+
 class ListImageInput(InputBase):
     def __init__(self, region_id: str, **kwargs):
         """
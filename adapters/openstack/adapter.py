@@ -10,6 +10,7 @@ from adapters import inputs
 from adapters import outputs
 
 from adapters import exceptions
+from .pool import get_connection_cache
 
 
 datetime_re = re.compile(
@@ -74,10 +75,20 @@ class OpenStackAdapter(BaseAdapter):
     def __init__(self,
                  endpoint_url: str,
                  auth: outputs.AuthenticateOutput = None,
-                 api_version: str = 'v3'
+                 api_version: str = 'v3',
+                 **kwargs
                  ):
         api_version = api_version if api_version in ['v3'] else 'v3'
-        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth)
+        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth, **kwargs)
+
+    region = 'RegionOne'
+    project_name = 'admin'
+    user_domain = 'default'
+    project_domain = 'default'
+
+    @property
+    def auth_url(self):
+        return self.endpoint_url + ':5000/v3/'
 
     def authenticate(self, params: inputs.AuthenticateInput, **kwargs):
         """
@@ -88,38 +99,35 @@ class OpenStackAdapter(BaseAdapter):
 
         :raises: AuthenticationFailed, Error
         """
+        self.check_deadline(kwargs.get('deadline'))
         username = params.username
         password = params.password
-        auth_url = self.endpoint_url + ':5000/v3/'
-        region = 'RegionOne'
-        project_name = 'admin'
-        user_domain = 'default'
-        project_domain = 'default'
 
         try:
-            connect = openstack.connect(
-                auth_url=auth_url,
-                project_name=project_name,
-                username=username,
-                password=password,
-                region_name=region,
-                user_domain_name=user_domain,
-                project_domain_name=project_domain,
-                app_name='examples',
-                app_version='1.0',
-            )
+            connect = self._get_connection(username=username, password=password)
+            connect.authorize()     # keystone认证，token和服务目录缓存在连接的会话中
             expire = (datetime.utcnow() + timedelta(hours=1)).timestamp()
             auth = outputs.AuthenticateOutput(style='token', token='', header=None, query=None,
-                                              expire=int(expire), username=username, password=password,
-                                              vmconnect=connect)
+                                              expire=int(expire), username=username, password=password)
         except Exception as e:
+            get_connection_cache().invalidate(auth_url=self.auth_url, username=username,
+                                              project_name=self.project_name, region_name=self.region)
             raise exceptions.AuthenticationFailed()
 
         self.auth = auth
         return auth
 
+    def _get_connection(self, username: str, password: str) -> openstack.connection.Connection:
+        return get_connection_cache().get_connection(
+            auth_url=self.auth_url, username=username, password=password, project_name=self.project_name,
+            region_name=self.region, user_domain_name=self.user_domain, project_domain_name=self.project_domain,
+            api_timeout=self.read_timeout)
+
     def _get_openstack_connect(self) -> openstack.connection.Connection:
-        return self.auth.kwargs['vmconnect']
+        """
+        进程内共享的连接
+        """
+        return self._get_connection(username=self.auth.username, password=self.auth.password)
 
     def server_create(self, params: inputs.ServerCreateInput, **kwargs):
         """
@@ -127,6 +135,7 @@ class OpenStackAdapter(BaseAdapter):
         :return:
             outputs.ServerCreateOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         service_instance = self._get_openstack_connect()
         try:
             flavor = self.get_or_create_flavor(params.ram, params.vcpu)
@@ -146,6 +155,7 @@ class OpenStackAdapter(BaseAdapter):
         :return:
             outputs.ServerDetailOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
             service_instance = self._get_openstack_connect()
             server = service_instance.compute.get_server(params.server_id)
@@ -176,12 +186,60 @@ class OpenStackAdapter(BaseAdapter):
         except exceptions.Error as e:
             return outputs.ServerDetailOutput(ok=False, error=exceptions.Error('server detail failed'), server=None)
 
+    def list_servers(self, params: inputs.ListServerInput, **kwargs):
+        """
+        一次列举项目的云主机
+
+        :return:
+            outputs.ListServerOutput()
+        """
+        self.check_deadline(kwargs.get('deadline'))
+        server_ids = set(params.server_ids) if params.server_ids is not None else None
+        try:
+            service_instance = self._get_openstack_connect()
+            images = {}
+            servers = []
+            for server in service_instance.compute.servers(details=True):
+                if server_ids is not None and server.id not in server_ids:
+                    continue
+
+                try:
+                    adresses = server.addresses
+                    server_ip = {'ipv4': adresses[list(adresses.keys())[0]][0]['addr'], 'public_ipv4': None}
+                except Exception as e:
+                    server_ip = {'ipv4': '', 'public_ipv4': None}
+
+                image_id = server.image.id
+                if image_id not in images:
+                    try:
+                        image_temp = service_instance.image.get_image(image_id)
+                        images[image_id] = outputs.ServerImage(name=image_temp.name,
+                                                               system=image_temp.properties['os'])
+                    except Exception as e:
+                        images[image_id] = outputs.ServerImage(name='', system='')
+
+                flavor = server.flavor
+                servers.append(outputs.ServerDetailOutputServer(
+                    uuid=server.id,
+                    ram=flavor['ram'],
+                    vcpu=flavor['vcpus'],
+                    ip=outputs.ServerIP(**server_ip),
+                    image=images[image_id],
+                    creation_time=iso_to_datetime(server.created_at)
+                ))
+        except Exception as e:
+            return outputs.ListServerOutput(ok=False, error=exceptions.Error(f'list servers failed, {str(e)}'),
+                                            servers=[])
+
+        return outputs.ListServerOutput(servers=servers)
+
     def server_delete(self, params: inputs.ServerDeleteInput, **kwargs):
         """
         删除虚拟服务器
         :return:
             outputs.ServerDeleteOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         service_instance = self._get_openstack_connect()
         try:
             service_instance.compute.delete_server(params.server_id, force=True)
@@ -195,6 +253,7 @@ class OpenStackAdapter(BaseAdapter):
         :return:
             outputs.ServerActionOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         service_instance = self._get_openstack_connect()
         try:
             if params.action == inputs.ServerAction.START:
@@ -215,19 +274,22 @@ class OpenStackAdapter(BaseAdapter):
         except Exception as e:
             return outputs.ServerActionOutput(ok=False, error=exceptions.Error('server action failed'))
 
+    status_map = {
+        'ACTIVE': 1,
+        'UNKNOWN': 0,
+        'PAUSED': 3,
+        'SHUTOFF': 4,
+        'SUSPENDED': 7
+    }
+
     def server_status(self, params: inputs.ServerStatusInput, **kwargs):
         """
         :return:
             outputs.ServerStatusOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         service_instance = self._get_openstack_connect()
-        status_map = {
-            'ACTIVE': 1,
-            'UNKNOWN': 0,
-            'PAUSED': 3,
-            'SHUTOFF': 4,
-            'SUSPENDED': 7
-        }
+        status_map = self.status_map
         try:
             server = service_instance.compute.get_server(params.server_id)
             if server is None:
@@ -246,11 +308,39 @@ class OpenStackAdapter(BaseAdapter):
                 ok=False, error=exceptions.Error(f'get server status failed, {str(e)}'),
                 status=outputs.ServerStatus.NOSTATE, status_mean='')
 
+    def server_status_batch(self, params: inputs.ServerStatusBatchInput, **kwargs):
+        """
+        一次列举项目的云主机查询多个云主机的状态
+
+        :return:
+            outputs.ServerStatusBatchOutput()
+        """
+        self.check_deadline(kwargs.get('deadline'))
+        server_ids = set(params.server_ids)
+        service_instance = self._get_openstack_connect()
+        try:
+            status_codes = {}
+            for server in service_instance.compute.servers(details=True):
+                if server.id in server_ids:
+                    status_codes[server.id] = self.status_map.get(server.status, outputs.ServerStatus.NOSTATE)
+        except Exception as e:
+            return outputs.ServerStatusBatchOutput(
+                ok=False, error=exceptions.Error(f'get server status failed, {str(e)}'), statuses={})
+
+        statuses = {}
+        for server_id in params.server_ids:
+            status_code = status_codes.get(server_id, outputs.ServerStatus.MISS)
+            statuses[server_id] = outputs.ServerStatusOutput(
+                status=status_code, status_mean=outputs.ServerStatus.get_mean(status_code))
+
+        return outputs.ServerStatusBatchOutput(statuses=statuses)
+
     def server_vnc(self, params: inputs.ServerVNCInput, **kwargs):
         """
         :return:
             outputs.ServerVNCOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
             service_instance = self._get_openstack_connect()
             server = service_instance.compute.get_server(params.server_id)
@@ -271,6 +361,7 @@ class OpenStackAdapter(BaseAdapter):
         :return:
             output.ListImageOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         service_instance = self._get_openstack_connect()
         try:
             result = []
@@ -298,6 +389,7 @@ class OpenStackAdapter(BaseAdapter):
         列举子网
         :return:
         """
+        self.check_deadline(kwargs.get('deadline'))
         service_instance = self._get_openstack_connect()
         try:
             result = []
@@ -318,6 +410,7 @@ class OpenStackAdapter(BaseAdapter):
         :return:
             outputs.NetworkDetailOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
             service_instance = self._get_openstack_connect()
             network = service_instance.network.get_network(params.network_id)
@@ -0,0 +1,142 @@
+"""
+OpenStack连接(openstack.connection.Connection)缓存
+
+每个进程内按认证地址、用户名、项目和区域缓存Connection，所有线程共用；
+Connection内的keystone会话在token过期时自动重新认证，服务目录(catalog)随token缓存，不必每次请求重新发现；
+认证密码变更时，旧的Connection作废
+"""
+import hashlib
+import threading
+
+import openstack
+
+
+def connect_openstack(auth_url: str, username: str, password: str, project_name: str, region_name: str,
+                      user_domain_name: str, project_domain_name: str, api_timeout=None):
+    return openstack.connect(
+        auth_url=auth_url,
+        project_name=project_name,
+        username=username,
+        password=password,
+        region_name=region_name,
+        user_domain_name=user_domain_name,
+        project_domain_name=project_domain_name,
+        app_name='examples',
+        app_version='1.0',
+        api_timeout=api_timeout,
+    )
+
+
+def close_connection(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class CachedConnection:
+    def __init__(self, connection, password_hash: str):
+        self.connection = connection
+        self.password_hash = password_hash
+
+
+class OpenStackConnectionCache:
+    """
+    OpenStack连接缓存，线程安全
+    """
+    def __init__(self, connect_func=connect_openstack, close_func=close_connection):
+        self.connect_func = connect_func
+        self.close_func = close_func
+        self._connections = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @staticmethod
+    def build_key(auth_url: str, username: str, project_name: str, region_name: str):
+        return f'{auth_url.lower()}|{username}|{project_name}|{region_name}'
+
+    @staticmethod
+    def hash_password(password: str):
+        return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    def get_connection(self, auth_url: str, username: str, password: str, project_name: str = 'admin',
+                       region_name: str = 'RegionOne', user_domain_name: str = 'default',
+                       project_domain_name: str = 'default', api_timeout=None):
+        """
+        获取缓存的连接，没有或密码已变更时创建新连接
+
+        :return:
+            openstack.connection.Connection()
+        """
+        key = self.build_key(auth_url=auth_url, username=username, project_name=project_name,
+                             region_name=region_name)
+        password_hash = self.hash_password(password)
+        expired = None
+        with self._lock:
+            cached = self._connections.get(key)
+            if cached is not None:
+                if cached.password_hash == password_hash:
+                    self.stats['hits'] += 1
+                    return cached.connection
+
+                expired = self._connections.pop(key)
+                self.stats['invalidations'] += 1
+
+            self.stats['misses'] += 1
+            connection = self.connect_func(
+                auth_url=auth_url, username=username, password=password, project_name=project_name,
+                region_name=region_name, user_domain_name=user_domain_name,
+                project_domain_name=project_domain_name, api_timeout=api_timeout)
+            self._connections[key] = CachedConnection(connection, password_hash=password_hash)
+
+        if expired is not None:
+            self.close_func(expired.connection)
+
+        return connection
+
+    def invalidate(self, auth_url: str, username: str, project_name: str = 'admin',
+                   region_name: str = 'RegionOne'):
+        """
+        移除缓存的连接，如认证失败时
+        """
+        key = self.build_key(auth_url=auth_url, username=username, project_name=project_name,
+                             region_name=region_name)
+        with self._lock:
+            cached = self._connections.pop(key, None)
+            if cached is not None:
+                self.stats['invalidations'] += 1
+
+        if cached is not None:
+            self.close_func(cached.connection)
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+
+        for cached in connections:
+            self.close_func(cached.connection)
+
+    def get_stats(self):
+        with self._lock:
+            size = len(self._connections)
+
+        return dict(self.stats, connections=size)
+
+
+_connection_cache = None
+_connection_cache_lock = threading.Lock()
+
+
+def get_connection_cache() -> OpenStackConnectionCache:
+    """
+    进程内全局的OpenStack连接缓存
+    """
+    global _connection_cache
+
+    if _connection_cache is None:
+        with _connection_cache_lock:
+            if _connection_cache is None:
+                _connection_cache = OpenStackConnectionCache()
+
+    return _connection_cache
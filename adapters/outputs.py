@@ -188,6 +188,15 @@ class ServerDetailOutput(OutputBase):
         super().__init__(**kwargs)
 
 
+class ListServerOutput(OutputBase):
+    def __init__(self, servers: list, **kwargs):
+        """
+        :param servers: [ServerDetailOutputServer(), ]
+        """
+        self.servers = servers
+        super().__init__(**kwargs)
+
+
 class ServerActionOutput(OutputBase):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -204,6 +213,15 @@ class ServerStatusOutput(OutputBase):
         super().__init__(**kwargs)
 
 
+class ServerStatusBatchOutput(OutputBase):
+    def __init__(self, statuses: dict, **kwargs):
+        """
+        :param statuses: 每个server的状态，{server_id: ServerStatusOutput()}
+        """
+        self.statuses = statuses
+        super().__init__(**kwargs)
+
+
 class ServerDeleteOutput(OutputBase):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -0,0 +1,114 @@
+"""
+进程内适配器实例注册表
+
+每个服务只创建一次适配器实例，所有线程共用(适配器的http连接池等也随之共用)；
+认证信息是每次调用的，使用时浅拷贝一个绑定认证信息的适配器(bind)，不修改共用的实例；
+服务配置(地址、版本、其他配置等)改变时，配置版本不同，重新创建适配器实例
+"""
+import copy
+import threading
+
+from service.models import ServiceConfig
+
+from . import client
+from .exceptions import MethodNotSupportInService
+
+
+class AdapterRegistry:
+    """
+    服务的适配器实例，按(服务id, 配置版本)缓存，线程安全
+    """
+    def __init__(self):
+        self._adapters = {}     # {(service_id, vpn): (version, adapter)}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @staticmethod
+    def get_config_version(service: ServiceConfig, vpn: bool = False):
+        """
+        影响适配器实例的服务配置
+        """
+        if vpn:
+            return (service.service_type, service.endpoint_url, service.vpn_endpoint_url,
+                    service.vpn_api_version, service.extra)
+
+        return service.service_type, service.endpoint_url, service.api_version, service.extra
+
+    def get(self, service: ServiceConfig, vpn: bool = False):
+        """
+        获取服务的适配器实例
+
+        :param vpn: True(vpn服务的适配器)
+        :return:
+            subclass of base.BaseAdapter
+        :raises: UnsupportedServiceType
+        """
+        key = (str(service.id), vpn)
+        version = self.get_config_version(service, vpn=vpn)
+        entry = self._adapters.get(key)
+        if entry is not None and entry[0] == version:
+            self.stats['hits'] += 1
+            return entry[1]
+
+        with self._lock:
+            entry = self._adapters.get(key)
+            if entry is not None and entry[0] == version:
+                self.stats['hits'] += 1
+                return entry[1]
+
+            if vpn:
+                adapter = client.get_service_vpn_client(service).adapter
+            else:
+                adapter = client.get_service_client(service).adapter
+
+            self._adapters[key] = (version, adapter)
+            self.stats['misses'] += 1
+
+        return adapter
+
+    def bind(self, service: ServiceConfig, auth=None, vpn: bool = False):
+        """
+        绑定认证信息的适配器，共用实例的浅拷贝(共用http连接池等)；
+        适配器方法读取和刷新认证信息(self.auth)只影响本次调用，并发的请求不会互相覆盖
+
+        :param auth: 认证信息
+        :raises: UnsupportedServiceType
+        """
+        adapter = copy.copy(self.get(service, vpn=vpn))
+        adapter.auth = auth
+        return adapter
+
+    def get_method(self, service: ServiceConfig, method: str, auth=None, vpn: bool = False):
+        """
+        获取绑定认证信息的服务适配器的方法
+
+        :param auth: 认证信息，本次调用使用
+        :raises: MethodNotSupportInService, UnsupportedServiceType
+        """
+        adapter = self.bind(service, auth=auth, vpn=vpn)
+        handler = getattr(adapter, method, None)
+        if handler is None:
+            raise MethodNotSupportInService()
+
+        return handler
+
+    def invalidate(self, service_id):
+        """
+        移除服务的适配器实例，下次使用时重新创建
+        """
+        service_id = str(service_id)
+        with self._lock:
+            for key in [k for k in self._adapters if k[0] == service_id]:
+                del self._adapters[key]
+
+        self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._adapters.clear()
+
+    def get_stats(self):
+        return dict(self.stats, adapters=len(self._adapters))
+
+
+adapter_registry = AdapterRegistry()
@@ -0,0 +1,227 @@
+"""
+适配器HTTP连接池
+
+每个进程内按服务endpoint复用requests.Session，底层urllib3连接池保持长连接(keep-alive)，
+避免每次请求后端服务都重新建立TCP(TLS)连接
+"""
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_POOL_CONFIG = {
+    'POOL_CONNECTIONS': 4,      # 每个session缓存的urllib3连接池(host)数
+    'POOL_MAXSIZE': 8,          # 每个host连接池最多保持的连接数，不小于进程的线程数为宜
+    'POOL_BLOCK': False,        # 连接池连接数达到上限时是否阻塞等待
+    'KEEP_ALIVE': True,         # 是否开启TCP keep-alive
+    'RETRIES': 1,               # 连接被重置(reset)等连接错误时的重试次数
+    'BACKOFF_FACTOR': 0.1,
+}
+
+
+def get_pool_config():
+    """
+    连接池配置，django配置项ADAPTER_HTTP_POOL覆盖默认配置
+    """
+    config = DEFAULT_POOL_CONFIG.copy()
+    try:
+        from django.conf import settings
+        custom = getattr(settings, 'ADAPTER_HTTP_POOL', None)
+    except Exception:
+        custom = None
+
+    if isinstance(custom, dict):
+        config.update(custom)
+
+    return config
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """
+    可开启TCP keep-alive的HTTPAdapter
+    """
+    def __init__(self, keep_alive: bool = True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            from urllib3.connection import HTTPConnection
+
+            options = list(HTTPConnection.default_socket_options)
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            kwargs['socket_options'] = options
+
+        super().init_poolmanager(*args, **kwargs)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['keep_alive'] = self.keep_alive
+        return state
+
+
+class HTTPSessionPool:
+    """
+    进程内按endpoint缓存的requests.Session池，线程安全
+
+    requests.Session底层的urllib3连接池是线程安全的，同一进程内的线程共享同一个endpoint的Session
+    """
+    def __init__(self, pool_connections: int = 4, pool_maxsize: int = 8, pool_block: bool = False,
+                 keep_alive: bool = True, retries: int = 1, backoff_factor: float = 0.1):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.session_hits = 0       # 复用已有session次数
+        self.session_misses = 0     # 新建session次数
+
+    @classmethod
+    def from_config(cls, config: dict = None):
+        if config is None:
+            config = get_pool_config()
+
+        return cls(pool_connections=config['POOL_CONNECTIONS'], pool_maxsize=config['POOL_MAXSIZE'],
+                   pool_block=config['POOL_BLOCK'], keep_alive=config['KEEP_ALIVE'],
+                   retries=config['RETRIES'], backoff_factor=config['BACKOFF_FACTOR'])
+
+    @staticmethod
+    def endpoint_key(url: str):
+        """
+        url的scheme和host:port作为连接池的键
+        """
+        r = urlsplit(url)
+        return f'{r.scheme}://{r.netloc}'.lower()
+
+    def build_retry(self):
+        """
+        只重试连接错误和读取时连接被重置的幂等请求，不重试HTTP状态码错误
+        """
+        return Retry(total=self.retries, connect=self.retries, read=self.retries, status=0, redirect=0,
+                     backoff_factor=self.backoff_factor, raise_on_status=False,
+                     allowed_methods=Retry.DEFAULT_ALLOWED_METHODS)
+
+    def build_session(self):
+        session = requests.Session()
+        adapter = KeepAliveHTTPAdapter(
+            keep_alive=self.keep_alive, pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block, max_retries=self.build_retry())
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self, url: str):
+        """
+        获取url对应endpoint的Session，不存在时创建
+
+        :param url: 请求的url或endpoint url
+        :return:
+            requests.Session()
+        """
+        key = self.endpoint_key(url)
+        session = self._sessions.get(key)
+        if session is not None:
+            self.session_hits += 1
+            return session
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self.build_session()
+                self._sessions[key] = session
+                self.session_misses += 1
+            else:
+                self.session_hits += 1
+
+        return session
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        通过连接池发送请求
+
+        :return:
+            requests.Response()
+        :raises: requests.exceptions.RequestException
+        """
+        return self.get_session(url).request(method=method, url=url, **kwargs)
+
+    def close(self, url: str = None):
+        """
+        关闭并移除endpoint的Session，未指定url时关闭所有
+        """
+        with self._lock:
+            if url is None:
+                sessions = list(self._sessions.values())
+                self._sessions.clear()
+            else:
+                s = self._sessions.pop(self.endpoint_key(url), None)
+                sessions = [s] if s is not None else []
+
+        for s in sessions:
+            s.close()
+
+    def stats(self):
+        """
+        连接池统计信息
+
+        connection_hits: 复用已建立连接的请求数；connection_misses: 新建立的连接数
+        """
+        with self._lock:
+            sessions = dict(self._sessions)
+
+        endpoints = {}
+        total_requests = total_connections = 0
+        for key, session in sessions.items():
+            num_requests = num_connections = 0
+            for adapter in set(session.adapters.values()):
+                pm = getattr(adapter, 'poolmanager', None)
+                if pm is None:
+                    continue
+                for pool_key in list(pm.pools.keys()):
+                    pool = pm.pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+
+            endpoints[key] = {
+                'requests': num_requests,
+                'connection_hits': max(num_requests - num_connections, 0),
+                'connection_misses': num_connections
+            }
+            total_requests += num_requests
+            total_connections += num_connections
+
+        return {
+            'session_hits': self.session_hits,
+            'session_misses': self.session_misses,
+            'requests': total_requests,
+            'connection_hits': max(total_requests - total_connections, 0),
+            'connection_misses': total_connections,
+            'endpoints': endpoints
+        }
+
+
+_http_pool = None
+_http_pool_lock = threading.Lock()
+
+
+def get_http_pool() -> HTTPSessionPool:
+    """
+    进程内全局的HTTP连接池
+    """
+    global _http_pool
+
+    if _http_pool is None:
+        with _http_pool_lock:
+            if _http_pool is None:
+                _http_pool = HTTPSessionPool.from_config()
+
+    return _http_pool
@@ -0,0 +1,377 @@
+import time
+import threading
+from unittest import mock
+from types import SimpleNamespace
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from django.test import SimpleTestCase
+
+from .sessions import HTTPSessionPool
+from .deadline import Deadline
+from .evcloud.adapter import EVCloudAdapter, _no_uuids_filter_endpoints
+from .vmware.pool import VCenterSessionPool
+from .vmware.index import VMIndex
+from .openstack.pool import OpenStackConnectionCache
+from .evcloud.aio import AsyncEVCloudAdapter
+from . import exceptions, inputs, aio
+
+
+class OKHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        time.sleep(0.5)
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class EVCloudHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):    # 客户端已超时断开
+            pass
+
+    def do_GET(self):
+        time.sleep(0.3)
+        self.send_json(200, b'{"status": {"status_code": 1}}')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if '/jwt' in self.path:
+            self.send_json(400, b'{}')
+        else:
+            self.send_json(200, b'{"token": {"key": "test-token"}}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPSessionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), OKHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api/v3/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_reuse(self):
+        pool = HTTPSessionPool(pool_maxsize=2)
+        s1 = pool.get_session(self.url)
+        s2 = pool.get_session(self.url + 'vms/')
+        self.assertIs(s1, s2)
+        self.assertEqual(pool.session_misses, 1)
+        self.assertEqual(pool.session_hits, 1)
+
+        for _ in range(5):
+            r = pool.request('get', self.url)
+            self.assertEqual(r.status_code, 200)
+
+        stats = pool.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['connection_misses'], 1)
+        self.assertEqual(stats['connection_hits'], 4)
+
+        pool.close()
+        self.assertEqual(pool.stats()['endpoints'], {})
+
+
+class DeadlineTests(SimpleTestCase):
+    def test_limit(self):
+        deadline = Deadline(timeout=2)
+        connect, read = deadline.limit(5, 30)
+        self.assertLessEqual(connect, 2)
+        self.assertLessEqual(read, 2)
+        self.assertEqual(deadline.limit(0.5, 1), (0.5, 1))
+
+        deadline = Deadline(timeout=0)
+        self.assertTrue(deadline.expired)
+        self.assertEqual(deadline.remaining(), 0)
+        with self.assertRaises(exceptions.ServiceTimeout):
+            deadline.limit(5, 30)
+
+    def test_evcloud_timeout(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), OKHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            adapter = EVCloudAdapter(endpoint_url=f'http://127.0.0.1:{server.server_port}/', timeout=(1, 5))
+            self.assertEqual(adapter.get_timeout(), (1, 5))
+            params = inputs.AuthenticateInput(username='test', password='test')
+            auth = adapter.authenticate(params, deadline=Deadline(timeout=0.2))
+            self.assertFalse(auth.ok)
+            self.assertIsInstance(auth.error, exceptions.ServiceTimeout)
+            self.assertEqual(auth.error.code, 'ServiceTimeout')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class AsyncAdapterTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), EVCloudHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint_url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_evcloud_concurrently(self):
+        adapter = AsyncEVCloudAdapter(endpoint_url=self.endpoint_url, timeout=(1, 5))
+        auth = aio.run_coroutine(adapter.authenticate(inputs.AuthenticateInput(username='test', password='test')))
+        self.assertTrue(auth.ok)
+        self.assertEqual(auth.header.header_value, 'Token test-token')
+
+        start = time.monotonic()
+        rs = aio.run_concurrently(
+            [adapter.server_status(inputs.ServerStatusInput(server_id=str(i))) for i in range(5)],
+            deadline=Deadline(timeout=10))
+        self.assertLess(time.monotonic() - start, 1.2)
+        self.assertEqual([r.status for r in rs], [1] * 5)
+
+        with self.assertRaises(exceptions.ServiceTimeout):
+            aio.run_coroutine(adapter.server_status(inputs.ServerStatusInput(server_id='1')),
+                              deadline=Deadline(timeout=0.1))
+
+    def test_sync_wrapper(self):
+        adapter = aio.SyncAdapterWrapper(EVCloudAdapter(endpoint_url=self.endpoint_url, timeout=(1, 5)))
+        auth = aio.run_coroutine(adapter.authenticate(inputs.AuthenticateInput(username='test', password='test')))
+        self.assertTrue(auth.ok)
+
+        start = time.monotonic()
+        rs = aio.run_concurrently([adapter.server_status(inputs.ServerStatusInput(server_id=str(i))) for i in range(3)])
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual([r.status for r in rs], [1] * 3)
+
+
+class FakeServiceInstance:
+    def __init__(self, password):
+        self.password = password
+        self.alive = True
+        self.disconnected = False
+
+    def CurrentTime(self):
+        if not self.alive:
+            raise ConnectionError('session expired')
+
+
+class VCenterSessionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.connected = []
+
+        def connect(host, username, password, port):
+            si = FakeServiceInstance(password)
+            self.connected.append(si)
+            return si
+
+        def disconnect(si):
+            si.disconnected = True
+
+        self.pool = VCenterSessionPool(max_sessions=2, check_interval=0, borrow_timeout=0.1,
+                                       connect_func=connect, disconnect_func=disconnect)
+
+    def test_borrow_reuse_and_reconnect(self):
+        pool = self.pool
+        with pool.session('vcenter', 'user', 'pwd') as si1:
+            pass
+        with pool.session('vcenter', 'user', 'pwd') as si2:
+            self.assertIs(si1, si2)
+
+        self.assertEqual(len(self.connected), 1)
+
+        # 会话过期，健康检查失败后重新登录
+        si1.alive = False
+        with pool.session('vcenter', 'user', 'pwd') as si3:
+            self.assertIsNot(si3, si1)
+        self.assertTrue(si1.disconnected)
+        self.assertEqual(pool.stats['reconnects'], 1)
+
+        # 密码变更
+        with pool.session('vcenter', 'user', 'new') as si4:
+            self.assertEqual(si4.password, 'new')
+        self.assertTrue(si3.disconnected)
+
+    def test_max_sessions(self):
+        pool = self.pool
+        k1, s1 = pool.acquire('vcenter', 'user', 'pwd')
+        k2, s2 = pool.acquire('vcenter', 'user', 'pwd')
+        with self.assertRaises(exceptions.Error):
+            pool.acquire('vcenter', 'user', 'pwd')
+
+        pool.release(k1, s1)
+        k3, s3 = pool.acquire('vcenter', 'user', 'pwd')
+        self.assertIs(s3, s1)
+        pool.release(k2, s2)
+        pool.release(k3, s3)
+        self.assertEqual(pool.get_stats()['pools'][k1], {'created': 2, 'idle': 2})
+        pool.close_all()
+        self.assertTrue(s1.service_instance.disconnected)
+
+
+class OpenStackConnectionCacheTests(SimpleTestCase):
+    def test_reuse_and_invalidate(self):
+        closed = []
+        cache = OpenStackConnectionCache(connect_func=lambda **kwargs: SimpleNamespace(**kwargs),
+                                         close_func=closed.append)
+        c1 = cache.get_connection('http://openstack:5000/v3/', 'admin', 'pwd')
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get_connection('http://openstack:5000/v3/', 'admin', 'pwd'))
+        ) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertTrue(all(c is c1 for c in results))
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['hits'], 4)
+
+        # 密码变更
+        c2 = cache.get_connection('http://openstack:5000/v3/', 'admin', 'new')
+        self.assertEqual(c2.password, 'new')
+        self.assertEqual(closed, [c1])
+
+        cache.invalidate('http://openstack:5000/v3/', 'admin')
+        self.assertEqual(closed, [c1, c2])
+        self.assertEqual(cache.get_stats(), {'hits': 4, 'misses': 2, 'invalidations': 2, 'connections': 0})
+
+
+def vm_update(moid, kind, **changes):
+    obj = SimpleNamespace(_moId=moid)
+    change_set = [SimpleNamespace(name=k, op='assign', val=v) for k, v in changes.items()]
+    return SimpleNamespace(obj=obj, kind=kind, changeSet=change_set)
+
+
+class VMIndexTests(SimpleTestCase):
+    def test_apply_update_set(self):
+        index = VMIndex('vcenter', 'user', 'pwd', pool=object())
+        index.vms = {'vm-1': ('gosc-instance-1', 'uuid-1')}
+        update_set = SimpleNamespace(filterSet=[SimpleNamespace(objectSet=[
+            vm_update('vm-2', 'enter', **{'name': 'gosc-instance-2', 'config.instanceUuid': 'uuid-2'}),
+            vm_update('vm-1', 'modify', name='Renamed'),
+        ])])
+        index.apply_update_set(update_set)
+        self.assertEqual(index.name_map, {'renamed': 'vm-1', 'gosc-instance-2': 'vm-2'})
+        self.assertEqual(index.uuid_map, {'uuid-1': 'vm-1', 'uuid-2': 'vm-2'})
+
+        update_set = SimpleNamespace(filterSet=[SimpleNamespace(objectSet=[vm_update('vm-1', 'leave')])])
+        index.apply_update_set(update_set)
+        self.assertIsNone(index._get(name='renamed'))
+        self.assertEqual(index._get(uuid='uuid-2'), 'vm-2')
+
+    def test_lookup_miss_updates(self):
+        index = VMIndex('vcenter', 'user', 'pwd', pool=object(), update_interval=60)
+        index._collector = object()
+        index._updated_time = time.monotonic()
+        updates = []
+
+        def update():
+            updates.append(1)
+            index.vms['vm-3'] = ('gosc-instance-3', 'uuid-3')
+            index._rebuild_maps()
+
+        index._update = update
+        self.assertEqual(index.lookup_moid(name='GOSC-instance-3'), 'vm-3')
+        self.assertEqual(index.lookup_moid(name='gosc-instance-3'), 'vm-3')
+        self.assertEqual(len(updates), 1)
+
+    def test_update_failed_discard_session(self):
+        pool = mock.Mock()
+        index = VMIndex('vcenter', 'user', 'pwd', pool=pool)
+        session = object()
+        index._pool_key, index._session = 'key', session
+        index._collector = mock.Mock(WaitForUpdatesEx=mock.Mock(side_effect=Exception('session expired')))
+        index._build = mock.Mock()
+
+        index._update()
+        pool.release.assert_called_once_with('key', session, discard=True)
+        index._build.assert_called_once_with()
+        self.assertIsNone(index._session)
+
+    def test_lookup_during_refresh(self):
+        index = VMIndex('vcenter', 'user', 'pwd', pool=object(), update_interval=0)
+        index._collector = object()
+        index.vms = {'vm-1': ('gosc-instance-1', 'uuid-1')}
+        index._rebuild_maps()
+        started = threading.Event()
+        finish = threading.Event()
+
+        def update():
+            started.set()
+            finish.wait(5)
+
+        index._update = update
+        t = threading.Thread(target=index.lookup_moid, kwargs={'name': 'gosc-instance-1'})
+        t.start()
+        self.assertTrue(started.wait(5))
+        # 其他线程正在刷新时不等待，使用当前的映射
+        self.assertEqual(index.lookup_moid(uuid='uuid-1'), 'vm-1')
+        self.assertFalse(finish.is_set())
+        finish.set()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+
+def evcloud_vm(uuid):
+    return {'uuid': uuid, 'mem': 1024, 'vcpu': 1, 'image': 'centos8', 'mac_ip': '10.0.0.1',
+            'create_time': '2021-01-01T00:00:00Z'}
+
+
+class EVCloudListServersTests(SimpleTestCase):
+    def setUp(self):
+        self.adapter = EVCloudAdapter(endpoint_url='http://evcloud-list-servers/')
+        self.adapter.get_auth_header = lambda: {}
+        self.addCleanup(_no_uuids_filter_endpoints.discard, self.adapter.endpoint_url)
+
+    @staticmethod
+    def response(results, next_url=None):
+        return mock.Mock(json=mock.Mock(return_value={'results': results, 'next': next_url}))
+
+    def test_missing_not_probed(self):
+        self.adapter.do_request = mock.Mock(return_value=self.response([evcloud_vm('a')]))
+        self.adapter.server_detail = mock.Mock()
+        r = self.adapter.list_servers(inputs.ListServerInput(region_id='1', server_ids=['a', 'b']))
+        self.assertTrue(r.ok)
+        self.assertEqual([s.uuid for s in r.servers], ['a'])
+        self.assertEqual(self.adapter.do_request.call_count, 1)
+        self.adapter.server_detail.assert_not_called()
+
+    def test_uuids_filter_unsupported(self):
+        all_vms = self.response([evcloud_vm('a'), evcloud_vm('c'), evcloud_vm('b')])
+        self.adapter.do_request = mock.Mock(return_value=all_vms)
+        r = self.adapter.list_servers(inputs.ListServerInput(region_id='1', server_ids=['a', 'b']))
+        self.assertEqual([s.uuid for s in r.servers], ['a', 'b'])
+        self.assertEqual(self.adapter.do_request.call_count, 2)
+        self.assertIn(self.adapter.endpoint_url, _no_uuids_filter_endpoints)
+
+        # 已标记，直接列举全部
+        self.adapter.do_request.reset_mock()
+        r = self.adapter.list_servers(inputs.ListServerInput(region_id='1', server_ids=['b', 'd']))
+        self.assertEqual([s.uuid for s in r.servers], ['b'])
+        self.assertEqual(self.adapter.do_request.call_count, 1)
+        self.assertNotIn('uuids', self.adapter.do_request.call_args[1]['url'])
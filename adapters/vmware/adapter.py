@@ -10,12 +10,12 @@ from adapters import outputs
 
 from adapters import exceptions
 
-import atexit
-
-from pyVim.connect import SmartConnectNoSSL, Disconnect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 from pyVim.task import WaitForTask
 
+from .pool import get_session_pool
+from .index import get_vm_index
+
 
 datetime_re = re.compile(
     r'(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})'
@@ -79,10 +79,13 @@ def iso_to_datetime(value, default=datetime(year=1, month=1, day=1, hour=0, minu
 def get_obj(content, vimtype, name):
     obj = None
     container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    for c in container.view:
-        if c.name.lower() == name.lower():
-            obj = c
-            break
+    try:
+        for c in container.view:
+            if c.name.lower() == name.lower():
+                obj = c
+                break
+    finally:
+        container.DestroyView()
     return obj
 
 
@@ -104,8 +107,11 @@ def get_obj_by_uuid(content, _uuid):
 def get_all_obj(content, vimtype):
     result = []
     container = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    for c in container.view:
-        result.append(c)
+    try:
+        for c in container.view:
+            result.append(c)
+    finally:
+        container.DestroyView()
     return result
 
 
@@ -117,10 +123,11 @@ class VmwareAdapter(BaseAdapter):
     def __init__(self,
                  endpoint_url: str,
                  auth: outputs.AuthenticateOutput = None,
-                 api_version: str = 'v3'
+                 api_version: str = 'v3',
+                 **kwargs
                  ):
         api_version = api_version if api_version in ['v3'] else 'v3'
-        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth)
+        super().__init__(endpoint_url=endpoint_url, api_version=api_version, auth=auth, **kwargs)
 
     def authenticate(self, params: inputs.AuthenticateInput, **kwargs):
         """
@@ -131,119 +138,140 @@ class VmwareAdapter(BaseAdapter):
 
         :raises: AuthenticationFailed, Error
         """
+        self.check_deadline(kwargs.get('deadline'))
         username = params.username
         password = params.password
 
         try:
-            service_instance = SmartConnectNoSSL(host=self.endpoint_url,
-                                                 user=username,
-                                                 pwd=password,
-                                                 port=int(443))
-            atexit.register(Disconnect, service_instance)
-            expire = (datetime.utcnow() + timedelta(hours=1)).timestamp()
-            auth = outputs.AuthenticateOutput(style='token', token='', header=None, query=None,
-                                              expire=int(expire), username=username, password=password,
-                                              vmconnect=service_instance)
+            # 从会话池借出会话，没有可用会话时登录
+            with get_session_pool().session(host=self.endpoint_url, username=username, password=password):
+                pass
+        except exceptions.AuthenticationFailed as e:
+            raise e
         except Exception as e:
             raise exceptions.AuthenticationFailed(message=str(e))
 
+        expire = (datetime.utcnow() + timedelta(hours=1)).timestamp()
+        auth = outputs.AuthenticateOutput(style='token', token='', header=None, query=None,
+                                          expire=int(expire), username=username, password=password)
         self.auth = auth
         return auth
 
+    def _session(self):
+        """
+        从会话池借出vCenter会话
+
+            with self._session() as service_instance:
+                ...
+        """
+        return get_session_pool().session(host=self.endpoint_url, username=self.auth.username,
+                                          password=self.auth.password)
+
+    def _get_vm(self, service_instance, name: str):
+        """
+        通过虚拟机索引查找虚拟机，索引不可用时遍历查找
+
+        :return:
+            vim.VirtualMachine()
+            None        # not found
+        """
+        try:
+            index = get_vm_index(host=self.endpoint_url, username=self.auth.username, password=self.auth.password)
+            return index.lookup(service_instance, name=name)
+        except exceptions.Error:
+            return get_obj(service_instance.content, [vim.VirtualMachine], name)
+
     def server_create(self, params: inputs.ServerCreateInput, **kwargs):
         """
         创建虚拟服务器
         :return:
             outputs.ServerCreateOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
             vm_name = 'gosc-instance-' + str(uuid.uuid1())
             deploy_settings = {'template': 'centos8_gui', 'hostname': 'gosc_003', 'ips': '10.0.200.243',
                                'cpus': params.vcpu, 'mem': params.ram, "new_vm_name": vm_name,
                                'template_name': params.image_id}
 
-            # connect to vCenter server
-            service_instance = self.auth.kwargs['vmconnect']
-
-            # add a clean up routine
-            atexit.register(Disconnect, service_instance)
-            content = service_instance.RetrieveContent()
-            datacenter = get_obj(content, [vim.Datacenter], 'Datacenter')
-            destfolder = datacenter.vmFolder
-            cluster = get_obj(content, [vim.ClusterComputeResource], 'gosc_cluster')
-            resource_pool = cluster.resourcePool  # use same root resource pool that my desired cluster uses
-            datastore = get_obj(content, [vim.Datastore], 'datastore1')
-            template_vm = get_obj(content, [vim.VirtualMachine], deploy_settings["template_name"])
-            # Relocation spec
-            relospec = vim.vm.RelocateSpec()
-            relospec.datastore = datastore
-            relospec.pool = resource_pool
-
-            '''
-             Networking config for VM and guest OS
-            '''
-            devices_changes = []
-
-            for device in template_vm.config.hardware.device:
-                if isinstance(device, vim.vm.device.VirtualEthernetCard):
-                    remove_nicspec = vim.vm.device.VirtualDeviceSpec()
-                    remove_nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
-                    remove_nicspec.device = device
-                    devices_changes.append(remove_nicspec)
-            nic = vim.vm.device.VirtualDeviceSpec()
-            nic.operation = vim.vm.device.VirtualDeviceSpec.Operation.add  # or edit if a device exists
-            nic.device = vim.vm.device.VirtualVmxnet3()
-            nic.device.wakeOnLanEnabled = True
-            nic.device.addressType = 'assigned'
-            nic.device.key = 4000  # 4000 seems to be the value to use for a vmxnet3 device
-            nic.device.deviceInfo = vim.Description()
-            nic.device.deviceInfo.label = "Network Adapter 22"
-            nic.device.deviceInfo.summary = params.network_id
-            nic.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
-            nic.device.backing.network = get_obj(content, [vim.Network], params.network_id)
-            nic.device.backing.deviceName = params.network_id
-            nic.device.backing.useAutoDetect = False
-            nic.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-            nic.device.connectable.startConnected = True
-            nic.device.connectable.allowGuestControl = True
-            devices_changes.append(nic)
-
-            # VM config spec
-            vmconf = vim.vm.ConfigSpec()
-            vmconf.numCPUs = deploy_settings['cpus']
-            vmconf.memoryMB = deploy_settings['mem']
-            vmconf.cpuHotAddEnabled = True
-            vmconf.memoryHotAddEnabled = True
-            vmconf.deviceChange = devices_changes
-
-            # DNS settings
-            globalip = vim.vm.customization.GlobalIPSettings()
-            globalip.dnsServerList = ''
-            globalip.dnsSuffixList = 'localhost'
-
-            # Hostname settings
-            ident = vim.vm.customization.LinuxPrep()
-            ident.domain = 'localhost'
-            ident.hostName = vim.vm.customization.FixedName()
-            ident.hostName.name = deploy_settings["new_vm_name"]
-
-            customspec = vim.vm.customization.Specification()
-            customspec.identity = ident
-            customspec.globalIPSettings = globalip
-
-            # Clone spec
-            clonespec = vim.vm.CloneSpec()
-            clonespec.location = relospec
-            clonespec.config = vmconf
-            clonespec.customization = customspec
-            clonespec.powerOn = True
-            clonespec.template = False
-            # fire the clone task
-            task = template_vm.Clone(folder=destfolder, name=deploy_settings["new_vm_name"].title(), spec=clonespec)
-            server = outputs.ServerCreateOutputServer(
-                uuid=vm_name
-            )
-            return outputs.ServerCreateOutput(server=server)
+            with self._session() as service_instance:
+                content = service_instance.RetrieveContent()
+                datacenter = get_obj(content, [vim.Datacenter], 'Datacenter')
+                destfolder = datacenter.vmFolder
+                cluster = get_obj(content, [vim.ClusterComputeResource], 'gosc_cluster')
+                resource_pool = cluster.resourcePool  # use same root resource pool that my desired cluster uses
+                datastore = get_obj(content, [vim.Datastore], 'datastore1')
+                template_vm = self._get_vm(service_instance, deploy_settings["template_name"])
+                # Relocation spec
+                relospec = vim.vm.RelocateSpec()
+                relospec.datastore = datastore
+                relospec.pool = resource_pool
+
+                '''
+                 Networking config for VM and guest OS
+                '''
+                devices_changes = []
+
+                for device in template_vm.config.hardware.device:
+                    if isinstance(device, vim.vm.device.VirtualEthernetCard):
+                        remove_nicspec = vim.vm.device.VirtualDeviceSpec()
+                        remove_nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
+                        remove_nicspec.device = device
+                        devices_changes.append(remove_nicspec)
+                nic = vim.vm.device.VirtualDeviceSpec()
+                nic.operation = vim.vm.device.VirtualDeviceSpec.Operation.add  # or edit if a device exists
+                nic.device = vim.vm.device.VirtualVmxnet3()
+                nic.device.wakeOnLanEnabled = True
+                nic.device.addressType = 'assigned'
+                nic.device.key = 4000  # 4000 seems to be the value to use for a vmxnet3 device
+                nic.device.deviceInfo = vim.Description()
+                nic.device.deviceInfo.label = "Network Adapter 22"
+                nic.device.deviceInfo.summary = params.network_id
+                nic.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+                nic.device.backing.network = get_obj(content, [vim.Network], params.network_id)
+                nic.device.backing.deviceName = params.network_id
+                nic.device.backing.useAutoDetect = False
+                nic.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+                nic.device.connectable.startConnected = True
+                nic.device.connectable.allowGuestControl = True
+                devices_changes.append(nic)
+
+                # VM config spec
+                vmconf = vim.vm.ConfigSpec()
+                vmconf.numCPUs = deploy_settings['cpus']
+                vmconf.memoryMB = deploy_settings['mem']
+                vmconf.cpuHotAddEnabled = True
+                vmconf.memoryHotAddEnabled = True
+                vmconf.deviceChange = devices_changes
+
+                # DNS settings
+                globalip = vim.vm.customization.GlobalIPSettings()
+                globalip.dnsServerList = ''
+                globalip.dnsSuffixList = 'localhost'
+
+                # Hostname settings
+                ident = vim.vm.customization.LinuxPrep()
+                ident.domain = 'localhost'
+                ident.hostName = vim.vm.customization.FixedName()
+                ident.hostName.name = deploy_settings["new_vm_name"]
+
+                customspec = vim.vm.customization.Specification()
+                customspec.identity = ident
+                customspec.globalIPSettings = globalip
+
+                # Clone spec
+                clonespec = vim.vm.CloneSpec()
+                clonespec.location = relospec
+                clonespec.config = vmconf
+                clonespec.customization = customspec
+                clonespec.powerOn = True
+                clonespec.template = False
+                # fire the clone task
+                task = template_vm.Clone(folder=destfolder, name=deploy_settings["new_vm_name"].title(), spec=clonespec)
+                server = outputs.ServerCreateOutputServer(
+                    uuid=vm_name
+                )
+                return outputs.ServerCreateOutput(server=server)
         except Exception as e:
             return outputs.ServerCreateOutput(ok=False, error=exceptions.Error('server created failed'), server=None)
 
@@ -252,34 +280,35 @@ class VmwareAdapter(BaseAdapter):
         :return:
             outputs.ServerDetailOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            VM = get_obj(service_instance.content, [vim.VirtualMachine], params.server_id)
-            try:
-                server_ip = {'ipv4': VM.guest.ipAddress, 'public_ipv4': None}
-            except Exception as e:
-                server_ip = {'ipv4': None, 'public_ipv4': None}
-
-            ip = outputs.ServerIP(**server_ip)
-            try:
-                image_name = params.server_id.split('-&&image&&-')[1]
-            except Exception as e:
-                image_name = None
-
-            image = outputs.ServerImage(
-                name=image_name,
-                system=VM.config.guestId
-            )
-
-            server = outputs.ServerDetailOutputServer(
-                uuid=params.server_id,
-                ram=VM.summary.config.memorySizeMB,
-                vcpu=VM.summary.config.numCpu,
-                ip=ip,
-                image=image,
-                creation_time=iso_to_datetime(VM.config.createDate)
-            )
-            return outputs.ServerDetailOutput(server=server)
+            with self._session() as service_instance:
+                VM = self._get_vm(service_instance, params.server_id)
+                try:
+                    server_ip = {'ipv4': VM.guest.ipAddress, 'public_ipv4': None}
+                except Exception as e:
+                    server_ip = {'ipv4': None, 'public_ipv4': None}
+
+                ip = outputs.ServerIP(**server_ip)
+                try:
+                    image_name = params.server_id.split('-&&image&&-')[1]
+                except Exception as e:
+                    image_name = None
+
+                image = outputs.ServerImage(
+                    name=image_name,
+                    system=VM.config.guestId
+                )
+
+                server = outputs.ServerDetailOutputServer(
+                    uuid=params.server_id,
+                    ram=VM.summary.config.memorySizeMB,
+                    vcpu=VM.summary.config.numCpu,
+                    ip=ip,
+                    image=image,
+                    creation_time=iso_to_datetime(VM.config.createDate)
+                )
+                return outputs.ServerDetailOutput(server=server)
         except exceptions.Error as e:
             return outputs.ServerDetailOutput(ok=False, error=exceptions.Error('server detail failed'), server=None)
 
@@ -289,17 +318,18 @@ class VmwareAdapter(BaseAdapter):
         :return:
             outputs.ServerDeleteOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            vm = get_obj(service_instance.content, [vim.VirtualMachine], params.server_id)
-            if not vm:
-                return outputs.ServerActionOutput()
-            if format(vm.runtime.powerState) == "poweredOn":
-                task = vm.PowerOffVM_Task()
+            with self._session() as service_instance:
+                vm = self._get_vm(service_instance, params.server_id)
+                if not vm:
+                    return outputs.ServerActionOutput()
+                if format(vm.runtime.powerState) == "poweredOn":
+                    task = vm.PowerOffVM_Task()
+                    WaitForTask(task=task, si=service_instance)
+                task = vm.Destroy_Task()
                 WaitForTask(task=task, si=service_instance)
-            task = vm.Destroy_Task()
-            WaitForTask(task=task, si=service_instance)
-            return outputs.ServerActionOutput()
+                return outputs.ServerActionOutput()
         except Exception as e:
             msg = 'Failed to destroy server.'
             if hasattr(e, 'msg'):
@@ -312,71 +342,128 @@ class VmwareAdapter(BaseAdapter):
         :return:
             outputs.ServerActionOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            vm = get_obj(service_instance.content, [vim.VirtualMachine], params.server_id)
-            if not vm:
-                return outputs.ServerActionOutput()
-            if params.action == inputs.ServerAction.START:
-                task = vm.PowerOn()
-                return outputs.ServerActionOutput()
-            elif params.action == inputs.ServerAction.SHUTDOWN:
-                task = vm.PowerOffVM_Task()
-                return outputs.ServerActionOutput()
-            elif params.action in [inputs.ServerAction.DELETE, inputs.ServerAction.DELETE_FORCE]:
-                if format(vm.runtime.powerState) == "poweredOn":
+            with self._session() as service_instance:
+                vm = self._get_vm(service_instance, params.server_id)
+                if not vm:
+                    return outputs.ServerActionOutput()
+                if params.action == inputs.ServerAction.START:
+                    task = vm.PowerOn()
+                    return outputs.ServerActionOutput()
+                elif params.action == inputs.ServerAction.SHUTDOWN:
                     task = vm.PowerOffVM_Task()
+                    return outputs.ServerActionOutput()
+                elif params.action in [inputs.ServerAction.DELETE, inputs.ServerAction.DELETE_FORCE]:
+                    if format(vm.runtime.powerState) == "poweredOn":
+                        task = vm.PowerOffVM_Task()
+                        WaitForTask(task=task, si=service_instance)
+                    task = vm.Destroy_Task()
                     WaitForTask(task=task, si=service_instance)
-                task = vm.Destroy_Task()
-                WaitForTask(task=task, si=service_instance)
-                return outputs.ServerActionOutput()
-            elif params.action == inputs.ServerAction.POWER_OFF:
-                task = vm.PowerOffVM_Task()
-                return outputs.ServerActionOutput()
-            elif params.action == inputs.ServerAction.REBOOT:
-                task = vm.ResetVM_Task()
-                return outputs.ServerActionOutput()
-            else:
-                return outputs.ServerActionOutput(ok=False, error=exceptions.Error('server action failed'))
+                    return outputs.ServerActionOutput()
+                elif params.action == inputs.ServerAction.POWER_OFF:
+                    task = vm.PowerOffVM_Task()
+                    return outputs.ServerActionOutput()
+                elif params.action == inputs.ServerAction.REBOOT:
+                    task = vm.ResetVM_Task()
+                    return outputs.ServerActionOutput()
+                else:
+                    return outputs.ServerActionOutput(ok=False, error=exceptions.Error('server action failed'))
         except Exception as e:
             return outputs.ServerActionOutput(ok=False, error=exceptions.Error('server action failed'))
 
+    status_map = {
+        'running': 1,
+        'unknown': 0,
+        'notRunning': 4,
+    }
+
     def server_status(self, params: inputs.ServerStatusInput, **kwargs):
         """
         :return:
             outputs.ServerStatusOutput()
         """
-        status_map = {
-            'running': 1,
-            'unknown': 0,
-            'notRunning': 4,
-        }
+        self.check_deadline(kwargs.get('deadline'))
+        status_map = self.status_map
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            vm = get_obj(service_instance.content, [vim.VirtualMachine], params.server_id)
-            if not vm:
-                return outputs.ServerStatusOutput(status=outputs.ServerStatus.MISS,
-                                                  status_mean=outputs.ServerStatus.get_mean(outputs.ServerStatus.MISS))
-            status_code = status_map[vm.guest.guestState]
-            if status_code not in outputs.ServerStatus():
-                status_code = outputs.ServerStatus.NOSTATE
-            status_mean = outputs.ServerStatus.get_mean(status_code)
-            return outputs.ServerStatusOutput(status=status_code, status_mean=status_mean)
+            with self._session() as service_instance:
+                vm = self._get_vm(service_instance, params.server_id)
+                if not vm:
+                    return outputs.ServerStatusOutput(status=outputs.ServerStatus.MISS,
+                                                      status_mean=outputs.ServerStatus.get_mean(outputs.ServerStatus.MISS))
+                status_code = status_map[vm.guest.guestState]
+                if status_code not in outputs.ServerStatus():
+                    status_code = outputs.ServerStatus.NOSTATE
+                status_mean = outputs.ServerStatus.get_mean(status_code)
+                return outputs.ServerStatusOutput(status=status_code, status_mean=status_mean)
         except Exception as e:
             return outputs.ServerStatusOutput(ok=False, error=exceptions.Error('get server status failed'),
                                               status=outputs.ServerStatus.NOSTATE, status_mean='')
 
+    def server_status_batch(self, params: inputs.ServerStatusBatchInput, **kwargs):
+        """
+        虚拟机索引查找虚拟机，一次PropertyCollector查询所有虚拟机的状态
+
+        :return:
+            outputs.ServerStatusBatchOutput()
+        """
+        self.check_deadline(kwargs.get('deadline'))
+        try:
+            index = get_vm_index(host=self.endpoint_url, username=self.auth.username, password=self.auth.password)
+            moids = {server_id: index.lookup_moid(name=server_id) for server_id in params.server_ids}
+        except exceptions.Error:
+            return super().server_status_batch(params, **kwargs)
+
+        states = {}
+        try:
+            with self._session() as service_instance:
+                found = [moid for moid in moids.values() if moid]
+                if found:
+                    collector = service_instance.RetrieveContent().propertyCollector
+                    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(
+                        obj=vim.VirtualMachine(moid, service_instance._stub), skip=False) for moid in found]
+                    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+                        type=vim.VirtualMachine, pathSet=['guest.guestState'])
+                    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+                    options = vmodl.query.PropertyCollector.RetrieveOptions()
+                    result = collector.RetrievePropertiesEx([filter_spec], options)
+                    while result is not None:
+                        for obj in result.objects:
+                            props = {p.name: p.val for p in obj.propSet}
+                            states[obj.obj._moId] = props.get('guest.guestState')
+                        if not result.token:
+                            break
+                        result = collector.ContinueRetrievePropertiesEx(result.token)
+        except vmodl.fault.ManagedObjectNotFound:
+            # 索引更新前虚拟机已删除
+            return super().server_status_batch(params, **kwargs)
+        except Exception as e:
+            return outputs.ServerStatusBatchOutput(ok=False, error=exceptions.Error('get server status failed'),
+                                                   statuses={})
+
+        statuses = {}
+        for server_id, moid in moids.items():
+            if not moid or moid not in states:
+                status_code = outputs.ServerStatus.MISS
+            else:
+                status_code = self.status_map.get(states[moid], outputs.ServerStatus.NOSTATE)
+            statuses[server_id] = outputs.ServerStatusOutput(
+                status=status_code, status_mean=outputs.ServerStatus.get_mean(status_code))
+
+        return outputs.ServerStatusBatchOutput(statuses=statuses)
+
     def server_vnc(self, params: inputs.ServerVNCInput, **kwargs):
         """
         :return:
             outputs.ServerVNCOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            vm = get_obj(service_instance.content, [vim.VirtualMachine], params.server_id)
-            x = vm.AcquireTicket("webmks")
-            vnc_url = "wss://" + str(x.host) + ":" + str(x.port) + "/ticket/" + str(x.ticket)
-            return outputs.ServerVNCOutput(vnc=outputs.ServerVNCOutputVNC(url=vnc_url))
+            with self._session() as service_instance:
+                vm = self._get_vm(service_instance, params.server_id)
+                x = vm.AcquireTicket("webmks")
+                vnc_url = "wss://" + str(x.host) + ":" + str(x.port) + "/ticket/" + str(x.ticket)
+                return outputs.ServerVNCOutput(vnc=outputs.ServerVNCOutputVNC(url=vnc_url))
         except Exception as e:
             return outputs.ServerVNCOutput(ok=False, error=exceptions.Error('get vnc failed'), vnc=None)
 
@@ -386,19 +473,20 @@ class VmwareAdapter(BaseAdapter):
         :return:
             output.ListImageOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            content = service_instance.RetrieveContent()
-            all_vm = get_all_obj(content, [vim.VirtualMachine])
-            result = []
-            for vm in all_vm:
-                if vm.config.template == True:
-                    img_obj = outputs.ListImageOutputImage(id=vm.name, name=vm.name, system=vm.config.guestFullName,
-                                                           desc=vm.config.guestFullName,
-                                                           system_type=vm.config.guestId,
-                                                           creation_time=vm.config.createDate)
-                    result.append(img_obj)
-            return outputs.ListImageOutput(images=result)
+            with self._session() as service_instance:
+                content = service_instance.RetrieveContent()
+                all_vm = get_all_obj(content, [vim.VirtualMachine])
+                result = []
+                for vm in all_vm:
+                    if vm.config.template == True:
+                        img_obj = outputs.ListImageOutputImage(id=vm.name, name=vm.name, system=vm.config.guestFullName,
+                                                               desc=vm.config.guestFullName,
+                                                               system_type=vm.config.guestId,
+                                                               creation_time=vm.config.createDate)
+                        result.append(img_obj)
+                return outputs.ListImageOutput(images=result)
         except Exception as e:
             return outputs.ListImageOutput(ok=False, error=exceptions.Error('list image failed'), images=[])
 
@@ -407,17 +495,18 @@ class VmwareAdapter(BaseAdapter):
         列举子网
         :return:
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            content = service_instance.RetrieveContent()
-            all_networks = get_all_obj(content, [vim.Network])
-            result = []
-            for net in all_networks:
-                public = False
-                new_net = outputs.ListNetworkOutputNetwork(id=net.name, name=net.name, public=public,
-                                                           segment='0.0.0.0')
-                result.append(new_net)
-            return outputs.ListNetworkOutput(networks=result)
+            with self._session() as service_instance:
+                content = service_instance.RetrieveContent()
+                all_networks = get_all_obj(content, [vim.Network])
+                result = []
+                for net in all_networks:
+                    public = False
+                    new_net = outputs.ListNetworkOutputNetwork(id=net.name, name=net.name, public=public,
+                                                               segment='0.0.0.0')
+                    result.append(new_net)
+                return outputs.ListNetworkOutput(networks=result)
 
         except Exception as e:
             return outputs.ListNetworkOutput(ok=False, error=exceptions.Error('list networks failed'), networks=[])
@@ -429,14 +518,15 @@ class VmwareAdapter(BaseAdapter):
         :return:
             outputs.NetworkDetailOutput()
         """
+        self.check_deadline(kwargs.get('deadline'))
         try:
-            service_instance = self.auth.kwargs['vmconnect']
-            content = service_instance.RetrieveContent()
-            network = get_obj(content, [vim.Network], params.network_id)
+            with self._session() as service_instance:
+                content = service_instance.RetrieveContent()
+                network = get_obj(content, [vim.Network], params.network_id)
 
-            new_net = outputs.NetworkDetail(id=params.network_id, name=params.network_id, public=False,
-                                            segment='0.0.0.0')
+                new_net = outputs.NetworkDetail(id=params.network_id, name=params.network_id, public=False,
+                                                segment='0.0.0.0')
 
-            return outputs.NetworkDetailOutput(network=new_net)
+                return outputs.NetworkDetailOutput(network=new_net)
         except exceptions.Error as e:
             return outputs.NetworkDetailOutput(ok=False, error=exceptions.Error(str(e)), network=None)
@@ -0,0 +1,273 @@
+"""
+vCenter虚拟机索引
+
+每个服务(vCenter)一个索引，虚拟机名称和instanceUuid映射到虚拟机managed object id；
+索引通过一次PropertyCollector RetrievePropertiesEx建立，之后通过WaitForUpdatesEx增量更新，
+查找虚拟机不再需要遍历整个vCenter的虚拟机
+"""
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+from adapters import exceptions
+from .pool import get_session_pool
+
+
+VM_PROPERTIES = ['name', 'config.instanceUuid']
+
+
+class VMIndex:
+    """
+    一个vCenter的虚拟机索引，线程安全
+
+    同时只有一个线程刷新(建立或增量更新)索引，刷新的网络请求不持有查找的锁，刷新完成后整体替换映射，
+    刷新期间其他线程使用当前的映射查找；
+
+    索引长期持有会话池中的一个会话，属性过滤器(PropertyFilter)属于这个会话；这个会话计入会话池每个vCenter
+    的并发会话数(VMWARE_MAX_SESSIONS)，API请求可用的会话数少一个；会话池最多会话数小于2时不建立索引；
+    会话池没有空闲会话时不等待，建立索引失败，调用者应回退到遍历查找
+    """
+    def __init__(self, host: str, username: str, password: str, pool=None, update_interval: float = 2,
+                 page_size: int = 1000):
+        """
+        :param update_interval: 查找时距上次增量更新超过多少秒，先增量更新索引
+        :param page_size: RetrievePropertiesEx每次返回的最多对象数
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.pool = pool if pool is not None else get_session_pool()
+        self.update_interval = update_interval
+        self.page_size = page_size
+        self._refresh_lock = threading.Lock()
+        self._refreshed_from = 0    # 最近一次完成的刷新开始的时间
+        self._pool_key = None
+        self._session = None
+        self._collector = None
+        self._view = None
+        self._version = ''
+        self._updated_time = 0
+        self.vms = {}           # moid: (name, uuid)
+        self.name_map = {}      # name.lower(): moid
+        self.uuid_map = {}      # uuid: moid
+
+    def lookup(self, service_instance, name: str = None, uuid: str = None):
+        """
+        按名称或instanceUuid查找虚拟机
+
+        :param service_instance: 调用者使用的会话，返回的虚拟机对象绑定到此会话
+        :return:
+            vim.VirtualMachine()
+            None        # not found
+        :raises: Error
+        """
+        moid = self.lookup_moid(name=name, uuid=uuid)
+        if moid is None:
+            return None
+
+        return vim.VirtualMachine(moid, service_instance._stub)
+
+    def lookup_moid(self, name: str = None, uuid: str = None):
+        """
+        :return:
+            str     # 虚拟机managed object id
+            None    # not found
+        :raises: Error
+        """
+        if self._collector is None:
+            self._refresh()
+        elif (time.monotonic() - self._updated_time) >= self.update_interval:
+            self._refresh(wait=False)   # 其他线程正在刷新时使用当前的映射
+
+        moid = self._get(name=name, uuid=uuid)
+        if moid is None:    # 可能是刚创建的虚拟机
+            self._refresh()
+            moid = self._get(name=name, uuid=uuid)
+
+        return moid
+
+    def _refresh(self, wait: bool = True):
+        """
+        索引未建立时建立，否则增量更新
+
+        :param wait: True(等待其他线程正在进行的刷新，等待开始后已开始的刷新完成时不再刷新)；False(其他线程正在刷新时不刷新)
+        :raises: Error
+        """
+        started = time.monotonic()
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+
+        try:
+            if self._refreshed_from >= started:
+                return
+
+            refresh_time = time.monotonic()
+            if self._collector is None:
+                self._build()
+            else:
+                self._update()
+
+            self._refreshed_from = refresh_time
+        finally:
+            self._refresh_lock.release()
+
+    def _get(self, name: str = None, uuid: str = None):
+        if name:
+            return self.name_map.get(name.lower())
+        if uuid:
+            return self.uuid_map.get(uuid)
+
+        return None
+
+    def _build(self):
+        """
+        一次RetrievePropertiesEx建立索引，并创建属性过滤器用于增量更新
+        """
+        if getattr(self.pool, 'max_sessions', 2) < 2:
+            raise exceptions.Error(message='Not enough vCenter sessions for vm index.')
+
+        self._close()
+        self._pool_key, self._session = self.pool.acquire(host=self.host, username=self.username,
+                                                          password=self.password, timeout=0)
+        try:
+            si = self._session.service_instance
+            content = si.RetrieveContent()
+            self._view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+            self._collector = content.propertyCollector.CreatePropertyCollector()
+            filter_spec = self._build_filter_spec(self._view)
+
+            vms = {}
+            options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=self.page_size)
+            result = self._collector.RetrievePropertiesEx([filter_spec], options)
+            while result is not None:
+                for obj in result.objects:
+                    props = {p.name: p.val for p in obj.propSet}
+                    vms[obj.obj._moId] = (props.get('name'), props.get('config.instanceUuid'))
+                if not result.token:
+                    break
+                result = self._collector.ContinueRetrievePropertiesEx(result.token)
+
+            self.vms = vms
+            self._rebuild_maps()
+            self._collector.CreateFilter(filter_spec, partialUpdates=False)
+            self._version = ''
+            self._updated_time = time.monotonic()
+        except Exception as e:
+            self._close(discard=True)
+            raise exceptions.Error(message=f'Failed to build vm index, {str(e)}')
+
+    @staticmethod
+    def _build_filter_spec(view):
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES)
+        return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+    def _update(self):
+        """
+        WaitForUpdatesEx增量更新，不等待
+        """
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        try:
+            update_set = self._collector.WaitForUpdatesEx(self._version, options)
+            while update_set is not None:
+                self.apply_update_set(update_set)
+                self._version = update_set.version
+                if not update_set.truncated:
+                    break
+                update_set = self._collector.WaitForUpdatesEx(self._version, options)
+        except Exception:
+            # 会话过期等，断开会话(不归还到会话池)，重建索引
+            self._close(discard=True)
+            self._build()
+            return
+
+        self._updated_time = time.monotonic()
+
+    def apply_update_set(self, update_set):
+        """
+        应用属性收集器返回的更新
+        """
+        changed = False
+        for filter_update in update_set.filterSet:
+            for obj_update in filter_update.objectSet:
+                moid = obj_update.obj._moId
+                if obj_update.kind == 'leave':
+                    self.vms.pop(moid, None)
+                    changed = True
+                    continue
+
+                name, uuid = self.vms.get(moid, (None, None))
+                for change in obj_update.changeSet:
+                    val = change.val if change.op != 'remove' else None
+                    if change.name == 'name':
+                        name = val
+                    elif change.name == 'config.instanceUuid':
+                        uuid = val
+
+                self.vms[moid] = (name, uuid)
+                changed = True
+
+        if changed:
+            self._rebuild_maps()
+
+    def _rebuild_maps(self):
+        name_map = {}
+        uuid_map = {}
+        for moid, (name, uuid) in self.vms.items():
+            if name:
+                name_map[name.lower()] = moid
+            if uuid:
+                uuid_map[uuid] = moid
+
+        self.name_map = name_map
+        self.uuid_map = uuid_map
+
+    def close(self):
+        """
+        销毁属性收集器和视图，归还会话，等待正在进行的刷新完成
+        """
+        with self._refresh_lock:
+            self._close()
+
+    def _close(self, discard: bool = False):
+        for obj in (self._collector, self._view):
+            if obj is None:
+                continue
+            try:
+                obj.Destroy() if obj is self._collector else obj.DestroyView()
+            except Exception:
+                pass
+
+        self._collector = None
+        self._view = None
+        if self._session is not None:
+            self.pool.release(self._pool_key, self._session, discard=discard)
+            self._session = None
+            self._pool_key = None
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_vm_index(host: str, username: str, password: str) -> VMIndex:
+    """
+    服务(vCenter)的虚拟机索引，进程内共享
+    """
+    key = f'{host.lower()}@{username}'
+    index = _indexes.get(key)
+    if index is not None and index.password == password:
+        return index
+
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None or index.password != password:
+            if index is not None:
+                index.close()
+            index = VMIndex(host=host, username=username, password=password)
+            _indexes[key] = index
+
+    return index
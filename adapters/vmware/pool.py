@@ -0,0 +1,251 @@
+"""
+vCenter会话(ServiceInstance)池
+
+每个进程内按vCenter地址和用户名缓存已登录的pyVmomi ServiceInstance，限制每个vCenter的并发会话数，
+借出前通过CurrentTime()检查会话是否有效，会话过期时自动重新登录
+"""
+import atexit
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+from pyVim.connect import SmartConnectNoSSL, Disconnect
+from pyVmomi import vim
+
+from adapters import exceptions
+
+
+def connect_vcenter(host: str, username: str, password: str, port: int = 443):
+    return SmartConnectNoSSL(host=host, user=username, pwd=password, port=port)
+
+
+def disconnect_vcenter(service_instance):
+    try:
+        Disconnect(service_instance)
+    except Exception:
+        pass
+
+
+class PooledSession:
+    def __init__(self, service_instance, password_hash: str):
+        self.service_instance = service_instance
+        self.password_hash = password_hash     # 登录使用的密码，密码变更后会话不再归还到池中
+        self.checked_time = time.monotonic()     # 最近一次确认会话有效的时间
+
+
+class VCenterSessions:
+    """
+    一个vCenter(同一用户)的会话
+    """
+    def __init__(self, max_sessions: int, password_hash: str):
+        self.semaphore = threading.BoundedSemaphore(max_sessions)
+        self.idle = []          # 空闲的会话，后进先出
+        self.password_hash = password_hash
+        self.created = 0        # 当前已创建的会话数
+
+
+class VCenterSessionPool:
+    """
+    vCenter会话池，线程安全
+    """
+    def __init__(self, max_sessions: int = 4, check_interval: int = 60, borrow_timeout: int = 30,
+                 connect_func=connect_vcenter, disconnect_func=disconnect_vcenter):
+        """
+        :param max_sessions: 每个vCenter最多的并发会话数
+        :param check_interval: 空闲会话超过多少秒未使用，借出前检查会话是否有效
+        :param borrow_timeout: 等待空闲会话的超时时间，单位秒
+        """
+        self.max_sessions = max_sessions
+        self.check_interval = check_interval
+        self.borrow_timeout = borrow_timeout
+        self.connect_func = connect_func
+        self.disconnect_func = disconnect_func
+        self._pools = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'connects': 0, 'reconnects': 0, 'discards': 0}
+
+    @staticmethod
+    def build_key(host: str, username: str, port: int = 443):
+        return f'{host.lower()}:{port}@{username}'
+
+    @staticmethod
+    def hash_password(password: str):
+        return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    def _get_sessions(self, key: str, password: str):
+        password_hash = self.hash_password(password)
+        expired = []
+        with self._lock:
+            sessions = self._pools.get(key)
+            if sessions is None:
+                sessions = VCenterSessions(max_sessions=self.max_sessions, password_hash=password_hash)
+                self._pools[key] = sessions
+            elif sessions.password_hash != password_hash:   # 密码变更，已登录的会话作废
+                sessions.password_hash = password_hash
+                expired = sessions.idle
+                sessions.idle = []
+                sessions.created -= len(expired)
+
+        for s in expired:
+            self.disconnect_func(s.service_instance)
+
+        return sessions
+
+    def _is_alive(self, session: PooledSession):
+        if (time.monotonic() - session.checked_time) < self.check_interval:
+            return True
+
+        try:
+            session.service_instance.CurrentTime()
+        except Exception:
+            return False
+
+        session.checked_time = time.monotonic()
+        return True
+
+    def _connect(self, host: str, username: str, password: str, port: int):
+        try:
+            si = self.connect_func(host=host, username=username, password=password, port=port)
+        except vim.fault.InvalidLogin as e:
+            raise exceptions.AuthenticationFailed(message=str(e.msg))
+        except Exception as e:
+            raise exceptions.Error(message=f'Failed to connect vCenter, {str(e)}')
+
+        self.stats['connects'] += 1
+        return PooledSession(si, password_hash=self.hash_password(password))
+
+    def acquire(self, host: str, username: str, password: str, port: int = 443, timeout: float = None):
+        """
+        借出一个会话，使用完必须release()
+
+        :param timeout: 等待空闲会话的超时时间，默认borrow_timeout
+        :return:
+            (key, PooledSession())
+        :raises: Error, AuthenticationFailed
+        """
+        key = self.build_key(host=host, username=username, port=port)
+        sessions = self._get_sessions(key, password)
+        timeout = self.borrow_timeout if timeout is None else timeout
+        if not sessions.semaphore.acquire(timeout=timeout):
+            raise exceptions.Error(message='Too many concurrent sessions to vCenter, no session available.')
+
+        try:
+            while True:
+                with self._lock:
+                    session = sessions.idle.pop() if sessions.idle else None
+
+                if session is None:
+                    break
+
+                if self._is_alive(session):
+                    self.stats['hits'] += 1
+                    return key, session
+
+                self.stats['reconnects'] += 1
+                self._discard(sessions, session)
+
+            session = self._connect(host=host, username=username, password=password, port=port)
+            with self._lock:
+                sessions.created += 1
+        except Exception:
+            sessions.semaphore.release()
+            raise
+
+        return key, session
+
+    def release(self, key: str, session: PooledSession, discard: bool = False):
+        """
+        归还会话
+
+        :param discard: True(会话已不可用，断开连接)
+        """
+        sessions = self._pools.get(key)
+        if sessions is None:
+            self.disconnect_func(session.service_instance)
+            return
+
+        try:
+            if discard or session.password_hash != sessions.password_hash:
+                self._discard(sessions, session)
+            else:
+                session.checked_time = time.monotonic()
+                with self._lock:
+                    sessions.idle.append(session)
+        finally:
+            sessions.semaphore.release()
+
+    def _discard(self, sessions: VCenterSessions, session: PooledSession):
+        with self._lock:
+            sessions.created -= 1
+
+        self.stats['discards'] += 1
+        self.disconnect_func(session.service_instance)
+
+    @contextmanager
+    def session(self, host: str, username: str, password: str, port: int = 443):
+        """
+        借出会话的上下文管理器
+
+            with pool.session(host, username, password) as service_instance:
+                ...
+
+        :raises: Error, AuthenticationFailed
+        """
+        key, session = self.acquire(host=host, username=username, password=password, port=port)
+        discard = False
+        try:
+            yield session.service_instance
+        except vim.fault.NotAuthenticated:
+            discard = True
+            raise exceptions.AuthenticationFailed(message='vCenter session is not authenticated.')
+        except (OSError, ConnectionError):
+            discard = True
+            raise
+        finally:
+            self.release(key, session, discard=discard)
+
+    def close_all(self):
+        """
+        断开所有空闲会话
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+
+        for sessions in pools:
+            for s in sessions.idle:
+                self.disconnect_func(s.service_instance)
+            sessions.idle = []
+
+    def get_stats(self):
+        with self._lock:
+            pools = {k: {'created': v.created, 'idle': len(v.idle)} for k, v in self._pools.items()}
+
+        return dict(self.stats, pools=pools)
+
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool() -> VCenterSessionPool:
+    """
+    进程内全局的vCenter会话池
+    """
+    global _session_pool
+
+    if _session_pool is None:
+        with _session_pool_lock:
+            if _session_pool is None:
+                max_sessions = 4
+                try:
+                    from django.conf import settings
+                    max_sessions = getattr(settings, 'VMWARE_MAX_SESSIONS', max_sessions)
+                except Exception:
+                    pass
+
+                _session_pool = VCenterSessionPool(max_sessions=max_sessions)
+                atexit.register(_session_pool.close_all)
+
+    return _session_pool
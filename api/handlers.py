@@ -10,7 +10,7 @@ from servers.managers import ServerManager, ServerArchiveManager
 from service.managers import (
     UserQuotaManager, VmServiceApplyManager, OrganizationApplyManager,
     ServicePrivateQuotaManager, ServiceShareQuotaManager, ServiceManager,
-    ApplyQuotaManager
+    ApplyQuotaManager, QuotaReservationManager
 )
 from service.models import ApplyQuota
 from vo.managers import VoManager, VoMemberManager
@@ -18,6 +18,8 @@ from activity.managers import QuotaActivityManager
 from utils import storagers
 from utils import time
 from core import errors as exceptions
+from core.catalog import catalog_cache
+from core.breaker import breakers
 from . import serializers
 from . import paginations
 
@@ -69,7 +71,8 @@ class UserQuotaHandler:
             queryset = UserQuotaManager().filter_user_quota_queryset(user=request.user, service=service_id, usable=usable)
             paginator = view.paginator
             quotas = paginator.paginate_queryset(request=request, queryset=queryset)
-            serializer = serializers.UserQuotaSerializer(quotas, many=True)
+            reserved_map = QuotaReservationManager().get_reserved_map([q.id for q in quotas])
+            serializer = serializers.UserQuotaSerializer(quotas, many=True, context={'reserved_map': reserved_map})
             response = paginator.get_paginated_response(data=serializer.data)
         except Exception as exc:
             err = exceptions.convert_to_error(exc)
@@ -93,7 +96,8 @@ class UserQuotaHandler:
                 vo=vo, service=service_id, usable=usable)
             paginator = view.paginator
             quotas = paginator.paginate_queryset(request=request, queryset=queryset)
-            serializer = serializers.UserQuotaSerializer(quotas, many=True)
+            reserved_map = QuotaReservationManager().get_reserved_map([q.id for q in quotas])
+            serializer = serializers.UserQuotaSerializer(quotas, many=True, context={'reserved_map': reserved_map})
             return paginator.get_paginated_response(data=serializer.data)
         except Exception as exc:
             err = exceptions.convert_to_error(exc)
@@ -111,10 +115,10 @@ class UserQuotaHandler:
             return view.exception_response(exc)
 
         try:
-            queryset = Server.objects.filter(user_quota=quota)
+            queryset = serializers.ServerValuesSerializer.values(Server.objects.filter(user_quota=quota))
             paginator = view.pagination_class()
             servers = paginator.paginate_queryset(request=request, queryset=queryset)
-            serializer = serializers.ServerSimpleSerializer(servers, many=True)
+            serializer = serializers.ServerValuesSerializer(servers)
             response = paginator.get_paginated_response(data=serializer.data)
             return response
         except Exception as exc:
@@ -1252,6 +1256,36 @@ class VmServiceHandler:
         service_qs = ServiceManager().filter_vo_service(vo=vo, center_id=center_id)
         return view.paginate_service_response(request=request, qs=service_qs)
 
+    @staticmethod
+    def invalidate_catalog_cache(view, request, kwargs):
+        """
+        服务的镜像、网络等缓存数据失效
+        """
+        try:
+            service = VmServiceHandler.get_user_perm_service(
+                _id=kwargs.get(view.lookup_field), user=request.user)
+        except exceptions.Error as exc:
+            return view.exception_response(exc)
+
+        catalog_cache.invalidate(service.id)
+        return Response(status=204)
+
+    @staticmethod
+    def get_breaker_state(view, request, kwargs):
+        """
+        查询服务的熔断器状态
+        """
+        try:
+            service = VmServiceHandler.get_user_perm_service(
+                _id=kwargs.get(view.lookup_field), user=request.user)
+        except exceptions.Error as exc:
+            return view.exception_response(exc)
+
+        breaker = breakers.get(service.id)
+        data = breaker.get_state()
+        data['stats'] = dict(breaker.stats)
+        return Response(data=data)
+
 
 class VoHandler:
     @staticmethod
@@ -1392,12 +1426,12 @@ class ServerHandler:
     def list_servers(view, request, kwargs):
         service_id = request.query_params.get('service_id', None)
         servers = ServerManager().get_user_servers_queryset(user=request.user, service_id=service_id)
+        servers = serializers.ServerListValuesSerializer.values(servers)
 
-        service_id_map = ServiceManager.get_service_id_map(use_cache=True)
         paginator = paginations.ServersPagination()
         try:
             page = paginator.paginate_queryset(servers, request, view=view)
-            serializer = serializers.ServerSerializer(page, many=True, context={'service_id_map': service_id_map})
+            serializer = serializers.ServerListValuesSerializer(page)
             return paginator.get_paginated_response(data=serializer.data)
         except Exception as exc:
             return view.exception_response(exceptions.convert_to_error(exc))
@@ -1418,12 +1452,12 @@ class ServerHandler:
             return view.exception_response(exc)
 
         servers = ServerManager().get_vo_servers_queryset(vo_id=vo_id, service_id=service_id)
+        servers = serializers.ServerListValuesSerializer.values(servers)
 
-        service_id_map = ServiceManager.get_service_id_map(use_cache=True)
         paginator = paginations.ServersPagination()
         try:
             page = paginator.paginate_queryset(servers, request, view=view)
-            serializer = serializers.ServerSerializer(page, many=True, context={'service_id_map': service_id_map})
+            serializer = serializers.ServerListValuesSerializer(page)
             return paginator.get_paginated_response(data=serializer.data)
         except Exception as exc:
             return view.exception_response(exceptions.convert_to_error(exc))
@@ -1435,11 +1469,12 @@ class ServerArchiveHandler:
         service_id = request.query_params.get('service_id', None)
         queryset = ServerArchiveManager().get_user_archives_queryset(
             user=request.user, service_id=service_id)
+        queryset = serializers.ServerArchiveValuesSerializer.values(queryset)
 
         paginator = view.paginator
         try:
             page = paginator.paginate_queryset(queryset, request=request, view=view)
-            serializer = serializers.ServerArchiveSerializer(page, many=True)
+            serializer = serializers.ServerArchiveValuesSerializer(page)
             return paginator.get_paginated_response(data=serializer.data)
         except Exception as exc:
             return view.exception_response(exceptions.convert_to_error(exc))
@@ -1460,10 +1495,11 @@ class ServerArchiveHandler:
             return view.exception_response(exc)
 
         queryset = ServerArchiveManager().get_vo_archives_queryset(vo_id=vo_id, service_id=service_id)
+        queryset = serializers.ServerArchiveValuesSerializer.values(queryset)
         paginator = view.paginator
         try:
             page = paginator.paginate_queryset(queryset, request, view=view)
-            serializer = serializers.ServerArchiveSerializer(page, many=True)
+            serializer = serializers.ServerArchiveValuesSerializer(page)
             return paginator.get_paginated_response(data=serializer.data)
         except Exception as exc:
             return view.exception_response(exceptions.convert_to_error(exc))
@@ -1,24 +1,275 @@
+import json
+import base64
+import hashlib
 from collections import OrderedDict
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator as DjangoPaginator
+from django.db import connections
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from django.utils.translation import gettext as _
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
+from core import errors
+from core.model_version import model_version
 
-class ServersPagination(PageNumberPagination):
-    ordering = '-creation_time'
-    page_size_query_param = 'page_size'
-    page_size = 20
+
+DEFAULT_PAGINATION_COUNT = {
+    'TTL': 30,                      # 分页总数缓存时间(秒)，0不缓存
+    'APPROXIMATE_THRESHOLD': 0,     # 估算行数不少于此值时返回估算的总数，0不估算
+}
+
+
+def get_pagination_count_config():
+    c = dict(DEFAULT_PAGINATION_COUNT)
+    c.update(getattr(settings, 'PAGINATION_COUNT', {}))
+    return c
+
+
+def estimate_count(queryset):
+    """
+    通过数据库的执行计划(表统计信息)估算查询的行数，支持MySQL和PostgreSQL
+
+    :return:
+        int     # 估算的行数
+        None    # 不支持或估算失败
+    """
+    connection = connections[queryset.db]
+    if connection.vendor not in ('mysql', 'postgresql'):
+        return None
+
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                cursor.execute(f'EXPLAIN {sql}', params)
+                columns = [c[0] for c in cursor.description]
+                row = dict(zip(columns, cursor.fetchone()))
+                return int((row.get('rows') or 0) * (row.get('filtered') or 100) / 100)
+
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+    except Exception as exc:
+        return None
+
+
+def get_queryset_count(queryset):
+    """
+    查询的总数，缓存一段时间
+
+    缓存键是查询sql和参数(包含了用户、vo组等过滤条件)及查询涉及的表的数据版本号的摘要，数据修改后缓存失效；
+    总数缓存在进程内，版本号跨进程共享；查询涉及没有版本号(未track)的表时不缓存
+
+    :return:
+        (count: int, approximate: bool)
+    """
+    config = get_pagination_count_config()
+    ttl = config['TTL']
+    key = None
+    if ttl:
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0, False
+
+        tables = model_version.get_queryset_tables(queryset, sql=sql)
+        if model_version.is_tracked(tables):
+            versions = model_version.get_many(tables)
+            digest = hashlib.md5(f'{queryset.db}:{sql}:{params!r}:{versions!r}'.encode('utf-8')).hexdigest()
+            key = f'gosc_page_count_{digest}'
+            value = cache.get(key)
+            if value is not None:
+                return value
+
+    value = None
+    threshold = config['APPROXIMATE_THRESHOLD']
+    if threshold:
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate >= threshold:
+            value = (estimate, True)
+
+    if value is None:
+        value = (queryset.count(), False)
+
+    if key:
+        cache.set(key, value, timeout=ttl)
+
+    return value
+
+
+class CachedCountPaginator(DjangoPaginator):
+    """
+    总数缓存的分页器，总数可能是估算的(approximate)
+    """
+    approximate = False
+
+    @cached_property
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return DjangoPaginator.count.func(self)
+
+        count, self.approximate = get_queryset_count(self.object_list)
+        return count
+
+
+class KeysetPaginationMixin:
+    """
+    可选的键集(游标)分页，请求参数中有cursor时使用(第一页cursor为空)，否则按页码分页；
+
+    按keyset_ordering排序，用上一页最后(或第一)条记录的排序字段值作为不透明游标，
+    查询条件为 (creation_time, id) < (t, i)，可用索引范围扫描，不需要COUNT和OFFSET，"count"为null
+    """
+    cursor_query_param = 'cursor'
+    keyset_ordering = ('-creation_time', '-id')     # 排序字段方向须一致，最后一个字段须唯一
+    results_key = 'results'
+
+    keyset = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view=view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        fields = [f.lstrip('-') for f in self.keyset_ordering]
+        descending = self.keyset_ordering[0].startswith('-')
+        position, reverse = self.decode_cursor(request, queryset.model, fields)
+
+        ordering = self.keyset_ordering
+        if reverse:
+            ordering = tuple(f[1:] if f.startswith('-') else f'-{f}' for f in ordering)
+
+        if position is not None:
+            lookup = 'lt' if descending != reverse else 'gt'
+            queryset = queryset.filter(self._keyset_q(fields, position, lookup))
+
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.keyset_fields = fields
+        self.page_rows = rows
+        return rows
+
+    @staticmethod
+    def _keyset_q(fields, position, lookup: str):
+        """
+        (f1, f2) < (v1, v2)  ==>  f1 < v1 OR (f1 = v1 AND f2 < v2)
+        """
+        q = Q()
+        for i, f in enumerate(fields):
+            cond = Q(**{f'{fields[j]}': position[j] for j in range(i)})
+            q |= cond & Q(**{f'{f}__{lookup}': position[i]})
+
+        return q
+
+    def decode_cursor(self, request, model, fields):
+        """
+        :return:
+            (position, reverse)     # position=None时为第一页
+        :raises: InvalidArgument
+        """
+        cursor = request.query_params.get(self.cursor_query_param, '')
+        if not cursor:
+            return None, False
+
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            values = data['p']
+            if len(values) != len(fields):
+                raise ValueError('position length')
+
+            position = [model._meta.get_field(f).to_python(v) for f, v in zip(fields, values)]
+            return position, bool(data.get('r', 0))
+        except Exception as exc:
+            raise errors.InvalidArgument(message=_('无效的分页游标'))
+
+    @staticmethod
+    def encode_cursor(position: list, reverse: bool):
+        values = [v.isoformat() if hasattr(v, 'isoformat') else v for v in position]
+        data = json.dumps({'p': values, 'r': int(reverse)}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def _keyset_link(self, obj, reverse: bool):
+        url = remove_query_param(self.base_url, self.page_query_param)
+        if isinstance(obj, dict):     # values()查询的行
+            position = [obj[f] for f in self.keyset_fields]
+        else:
+            position = [getattr(obj, f) for f in self.keyset_fields]
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(position, reverse))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+
+        if not self.has_next or not self.page_rows:
+            return None
+
+        return self._keyset_link(self.page_rows[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+
+        if not self.has_previous or not self.page_rows:
+            return None
+
+        return self._keyset_link(self.page_rows[0], reverse=True)
+
+    def get_count(self):
+        if self.keyset:
+            return None
+
+        return self.page.paginator.count
 
     def get_paginated_response(self, data):
-        return Response(OrderedDict([
-            ('count', self.page.paginator.count),
+        items = [
+            ('count', self.get_count()),
             ('next', self.get_next_link()),
             ('previous', self.get_previous_link()),
-            ('servers', data)
-        ]))
+            (self.results_key, data)
+        ]
+        if not self.keyset and getattr(self.page.paginator, 'approximate', False):
+            items.insert(1, ('approximate', True))
+
+        return Response(OrderedDict(items))
+
+
+class ServersPagination(KeysetPaginationMixin, PageNumberPagination):
+    ordering = '-creation_time'
+    page_size_query_param = 'page_size'
+    page_size = 20
+    results_key = 'servers'
+    django_paginator_class = CachedCountPaginator
 
 
 class DefaultPageNumberPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     # page_size = 20
+    django_paginator_class = CachedCountPaginator
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.page.paginator.approximate:
+            response.data['approximate'] = True
+
+        return response
+
 
+class ServerArchivePagination(KeysetPaginationMixin, DefaultPageNumberPagination):
+    keyset_ordering = ('-deleted_time', '-id')
@@ -4,7 +4,7 @@ from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from service.models import ServiceConfig
+from service.models import ServiceConfig, UserQuota
 from activity.models import QuotaActivity
 
 
@@ -50,6 +50,7 @@ class ServerSerializer(ServerBaseSerializer):
     user_quota = UserQuotaSimpleSerializer(required=False)
     center_quota = serializers.IntegerField()
     vo_id = serializers.CharField()
+    synced_at = serializers.DateTimeField()
 
     def get_vms_endpoint_url(self, obj):
         service_id_map = self.context.get('service_id_map')
@@ -95,6 +96,15 @@ class ServerCreateSerializer(serializers.Serializer):
         return attrs
 
 
+class ServerStatusBatchSerializer(serializers.Serializer):
+    """
+    批量查询虚拟服务器状态序列化器
+    """
+    ids = serializers.ListField(
+        label=_('服务器实例id'), child=serializers.CharField(max_length=36), allow_empty=False, max_length=100,
+        help_text=_('服务器实例ID列表，最多100个'))
+
+
 class ServerArchiveSerializer(ServerBaseSerializer):
     """
     虚拟服务器归档记录序列化器
@@ -118,6 +128,148 @@ class ServerArchiveSerializer(ServerBaseSerializer):
         return None
 
 
+_datetime_field = serializers.DateTimeField()
+_tag_display_map = dict(UserQuota.CHOICES_TAG)
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _bool(value):
+    return None if value is None else bool(value)
+
+
+def _datetime(value):
+    return None if value is None else _datetime_field.to_representation(value)
+
+
+class ServerValuesSerializer:
+    """
+    列表的快速序列化，直接由QuerySet.values()查询的行(包括关联表的字段)一次构建输出数据，
+    不创建模型实例，没有DRF序列化器逐个字段的开销；输出数据结构与ServerSimpleSerializer相同
+
+        rows = ServerValuesSerializer.values(queryset)
+        data = ServerValuesSerializer(rows).data
+    """
+    values_fields = (
+        'id', 'name', 'vcpus', 'ram', 'ipv4', 'public_ip', 'image', 'creation_time', 'expiration_time',
+        'remarks', 'classification'
+    )
+
+    def __init__(self, rows, context: dict = None):
+        self.rows = rows
+        self.context = context or {}
+
+    @classmethod
+    def values(cls, queryset):
+        return queryset.values(*cls.values_fields)
+
+    @property
+    def data(self):
+        return [self.to_representation(row) for row in self.rows]
+
+    def to_representation(self, row: dict):
+        return {
+            'id': _str(row['id']),
+            'name': _str(row['name']),
+            'vcpus': _int(row['vcpus']),
+            'ram': _int(row['ram']),
+            'ipv4': _str(row['ipv4']),
+            'public_ip': _bool(row['public_ip']),
+            'image': _str(row['image']),
+            'creation_time': _datetime(row['creation_time']),
+            'expiration_time': _datetime(row['expiration_time']),
+            'remarks': _str(row['remarks']),
+            'classification': _str(row['classification']),
+        }
+
+
+class ServerDetailValuesSerializer(ServerValuesSerializer):
+    """
+    关联服务、用户配额字段的列表快速序列化基类
+    """
+    values_fields = ServerValuesSerializer.values_fields + (
+        'center_quota', 'vo_id', 'service_id', 'service__name', 'service__service_type',
+        'user_quota_id', 'user_quota__tag', 'user_quota__expiration_time', 'user_quota__deleted',
+        'user_quota__vcpu_total', 'user_quota__ram_total', 'user_quota__disk_size_total',
+        'user_quota__public_ip_total', 'user_quota__private_ip_total', 'user_quota__duration_days'
+    )
+
+    @staticmethod
+    def get_service(row: dict):
+        if row['service_id'] is None:
+            return None
+
+        return {
+            'id': row['service_id'],
+            'name': row['service__name'],
+            'service_type': row['service__service_type']
+        }
+
+    @staticmethod
+    def get_user_quota(row: dict):
+        if row['user_quota_id'] is None:
+            return None
+
+        tag_display = str(_tag_display_map.get(row['user_quota__tag'], row['user_quota__tag']))
+        return {
+            'id': _str(row['user_quota_id']),
+            'tag': {'value': row['user_quota__tag'], 'display': tag_display},
+            'expiration_time': _datetime(row['user_quota__expiration_time']),
+            'deleted': _bool(row['user_quota__deleted']),
+            'display': UserQuota.build_display(
+                tag_display=tag_display, vcpu_total=row['user_quota__vcpu_total'],
+                ram_total=row['user_quota__ram_total'], disk_size_total=row['user_quota__disk_size_total'],
+                public_ip_total=row['user_quota__public_ip_total'],
+                private_ip_total=row['user_quota__private_ip_total'],
+                duration_days=row['user_quota__duration_days'])
+        }
+
+
+class ServerListValuesSerializer(ServerDetailValuesSerializer):
+    """
+    输出数据结构与ServerSerializer相同
+    """
+    values_fields = ServerDetailValuesSerializer.values_fields + (
+        'synced_at', 'service__data_center_id', 'service__data_center__endpoint_vms'
+    )
+
+    def to_representation(self, row: dict):
+        data = super().to_representation(row)
+        if row['service_id'] is None or row['service__data_center_id'] is None:
+            data['endpoint_url'] = ''
+        else:
+            data['endpoint_url'] = row['service__data_center__endpoint_vms']
+
+        data['service'] = self.get_service(row)
+        data['user_quota'] = self.get_user_quota(row)
+        data['center_quota'] = _int(row['center_quota'])
+        data['vo_id'] = _str(row['vo_id'])
+        data['synced_at'] = _datetime(row['synced_at'])
+        return data
+
+
+class ServerArchiveValuesSerializer(ServerDetailValuesSerializer):
+    """
+    输出数据结构与ServerArchiveSerializer相同
+    """
+    values_fields = ServerDetailValuesSerializer.values_fields + ('deleted_time',)
+
+    def to_representation(self, row: dict):
+        data = super().to_representation(row)
+        data['service'] = self.get_service(row)
+        data['user_quota'] = self.get_user_quota(row)
+        data['center_quota'] = _int(row['center_quota'])
+        data['deleted_time'] = _datetime(row['deleted_time'])
+        data['vo_id'] = _str(row['vo_id'])
+        return data
+
+
 class ImageSerializer(serializers.Serializer):
     id = serializers.CharField()
     name = serializers.CharField()
@@ -161,6 +313,16 @@ class UserQuotaSerializer(serializers.Serializer):
     duration_days = serializers.IntegerField(label=_('资源可用时长'))
     classification = serializers.CharField(
         label=_('资源配额归属类型'), read_only=True, help_text=_('标识配额属于申请者个人的，还是vo组的'))
+    reserved = serializers.SerializerMethodField(method_name='get_reserved')
+
+    def get_reserved(self, obj):
+        """
+        预留中(创建中资源)的资源数，已包含在已用数中
+        """
+        reserved_map = self.context.get('reserved_map') or {}
+        r = reserved_map.get(obj.id, {})
+        return {'vcpu': r.get('vcpus', 0), 'ram': r.get('ram', 0), 'disk_size': r.get('disk_size', 0),
+                'public_ip': r.get('public_ip', 0), 'private_ip': r.get('private_ip', 0)}
 
     @staticmethod
     def get_user(obj):
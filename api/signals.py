@@ -0,0 +1,7 @@
+from core.model_version import model_version
+from servers.models import Server, ServerArchive
+from service.models import DataCenter, ServiceConfig, UserQuota, QuotaReservation
+
+
+# 列举接口的分页总数缓存和ETag依赖的模型
+model_version.track(Server, ServerArchive, DataCenter, ServiceConfig, UserQuota, QuotaReservation)
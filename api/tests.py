@@ -1,3 +1,5 @@
+import json
+from unittest import mock
 import hashlib
 import collections
 import io
@@ -8,9 +10,11 @@ from urllib import parse
 
 from django.urls import reverse
 from django.utils import timezone
+from django.db import transaction
 from rest_framework.test import APITestCase
 
-from servers.models import Flavor, Server
+from servers.models import Flavor, Server, ServerArchive
+from api import serializers
 from service.managers import UserQuotaManager
 from service.models import (
     ApplyOrganization, DataCenter, ApplyVmService, ServiceConfig, ApplyQuota, UserQuota
@@ -19,6 +23,11 @@ from utils.test import get_or_create_user, get_or_create_service, get_or_create_
 from adapters import outputs
 from vo.models import VirtualOrganization, VoMember
 from activity.models import QuotaActivity
+from core import errors
+from jobs.models import Job
+from jobs.handlers import JOB_SERVER_DELETE
+from api.views import ServersViewSet
+from core.model_version import model_version
 
 
 def random_string(length: int = 10):
@@ -421,6 +430,19 @@ class ServersTests(MyAPITestCase):
         self.assertKeysIn(['code', 'message'], response.data)
         self.assertEqual(response.data['code'], 'NotFound')
 
+    def test_server_status_batch(self):
+        url = reverse('api:servers-server-status-batch')
+        response = self.client.post(url, data={'ids': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(url, data={'ids': [self.miss_server.id, self.vo_server.id, 'notfound']},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertKeysIn(['statuses', 'errors'], response.data)
+        self.assertEqual(response.data['errors']['notfound']['code'], 'NotFound')
+        for server_id in [self.miss_server.id, self.vo_server.id]:
+            self.assertTrue(server_id in response.data['statuses'] or server_id in response.data['errors'])
+
     def test_server_detail(self):
         url = reverse('api:servers-detail', kwargs={'id': 'motfound'})
         response = self.client.get(url)
@@ -494,6 +516,137 @@ class ServersTests(MyAPITestCase):
             'id': vo_server.id, 'vo_id': vo_id
         }, d=response.data['server'])
 
+    def test_server_list_cursor(self):
+        for _ in range(4):
+            create_server_metadata(service=self.service, user=self.user, user_quota=None)
+
+        url = reverse('api:servers-list')
+        query = parse.urlencode(query={'cursor': '', 'page_size': 2})
+        response = self.client.get(f'{url}?{query}')
+        self.assertEqual(response.status_code, 200)
+        self.assertKeysIn(['count', 'next', 'previous', 'servers'], response.data)
+        self.assertIsNone(response.data['count'])
+        self.assertIsNone(response.data['previous'])
+        ids = [s['id'] for s in response.data['servers']]
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        ids += [s['id'] for s in response.data['servers']]
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['next'])
+        ids += [s['id'] for s in response.data['servers']]
+        servers = Server.objects.filter(user=self.user, classification=Server.Classification.PERSONAL)
+        self.assertEqual(ids, list(servers.order_by('-creation_time', '-id').values_list('id', flat=True)))
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s['id'] for s in response.data['servers']], ids[2:4])
+
+        query = parse.urlencode(query={'cursor': 'invalid'})
+        response = self.client.get(f'{url}?{query}')
+        self.assertErrorResponse(status_code=400, code='InvalidArgument', response=response)
+
+    def test_server_list_count_cache(self):
+        url = reverse('api:servers-list')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        self.assertNotIn('approximate', response.data)
+
+        # update()不发送信号，总数缓存未失效
+        Server.objects.filter(id=self.miss_server.id).update(user=None)
+        response = self.client.get(url)
+        self.assertEqual(response.data['count'], 1)
+
+        create_server_metadata(service=self.service, user=self.user, user_quota=None)
+        response = self.client.get(url)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['servers']), 1)
+        self.assertNotEqual(response.data['servers'][0]['id'], self.miss_server.id)
+
+    def test_values_serializer(self):
+        quota = UserQuotaManager().create_quota(user=self.user, service=self.service)
+        UserQuotaManager().increase(user=self.user, quota_id=quota.id, vcpus=6, ram=2048)
+        create_server_metadata(service=self.service, user=self.user, user_quota=quota)
+        create_server_metadata(service=None, user=self.user, user_quota=None)
+        servers = Server.objects.select_related('service', 'user_quota').order_by('id')
+        expected = serializers.ServerSerializer(servers, many=True).data
+        data = serializers.ServerListValuesSerializer(
+            serializers.ServerListValuesSerializer.values(servers.order_by('id'))).data
+        self.assertEqual(json.dumps(data), json.dumps(expected))
+        expected = serializers.ServerSimpleSerializer(servers, many=True).data
+        data = serializers.ServerValuesSerializer(serializers.ServerValuesSerializer.values(servers)).data
+        self.assertEqual(json.dumps(data), json.dumps(expected))
+
+        self.miss_server.user_quota = quota
+        self.miss_server.do_archive()
+        archives = ServerArchive.objects.select_related('service', 'user_quota').all()
+        expected = serializers.ServerArchiveSerializer(archives, many=True).data
+        data = serializers.ServerArchiveValuesSerializer(
+            serializers.ServerArchiveValuesSerializer.values(archives)).data
+        self.assertEqual(json.dumps(data), json.dumps(expected))
+
+    def test_server_list_etag(self):
+        url = reverse('api:servers-list')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(f'{url}?page_size=1', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        self.miss_server.remarks = 'etag'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.miss_server.save(update_fields=['remarks'])
+            # 事务提交后才更新版本号
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['servers'][0]['remarks'], 'etag')
+        self.assertNotEqual(response['ETag'], etag)
+
+        # 通过QuerySet删除(管理后台批量删除、级联删除等)，一个事务中只更新一次版本号
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            servers = [create_server_metadata(service=self.service, user=self.user, user_quota=None)
+                       for _ in range(2)]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['count'], 3)
+        etag = response['ETag']
+        with mock.patch.object(model_version, '_set_new_version', wraps=model_version._set_new_version) as set_ver, \
+                self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Server.objects.filter(id__in=[s.id for s in servers]).delete()
+        set_ver.assert_called_once_with(Server._meta.db_table)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Server.bulk_archive([self.miss_server])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_server_delete_retry(self):
+        url = reverse('api:servers-detail', kwargs={'id': self.miss_server.id})
+        with mock.patch.object(ServersViewSet, 'request_service', side_effect=errors.ServiceTimeout()), \
+                self.settings(JOBS={'SERVER_DELETE_RETRY': True}):
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(name=JOB_SERVER_DELETE)
+        self.assertEqual(json.loads(job.params), {'server_id': self.miss_server.id, 'force': False})
+        self.assertTrue(Server.objects.filter(id=self.miss_server.id).exists())
+
     def test_server_action(self):
         url = reverse('api:servers-server-action', kwargs={'id': 'motfound'})
         response = self.client.post(url)
@@ -721,7 +874,8 @@ class ServiceTests(MyAPITestCase):
         self.assertKeysIn(["count", "next", "previous", "results"], response.data)
         self.assertEqual(response.data['count'], 0)
 
-        self.service.users.add(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.users.add(self.user)
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertKeysIn(["count", "next", "previous", "results"], response.data)
@@ -774,6 +928,25 @@ class ServiceTests(MyAPITestCase):
         url = reverse('api:service-share-quota', kwargs={'id': self.service.id})
         self.service_quota_get_update(url=url)
 
+    def test_invalidate_catalog_cache(self):
+        url = reverse('api:service-catalog-cache-invalidate', kwargs={'id': self.service.id})
+        response = self.client.post(url)
+        self.assertErrorResponse(status_code=403, code='AccessDenied', response=response)
+
+        self.service.users.add(self.user)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 204)
+
+    def test_breaker_state(self):
+        url = reverse('api:service-breaker', kwargs={'id': self.service.id})
+        response = self.client.get(url)
+        self.assertErrorResponse(status_code=403, code='AccessDenied', response=response)
+
+        self.service.users.add(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertKeysIn(['state', 'opened_at', 'until', 'reason', 'stats'], response.data)
+
 
 class ImageTests(MyAPITestCase):
     def setUp(self):
@@ -1,5 +1,5 @@
-import random
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from datetime import timedelta
 
@@ -22,17 +22,20 @@ from servers.models import Server, Flavor, ServerArchive
 from servers.managers import ServerManager
 from service.managers import ServiceManager
 from service.models import DataCenter, ApplyOrganization, ApplyVmService
-from service.models import ApplyQuota
+from service.models import ApplyQuota, ServiceConfig, UserQuota, QuotaReservation
 from adapters import inputs, outputs
 from core.quota import QuotaAPI
 from core import request as core_request
 from core import errors as exceptions
 from core.taskqueue import server_build_status
+from core.taskqueue.server_sync import apply_server_detail
+from jobs.managers import get_jobs_config
+from jobs.handlers import enqueue_server_delete, enqueue_server_archive
 from vo.models import VoMember
 from activity.models import QuotaActivity
 from . import serializers
 from .viewsets import CustomGenericViewSet
-from .paginations import ServersPagination, DefaultPageNumberPagination
+from .paginations import ServersPagination, DefaultPageNumberPagination, ServerArchivePagination
 from . import handlers
 from .handlers import serializer_error_msg
 
@@ -64,6 +67,7 @@ class ServersViewSet(CustomGenericViewSet):
     permission_classes = [IsAuthenticated, ]
     pagination_class = ServersPagination
     lookup_field = 'id'
+    etag_models = {'list': (Server, ServiceConfig, DataCenter, UserQuota)}
     # lookup_value_regex = '[0-9a-z-]+'
 
     @swagger_auto_schema(
@@ -76,6 +80,13 @@ class ServersViewSet(CustomGenericViewSet):
                 required=False,
                 description='服务端点id'
             ),
+            openapi.Parameter(
+                name='cursor',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='游标分页，第一页为空，之后使用返回的next或previous链接；不统计总数，"count"为null'
+            ),
         ],
         responses={
             200: ''
@@ -86,8 +97,8 @@ class ServersViewSet(CustomGenericViewSet):
         列举用户个人服务器实例
 
             200: {
-              "count": 8,
-              "next": "http://xxx/api/server/?page=2&page_size=2",
+              "count": 8,           # 游标分页时为null
+              "next": "http://xxx/api/server/?page=2&page_size=2",     # 游标分页时 ?cursor=xxx
               "previous": null,
               "servers": [
                 {
@@ -135,6 +146,13 @@ class ServersViewSet(CustomGenericViewSet):
                 required=False,
                 description='服务端点id'
             ),
+            openapi.Parameter(
+                name='cursor',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='游标分页，第一页为空，之后使用返回的next或previous链接；不统计总数，"count"为null'
+            ),
         ],
         responses={
             200: ''
@@ -236,9 +254,9 @@ class ServersViewSet(CustomGenericViewSet):
 
         is_public_network = out_net.network.public
 
-        # 资源配额扣除
+        # 资源配额扣除，预留到服务器记录保存后确认
         try:
-            user_quota = QuotaAPI().server_create_quota_apply(
+            user_quota, reservation = QuotaAPI().server_create_quota_lease(
                 service=service, user=request.user, vcpu=flavor.vcpus, ram=flavor.ram,
                 public_ip=is_public_network, user_quota_id=quota_id)
         except exceptions.Error as exc:
@@ -250,9 +268,7 @@ class ServersViewSet(CustomGenericViewSet):
             out = self.request_service(service=service, method='server_create', params=params)
         except exceptions.APIException as exc:
             try:
-                QuotaAPI().server_quota_release(service=service, vcpu=flavor.vcpus,
-                                                ram=flavor.ram, public_ip=is_public_network,
-                                                user=request.user, user_quota_id=user_quota.id)
+                QuotaAPI().server_quota_cancel(reservation)
             except exceptions.Error:
                 pass
             return Response(data=exc.err_data(), status=exc.status_code)
@@ -280,6 +296,7 @@ class ServersViewSet(CustomGenericViewSet):
                         **kwargs
                         )
         server.save()
+        QuotaAPI().server_quota_confirm(reservation, server=server)
         if service.service_type == service.ServiceType.EVCLOUD:
             if self._update_server_detail(server):
                 return Response(data={'id': server.id}, status=status.HTTP_201_CREATED)
@@ -287,15 +304,24 @@ class ServersViewSet(CustomGenericViewSet):
         server_build_status.creat_task(server)      # 异步任务查询server创建结果，更新server信息和创建状态
         return Response(data={'id': server.id}, status=status.HTTP_202_ACCEPTED)
 
-    @staticmethod
-    def _update_server_detail(server, task_status: int = None):
+    def _update_server_detail(self, server, task_status: int = None):
         try:
-            return core_request.update_server_detail(server=server, task_status=task_status)
+            return core_request.update_server_detail(server=server, task_status=task_status,
+                                                     deadline=self.get_deadline())
         except exceptions.Error as e:
             pass
 
     @swagger_auto_schema(
         operation_summary=gettext_lazy('查询服务器实例信息'),
+        manual_parameters=[
+            openapi.Parameter(
+                name='refresh',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_BOOLEAN,
+                required=False,
+                description='从服务刷新元数据，默认返回定期同步的元数据'
+            ),
+        ],
         responses={
         }
     )
@@ -303,6 +329,8 @@ class ServersViewSet(CustomGenericViewSet):
         """
         查询服务器实例信息
 
+            元数据由管理命令sync_servers定期批量同步，元数据不完整或参数refresh=true时从服务刷新
+
             http code 200:
             {
               "server": {
@@ -333,7 +361,8 @@ class ServersViewSet(CustomGenericViewSet):
                 },
                 "center_quota": 2,         # 1: 服务的私有资源配额，"user_quota"=null; 2: 服务的分享资源配额
                 "classification": "vo",
-                "vo_id": "3d7cd5fc-d236-11eb-9da9-c8009fe2eb10"    # null when "classification"=="personal"
+                "vo_id": "3d7cd5fc-d236-11eb-9da9-c8009fe2eb10",    # null when "classification"=="personal"
+                "synced_at": "2020-09-23T07:20:14.009418Z"      # may be null, 元数据同步时间
               }
             }
         """
@@ -345,21 +374,11 @@ class ServersViewSet(CustomGenericViewSet):
         except exceptions.APIException as exc:
             return Response(data=exc.err_data(), status=exc.status_code)
 
-        # 如果元数据完整，各种服务不同概率去更新元数据
-        if server.ipv4 and server.image:
-            need_update = False
-            if server.service.service_type == server.service.ServiceType.EVCLOUD:
-                if random.choice(range(10)) == 0:
-                    need_update = True
-            elif server.service.service_type == server.service.ServiceType.OPENSTACK:
-                if random.choice(range(5)) == 0:
-                    need_update = True
-            elif random.choice(range(2)) == 0:
-                need_update = True
-
-            if not need_update:
-                serializer = serializers.ServerSerializer(server)
-                return Response(data={'server': serializer.data})
+        # 元数据完整时直接返回定期同步的元数据
+        refresh = request.query_params.get('refresh', '').lower() == 'true'
+        if server.ipv4 and server.image and not refresh:
+            serializer = serializers.ServerSerializer(server)
+            return Response(data={'server': serializer.data})
 
         service = server.service
         params = inputs.ServerDetailInput(server_id=server.instance_id)
@@ -368,37 +387,13 @@ class ServersViewSet(CustomGenericViewSet):
         except exceptions.APIException as exc:
             return Response(data=exc.err_data(), status=exc.status_code)
 
-        update_fields = []
-        new_vcpu = out.server.vcpu
-        if new_vcpu and server.vcpus != new_vcpu:
-            server.vcpus = new_vcpu
-            update_fields.append('vcpus')
-
-        new_ram = out.server.ram
-        if new_ram and server.ram != new_ram:
-            server.ram = new_ram
-            update_fields.append('ram')
-
-        new_ipv4 = out.server.ip.ipv4
-        if new_ipv4 and server.ipv4 != new_ipv4:
-            server.ipv4 = new_ipv4
-            update_fields.append('ipv4')
-
-        new_name = out.server.image.name
-        if new_name and server.image != new_name:
-            server.image = new_name
-            update_fields.append('image')
-
-        new_pub = out.server.ip.public_ipv4
-        if new_pub is not None and server.public_ip != new_pub:
-            server.public_ip = new_pub
-            update_fields.append('public_ip')
-
-        if update_fields:
-            try:
-                server.save(update_fields=update_fields)
-            except Exception as e:
-                pass
+        update_fields = apply_server_detail(server, out.server)
+        server.synced_at = timezone.now()
+        update_fields.append('synced_at')
+        try:
+            server.save(update_fields=update_fields)
+        except Exception as e:
+            pass
 
         serializer = serializers.ServerSerializer(server)
         return Response(data={'server': serializer.data})
@@ -415,6 +410,7 @@ class ServersViewSet(CustomGenericViewSet):
             ),
         ],
         responses={
+            202: """ACCEPTED, 请求服务超时或服务不可用，已加入任务队列稍后删除""",
             204: """NO CONTENT""",
             403: """
                 {
@@ -451,11 +447,26 @@ class ServersViewSet(CustomGenericViewSet):
         params = inputs.ServerDeleteInput(server_id=server.instance_id, force=force)
         try:
             self.request_service(server.service, method='server_delete', params=params)
+        except (exceptions.ServiceTimeout, exceptions.ServiceUnavailable) as exc:
+            if not get_jobs_config()['SERVER_DELETE_RETRY']:
+                return Response(data=exc.err_data(), status=exc.status_code)
+
+            try:
+                enqueue_server_delete(server, force=force)     # 任务队列中重试删除，并归档
+            except Exception as e:
+                return Response(data=exc.err_data(), status=exc.status_code)
+
+            return Response(status=status.HTTP_202_ACCEPTED)
         except exceptions.APIException as exc:
             return Response(data=exc.err_data(), status=exc.status_code)
 
         if server.do_archive():     # 记录归档
             self.release_server_quota(server=server)    # 释放资源配额
+        else:
+            try:
+                enqueue_server_archive(server)      # 任务队列中重试归档
+            except Exception as e:
+                pass
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -586,7 +597,7 @@ class ServersViewSet(CustomGenericViewSet):
             return Response(data=exc.err_data(), status=exc.status_code)
 
         try:
-            status_code, status_text = core_request.server_status_code(server=server)
+            status_code, status_text = core_request.server_status_code(server=server, deadline=self.get_deadline())
         except exceptions.APIException as exc:
             return Response(data=exc.err_data(), status=exc.status_code)
 
@@ -713,9 +724,92 @@ class ServersViewSet(CustomGenericViewSet):
 
         return Response(data={'remarks': remarks})
 
+    @swagger_auto_schema(
+        operation_summary=gettext_lazy('批量查询服务器状态'),
+        responses={
+            200: """
+                {
+                  "statuses": {
+                    "<server id>": {
+                      "status_code": 1,
+                      "status_text": "running"
+                    }
+                  },
+                  "errors": {
+                    "<server id>": {
+                      "code": "NotFound",
+                      "message": "xxx"
+                    }
+                  }
+                }
+                """,
+            400: """
+                {
+                    "code": "BadRequest",
+                    "message": "xxx"
+                }
+                """
+        }
+    )
+    @action(methods=['post'], url_path='status/batch', detail=False, url_name='server-status-batch')
+    def server_status_batch(self, request, *args, **kwargs):
+        """
+        批量查询服务器状态，同一服务的服务器通过一次请求查询，不同服务并行查询
+
+            status code同服务器状态查询
+        """
+        serializer = self.get_serializer(data=request.data)
+        if not serializer.is_valid(raise_exception=False):
+            msg = serializer_error_msg(serializer.errors)
+            exc = exceptions.BadRequest(msg)
+            return Response(data=exc.err_data(), status=exc.status_code)
+
+        server_ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        servers, errs = ServerManager().get_read_perm_servers(server_ids=server_ids, user=request.user)
+
+        service_servers = {}
+        for server in servers:
+            service_servers.setdefault(server.service_id, []).append(server)
+
+        results = {}
+        deadline = self.get_deadline()
+        if service_servers:
+            with ThreadPoolExecutor(max_workers=min(len(service_servers), 8)) as executor:
+                futures = [(group, executor.submit(core_request.servers_status_code, servers=group, deadline=deadline))
+                           for group in service_servers.values()]
+                for group, future in futures:
+                    try:
+                        results.update(future.result())
+                    except exceptions.Error as exc:
+                        results.update({server.id: exc for server in group})
+
+        statuses = {}
+        for server in servers:
+            r = results.get(server.id)
+            if isinstance(r, exceptions.Error):
+                errs[server.id] = r
+                continue
+
+            status_code, status_text = r
+            if status_code in outputs.ServerStatus.normal_values():     # 虚拟服务器状态正常
+                if server.task_status == server.TASK_IN_CREATING:
+                    self._update_server_detail(server, task_status=server.TASK_CREATED_OK)
+            elif status_code == outputs.ServerStatus.NOSTATE and server.task_status == server.TASK_IN_CREATING:
+                status_code = outputs.ServerStatus.BUILDING
+                status_text = outputs.ServerStatus.get_mean(status_code)
+
+            statuses[server.id] = {'status_code': status_code, 'status_text': status_text}
+
+        return Response(data={
+            'statuses': statuses,
+            'errors': {k: v.err_data() for k, v in errs.items()}
+        })
+
     def get_serializer_class(self):
         if self.action == 'create':
             return serializers.ServerCreateSerializer
+        elif self.action == 'server_status_batch':
+            return serializers.ServerStatusBatchSerializer
 
         return Serializer
 
@@ -1159,7 +1253,14 @@ class QuotaViewSet(CustomGenericViewSet):
                   "deleted": false,
                   "display": "[普通配额](vCPU: 10, RAM: 10240Mb, PublicIP: 5, PrivateIP: 5)",
                   "duration_days": 365,
-                  "classification": "personal"
+                  "classification": "personal",
+                  "reserved": {             # 预留中(创建中资源)的资源数，已包含在已用数中
+                    "vcpu": 0,
+                    "ram": 0,
+                    "disk_size": 0,
+                    "public_ip": 0,
+                    "private_ip": 0
+                  }
                 }
               ]
             }
@@ -1227,7 +1328,14 @@ class QuotaViewSet(CustomGenericViewSet):
                   "deleted": false,
                   "display": "[普通配额](vCPU: 10, RAM: 10240Mb, PublicIP: 5, PrivateIP: 5)",
                   "duration_days": 365,
-                  "classification": "personal"
+                  "classification": "personal",
+                  "reserved": {             # 预留中(创建中资源)的资源数，已包含在已用数中
+                    "vcpu": 0,
+                    "ram": 0,
+                    "disk_size": 0,
+                    "public_ip": 0,
+                    "private_ip": 0
+                  }
                 }
               ]
             }
@@ -1356,6 +1464,7 @@ class UserQuotaViewSet(CustomGenericViewSet):
     permission_classes = [IsAuthenticated]
     pagination_class = DefaultPageNumberPagination
     lookup_field = 'id'
+    etag_models = {'list': (UserQuota, ServiceConfig, QuotaReservation)}
 
     page_manual_parameters = [
         openapi.Parameter(
@@ -1432,6 +1541,7 @@ class ServiceViewSet(CustomGenericViewSet):
     permission_classes = [IsAuthenticated]
     pagination_class = DefaultPageNumberPagination
     lookup_field = 'id'
+    etag_models = {'list': (ServiceConfig, DataCenter, UserQuota)}
 
     @swagger_auto_schema(
         operation_summary=gettext_lazy('列举已接入的服务'),
@@ -1656,6 +1766,52 @@ class ServiceViewSet(CustomGenericViewSet):
         return handlers.VmServiceHandler.change_share_quota(
             view=self, request=request, kwargs=kwargs)
 
+    @swagger_auto_schema(
+        operation_summary=gettext_lazy('清除服务的镜像和网络缓存'),
+        request_body=no_body,
+        responses={
+            status.HTTP_204_NO_CONTENT: ''
+        }
+    )
+    @action(methods=['post'], detail=True, url_path='catalog-cache/invalidate', url_name='catalog-cache-invalidate')
+    def invalidate_catalog_cache(self, request, *args, **kwargs):
+        """
+        清除服务的镜像、网络等缓存数据，需要有管理员权限，服务的镜像、网络等变更后调用
+
+            http code 204 ok
+        """
+        return handlers.VmServiceHandler.invalidate_catalog_cache(
+            view=self, request=request, kwargs=kwargs)
+
+    @swagger_auto_schema(
+        operation_summary=gettext_lazy('查询服务的熔断器状态'),
+        responses={
+            status.HTTP_200_OK: ''
+        }
+    )
+    @action(methods=['get'], detail=True, url_path='breaker', url_name='breaker')
+    def breaker_state(self, request, *args, **kwargs):
+        """
+        查询服务的熔断器状态，需要有管理员权限；熔断器打开时请求此服务立即失败(503 ServiceUnavailable)
+
+            http code 200 ok:
+            {
+              "state": "open",              # closed: 关闭(正常); open: 打开; half-open: 半开，允许一个探测请求
+              "opened_at": 1634000000.0,    # 打开时间戳，closed时为null
+              "until": 1634000030.0,        # 打开状态持续到，之后进入半开状态
+              "reason": "failure rate 6/10, xxx",
+              "stats": {                    # 当前进程的统计
+                "calls": 10,
+                "failures": 6,
+                "slow_calls": 0,
+                "rejected": 3,
+                "opened": 1
+              }
+            }
+        """
+        return handlers.VmServiceHandler.get_breaker_state(
+            view=self, request=request, kwargs=kwargs)
+
     def paginate_service_response(self, request, qs):
         paginator = self.paginator
         try:
@@ -1691,6 +1847,7 @@ class DataCenterViewSet(CustomGenericViewSet):
     queryset = []
     permission_classes = [IsAuthenticated]
     pagination_class = None
+    etag_models = {'list': (DataCenter,)}
 
     @swagger_auto_schema(
         operation_summary=gettext_lazy('联邦成员机构注册表'),
@@ -1743,7 +1900,7 @@ class ServerArchiveViewSet(CustomGenericViewSet):
     """
     queryset = []
     permission_classes = [IsAuthenticated]
-    pagination_class = DefaultPageNumberPagination
+    pagination_class = ServerArchivePagination
 
     @swagger_auto_schema(
         operation_summary=gettext_lazy('列举用户虚拟服务器归档记录'),
@@ -1755,6 +1912,13 @@ class ServerArchiveViewSet(CustomGenericViewSet):
                 required=False,
                 description='服务provider id'
             ),
+            openapi.Parameter(
+                name='cursor',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='游标分页，第一页为空，之后使用返回的next或previous链接；不统计总数，"count"为null'
+            ),
         ],
         responses={
             status.HTTP_200_OK: ''
@@ -1817,6 +1981,13 @@ class ServerArchiveViewSet(CustomGenericViewSet):
                 required=False,
                 description='服务provider id'
             ),
+            openapi.Parameter(
+                name='cursor',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='游标分页，第一页为空，之后使用返回的next或previous链接；不统计总数，"count"为null'
+            ),
         ],
         responses={
             200: ''
@@ -1,4 +1,10 @@
+import time
+import hashlib
+
+from django.utils import translation
+from django.utils.http import parse_etags
 from django.utils.translation import gettext as _
+from django.conf import settings
 from django.http import Http404
 from django.core.exceptions import PermissionDenied
 from rest_framework import viewsets
@@ -6,11 +12,18 @@ from rest_framework.views import set_rollback
 from rest_framework.response import Response
 from rest_framework.exceptions import (APIException, NotAuthenticated, AuthenticationFailed)
 
+from adapters.deadline import Deadline
 from service.models import ServiceConfig
 from core.request import request_service, request_vpn_service
+from core.model_version import model_version
 from core import errors as exceptions
 
 
+DEFAULT_API_ETAG = {
+    'MAX_AGE': 60,      # ETag最长有效时间(秒)，覆盖不发送信号的批量修改(如QuerySet.update())，0不限制
+}
+
+
 def str_to_int_or_default(val, default):
     """
     字符串转int，转换失败返回设置的默认值
@@ -63,33 +76,120 @@ def exception_handler(exc, context):
     return Response(exc.err_data(), status=exc.status_code)
 
 
+def get_api_etag_max_age():
+    c = dict(DEFAULT_API_ETAG)
+    c.update(getattr(settings, 'API_ETAG', {}))
+    return c['MAX_AGE']
+
+
+class NotModified(Exception):
+    """
+    条件GET请求的ETag匹配，数据未修改
+    """
+    def __init__(self, etag: str):
+        self.etag = etag
+
+
+def get_request_deadline_seconds():
+    """
+    一个API请求请求后端服务可用的总时间，单位秒
+    """
+    return getattr(settings, 'API_REQUEST_DEADLINE', 15)
+
+
 class CustomGenericViewSet(viewsets.GenericViewSet):
+    deadline = None     # 请求截止时间，每个API请求创建一个
+    # 支持条件GET(ETag/If-None-Match)的动作和其数据依赖的模型，{action: [model]}，子类设置；
+    # ETag由依赖模型的数据版本号、用户、请求路径和参数生成，数据未修改时在查询数据库之前返回304
+    etag_models = None
+    etag = None
+
+    def initial(self, request, *args, **kwargs):
+        self.deadline = Deadline(timeout=get_request_deadline_seconds())
+        super().initial(request, *args, **kwargs)
+        self.etag = self.get_etag(request)
+        if self.etag is not None:
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match and self.etag_matches(self.etag, if_none_match):
+                raise NotModified(etag=self.etag)
+
+    def get_etag(self, request):
+        """
+        本次请求的ETag，不支持条件GET时为None
+
+        :return:
+            str or None
+        """
+        if request.method not in ('GET', 'HEAD') or not self.etag_models:
+            return None
+
+        models = self.etag_models.get(self.action)
+        if not models:
+            return None
+
+        versions = model_version.get_many(sorted({m._meta.db_table for m in models}))
+        max_age = get_api_etag_max_age()
+        period = int(time.time() // max_age) if max_age else 0
+        value = f'{self.basename}:{self.action}:{request.user.id}:{translation.get_language()}:' \
+                f'{request.get_full_path()}:{versions!r}:{period}'
+        return f'"{hashlib.md5(value.encode("utf-8")).hexdigest()}"'
+
     @staticmethod
-    def request_service(service, method: str, **kwargs):
+    def etag_matches(etag: str, if_none_match: str):
+        etags = parse_etags(if_none_match)
+        if '*' in etags:
+            return True
+
+        return etag in [e[2:] if e.startswith('W/') else e for e in etags]
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=304, headers={'ETag': exc.etag})
+
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.etag is not None and response.status_code == 200:
+            response['ETag'] = self.etag
+
+        return response
+
+    def get_deadline(self):
+        """
+        本次API请求的截止时间
+        """
+        if self.deadline is None:
+            self.deadline = Deadline(timeout=get_request_deadline_seconds())
+
+        return self.deadline
+
+    def request_service(self, service, method: str, **kwargs):
         """
-        向服务发送请求
+        向服务发送请求，使用本次API请求的剩余时间
 
         :param service: 接入的服务配置对象
         :param method:
         :param kwargs:
         :return:
 
-        :raises: APIException
+        :raises: APIException, ServiceTimeout
         """
+        kwargs.setdefault('deadline', self.get_deadline())
         return request_service(service=service, method=method, **kwargs)
 
-    @staticmethod
-    def request_vpn_service(service, method: str, **kwargs):
+    def request_vpn_service(self, service, method: str, **kwargs):
         """
-        向vpn服务发送请求
+        向vpn服务发送请求，使用本次API请求的剩余时间
 
         :param service: 接入的服务配置对象
         :param method:
         :param kwargs:
         :return:
 
-        :raises: APIException
+        :raises: APIException, ServiceTimeout
         """
+        kwargs.setdefault('deadline', self.get_deadline())
         return request_vpn_service(service=service, method=method, **kwargs)
 
     def get_service(self, request, lookup='service_id', in_='query'):
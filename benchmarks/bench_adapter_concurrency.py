@@ -0,0 +1,124 @@
+"""
+多服务适配器请求，顺序执行同步适配器和并发执行异步适配器的耗时对比
+
+本地启动多个模拟EVCloud服务(每个请求延迟--delay秒)，每个服务查询--servers个云主机的状态
+
+    python benchmarks/bench_adapter_concurrency.py --services 5 --servers 4 --delay 0.2
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gosc.settings')
+
+import django
+django.setup()
+
+from adapters import inputs, aio
+from adapters.evcloud.adapter import EVCloudAdapter
+from adapters.evcloud.aio import AsyncEVCloudAdapter
+
+
+class EVCloudHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0.2
+
+    def send_json(self, body: bytes, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_json(b'{"status": {"status_code": 1}}')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.delay)
+        if '/jwt' in self.path:
+            self.send_json(b'{}', status=400)
+        else:
+            self.send_json(b'{"token": {"key": "bench"}}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_services(num: int):
+    servers = []
+    for _ in range(num):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), EVCloudHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    return servers
+
+
+def run_sync(urls, num_servers: int):
+    """
+    逐个服务认证，逐个查询云主机状态
+    """
+    for url in urls:
+        adapter = EVCloudAdapter(endpoint_url=url)
+        adapter.authenticate(inputs.AuthenticateInput(username='bench', password='bench'))
+        for i in range(num_servers):
+            adapter.server_status(inputs.ServerStatusInput(server_id=str(i)))
+
+
+async def _one_service(url, num_servers: int):
+    adapter = AsyncEVCloudAdapter(endpoint_url=url)
+    await adapter.authenticate(inputs.AuthenticateInput(username='bench', password='bench'))
+    return await asyncio.gather(
+        *[adapter.server_status(inputs.ServerStatusInput(server_id=str(i))) for i in range(num_servers)])
+
+
+def run_async(urls, num_servers: int):
+    """
+    所有服务并发认证，认证后并发查询云主机状态
+    """
+    aio.run_concurrently([_one_service(url, num_servers) for url in urls])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', type=int, default=5, help='服务数')
+    parser.add_argument('--servers', type=int, default=4, help='每个服务查询的云主机数')
+    parser.add_argument('--delay', type=float, default=0.2, help='模拟服务每个请求的延迟，单位秒')
+    args = parser.parse_args()
+
+    EVCloudHandler.delay = args.delay
+    servers = start_services(args.services)
+    urls = [f'http://127.0.0.1:{s.server_port}/' for s in servers]
+    try:
+        start = time.monotonic()
+        run_sync(urls, args.servers)
+        sync_seconds = time.monotonic() - start
+
+        start = time.monotonic()
+        run_async(urls, args.servers)
+        async_seconds = time.monotonic() - start
+    finally:
+        for s in servers:
+            s.shutdown()
+            s.server_close()
+
+    print(f'services={args.services}, servers per service={args.servers}, delay={args.delay}s')
+    print(f'sequential sync adapters:    {sync_seconds:.3f}s')
+    print(f'concurrent async adapters:   {async_seconds:.3f}s')
+    print(f'speedup: {sync_seconds / async_seconds:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
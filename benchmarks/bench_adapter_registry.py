@@ -0,0 +1,49 @@
+"""
+每次请求创建适配器(OneServiceClient)与从注册表获取适配器实例的开销对比
+
+    python benchmarks/bench_adapter_registry.py --number 100000
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gosc.settings')
+
+import django
+django.setup()
+
+from service.models import ServiceConfig
+from adapters import client
+from adapters.registry import AdapterRegistry
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000, help='每种方式执行次数')
+    args = parser.parse_args()
+
+    registry = AdapterRegistry()
+    print(f'number={args.number}')
+    for service_type in [ServiceConfig.ServiceType.EVCLOUD, ServiceConfig.ServiceType.OPENSTACK,
+                         ServiceConfig.ServiceType.VMWARE]:
+        service = ServiceConfig(id=f'bench-{service_type}', service_type=service_type,
+                                endpoint_url=f'http://{service_type}.bench/', api_version='v3', extra='')
+
+        def build_client():
+            cli = client.get_service_client(service, auth=None)
+            return getattr(cli, 'server_status')
+
+        def from_registry():
+            return registry.get_method(service, method='server_status', auth=None)
+
+        build_seconds = min(timeit.repeat(build_client, number=args.number, repeat=3))
+        registry_seconds = min(timeit.repeat(from_registry, number=args.number, repeat=3))
+        print(f'{service_type:10}  build client: {build_seconds / args.number * 1e6:6.2f}us/call   '
+              f'registry: {registry_seconds / args.number * 1e6:6.2f}us/call   '
+              f'speedup: {build_seconds / registry_seconds:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
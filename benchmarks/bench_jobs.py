@@ -0,0 +1,76 @@
+"""
+异步任务队列的吞吐量
+
+在settings中配置的数据库(SQLite/MySQL)上创建测试数据库，添加--jobs个空任务，--workers个worker并发领取执行
+
+    python benchmarks/bench_jobs.py --jobs 2000 --workers 4 --concurrency 8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gosc.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+
+from jobs.models import Job
+from jobs.handlers import register
+from jobs.worker import JobWorker
+
+
+@register('bench_noop')
+def noop(job, params):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=2000, help='任务数')
+    parser.add_argument('--workers', type=int, default=2, help='worker数')
+    parser.add_argument('--concurrency', type=int, default=4, help='每个worker并发执行的任务数')
+    args = parser.parse_args()
+
+    if connection.vendor == 'sqlite':     # 内存数据库是表级锁，多线程并发写会立即失败，使用文件数据库
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'gosc_bench_jobs.sqlite3')
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        Job.objects.bulk_create([Job(name='bench_noop') for _ in range(args.jobs)], batch_size=500)
+        stop_event = threading.Event()
+        workers = [JobWorker(concurrency=args.concurrency, config={'POLL_INTERVAL': 0.05, 'MAX_PER_SERVICE': 0})
+                   for _ in range(args.workers)]
+        threads = [threading.Thread(target=w.run, kwargs={'stop_event': stop_event}) for w in workers]
+
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+
+        while sum(w.stats['succeeded'] for w in workers) < args.jobs:
+            if time.monotonic() - start > 600:
+                break
+            time.sleep(0.05)
+
+        seconds = time.monotonic() - start
+        stop_event.set()
+        for t in threads:
+            t.join()
+
+        succeeded = Job.objects.filter(status=Job.Status.SUCCEEDED).count()
+        attempts = sum(Job.objects.values_list('attempts', flat=True))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print(f'database={connection.vendor}, workers={args.workers}, concurrency={args.concurrency}')
+    print(f'{succeeded}/{args.jobs} jobs succeeded in {seconds:.2f}s, {succeeded / seconds:.0f} jobs/s, '
+          f'duplicate executions: {attempts - succeeded}')
+
+
+if __name__ == '__main__':
+    main()
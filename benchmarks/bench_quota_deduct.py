@@ -0,0 +1,101 @@
+"""
+并发扣除同一服务资源配额的吞吐量：加行锁读-改-写 vs 一条条件UPDATE
+
+在settings中配置的数据库(SQLite/MySQL)上创建测试数据库，--threads个线程共扣除--ops次，每次1个vCPU；
+行锁的效果在MySQL上才能体现，SQLite是库级写锁
+
+    python benchmarks/bench_quota_deduct.py --ops 2000 --threads 16
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gosc.settings')
+
+import django
+django.setup()
+
+from django.db import connection, transaction, close_old_connections
+
+from core import errors
+from service.models import ServiceConfig, DataCenter
+from service.managers import ServicePrivateQuotaManager
+
+
+def locked_deduct(mgr, service, vcpus: int):
+    """
+    原实现：SELECT ... FOR UPDATE，检查后save
+    """
+    with transaction.atomic():
+        quota = mgr.MODEL.objects.select_for_update().filter(service=service).first()
+        if (quota.vcpu_total - quota.vcpu_used) < vcpus:
+            raise errors.QuotaShortageError()
+
+        quota.vcpu_used = quota.vcpu_used + vcpus
+        quota.save(update_fields=['vcpu_used'])
+
+
+def conditional_deduct(mgr, service, vcpus: int):
+    mgr.deduct(service=service, vcpus=vcpus)
+
+
+def run(func, service, ops: int, threads: int):
+    mgr = ServicePrivateQuotaManager()
+    mgr.MODEL.objects.filter(service=service).update(vcpu_total=ops, vcpu_used=0)
+    counter = {'ok': 0, 'error': 0}
+    lock = threading.Lock()
+
+    def worker(n):
+        for _ in range(n):
+            try:
+                func(mgr, service, 1)
+                key = 'ok'
+            except Exception:
+                key = 'error'
+            with lock:
+                counter[key] += 1
+        close_old_connections()
+
+    per_thread = [ops // threads + (1 if i < ops % threads else 0) for i in range(threads)]
+    ts = [threading.Thread(target=worker, args=(n,)) for n in per_thread]
+    start = time.monotonic()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+    seconds = time.monotonic() - start
+    used = mgr.get_quota(service=service).vcpu_used
+    return seconds, counter, used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ops', type=int, default=2000, help='扣除次数')
+    parser.add_argument('--threads', type=int, default=16, help='并发线程数')
+    args = parser.parse_args()
+
+    if connection.vendor == 'sqlite':     # 内存数据库是表级锁，多线程并发写会立即失败，使用文件数据库
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'gosc_bench_quota.sqlite3')
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        center = DataCenter.objects.create(name='bench')
+        service = ServiceConfig.objects.create(data_center=center, name='bench', endpoint_url='http://127.0.0.1')
+        ServicePrivateQuotaManager().get_quota(service=service)
+
+        print(f'database={connection.vendor}, ops={args.ops}, threads={args.threads}')
+        for name, func in [('select_for_update', locked_deduct), ('conditional update', conditional_deduct)]:
+            seconds, counter, used = run(func, service=service, ops=args.ops, threads=args.threads)
+            print(f'{name:>20}: {counter["ok"]} ok, {counter["error"]} errors in {seconds:.2f}s, '
+                  f'{counter["ok"] / seconds:.0f} ops/s, vcpu_used={used}')
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+并发扣除同一服务资源配额的吞吐量：单行条件UPDATE vs 分片计数
+
+在settings中配置的数据库(SQLite/MySQL)上创建测试数据库，--threads个线程共扣除--ops次，每次1个vCPU；
+分片减少的是同一行上的锁等待，在MySQL上才能体现，SQLite是库级写锁
+
+    python benchmarks/bench_quota_shards.py --ops 2000 --threads 16 --shards 8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gosc.settings')
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.db import connection, close_old_connections
+
+from service.models import ServiceConfig, DataCenter
+from service.managers import ServicePrivateQuotaManager
+
+
+def run(mgr, service, ops: int, threads: int):
+    mgr.MODEL.objects.filter(service=service).update(vcpu_total=ops, vcpu_used=0)
+    counter = {'ok': 0, 'error': 0}
+    lock = threading.Lock()
+
+    def worker(n):
+        for _ in range(n):
+            try:
+                mgr.deduct(service=service, vcpus=1)
+                key = 'ok'
+            except Exception:
+                key = 'error'
+            with lock:
+                counter[key] += 1
+        close_old_connections()
+
+    per_thread = [ops // threads + (1 if i < ops % threads else 0) for i in range(threads)]
+    ts = [threading.Thread(target=worker, args=(n,)) for n in per_thread]
+    start = time.monotonic()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+    seconds = time.monotonic() - start
+    mgr.fold_shards(service=service)
+    used = mgr.MODEL.objects.get(service=service).vcpu_used
+    return seconds, counter, used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ops', type=int, default=2000, help='扣除次数')
+    parser.add_argument('--threads', type=int, default=16, help='并发线程数')
+    parser.add_argument('--shards', type=int, default=8, help='每个服务配额的分片数')
+    args = parser.parse_args()
+
+    settings.SERVICE_QUOTA_SHARDS = dict(getattr(settings, 'SERVICE_QUOTA_SHARDS', {}), SHARDS=args.shards)
+    if connection.vendor == 'sqlite':     # 内存数据库是表级锁，多线程并发写会立即失败，使用文件数据库
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'gosc_bench_quota.sqlite3')
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        center = DataCenter.objects.create(name='bench')
+        service = ServiceConfig.objects.create(data_center=center, name='bench', endpoint_url='http://127.0.0.1')
+        ServicePrivateQuotaManager().get_quota(service=service)
+
+        print(f'database={connection.vendor}, ops={args.ops}, threads={args.threads}, shards={args.shards}')
+        for name, sharded in [('single row', False), ('sharded', True)]:
+            mgr = ServicePrivateQuotaManager(sharded=sharded)
+            seconds, counter, used = run(mgr, service=service, ops=args.ops, threads=args.threads)
+            print(f'{name:>12}: {counter["ok"]} ok, {counter["error"]} errors in {seconds:.2f}s, '
+                  f'{counter["ok"] / seconds:.0f} ops/s, vcpu_used={used}')
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+云服务器列表序列化每行的开销：DRF ServerSerializer(select_related模型实例) vs ServerListValuesSerializer(values()行)
+
+在settings中配置的数据库上创建测试数据库和--rows个云服务器，每种方式查询并序列化一页--page-size行，
+统计包括查询的总时间
+
+    python benchmarks/bench_server_serializer.py --rows 1000 --page-size 1000 --number 20
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gosc.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+
+from api import serializers
+from servers.models import Server
+from service.models import ServiceConfig, DataCenter, UserQuota
+from users.models import UserProfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000, help='云服务器数')
+    parser.add_argument('--page-size', type=int, default=1000, help='每页行数')
+    parser.add_argument('--number', type=int, default=20, help='每种方式执行次数')
+    args = parser.parse_args()
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        center = DataCenter.objects.create(name='bench', endpoint_vms='http://127.0.0.1/vms/')
+        service = ServiceConfig.objects.create(data_center=center, name='bench', endpoint_url='http://127.0.0.1')
+        user = UserProfile.objects.create(username='bench')
+        quota = UserQuota.objects.create(user=user, service=service, vcpu_total=100, ram_total=10240)
+        Server.objects.bulk_create([
+            Server(id=f'bench-{i:08}', service=service, user=user, user_quota=quota, instance_id=str(i),
+                   vcpus=2, ram=1024, ipv4='127.0.0.1', image='bench', remarks='')
+            for i in range(args.rows)
+        ])
+        queryset = Server.objects.select_related('service', 'user_quota').filter(user=user)
+
+        def drf():
+            servers = list(queryset[:args.page_size])
+            return serializers.ServerSerializer(servers, many=True).data
+
+        def values():
+            rows = list(serializers.ServerListValuesSerializer.values(queryset)[:args.page_size])
+            return serializers.ServerListValuesSerializer(rows).data
+
+        rows = len(values())
+        print(f'database={connection.vendor}, rows={rows}, number={args.number}')
+        drf_seconds = min(timeit.repeat(drf, number=args.number, repeat=3))
+        values_seconds = min(timeit.repeat(values, number=args.number, repeat=3))
+        per_row = args.number * rows
+        print(f'    ServerSerializer: {drf_seconds / per_row * 1e6:7.2f}us/row')
+        print(f'  values() fast path: {values_seconds / per_row * 1e6:7.2f}us/row   '
+              f'speedup: {drf_seconds / values_seconds:.1f}x')
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,356 @@
+import os
+import time
+import threading
 from datetime import datetime
-from threading import local
 
-from adapters import exceptions as os_exceptions, client
-from adapters import inputs
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from adapters import exceptions as os_exceptions
+from adapters.registry import adapter_registry
+from adapters import inputs, outputs
 from service.models import ServiceConfig
 from . import errors as exceptions
 
 
+def utc_timestamp():
+    return datetime.utcnow().timestamp()
+
+
 class AuthCacheHandler:
-    def __init__(self):
-        self._auths = local()
+    """
+    服务身份认证信息缓存
 
-    def __getitem__(self, key):
-        if hasattr(self._auths, key):
-            return getattr(self._auths, key)
+    * 进程内所有线程共享认证信息；可序列化的认证信息(如EVCloud的token)同时保存到跨进程共享的缓存(django cache)中，
+      多个进程共用一个token；
+    * 同一服务的并发认证合并为一次认证请求，其他调用者等待认证结果；跨进程的认证锁用共享缓存的add()，
+      须是原子的(如utils.cache.FileBasedCache、memcached、redis)，否则多个进程可能同时认证；
+    * 认证信息过期前(refresh_ahead秒)主动刷新，刷新期间其他调用者继续使用未过期的认证信息。
+    """
+    cache_alias = 'shared'      # 跨进程共享缓存的django cache配置名称，不存在时使用default
+    cache_key_prefix = 'gosc_auth_'
+    refresh_ahead = 60          # 过期前多少秒主动刷新
+    lock_timeout = 30           # 跨进程认证锁的超时时间，单位秒
+    wait_interval = 0.1         # 等待其他进程认证结果的轮询间隔，单位秒
 
-        return None
+    def __init__(self, cache_alias: str = None):
+        if cache_alias:
+            self.cache_alias = cache_alias
+
+        self._auths = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'shared_hits': 0, 'authenticate': 0, 'wait': 0}
+
+    def __getitem__(self, key):
+        return self._auths.get(key, None)
 
     def __setitem__(self, key, value):
-        setattr(self._auths, key, value)
+        self._auths[key] = value
 
     def __delitem__(self, key):
-        delattr(self._auths, key)
+        self._auths.pop(key, None)
 
-    def get_auth(self, service: ServiceConfig, refresh=False):
+    @property
+    def cache(self):
+        try:
+            return caches[self.cache_alias]
+        except InvalidCacheBackendError:
+            return caches['default']
+
+    def get_auth(self, service: ServiceConfig, refresh=False, deadline=None):
         """
         获取身份认证信息
 
         :param service:
-        :param refresh:
+        :param refresh: True(当前认证信息已失效，需要刷新)
+        :param deadline: 请求截止时间
         :return:
 
-        :raises: AuthenticationFailed
+        :raises: AuthenticationFailed, ServiceTimeout
         """
-        now = datetime.utcnow().timestamp()
         key = self.get_service_key(service)
 
-        if refresh:
-            del self[key]
-        else:
-            auth = self[key]
-            if auth:
-                expire = auth.expire
-                if now < expire:
-                    return auth
-
-        s_client = client.get_service_client(service)
-        try:
-            password = service.raw_password()
-            if password is None:
-                raise exceptions.AuthenticationFailed(f'Invalid password of service "{str(service)}"')
+        def authenticate():
+            s_client = adapter_registry.bind(service)
+            try:
+                password = service.raw_password()
+                if password is None:
+                    raise exceptions.AuthenticationFailed(f'Invalid password of service "{str(service)}"')
 
-            params = inputs.AuthenticateInput(username=service.username, password=password)
-            auth = s_client.authenticate(params)
-            if not auth.ok:
+                params = inputs.AuthenticateInput(username=service.username, password=password)
+                auth = s_client.authenticate(params, deadline=deadline)
+                if not auth.ok:
+                    if isinstance(auth.error, os_exceptions.ServiceTimeout):
+                        raise exceptions.ServiceTimeout(f'Authentication timed out to service "{str(service)}"')
+                    raise exceptions.AuthenticationFailed(f'Authentication failed to service "{str(service)}"')
+            except os_exceptions.AuthenticationFailed:
                 raise exceptions.AuthenticationFailed(f'Authentication failed to service "{str(service)}"')
-        except os_exceptions.AuthenticationFailed:
-            raise exceptions.AuthenticationFailed(f'Authentication failed to service "{str(service)}"')
+            except os_exceptions.ServiceTimeout:
+                raise exceptions.ServiceTimeout(f'Authentication timed out to service "{str(service)}"')
 
-        self[key] = auth
-        return auth
+            return auth
 
-    def get_vpn_auth(self, service: ServiceConfig, refresh=False):
+        return self._get_or_authenticate(key=key, username=service.username, password_func=service.raw_password,
+                                         authenticate=authenticate, refresh=refresh, deadline=deadline)
+
+    def get_vpn_auth(self, service: ServiceConfig, refresh=False, deadline=None):
         if service.service_type == service.ServiceType.EVCLOUD:
-            return self.get_auth(service=service, refresh=refresh)
+            return self.get_auth(service=service, refresh=refresh, deadline=deadline)
 
-        now = datetime.utcnow().timestamp()
         key = self.get_service_vpn_key(service)
 
+        def authenticate():
+            cli = adapter_registry.bind(service, vpn=True)
+            try:
+                vpn_password = service.raw_vpn_password()
+                if vpn_password is None:
+                    raise exceptions.AuthenticationFailed(f'Invalid vpn_password of service "{str(service)}"')
+
+                params = inputs.AuthenticateInput(username=service.vpn_username, password=vpn_password)
+                auth = cli.authenticate(params, deadline=deadline)
+                if not auth.ok:
+                    if isinstance(auth.error, os_exceptions.ServiceTimeout):
+                        raise exceptions.ServiceTimeout(
+                            f'Authentication timed out to vpn of service "{str(service)}"')
+                    raise exceptions.AuthenticationFailed(
+                        f'Authentication failed to vpn of service "{str(service)}"')
+            except os_exceptions.AuthenticationFailed:
+                raise exceptions.AuthenticationFailed(f'Authentication failed to vpn of service "{str(service)}"')
+            except os_exceptions.ServiceTimeout:
+                raise exceptions.ServiceTimeout(f'Authentication timed out to vpn of service "{str(service)}"')
+
+            return auth
+
+        return self._get_or_authenticate(key=key, username=service.vpn_username,
+                                         password_func=service.raw_vpn_password,
+                                         authenticate=authenticate, refresh=refresh, deadline=deadline)
+
+    def _get_or_authenticate(self, key: str, username: str, password_func, authenticate, refresh: bool, deadline):
+        """
+        获取缓存的认证信息，需要时认证
+
+        :param key: 缓存键
+        :param username: 服务认证用户名，与缓存的认证信息的用户名不一致时缓存无效
+        :param password_func: 获取服务认证密码的函数，从共享缓存加载认证信息时使用
+        :param authenticate: 认证函数
+        :param refresh: True(强制刷新)
+        :param deadline: 请求截止时间，等待其他线程或进程认证的时间不超过剩余时间
+        :raises: ServiceTimeout
+        """
+        now = utc_timestamp()
+        failed_auth = None      # 已失效的认证信息
+        stale_auth = None       # 未过期，但需要主动刷新的认证信息
+        auth = self._load(key=key, username=username, password_func=password_func)
         if refresh:
-            del self[key]
+            failed_auth = auth
+        elif auth is not None:
+            if not self._need_refresh(auth, now):
+                self.stats['hits'] += 1
+                return auth
+
+            stale_auth = auth
+
+        lock = self._get_lock(key)
+        # 有未过期的认证信息时不等待其他线程刷新
+        if stale_auth is not None:
+            acquired = lock.acquire(blocking=False)
         else:
-            auth = self[key]
-            if auth:
-                expire = auth.expire
-                if now < expire:
-                    return auth
+            timeout = self.lock_timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline.remaining())
+            acquired = lock.acquire(timeout=timeout)
+
+        if not acquired:
+            if stale_auth is not None:
+                return stale_auth
+
+            self._check_deadline(deadline)
+            return authenticate()
 
-        cli = client.get_service_vpn_client(service)
         try:
-            vpn_password = service.raw_vpn_password()
-            if vpn_password is None:
-                raise exceptions.AuthenticationFailed(f'Invalid vpn_password of service "{str(service)}"')
+            # 获得锁后，认证信息可能已被其他线程或进程刷新
+            auth = self._load(key=key, username=username, password_func=password_func, old_auth=failed_auth)
+            now = utc_timestamp()
+            if self._is_new_valid_auth(auth, old_auth=failed_auth, now=now) and not self._need_refresh(auth, now):
+                self.stats['shared_hits'] += 1
+                return auth
 
-            params = inputs.AuthenticateInput(username=service.vpn_username, password=vpn_password)
-            auth = cli.authenticate(params)
-            if not auth.ok:
-                raise exceptions.AuthenticationFailed(f'Authentication failed to vpn of service "{str(service)}"')
-        except os_exceptions.AuthenticationFailed:
-            raise exceptions.AuthenticationFailed(f'Authentication failed to vpn of service "{str(service)}"')
+            lock_key = self._lock_cache_key(key)
+            if not self.cache.add(lock_key, os.getpid(), timeout=self.lock_timeout):
+                # 其他进程正在认证
+                if stale_auth is not None:
+                    return stale_auth
+
+                auth = self._wait_other_process(key=key, username=username, password_func=password_func,
+                                                old_auth=failed_auth, lock_key=lock_key, deadline=deadline)
+                if auth is not None:
+                    self.stats['wait'] += 1
+                    return auth
+
+                self._check_deadline(deadline)
+                return self._authenticate_and_save(key, authenticate)
+
+            try:
+                return self._authenticate_and_save(key, authenticate)
+            finally:
+                self.cache.delete(lock_key)
+        finally:
+            lock.release()
+
+    def _authenticate_and_save(self, key, authenticate):
+        auth = authenticate()
+        self.stats['authenticate'] += 1
+        self._save(key, auth)
+        return auth
+
+    def _wait_other_process(self, key, username, password_func, old_auth, lock_key, deadline):
+        """
+        等待其他进程的认证结果
+
+        :return:
+            AuthenticateOutput()    # 其他进程认证成功
+            None                    # 等待超时或其他进程认证失败
+        """
+        wait_until = time.monotonic() + self.lock_timeout
+        if deadline is not None:
+            wait_until = min(wait_until, time.monotonic() + deadline.remaining())
 
+        while time.monotonic() < wait_until:
+            time.sleep(self.wait_interval)
+            auth = self._load(key=key, username=username, password_func=password_func, old_auth=old_auth)
+            if self._is_new_valid_auth(auth, old_auth=old_auth, now=utc_timestamp()):
+                return auth
+
+            if self.cache.get(lock_key) is None:    # 其他进程认证结束，但未得到有效的认证信息
+                break
+
+        return None
+
+    @staticmethod
+    def _check_deadline(deadline):
+        """
+        :raises: ServiceTimeout
+        """
+        if deadline is not None and deadline.expired:
+            raise exceptions.ServiceTimeout('Timed out waiting for service authentication')
+
+    def _need_refresh(self, auth, now: float):
+        return now >= (auth.expire - self.refresh_ahead)
+
+    @staticmethod
+    def _is_new_valid_auth(auth, old_auth, now: float):
+        if auth is None or now >= auth.expire:
+            return False
+
+        if old_auth is not None and auth.token == old_auth.token:
+            return False
+
+        return True
+
+    def _get_lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+
+        return lock
+
+    def _load(self, key: str, username: str, password_func, old_auth=None):
+        """
+        从进程内缓存或共享缓存加载认证信息
+
+        :param old_auth: 已失效的认证信息，忽略与之相同的token
+        :return:
+            AuthenticateOutput()    # 未过期的认证信息
+            None
+        """
+        now = utc_timestamp()
+        old_token = old_auth.token if old_auth is not None else None
+        auth = self[key]
+        if auth is not None and auth.username == username and now < auth.expire and auth.token != old_token:
+            return auth
+
+        data = self._load_shared_data(key)
+        if not data or data.get('username') != username or now >= data.get('expire', 0):
+            return None
+
+        if data.get('token') == old_token:
+            return None
+
+        auth = self.data_to_auth(data, password=password_func())
         self[key] = auth
         return auth
 
+    def _load_shared_data(self, key):
+        try:
+            return self.cache.get(self._shared_cache_key(key))
+        except Exception:
+            return None
+
+    def _save(self, key: str, auth):
+        self[key] = auth
+        data = self.auth_to_data(auth)
+        if data is None:
+            return
+
+        timeout = int(auth.expire - utc_timestamp())
+        if timeout <= 0:
+            return
+
+        try:
+            self.cache.set(self._shared_cache_key(key), data, timeout=timeout)
+        except Exception:
+            pass
+
+    @staticmethod
+    def auth_to_data(auth):
+        """
+        可跨进程共享的认证信息转为字典，不包括密码
+
+        :return:
+            dict
+            None    # 认证信息包含连接对象等不能共享的数据
+        """
+        if auth.kwargs.get('vmconnect', None) is not None:
+            return None
+
+        header = tuple(auth.header) if auth.header else None
+        query = tuple(auth.query) if auth.query else None
+        return {
+            'style': auth.style, 'token': auth.token, 'expire': auth.expire,
+            'header': header, 'query': query, 'username': auth.username
+        }
+
+    @staticmethod
+    def data_to_auth(data: dict, password: str):
+        header = outputs.AuthenticateOutputHeader(*data['header']) if data.get('header') else None
+        query = outputs.AuthenticateOutputQuery(*data['query']) if data.get('query') else None
+        return outputs.AuthenticateOutput(
+            style=data['style'], token=data['token'], expire=data['expire'], header=header, query=query,
+            username=data['username'], password=password)
+
     def auth_to_cache(self, service, auth):
         key = self.get_service_key(service)
-        self[key] = auth
+        self._save(key, auth)
 
     def auth_from_cache(self, service):
         key = self.get_service_key(service)
         return self[key]
 
     def auth_delete_from_cache(self, service):
-        delattr(self._auths, service.id)
+        key = self.get_service_key(service)
+        del self[key]
+        try:
+            self.cache.delete(self._shared_cache_key(key))
+        except Exception:
+            pass
+
+    def _shared_cache_key(self, key):
+        return f'{self.cache_key_prefix}{key}'
+
+    def _lock_cache_key(self, key):
+        return f'{self.cache_key_prefix}lock_{key}'
 
     @staticmethod
     def get_service_key(service):
@@ -0,0 +1,252 @@
+"""
+服务熔断器
+
+每个服务一个熔断器，closed(关闭) -> open(打开) -> half-open(半开) -> closed；
+进程内统计最近时间窗口内请求的失败率和慢请求率，超过阈值时打开熔断器，
+打开状态保存在跨进程共享的缓存(django cache)中，所有进程的请求都立即失败；
+打开一段时间后进入半开状态，所有进程中只允许一个探测请求(共享缓存的add()，须是原子的，见settings.CACHES['shared'])，
+探测成功关闭熔断器，失败重新打开
+"""
+import os
+import time
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from . import errors as exceptions
+
+
+DEFAULT_CIRCUIT_BREAKER = {
+    'ENABLE': True,
+    'WINDOW': 60,                   # 统计时间窗口，单位秒
+    'MIN_CALLS': 10,                # 时间窗口内请求数不少于此值才计算失败率
+    'FAILURE_RATE': 0.5,            # 失败率阈值
+    'SLOW_CALL_SECONDS': 10,        # 请求耗时超过此值为慢请求
+    'SLOW_CALL_RATE': 0.8,          # 慢请求率阈值
+    'OPEN_SECONDS': 30,             # 打开多少秒后进入半开状态
+    'SYNC_INTERVAL': 1,             # 读取共享状态的最小间隔，单位秒
+}
+
+
+class CircuitBreaker:
+    """
+    一个服务的熔断器，线程安全
+    """
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half-open'
+
+    cache_alias = 'shared'      # 跨进程共享缓存的django cache配置名称，不存在时使用default
+    cache_key_prefix = 'gosc_breaker_'
+
+    def __init__(self, service_id: str, config: dict = None):
+        self.service_id = str(service_id)
+        c = dict(DEFAULT_CIRCUIT_BREAKER)
+        c.update(config or {})
+        self.window = c['WINDOW']
+        self.min_calls = c['MIN_CALLS']
+        self.failure_rate = c['FAILURE_RATE']
+        self.slow_call_seconds = c['SLOW_CALL_SECONDS']
+        self.slow_call_rate = c['SLOW_CALL_RATE']
+        self.open_seconds = c['OPEN_SECONDS']
+        self.sync_interval = c['SYNC_INTERVAL']
+        self._calls = deque()       # (time, failed, slow)
+        self._lock = threading.Lock()
+        self._shared_state = None
+        self._synced_time = 0
+        self.stats = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+
+    @property
+    def cache(self):
+        try:
+            return caches[self.cache_alias]
+        except InvalidCacheBackendError:
+            return caches['default']
+
+    @property
+    def state_key(self):
+        return f'{self.cache_key_prefix}{self.service_id}'
+
+    @property
+    def probe_key(self):
+        return f'{self.cache_key_prefix}probe_{self.service_id}'
+
+    def _get_shared_state(self, force: bool = False):
+        now = time.monotonic()
+        if force or (now - self._synced_time) >= self.sync_interval:
+            try:
+                self._shared_state = self.cache.get(self.state_key)
+            except Exception:
+                self._shared_state = None
+            self._synced_time = now
+
+        return self._shared_state
+
+    def get_state(self):
+        """
+        :return:
+            {
+                'state': 'closed',      # closed, open, half-open
+                'opened_at': None,      # 打开时间戳
+                'until': None,          # 打开状态持续到，之后进入半开状态
+                'reason': ''
+            }
+        """
+        shared = self._get_shared_state(force=True)
+        if not shared:
+            return {'state': self.STATE_CLOSED, 'opened_at': None, 'until': None, 'reason': ''}
+
+        state = self.STATE_OPEN if time.time() < shared['until'] else self.STATE_HALF_OPEN
+        return dict(shared, state=state)
+
+    def allow(self):
+        """
+        检查是否允许请求
+
+        :return:
+            False       # 允许，普通请求
+            True        # 允许，半开状态的探测请求
+        :raises: ServiceUnavailable
+        """
+        shared = self._get_shared_state()
+        if not shared:
+            return False
+
+        if time.time() < shared['until']:
+            self.stats['rejected'] += 1
+            raise exceptions.ServiceUnavailable(extend_msg=shared.get('reason', ''))
+
+        # 半开，所有进程中只有一个探测请求；共享缓存的add()不是原子的(如django的FileBasedCache)时可能有多个
+        try:
+            acquired = self.cache.add(self.probe_key, os.getpid(), timeout=max(int(self.slow_call_seconds), 1) * 3)
+        except Exception:
+            acquired = False
+
+        if not acquired:
+            self.stats['rejected'] += 1
+            raise exceptions.ServiceUnavailable(extend_msg=shared.get('reason', ''))
+
+        return True
+
+    def call(self, func, probe: bool = False):
+        """
+        执行请求并记录结果
+
+        :param func: 请求函数，抛出Error表示请求失败
+        :param probe: 是否是半开状态的探测请求
+        :raises: func()抛出的错误
+        """
+        start = time.monotonic()
+        try:
+            ret = func()
+        except exceptions.Error as exc:
+            failed = self.is_failure(exc)
+            self.record(failed=failed, elapsed=time.monotonic() - start, probe=probe, reason=str(exc))
+            raise
+
+        self.record(failed=False, elapsed=time.monotonic() - start, probe=probe)
+        return ret
+
+    @staticmethod
+    def is_failure(exc):
+        """
+        服务端错误和超时计为失败，资源不存在、参数错误等不计
+        """
+        return getattr(exc, 'status_code', 500) >= 500
+
+    def record(self, failed: bool, elapsed: float, probe: bool = False, reason: str = ''):
+        slow = elapsed >= self.slow_call_seconds
+        self.stats['calls'] += 1
+        if failed:
+            self.stats['failures'] += 1
+        if slow:
+            self.stats['slow_calls'] += 1
+
+        if probe:
+            if failed or slow:
+                self.open(reason=f'probe failed, {reason}' if failed else 'probe slow')
+            else:
+                self.close()
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, failed, slow))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+
+            failures = sum(1 for c in self._calls if c[1])
+            slows = sum(1 for c in self._calls if c[2])
+
+        if failures / total >= self.failure_rate:
+            self.open(reason=f'failure rate {failures}/{total}, {reason}')
+        elif slows / total >= self.slow_call_rate:
+            self.open(reason=f'slow call rate {slows}/{total}')
+
+    def open(self, reason: str = ''):
+        now = time.time()
+        state = {'opened_at': now, 'until': now + self.open_seconds, 'reason': reason}
+        try:
+            self.cache.set(self.state_key, state, timeout=None)
+            self.cache.delete(self.probe_key)
+        except Exception:
+            pass
+
+        with self._lock:
+            self._calls.clear()
+
+        self._shared_state = state
+        self._synced_time = time.monotonic()
+        self.stats['opened'] += 1
+
+    def close(self):
+        try:
+            self.cache.delete(self.state_key)
+            self.cache.delete(self.probe_key)
+        except Exception:
+            pass
+
+        with self._lock:
+            self._calls.clear()
+
+        self._shared_state = None
+        self._synced_time = time.monotonic()
+
+
+class CircuitBreakerRegistry:
+    """
+    进程内每个服务的熔断器
+    """
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_config():
+        return getattr(settings, 'CIRCUIT_BREAKER', DEFAULT_CIRCUIT_BREAKER)
+
+    @property
+    def enabled(self):
+        return self.get_config().get('ENABLE', True)
+
+    def get(self, service_id) -> CircuitBreaker:
+        service_id = str(service_id)
+        breaker = self._breakers.get(service_id)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(service_id)
+                if breaker is None:
+                    breaker = CircuitBreaker(service_id, config=self.get_config())
+                    self._breakers[service_id] = breaker
+
+        return breaker
+
+
+breakers = CircuitBreakerRegistry()
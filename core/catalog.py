@@ -0,0 +1,227 @@
+"""
+服务目录数据(镜像、网络等)缓存
+
+适配器只读方法的结果按方法设置缓存时间，缓存过期后的一段时间内(stale)先返回旧数据，同时后台刷新；
+缓存数据是序列化后的紧凑json，进程内按LRU淘汰；按服务失效通过共享缓存的服务版本号在进程间同步
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.utils.dateparse import parse_datetime
+
+from adapters import outputs
+
+
+DEFAULT_CATALOG_CACHE = {
+    'TTL': {
+        'list_images': 300,
+        'list_networks': 300,
+        'network_detail': 300,
+    },
+    'STALE_TTL': 600,
+    'MAX_ENTRIES': 1024,
+}
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return {'__dt__': obj.isoformat()}
+
+    return str(obj)
+
+
+def _json_object_hook(obj):
+    if '__dt__' in obj and len(obj) == 1:
+        return parse_datetime(obj['__dt__'])
+
+    return obj
+
+
+def dumps_output(method: str, output) -> bytes:
+    """
+    适配器输出对象序列化为紧凑的json
+    """
+    if method == 'list_images':
+        data = {'images': [vars(i) for i in output.images]}
+    elif method == 'list_networks':
+        data = {'networks': [vars(n) for n in output.networks]}
+    elif method == 'network_detail':
+        data = {'network': vars(output.network) if output.network is not None else None}
+    else:
+        raise ValueError(f'method "{method}" can not be cached')
+
+    return json.dumps(data, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+
+def loads_output(method: str, value: bytes):
+    """
+    json还原为适配器输出对象
+    """
+    data = json.loads(value.decode('utf-8'), object_hook=_json_object_hook)
+    if method == 'list_images':
+        return outputs.ListImageOutput(images=[outputs.ListImageOutputImage(**i) for i in data['images']])
+    elif method == 'list_networks':
+        return outputs.ListNetworkOutput(networks=[outputs.ListNetworkOutputNetwork(**n) for n in data['networks']])
+    elif method == 'network_detail':
+        network = outputs.NetworkDetail(**data['network']) if data['network'] is not None else None
+        return outputs.NetworkDetailOutput(network=network)
+
+    raise ValueError(f'method "{method}" can not be cached')
+
+
+class CatalogEntry:
+    def __init__(self, value: bytes, generation: int, created_time: float):
+        self.value = value
+        self.generation = generation
+        self.created_time = created_time
+
+
+class CatalogCache:
+    """
+    服务目录数据缓存，线程安全
+    """
+    cache_alias = 'shared'      # 保存服务版本号的跨进程共享缓存，不存在时使用default
+    generation_key_prefix = 'gosc_catalog_gen_'
+
+    def __init__(self, ttls: dict = None, stale_ttl: int = None, max_entries: int = None):
+        """
+        :param ttls: 每个方法的缓存时间，{method: seconds}，单位秒
+        :param stale_ttl: 缓存过期后多少秒内仍可返回旧数据并后台刷新
+        :param max_entries: 进程内最多缓存条目数
+        """
+        config = getattr(settings, 'CATALOG_CACHE', {})
+        self.ttls = ttls if ttls is not None else config.get('TTL', DEFAULT_CATALOG_CACHE['TTL'])
+        self.stale_ttl = stale_ttl if stale_ttl is not None else config.get(
+            'STALE_TTL', DEFAULT_CATALOG_CACHE['STALE_TTL'])
+        self.max_entries = max_entries if max_entries is not None else config.get(
+            'MAX_ENTRIES', DEFAULT_CATALOG_CACHE['MAX_ENTRIES'])
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @property
+    def cache(self):
+        try:
+            return caches[self.cache_alias]
+        except InvalidCacheBackendError:
+            return caches['default']
+
+    def is_cacheable(self, method: str):
+        return bool(self.ttls.get(method))
+
+    @staticmethod
+    def build_key(service, method: str, params):
+        params = json.dumps(vars(params) if params is not None else None, sort_keys=True, default=str)
+        return str(service.id), method, params
+
+    def get_generation(self, service_id: str) -> int:
+        try:
+            return self.cache.get(f'{self.generation_key_prefix}{service_id}', 0)
+        except Exception:
+            return 0
+
+    def get_or_fetch(self, service, method: str, params, fetch):
+        """
+        获取缓存的数据，没有缓存时请求后端
+
+        :param fetch: 请求后端的函数，fetch(background: bool)，返回适配器输出对象
+        :return:
+            适配器输出对象
+        :raises: fetch()抛出的错误
+        """
+        key = self.build_key(service, method=method, params=params)
+        generation = self.get_generation(key[0])
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.generation != generation:    # 已失效
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        ttl = self.ttls[method]
+        if entry is not None:
+            age = now - entry.created_time
+            if age < ttl:
+                self.stats['hits'] += 1
+                return loads_output(method, entry.value)
+
+            if age < ttl + self.stale_ttl:
+                self.stats['stale_hits'] += 1
+                self._refresh_in_background(key, method=method, generation=generation, fetch=fetch)
+                return loads_output(method, entry.value)
+
+        self.stats['misses'] += 1
+        output = fetch(background=False)
+        self._set(key, method=method, output=output, generation=generation)
+        return output
+
+    def _set(self, key, method: str, output, generation: int):
+        if not getattr(output, 'ok', False):
+            return
+
+        entry = CatalogEntry(dumps_output(method, output), generation=generation, created_time=time.monotonic())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def _refresh_in_background(self, key, method: str, generation: int, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                output = fetch(background=True)
+                self._set(key, method=method, output=output, generation=generation)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def invalidate(self, service_id: str):
+        """
+        服务的缓存全部失效，所有进程
+        """
+        service_id = str(service_id)
+        gen_key = f'{self.generation_key_prefix}{service_id}'
+        try:
+            if not self.cache.add(gen_key, 1, timeout=None):
+                self.cache.incr(gen_key)
+        except Exception:
+            pass
+
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == service_id]:
+                del self._entries[key]
+
+        self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            size = len(self._entries)
+            nbytes = sum(len(e.value) for e in self._entries.values())
+
+        return dict(self.stats, entries=size, bytes=nbytes)
+
+
+catalog_cache = CatalogCache()
@@ -185,6 +185,18 @@ class MethodNotSupportInService(APIException):
     default_status_code = 405
 
 
+class ServiceTimeout(APIException):
+    default_message = 'The request to the service timed out.'
+    default_code = 'ServiceTimeout'
+    default_status_code = 504
+
+
+class ServiceUnavailable(APIException):
+    default_message = 'The service is temporarily unavailable, please try again later.'
+    default_code = 'ServiceUnavailable'
+    default_status_code = 503
+
+
 class ConflictError(APIException):
     default_message = '由于和被请求的资源的当前状态之间存在冲突，请求无法完成'
     default_code = 'Conflict'
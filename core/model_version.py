@@ -0,0 +1,144 @@
+"""
+模型数据版本号
+
+注册(track)的每个模型(数据库表)一个版本号，保存在跨进程共享缓存中，模型实例保存、删除或多对多关系修改时
+(post_save、post_delete、m2m_changed信号)在事务提交后更新版本号；用于使依赖模型数据的缓存(如分页总数、ETag)失效。
+版本号每次更新为一个新的随机值，不依赖缓存incr的原子性，并发更新不会丢失。
+QuerySet.update()、bulk_create()等不发送信号，须调用model_version.bump()；
+连接删除信号后模型不再快速删除，QuerySet.delete()和级联删除逐个对象发送post_delete，同一事务中一个表只更新一次版本号
+"""
+import uuid
+import threading
+from functools import lru_cache
+
+from django.apps import apps
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+
+@lru_cache(maxsize=None)
+def get_all_tables() -> tuple:
+    """
+    所有模型(包括多对多关系中间模型)的表名
+    """
+    return tuple({m._meta.db_table for m in apps.get_models(include_auto_created=True)})
+
+
+class ModelVersion:
+    """
+    模型数据版本号，按数据库表名
+    """
+    cache_alias = 'shared'      # 保存版本号的跨进程共享缓存，不存在时使用default
+    key_prefix = 'gosc_model_ver_'
+
+    def __init__(self):
+        self._tracked = set()
+        self._local = threading.local()     # 每个线程(数据库连接)当前事务待更新的版本号
+
+    @property
+    def cache(self):
+        try:
+            return caches[self.cache_alias]
+        except InvalidCacheBackendError:
+            return caches['default']
+
+    def track(self, *models):
+        """
+        注册模型，连接信号维护版本号，包括模型的多对多关系中间模型
+        """
+        for model in models:
+            label = model._meta.label_lower
+            self._tracked.add(model._meta.db_table)
+            post_save.connect(bump_model_version, sender=model, dispatch_uid=f'model_version_save_{label}')
+            post_delete.connect(bump_model_version, sender=model, dispatch_uid=f'model_version_delete_{label}')
+
+            for field in model._meta.many_to_many:
+                through = field.remote_field.through
+                self._tracked.add(through._meta.db_table)
+                m2m_changed.connect(bump_model_version, sender=through,
+                                    dispatch_uid=f'model_version_m2m_{through._meta.label_lower}')
+
+    def is_tracked(self, tables) -> bool:
+        """
+        表是否都有版本号
+        """
+        return all(t in self._tracked for t in tables)
+
+    @staticmethod
+    def get_queryset_tables(queryset, sql: str = None) -> list:
+        """
+        查询涉及的表，包括关联查询和子查询的表
+
+        :param sql: 查询的sql，默认编译queryset
+        """
+        if sql is None:
+            sql = str(queryset.query)
+
+        quote_name = connections[queryset.db].ops.quote_name
+        tables = {queryset.model._meta.db_table}
+        tables.update(t for t in get_all_tables() if quote_name(t) in sql)
+        return sorted(tables)
+
+    def get(self, table: str):
+        try:
+            return self.cache.get(f'{self.key_prefix}{table}', 0)
+        except Exception:
+            return 0
+
+    def get_many(self, tables: list) -> dict:
+        """
+        :return:
+            {table: version}
+        """
+        try:
+            values = self.cache.get_many([f'{self.key_prefix}{t}' for t in tables])
+        except Exception:
+            values = {}
+
+        return {t: values.get(f'{self.key_prefix}{t}', 0) for t in tables}
+
+    def bump(self, table: str, using: str = None):
+        """
+        当前事务提交后更新版本号，不在事务中时立即更新；事务回滚时不更新；
+        同一事务中多次更新(如批量删除时每个对象的post_delete)在提交后只写一次缓存
+
+        :param using: 数据库别名，默认default
+        """
+        pending = self._local.__dict__.setdefault('pending', {})
+        key = (using or DEFAULT_DB_ALIAS, table)
+        marker = pending.get(key)
+        if marker is None or marker['done']:
+            marker = {'done': False}
+            pending[key] = marker
+
+        def set_new_version():
+            # 一个事务提交后的回调中，同一marker只有第一个更新
+            if marker['done']:
+                return
+
+            marker['done'] = True
+            self._set_new_version(table)
+
+        transaction.on_commit(set_new_version, using=using)
+
+    def _set_new_version(self, table: str):
+        try:
+            self.cache.set(f'{self.key_prefix}{table}', uuid.uuid4().hex, timeout=None)
+        except Exception:
+            pass
+
+
+model_version = ModelVersion()
+
+
+def bump_model_version(sender, **kwargs):
+    """
+    post_save、post_delete、m2m_changed信号处理；
+    m2m_changed的sender是多对多关系的中间模型
+    """
+    if kwargs.get('action', 'post_').startswith('pre_'):
+        return
+
+    model_version.bump(sender._meta.db_table, using=kwargs.get('using'))
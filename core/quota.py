@@ -1,9 +1,24 @@
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
-from service.managers import UserQuotaManager, ServicePrivateQuotaManager
+from service.managers import (
+    UserQuotaManager, ServicePrivateQuotaManager, QuotaReservationManager, conditional_deduct, DEDUCT_RETRIES
+)
 from . import errors
 
 
+logger = logging.getLogger('gosc.quota')
+
+
+class _ReserveFailed(Exception):
+    """条件更新未扣除，回滚事务"""
+    pass
+
+
 class QuotaAPI:
     @staticmethod
     def server_create_quota_apply(service, user, vcpu: int, ram: int, public_ip: bool,
@@ -29,34 +44,167 @@ class QuotaAPI:
             raise errors.QuotaError.from_error(
                 errors.BadRequestError('必须指定一个用户资源配额'))
 
-        # 资源配额满足要求，扣除数据中心资源或用户资源
+        # 用户是否有使用权限
+        try:
+            user_quota = UserQuotaManager().get_user_manage_perm_quota(user_quota_id, user=user)
+        except errors.Error as e:
+            raise errors.QuotaError.from_error(e)
+
+        # 一个事务中扣除服务私有资源配额和用户配额
+        QuotaAPI.server_quota_reserve(service=service, user_quota=user_quota, vcpu=vcpu, ram=ram,
+                                      public_ip=public_ip)
+        return user_quota
+
+    @staticmethod
+    def server_create_quota_lease(service, user, vcpu: int, ram: int, public_ip: bool,
+                                  user_quota_id: str = None, ttl: int = None):
+        """
+        检测资源配额是否满足，扣除并创建有有效期的预留记录；
+        服务器创建成功后需要调用server_quota_confirm确认，失败时调用server_quota_cancel释放，
+        超过有效期未确认的预留由回收任务释放
+
+        :param ttl: 预留有效期(秒)，默认settings.QUOTA_RESERVATION['TTL']
+        :return:
+            (
+                user_quota,         # 用户配额对象
+                reservation         # 预留记录对象
+            )
+
+        :raises: QuotaShortageError, QuotaError
+        """
+        if not user_quota_id:
+            raise errors.QuotaError.from_error(
+                errors.BadRequestError('必须指定一个用户资源配额'))
+
+        try:
+            user_quota = UserQuotaManager().get_user_manage_perm_quota(user_quota_id, user=user)
+        except errors.Error as e:
+            raise errors.QuotaError.from_error(e)
+
+        reservation = QuotaAPI.server_quota_reserve(service=service, user_quota=user_quota, vcpu=vcpu, ram=ram,
+                                                    public_ip=public_ip, lease=True, ttl=ttl)
+        return user_quota, reservation
+
+    @staticmethod
+    def server_quota_confirm(reservation, server):
+        """
+        服务器创建成功，确认预留的资源配额；预留已过期被回收时重新扣除(资源已创建，配额不足也不报错)；
+        重新扣除失败时记录日志，并在回收的预留记录上记录云服务器id，已用数的偏差由reconcile_quotas按实际用量修正
+
+        :return:
+            True
+            False   # 预留已被回收，重新扣除失败
+        """
+        r_mgr = QuotaReservationManager()
+        if r_mgr.confirm(reservation, server_id=server.id):
+            return True
+
+        error = None
+        if server.user_quota is None:
+            error = 'no user quota'
+        else:
+            try:
+                QuotaAPI.server_quota_reserve(service=server.service, user_quota=server.user_quota,
+                                              vcpu=server.vcpus, ram=server.ram, public_ip=server.public_ip)
+            except errors.Error as e:
+                error = str(e)
+
+        if error is None:
+            return True
+
+        logger.warning(f'quota reservation {reservation.id} was reaped and server {server.id} '
+                       f'could not be charged again ({error}), run reconcile_quotas to correct quota usage')
+        try:
+            r_mgr.MODEL.objects.filter(id=reservation.id, server_id='').update(server_id=server.id)
+        except Exception as e:
+            pass
+
+        return False
+
+    @staticmethod
+    def server_quota_cancel(reservation):
+        """
+        服务器创建失败，释放预留的资源配额
+
+        :return:
+            True
+            False   # 预留已被回收
+        """
+        return QuotaReservationManager().release(reservation)
+
+    @staticmethod
+    def server_quota_reserve(service, user_quota, vcpu: int, ram: int, public_ip: bool,
+                             lease: bool = False, ttl: int = None):
+        """
+        在一个事务中用条件UPDATE扣除服务私有资源配额和用户配额，任一不足时整个事务回滚，不需要补偿释放；
+        总是先服务配额后用户配额的顺序更新，并发时不会死锁。
+        服务配额分片计数模式下，服务配额的扣除须先提交(并发的扣除才可见)，在事务之前扣除，事务失败时补偿释放
+
+        :param service: 接入服务
+        :param user_quota: 用户配额对象，调用者已检查使用权限
+        :param vcpu: vCPU数
+        :param ram: 内存大小, 单位Mb
+        :param public_ip: True(公网IP); False(私网IP)
+        :param lease: True(同一事务中创建预留记录)
+        :param ttl: 预留有效期(秒)
+        :return:
+            QuotaReservation()  # lease=True
+            None
+
+        :raises: QuotaShortageError, QuotaError
+        """
         if public_ip:
-            kwargs = {'public_ip': 1}
+            kwargs = {'vcpus': vcpu, 'ram': ram, 'public_ip': 1}
         else:
-            kwargs = {'private_ip': 1}
+            kwargs = {'vcpus': vcpu, 'ram': ram, 'private_ip': 1}
 
-        # 资源配额是否满足需求，用户是否有使用权限
         u_mgr = UserQuotaManager()
-        user_quota = QuotaAPI.get_perm_meet_quota(user=user, vcpu=vcpu, ram=ram, public_ip=public_ip,
-                                                  user_quota_id=user_quota_id)
-
-        # 数据中心私有资源配额是否满足需求
         pri_mgr = ServicePrivateQuotaManager()
-        pri_service_quota = pri_mgr.get_quota(service=service)
-        if public_ip is True:
-            pri_mgr.requires(pri_service_quota, vcpus=vcpu, ram=ram, public_ip=1)
-        else:
-            pri_mgr.requires(pri_service_quota, vcpus=vcpu, ram=ram, private_ip=1)
+        for _i in range(DEDUCT_RETRIES):
+            service_deducted = False
+            try:
+                if pri_mgr.sharded:
+                    if not pri_mgr.try_deduct(service, **kwargs):
+                        raise _ReserveFailed()
+                    service_deducted = True
 
-        # 扣除服务私有资源配额和用户配额
-        pri_mgr.deduct(service=service, vcpus=vcpu, ram=ram, **kwargs)
-        try:
-            u_mgr.deduct(user=user, quota_id=user_quota.id, vcpus=vcpu, ram=ram, **kwargs)
-        except errors.QuotaError as e:
-            pri_mgr.release(service=service, vcpus=vcpu, ram=ram, **kwargs)
-            raise e
+                with transaction.atomic():
+                    if not pri_mgr.sharded and not pri_mgr.try_deduct(service, **kwargs):
+                        raise _ReserveFailed()
 
-        return user_quota
+                    now = timezone.now()
+                    user_qs = u_mgr.MODEL.objects.filter(id=user_quota.id).filter(
+                        Q(expiration_time__isnull=True) | Q(expiration_time__gt=now))
+                    if not conditional_deduct(user_qs, **kwargs):
+                        raise _ReserveFailed()
+
+                    reservation = None
+                    if lease:
+                        reservation = QuotaReservationManager().create(
+                            service=service, user_quota=user_quota, ttl=ttl, **kwargs)
+            except _ReserveFailed:
+                if service_deducted:
+                    pri_mgr.release_used(service, **kwargs)
+            except Exception as e:
+                if service_deducted:
+                    pri_mgr.release_used(service, **kwargs)
+                raise errors.QuotaError(message=_('扣除资源配额失败'))
+            else:
+                return reservation
+
+            # 查明不足的资源；都满足时是服务配额不存在(get_quota创建)或并发修改了配额，重试
+            quota = u_mgr.MODEL.objects.filter(id=user_quota.id).first()
+            if not quota:
+                raise errors.NoSuchQuotaError(_('参数无效，用户没有指定的资源配额'))
+
+            u_mgr.requires(quota, **kwargs)
+            pri_quota = pri_mgr.get_quota(service=service)
+            if not pri_quota:
+                raise errors.QuotaError(message=_('创建资源配额失败'))
+
+            pri_mgr.requires(pri_quota, **kwargs)
+
+        raise errors.QuotaError(message=_('扣除资源配额失败'))
 
     @staticmethod
     def server_quota_release(service, vcpu: int, ram: int, public_ip: bool,
@@ -88,6 +236,40 @@ class QuotaAPI:
 
         ServicePrivateQuotaManager().release(service=service, vcpus=vcpu, ram=ram, **kwargs)
 
+    @staticmethod
+    def servers_quota_release(servers: list):
+        """
+        批量释放多个服务器占用的服务提供者的私有资源配额，每个服务只更新一次配额
+
+        :param servers: 服务器对象列表
+        :return:
+            int     # 释放失败的服务数
+        """
+        stats = {}
+        for server in servers:
+            if not server.service_id:
+                continue
+
+            s = stats.setdefault(server.service_id, {'service': server.service, 'vcpus': 0, 'ram': 0,
+                                                     'public_ip': 0, 'private_ip': 0})
+            s['vcpus'] += server.vcpus
+            s['ram'] += server.ram
+            if server.public_ip:
+                s['public_ip'] += 1
+            else:
+                s['private_ip'] += 1
+
+        failed = 0
+        mgr = ServicePrivateQuotaManager()
+        for s in stats.values():
+            service = s.pop('service')
+            try:
+                mgr.release(service=service, **s)
+            except errors.Error as e:
+                failed += 1
+
+        return failed
+
     @staticmethod
     def get_perm_meet_quota(user, vcpu: int, ram: int, public_ip: bool, user_quota_id: str):
         """
@@ -1,48 +1,232 @@
-from adapters import exceptions as apt_exceptions, client as clients
+import json
+import threading
+from functools import partial
+
+from adapters import exceptions as apt_exceptions
+from adapters.registry import adapter_registry
 from adapters import inputs, outputs
+from adapters.deadline import Deadline
 from .auth import auth_handler
+from .catalog import catalog_cache
+from .breaker import breakers
 from . import errors as exceptions
 
 
-def request_service(service, method: str, raise_exception=True, **kwargs):
+def adapter_error_to_exception(error, prefix: str = ''):
+    """
+    适配器输出的错误转换为API错误
+
+    保留适配器错误的类别，资源不存在为404，其他后端4xx(参数错误等)为400，不计入熔断器的失败；
+    后端认证失败(401、403)和其他错误为500
+
+    :param error: 适配器输出对象的error
+    :param prefix: 错误信息前缀
+    :return:
+        APIException
+    """
+    if isinstance(error, apt_exceptions.ServiceTimeout):
+        return exceptions.ServiceTimeout(message=error.message)
+
+    message = prefix + error.message
+    if isinstance(error, apt_exceptions.ServerNotExist):
+        return exceptions.ServerNotExist(message=message)
+
+    status_code = getattr(error, 'status_code', 500)
+    if status_code == 404:
+        return exceptions.NotFound(message=message)
+
+    if 400 <= status_code < 500 and status_code not in (401, 403):
+        return exceptions.BadRequest(message=message)
+
+    return exceptions.APIException(message=message)
+
+
+class SingleFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求，同一时间相同键的请求只执行一次，其他调用者等待并共享结果或错误
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, func, deadline: Deadline = None):
+        """
+        :param key: 请求键
+        :param func: 执行请求的函数
+        :param deadline: 等待其他调用者结果的截止时间
+        :return:
+            func()的返回值
+        :raises: func()抛出的错误，ServiceTimeout
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = SingleFlightCall()
+                self._calls[key] = call
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if not leader:
+            timeout = deadline.remaining() if deadline is not None else None
+            if not call.event.wait(timeout):
+                raise exceptions.ServiceTimeout()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+        return call.result
+
+    def get_stats(self):
+        """
+        :return:
+            {
+                'calls': 0,         # 实际执行的请求数
+                'shared': 0,        # 共享其他请求结果的请求数
+                'hit_rate': 0.0     # shared / (calls + shared)
+            }
+        """
+        calls = self.stats['calls']
+        shared = self.stats['shared']
+        total = calls + shared
+        return {'calls': calls, 'shared': shared, 'hit_rate': shared / total if total else 0.0}
+
+
+# 只读的适配器方法，相同参数的并发请求合并为一次后端请求
+SINGLE_FLIGHT_METHODS = (
+    'list_images', 'list_networks', 'network_detail', 'server_status', 'server_status_batch', 'server_detail'
+)
+
+single_flight = SingleFlight()
+
+
+def single_flight_key(service, method: str, kwargs: dict):
+    """
+    (服务, 方法, 规范化的参数)
+    """
+    params = {}
+    for k, v in kwargs.items():
+        if k == 'deadline':
+            continue
+        params[k] = vars(v) if hasattr(v, '__dict__') else v
+
+    return service.id, method, json.dumps(params, sort_keys=True, default=str)
+
+
+def request_service(service, method: str, raise_exception=True, deadline: Deadline = None, **kwargs):
     """
     向服务发送请求
 
+    * 目录数据方法(镜像、网络等)的结果缓存，见catalog_cache；
+    * 服务的熔断器打开时立即失败，见breakers；
+    * 只读方法(SINGLE_FLIGHT_METHODS)的相同并发请求合并为一次。
+
     :param service: 接入的服务配置对象
     :param method:
     :param raise_exception: 请求失败是否抛出错误，默认True抛出错误，False返回None
+    :param deadline: 请求截止时间，重试和认证只使用剩余的时间；默认None，只使用适配器的超时时间
     :param kwargs:
     :return:
 
-    :raises: APIException
+    :raises: APIException, ServiceTimeout, ServiceUnavailable
     """
     try:
-        auth_obj = auth_handler.get_auth(service)
+        if catalog_cache.is_cacheable(method):
+            def fetch(background: bool):
+                # 后台刷新不受当前请求截止时间限制
+                return _coalesced_request(service, method=method, deadline=None if background else deadline, **kwargs)
+
+            return catalog_cache.get_or_fetch(service, method=method, params=kwargs.get('params'), fetch=fetch)
+
+        return _coalesced_request(service, method=method, deadline=deadline, **kwargs)
+    except exceptions.Error as exc:
+        if raise_exception:
+            raise exc
+
+        return None
+
+
+def _coalesced_request(service, method: str, deadline: Deadline = None, **kwargs):
+    """
+    :raises: APIException, ServiceTimeout, ServiceUnavailable
+    """
+    def call():
+        return _request_service(service, method=method, raise_exception=True, deadline=deadline, **kwargs)
+
+    if breakers.enabled:
+        breaker = breakers.get(service.id)
+        if breaker.allow():     # 半开状态的探测请求，不与其他请求合并
+            return breaker.call(call, probe=True)
+
+        func = partial(breaker.call, call)
+    else:
+        func = call
+
+    if method not in SINGLE_FLIGHT_METHODS:
+        return func()
+
+    key = single_flight_key(service, method=method, kwargs=kwargs)
+    return single_flight.do(key, func=func, deadline=deadline)
+
+
+def _request_service(service, method: str, raise_exception=True, deadline: Deadline = None, **kwargs):
+    try:
+        auth_obj = auth_handler.get_auth(service, deadline=deadline)
     except apt_exceptions.AuthenticationFailed as exc:
         if raise_exception:
             raise exceptions.APIException(message='adapter authentication failed', extend_msg=exc.message)
         return None
+    except exceptions.ServiceTimeout as exc:
+        if raise_exception:
+            raise exc
+        return None
 
     raise_exc = exceptions.APIException()
     for _ in range(2):
-        cli = clients.get_service_client(service, auth=auth_obj)
-        handler = getattr(cli, method)
+        if deadline is not None and deadline.expired:
+            raise_exc = exceptions.ServiceTimeout()
+            break
+
         try:
-            r = handler(**kwargs)
+            handler = adapter_registry.get_method(service, method=method, auth=auth_obj)
+            r = handler(deadline=deadline, **kwargs)
             if hasattr(r, 'ok'):
                 if r.ok:
                     return r
 
-                raise_exc = exceptions.APIException(message='adapter error:' + r.error.message)
+                raise_exc = adapter_error_to_exception(r.error, prefix='adapter error:')
                 break
             else:
                 return r
         except apt_exceptions.AuthenticationFailed:
             try:
-                auth_obj = auth_handler.get_auth(service, refresh=True)
+                auth_obj = auth_handler.get_auth(service, refresh=True, deadline=deadline)
             except apt_exceptions.AuthenticationFailed as exc:
                 raise_exc = exceptions.APIException(message='adapter authentication failed', extend_msg=exc.message)
                 break
+            except exceptions.ServiceTimeout as exc:
+                raise_exc = exc
+                break
 
             continue
         except apt_exceptions.MethodNotSupportInService as exc:
@@ -50,6 +234,9 @@ def request_service(service, method: str, raise_exception=True, **kwargs):
             break
         except apt_exceptions.ServerNotExist as exc:
             raise_exc = exceptions.ServerNotExist(message=exc.message)
+        except apt_exceptions.ServiceTimeout as exc:
+            raise_exc = exceptions.ServiceTimeout(message=exc.message)
+            break
         except apt_exceptions.Error as exc:
             raise_exc = exceptions.APIException(message="adapter error:" + exc.message)
             break
@@ -63,51 +250,65 @@ def request_service(service, method: str, raise_exception=True, **kwargs):
     return None
 
 
-def request_vpn_service(service, method: str, raise_exception=True, **kwargs):
+def request_vpn_service(service, method: str, raise_exception=True, deadline: Deadline = None, **kwargs):
     """
     向VPN服务发送请求
 
     :param service: 接入的服务配置对象
     :param method:
     :param raise_exception: 请求失败是否抛出错误，默认True抛出错误，False返回None
+    :param deadline: 请求截止时间，重试和认证只使用剩余的时间；默认None，只使用适配器的超时时间
     :param kwargs:
     :return:
 
-    :raises: APIException
+    :raises: APIException, ServiceTimeout
     """
     try:
-        auth_obj = auth_handler.get_vpn_auth(service)
+        auth_obj = auth_handler.get_vpn_auth(service, deadline=deadline)
     except apt_exceptions.AuthenticationFailed as exc:
         if raise_exception:
             raise exceptions.APIException(message='vpn adapter authentication failed', extend_msg=exc.message)
 
         return None
+    except exceptions.ServiceTimeout as exc:
+        if raise_exception:
+            raise exc
+        return None
 
     raise_exc = exceptions.APIException()
     for _ in range(2):
-        cli = clients.get_service_vpn_client(service, auth=auth_obj)
-        handler = getattr(cli, method)
+        if deadline is not None and deadline.expired:
+            raise_exc = exceptions.ServiceTimeout()
+            break
+
         try:
-            r = handler(**kwargs)
+            handler = adapter_registry.get_method(service, method=method, auth=auth_obj, vpn=True)
+            r = handler(deadline=deadline, **kwargs)
             if hasattr(r, 'ok'):
                 if r.ok:
                     return r
 
-                raise_exc = exceptions.APIException(message='vpn adapter error:' + r.error.message)
+                raise_exc = adapter_error_to_exception(r.error, prefix='vpn adapter error:')
                 break
             else:
                 return r
         except apt_exceptions.AuthenticationFailed:
             try:
-                auth_obj = auth_handler.get_vpn_auth(service, refresh=True)
+                auth_obj = auth_handler.get_vpn_auth(service, refresh=True, deadline=deadline)
             except apt_exceptions.AuthenticationFailed as exc:
                 raise_exc = exceptions.APIException(message='vpn adapter authentication failed', extend_msg=exc.message)
                 break
+            except exceptions.ServiceTimeout as exc:
+                raise_exc = exc
+                break
 
             continue
         except apt_exceptions.MethodNotSupportInService as exc:
             raise_exc = exceptions.MethodNotSupportInService(message=exc.message)
             break
+        except apt_exceptions.ServiceTimeout as exc:
+            raise_exc = exceptions.ServiceTimeout(message=exc.message)
+            break
         except apt_exceptions.Error as exc:
             raise_exc = exceptions.APIException(message=exc.message)
             break
@@ -118,11 +319,12 @@ def request_vpn_service(service, method: str, raise_exception=True, **kwargs):
     return None
 
 
-def update_server_detail(server, task_status: int = None):
+def update_server_detail(server, task_status: int = None, deadline: Deadline = None):
     """
     尝试更新服务器的详细信息
     :param server:
     :param task_status: 设置server的创建状态；默认None忽略
+    :param deadline: 请求截止时间
     :return:
         True    # success
         raise Error   # failed
@@ -132,7 +334,7 @@ def update_server_detail(server, task_status: int = None):
     # 尝试获取详细信息
     params = inputs.ServerDetailInput(server_id=server.instance_id)
     try:
-        out = request_service(service=server.service, method='server_detail', params=params)
+        out = request_service(service=server.service, method='server_detail', params=params, deadline=deadline)
         out_server = out.server
     except exceptions.APIException as exc:      #
         raise exc
@@ -156,10 +358,13 @@ def update_server_detail(server, task_status: int = None):
     return True
 
 
-def server_status_code(server):
+def server_status_code(server, deadline: Deadline = None):
     """
     查询云服务器的状态
 
+    :param server:
+    :param deadline: 请求截止时间
+
     :return:
         (code: int, mean: str)
 
@@ -168,13 +373,47 @@ def server_status_code(server):
     params = inputs.ServerStatusInput(server_id=server.instance_id)
     service = server.service
     try:
-        r = request_service(service, method='server_status', params=params)
+        r = request_service(service, method='server_status', params=params, deadline=deadline)
     except exceptions.APIException as exc:
         raise exc
 
     return r.status, r.status_mean
 
 
+def servers_status_code(servers: list, deadline: Deadline = None):
+    """
+    一次请求查询同一服务的多个云服务器的状态
+
+    :param servers: 同一服务的云服务器
+    :param deadline: 请求截止时间
+
+    :return:
+        {
+            server.id: (code: int, mean: str) or APIException()
+        }
+
+    :raises: APIException
+    """
+    if not servers:
+        return {}
+
+    service = servers[0].service
+    params = inputs.ServerStatusBatchInput(server_ids=[s.instance_id for s in servers])
+    r = request_service(service, method='server_status_batch', params=params, deadline=deadline)
+
+    result = {}
+    for server in servers:
+        status = r.statuses.get(server.instance_id)
+        if status is None:
+            result[server.id] = exceptions.APIException(message='adapter error:no status returned')
+        elif not status.ok:
+            result[server.id] = adapter_error_to_exception(status.error, prefix='adapter error:')
+        else:
+            result[server.id] = (status.status, status.status_mean)
+
+    return result
+
+
 def server_build_status(server):
     """
     云服务器创建状态
@@ -190,6 +429,18 @@ def server_build_status(server):
     except Exception as e:
         return "error"
 
+    return build_status_of_code(status_code)
+
+
+def build_status_of_code(status_code: int):
+    """
+    云服务器状态码对应的创建状态
+
+    :return: str
+        "created"       # 创建完成
+        "failed"        # 创建失败
+        "building"      # 创建中
+    """
     if status_code in outputs.ServerStatus.normal_values():     # 虚拟服务器状态正常
         return "created"
     elif status_code in [outputs.ServerStatus.MISS, outputs.ServerStatus.BUILT_FAILED]:
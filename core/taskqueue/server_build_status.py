@@ -1,54 +1,290 @@
+"""
+云服务器创建状态协调器
+
+定期查询所有创建中(TASK_IN_CREATING)的云服务器，按服务分组批量查询状态，更新云服务器信息和创建状态；
+每个云服务器查询失败或仍在创建中时按指数退避延后下次查询，创建超过MAX_AGE仍未完成的标记为创建失败；
+所有进程中同一时间只有一个协调器工作(共享缓存中的租约，每次请求服务前续期，续期失败或缓存不可用时停止协调)，可以用管理命令reconcile_build_status单独运行，
+也可以在web进程中创建云服务器后按需启动后台线程(IN_PROCESS)，状态都在数据库中，进程重启不丢失
+"""
 import time
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db import close_old_connections
+from django.utils import timezone
 
+from adapters.deadline import Deadline
+from servers.models import Server
 from core import request
+from core.model_version import model_version
+from core import errors as exceptions
 
 
-_pool_executor = ThreadPoolExecutor()
+DEFAULT_BUILD_STATUS_RECONCILER = {
+    'IN_PROCESS': True,         # 创建云服务器后是否在web进程中启动协调线程
+    'INTERVAL': 2,              # 每轮查询间隔，单位秒
+    'BATCH_SIZE': 100,          # 一次批量查询状态的云服务器数
+    'BACKOFF_BASE': 1,          # 退避初始延时，单位秒
+    'BACKOFF_MAX': 60,          # 退避最大延时，单位秒
+    'MAX_AGE': 7200,            # 创建超过此时间(秒)仍在创建中的云服务器标记为创建失败
+    'REQUEST_TIMEOUT': 30,      # 每次请求服务的截止时间，单位秒
+    'IDLE_EXIT': 60,            # web进程中的协调线程空闲多少秒后退出
+}
 
 
-def creat_task(server):
-    try:
-        _pool_executor.submit(task_server_build_status, server)
-    except Exception as e:
+class LeaseLost(Exception):
+    pass
+
+
+class BuildStatusReconciler:
+    """
+    云服务器创建状态协调器
+    """
+    cache_alias = 'shared'      # 保存租约的跨进程共享缓存，不存在时使用default
+    lease_key = 'gosc_build_status_lease'
+
+    def __init__(self, config: dict = None, status_func=None, detail_func=None, cache_alias: str = None):
+        """
+        :param config: 配置，默认settings.BUILD_STATUS_RECONCILER
+        :param status_func: 批量查询状态的函数，默认request.servers_status_code
+        :param detail_func: 更新云服务器信息的函数，默认request.update_server_detail
+        :param cache_alias: 保存租约的django cache配置名称
+        """
+        if cache_alias:
+            self.cache_alias = cache_alias
+
+        c = dict(DEFAULT_BUILD_STATUS_RECONCILER)
+        c.update(getattr(settings, 'BUILD_STATUS_RECONCILER', {}))
+        c.update(config or {})
+        self.interval = c['INTERVAL']
+        self.batch_size = c['BATCH_SIZE']
+        self.backoff_base = c['BACKOFF_BASE']
+        self.backoff_max = c['BACKOFF_MAX']
+        self.max_age = c['MAX_AGE']
+        self.request_timeout = c['REQUEST_TIMEOUT']
+        self.status_func = status_func or request.servers_status_code
+        self.detail_func = detail_func or request.update_server_detail
+        self._backoffs = {}     # {server.id: (attempts, next_time)}
+        self._token = uuid.uuid4().hex
+        self.stats = {'rounds': 0, 'queried': 0, 'created': 0, 'failed': 0, 'retries': 0, 'expired': 0}
+
+    @property
+    def cache(self):
+        try:
+            return caches[self.cache_alias]
+        except InvalidCacheBackendError:
+            return caches['default']
+
+    @property
+    def lease_timeout(self):
+        """
+        租约时长，每次请求服务前续期，须大于一次请求的截止时间
+        """
+        return max(int(self.interval * 5), 10) + int(self.request_timeout * 2)
+
+    def acquire_lease(self):
+        """
+        获取或续期租约；续期只延长持有者是自己的租约时间(touch)，不改写持有者
+
+        :return:
+            True    # 持有租约
+            False   # 其他协调器持有租约，或共享缓存不可用
+        """
+        timeout = self.lease_timeout
+        try:
+            if self.cache.add(self.lease_key, self._token, timeout=timeout):
+                return True
+
+            if self.cache.get(self.lease_key) == self._token:
+                return bool(self.cache.touch(self.lease_key, timeout=timeout))
+        except Exception:
+            return False
+
         return False
 
-    return True
+    def renew_lease(self):
+        """
+        :raises: LeaseLost
+        """
+        if not self.acquire_lease():
+            raise LeaseLost()
+
+    def release_lease(self):
+        try:
+            if self.cache.get(self.lease_key) == self._token:
+                self.cache.delete(self.lease_key)
+        except Exception:
+            pass
+
+    def get_creating_servers(self):
+        after = timezone.now() - timedelta(seconds=self.max_age)
+        return list(Server.objects.filter(
+            task_status=Server.TASK_IN_CREATING, creation_time__gte=after, service__isnull=False
+        ).select_related('service'))
+
+    def fail_expired_servers(self):
+        """
+        创建超过MAX_AGE仍在创建中的云服务器标记为创建失败
+
+        :return:
+            int     # 标记的云服务器数
+        """
+        before = timezone.now() - timedelta(seconds=self.max_age)
+        count = Server.objects.filter(
+            task_status=Server.TASK_IN_CREATING, creation_time__lt=before
+        ).update(task_status=Server.TASK_CREATE_FAILED)
+        if count:
+            model_version.bump(Server._meta.db_table)   # update()不发送信号
+        self.stats['expired'] += count
+        return count
+
+    def backoff(self, server_id, now: float):
+        attempts = self._backoffs.get(server_id, (0, 0))[0] + 1
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        self._backoffs[server_id] = (attempts, now + delay)
+        self.stats['retries'] += 1
+
+    def is_due(self, server_id, now: float):
+        b = self._backoffs.get(server_id)
+        return b is None or now >= b[1]
+
+    def reconcile_once(self):
+        """
+        查询一轮到期的创建中云服务器，调用前须持有租约
 
+        :return:
+            int     # 创建中的云服务器数
+        :raises: LeaseLost     # 租约续期失败，本轮中止
+        """
+        self.renew_lease()
+        self.fail_expired_servers()
+        servers = self.get_creating_servers()
+        ids = {s.id for s in servers}
+        for server_id in [k for k in self._backoffs if k not in ids]:     # 已不在创建中
+            del self._backoffs[server_id]
 
-def task_server_build_status(server):
+        now = time.monotonic()
+        groups = defaultdict(list)
+        for server in servers:
+            if self.is_due(server.id, now):
+                groups[server.service_id].append(server)
+
+        for service_servers in groups.values():
+            for i in range(0, len(service_servers), self.batch_size):
+                self._reconcile_batch(service_servers[i:i + self.batch_size])
+
+        self.stats['rounds'] += 1
+        return len(servers)
+
+    def _reconcile_batch(self, servers: list):
+        """
+        :param servers: 同一服务的云服务器
+        """
+        self.renew_lease()
+        try:
+            results = self.status_func(servers, deadline=Deadline(timeout=self.request_timeout))
+        except exceptions.Error:
+            results = {}
+
+        self.stats['queried'] += len(servers)
+        now = time.monotonic()
+        for server in servers:
+            r = results.get(server.id)
+            if not isinstance(r, tuple):    # 查询失败
+                self.backoff(server.id, now)
+                continue
+
+            build_status = request.build_status_of_code(r[0])
+            if build_status == 'failed':
+                if Server.objects.filter(id=server.id, task_status=Server.TASK_IN_CREATING).update(
+                        task_status=Server.TASK_CREATE_FAILED):
+                    model_version.bump(Server._meta.db_table)
+                self._backoffs.pop(server.id, None)
+                self.stats['failed'] += 1
+            elif build_status == 'created':
+                self.renew_lease()
+                try:
+                    self.detail_func(server, deadline=Deadline(timeout=self.request_timeout))
+                except Exception:
+                    pass
+
+                if server.task_status == Server.TASK_CREATED_OK:
+                    self._backoffs.pop(server.id, None)
+                    self.stats['created'] += 1
+                else:   # 详细信息未更新或不完整(如未分配ip)，稍后再更新
+                    self.backoff(server.id, now)
+            else:
+                self.backoff(server.id, now)
+
+    def run(self, stop_event: threading.Event = None, once: bool = False, idle_exit: float = None):
+        """
+        循环协调，直到stop_event被设置
+
+        :param once: True(只执行一轮)
+        :param idle_exit: 没有创建中的云服务器(或租约被其他协调器持有)多少秒后退出，默认None不退出
+        """
+        stop_event = stop_event or threading.Event()
+        idle_since = None
+        try:
+            while not stop_event.is_set():
+                close_old_connections()
+                count = 0
+                if self.acquire_lease():
+                    try:
+                        count = self.reconcile_once()
+                    except LeaseLost:
+                        count = 0
+                    except Exception:
+                        count = 1       # 数据库等错误，下一轮重试
+
+                if once:
+                    break
+
+                if count > 0:
+                    idle_since = None
+                elif idle_exit is not None:
+                    now = time.monotonic()
+                    idle_since = idle_since or now
+                    if now - idle_since >= idle_exit:
+                        break
+
+                stop_event.wait(self.interval)
+        finally:
+            self.release_lease()
+            close_old_connections()
+
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def creat_task(server):
     """
-    尝试更新服务器的详细信息
-    :param server:
+    云服务器创建后，确保本进程中的协调线程在运行
+
     :return:
-        True    # success
-        False   # failed
+        True    # 已启动或无需启动(由reconcile_build_status命令协调)
+        False   # 启动失败
     """
-    marker = 0
-    while True:
-        r = request.server_build_status(server)
-        if r == 'failed':      # 创建失败
-            server.refresh_from_db()
-            if server.task_status == server.TASK_IN_CREATING:
-                server.task_status = server.TASK_CREATE_FAILED
-                server.save(update_fields=['task_status'])
-        elif r == 'created':
-            break
-        elif r == 'error':
-            marker += 1
-            if marker > 10:     # 多次查询失败，放弃
-                break
-
-        time.sleep(1)
-
-    marker = 0
-    while True:
-        try:
-            if request.update_server_detail(server):
-                break
-        except Exception as e:
-            marker += 1
-            if marker > 3:  # 多次更新失败，放弃
-                break
-
-        time.sleep(1)
+    global _thread
+
+    config = getattr(settings, 'BUILD_STATUS_RECONCILER', {})
+    if not config.get('IN_PROCESS', DEFAULT_BUILD_STATUS_RECONCILER['IN_PROCESS']):
+        return True
+
+    idle_exit = config.get('IDLE_EXIT', DEFAULT_BUILD_STATUS_RECONCILER['IDLE_EXIT'])
+    try:
+        with _thread_lock:
+            if _thread is None or not _thread.is_alive():
+                _thread = threading.Thread(target=BuildStatusReconciler().run, kwargs={'idle_exit': idle_exit},
+                                           name='gosc-build-status', daemon=True)
+                _thread.start()
+    except Exception as e:
+        return False
+
+    return True
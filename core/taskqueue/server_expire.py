@@ -0,0 +1,138 @@
+"""
+过期云服务器清理
+
+通过expiration_time索引查询已过期的云服务器，并发请求服务删除(每个服务限制并发数)，
+删除成功的云服务器分批批量归档(一个事务中bulk_create归档记录和一条DELETE)，并按服务批量释放资源配额；
+由管理命令sweep_expired_servers运行
+"""
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from adapters import inputs
+from adapters.deadline import Deadline
+from servers.models import Server
+from core import request
+from core.quota import QuotaAPI
+from core import errors as exceptions
+
+
+DEFAULT_SERVER_EXPIRE_SWEEPER = {
+    'CONCURRENCY': 16,          # 并发请求服务删除的总数
+    'PER_SERVICE': 4,           # 每个服务并发删除数
+    'BATCH_SIZE': 200,          # 每批处理的云服务器数
+    'REQUEST_TIMEOUT': 60,      # 每次请求服务的截止时间，单位秒
+}
+
+
+class ExpiredServerSweeper:
+    """
+    过期云服务器清理
+    """
+    def __init__(self, config: dict = None, delete_func=None, dry_run: bool = False, force: bool = False):
+        """
+        :param config: 配置，默认settings.SERVER_EXPIRE_SWEEPER
+        :param delete_func: 请求服务删除云服务器的函数delete_func(server, deadline)，失败抛出Error；
+                            默认请求服务的server_delete
+        :param dry_run: True只统计过期的云服务器，不删除
+        :param force: 是否强制删除
+        """
+        c = dict(DEFAULT_SERVER_EXPIRE_SWEEPER)
+        c.update(getattr(settings, 'SERVER_EXPIRE_SWEEPER', {}))
+        c.update(config or {})
+        self.concurrency = c['CONCURRENCY']
+        self.per_service = c['PER_SERVICE']
+        self.batch_size = c['BATCH_SIZE']
+        self.request_timeout = c['REQUEST_TIMEOUT']
+        self.delete_func = delete_func or self.delete_server
+        self.dry_run = dry_run
+        self.force = force
+        self._semaphores = defaultdict(lambda: threading.BoundedSemaphore(self.per_service))
+        self.stats = {'expired': 0, 'deleted': 0, 'archived': 0, 'failed': 0, 'seconds': 0}
+
+    def delete_server(self, server, deadline: Deadline = None):
+        params = inputs.ServerDeleteInput(server_id=server.instance_id, force=self.force)
+        request.request_service(server.service, method='server_delete', params=params, deadline=deadline)
+
+    @staticmethod
+    def get_expired_ids(now=None, limit: int = None):
+        """
+        查询已过期的云服务器id，按过期时间排序
+
+        :param limit: 最多返回数量，默认所有
+        """
+        now = now if now else timezone.now()
+        qs = Server.objects.filter(
+            expiration_time__lt=now, service__isnull=False
+        ).order_by('expiration_time').values_list('id', flat=True)
+        if limit:
+            qs = qs[:limit]
+
+        return list(qs)
+
+    def _delete(self, server):
+        """
+        :return:
+            True    # 删除成功
+            False
+        """
+        with self._semaphores[server.service_id]:
+            try:
+                self.delete_func(server, deadline=Deadline(self.request_timeout))
+                return True
+            except exceptions.Error as exc:
+                return False
+            finally:
+                close_old_connections()
+
+    def sweep_batch(self, servers: list, executor: ThreadPoolExecutor):
+        """
+        并发删除一批云服务器，删除成功的批量归档并释放资源配额
+
+        :return:
+            int     # 归档的云服务器数
+        """
+        for server in servers:      # 在当前线程中创建每个服务的信号量
+            self._semaphores[server.service_id]
+
+        results = executor.map(self._delete, servers)
+        deleted = [s for s, ok in zip(servers, results) if ok]
+        self.stats['deleted'] += len(deleted)
+        self.stats['failed'] += len(servers) - len(deleted)
+        if not deleted:
+            return 0
+
+        # 只归档和释放配额本次删除的记录，同时被其他请求(如用户删除)归档的不重复释放
+        archived = Server.bulk_archive(deleted)
+        self.stats['archived'] += len(archived)
+        QuotaAPI.servers_quota_release(archived)
+        return len(archived)
+
+    def sweep(self, limit: int = None):
+        """
+        清理一轮已过期的云服务器
+
+        :param limit: 最多处理的云服务器数，默认所有
+        :return:
+            int     # 归档的云服务器数，dry_run时为过期的云服务器数
+        """
+        start = time.monotonic()
+        ids = self.get_expired_ids(limit=limit)
+        self.stats['expired'] += len(ids)
+        if self.dry_run:
+            self.stats['seconds'] += time.monotonic() - start
+            return len(ids)
+
+        archived = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i in range(0, len(ids), self.batch_size):
+                servers = list(Server.objects.filter(id__in=ids[i:i + self.batch_size]).select_related('service'))
+                archived += self.sweep_batch(servers, executor=executor)
+
+        self.stats['seconds'] += time.monotonic() - start
+        return archived
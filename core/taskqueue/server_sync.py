@@ -0,0 +1,185 @@
+"""
+云服务器元数据定期同步
+
+按服务分批一次列举云服务器(list_servers)，批量更新变化的元数据(vcpus、ram、ipv4、image、public_ip)和同步时间synced_at；
+查询云服务器详情的接口只读数据库，不再随机请求服务刷新，可以用管理命令sync_servers定期运行
+"""
+import time
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from adapters import inputs
+from adapters.deadline import Deadline
+from service.models import ServiceConfig
+from servers.models import Server
+from core import request
+from core.model_version import model_version
+from core import errors as exceptions
+
+
+DEFAULT_SERVER_SYNC = {
+    'INTERVAL': 600,            # 每轮同步间隔，单位秒
+    'BATCH_SIZE': 500,          # 一次列举的云服务器数
+    'REQUEST_TIMEOUT': 60,      # 每次请求服务的截止时间，单位秒
+}
+
+
+def apply_server_detail(server, out_server):
+    """
+    用服务返回的云服务器信息更新云服务器对象的元数据，不保存
+
+    :param server: 云服务器对象
+    :param out_server: outputs.ServerDetailOutputServer()
+    :return:
+        list    # 变化的字段
+    """
+    update_fields = []
+    new_vcpu = out_server.vcpu
+    if new_vcpu and server.vcpus != new_vcpu:
+        server.vcpus = new_vcpu
+        update_fields.append('vcpus')
+
+    new_ram = out_server.ram
+    if new_ram and server.ram != new_ram:
+        server.ram = new_ram
+        update_fields.append('ram')
+
+    new_ipv4 = out_server.ip.ipv4
+    if new_ipv4 and server.ipv4 != new_ipv4:
+        server.ipv4 = new_ipv4
+        update_fields.append('ipv4')
+
+    new_name = out_server.image.name
+    if new_name and server.image != new_name:
+        server.image = new_name
+        update_fields.append('image')
+
+    new_pub = out_server.ip.public_ipv4
+    if new_pub is not None and server.public_ip != new_pub:
+        server.public_ip = new_pub
+        update_fields.append('public_ip')
+
+    return update_fields
+
+
+class ServerMetadataSync:
+    """
+    云服务器元数据同步
+    """
+    def __init__(self, config: dict = None, list_func=None):
+        """
+        :param config: 配置，默认settings.SERVER_SYNC
+        :param list_func: 列举云服务器的函数list_func(service, server_ids, deadline) -> [ServerDetailOutputServer()]，
+                          默认请求服务的list_servers
+        """
+        c = dict(DEFAULT_SERVER_SYNC)
+        c.update(getattr(settings, 'SERVER_SYNC', {}))
+        c.update(config or {})
+        self.interval = c['INTERVAL']
+        self.batch_size = c['BATCH_SIZE']
+        self.request_timeout = c['REQUEST_TIMEOUT']
+        self.list_func = list_func or self.list_servers
+        self.stats = {'rounds': 0, 'synced': 0, 'updated': 0, 'errors': 0}
+
+    @staticmethod
+    def list_servers(service, server_ids: list, deadline: Deadline = None):
+        params = inputs.ListServerInput(region_id=service.region_id, server_ids=server_ids)
+        out = request.request_service(service, method='list_servers', params=params, deadline=deadline)
+        return out.servers
+
+    def sync_service(self, service):
+        """
+        同步一个服务中创建成功的云服务器
+
+        :return:
+            int     # 同步的云服务器数
+        """
+        qs = Server.objects.filter(service=service, task_status=Server.TASK_CREATED_OK).only(
+            'id', 'instance_id', 'vcpus', 'ram', 'ipv4', 'image', 'public_ip').order_by('id')
+        synced = 0
+        last_id = ''
+        while True:
+            servers = list(qs.filter(id__gt=last_id)[:self.batch_size])
+            if not servers:
+                break
+
+            last_id = servers[-1].id
+            try:
+                out_servers = self.list_func(service, [s.instance_id for s in servers],
+                                             deadline=Deadline(self.request_timeout))
+            except exceptions.Error as exc:
+                self.stats['errors'] += 1
+                continue
+
+            out_map = {s.uuid: s for s in out_servers}
+            changed = []
+            fields = set()
+            unchanged_ids = []
+            for server in servers:
+                out_server = out_map.get(server.instance_id)
+                if out_server is None:      # 服务中不存在或查询失败，不更新同步时间
+                    continue
+
+                update_fields = apply_server_detail(server, out_server)
+                if update_fields:
+                    changed.append(server)
+                    fields.update(update_fields)
+                else:
+                    unchanged_ids.append(server.id)
+
+            now = timezone.now()
+            if changed:
+                for server in changed:
+                    server.synced_at = now
+                Server.objects.bulk_update(changed, fields=list(fields) + ['synced_at'])
+            if unchanged_ids:
+                Server.objects.filter(id__in=unchanged_ids).update(synced_at=now)
+            if changed or unchanged_ids:
+                model_version.bump(Server._meta.db_table)   # bulk_update()、update()不发送信号
+
+            synced += len(changed) + len(unchanged_ids)
+            self.stats['updated'] += len(changed)
+
+        self.stats['synced'] += synced
+        return synced
+
+    def sync_once(self, service_ids: list = None):
+        """
+        同步一轮所有服务
+
+        :param service_ids: 只同步这些服务，默认所有
+        :return:
+            int     # 同步的云服务器数
+        """
+        services = ServiceConfig.objects.filter(status=ServiceConfig.Status.ENABLE)
+        if service_ids:
+            services = services.filter(id__in=service_ids)
+
+        synced = 0
+        for service in services:
+            try:
+                synced += self.sync_service(service)
+            except Exception as exc:
+                self.stats['errors'] += 1
+
+        self.stats['rounds'] += 1
+        return synced
+
+    def run(self, stop_event: threading.Event = None, once: bool = False, service_ids: list = None):
+        """
+        循环同步，直到stop_event被设置
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            close_old_connections()
+            start = time.monotonic()
+            self.sync_once(service_ids=service_ids)
+            if once:
+                break
+
+            stop_event.wait(max(self.interval - (time.monotonic() - start), 0))
+
+        close_old_connections()
@@ -0,0 +1,533 @@
+import os
+import time
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from adapters import outputs, inputs
+from adapters.evcloud import exceptions as evcloud_exceptions
+from servers.models import Server, ServerArchive
+from utils.test import get_or_create_service
+from utils.cache import FileBasedCache
+from adapters.deadline import Deadline
+from .auth import AuthCacheHandler
+from .request import SingleFlight, single_flight_key, adapter_error_to_exception
+from .catalog import CatalogCache, dumps_output, loads_output
+from .breaker import CircuitBreaker
+from .model_version import model_version
+from .taskqueue.server_build_status import BuildStatusReconciler, LeaseLost
+from .taskqueue.server_sync import ServerMetadataSync
+from .taskqueue.server_expire import ExpiredServerSweeper
+from . import errors
+
+
+def build_auth(token: str, expire_seconds: int = 3600):
+    expire = (datetime.utcnow() + timedelta(seconds=expire_seconds)).timestamp()
+    header = outputs.AuthenticateOutputHeader(header_name='Authorization', header_value=f'Token {token}')
+    return outputs.AuthenticateOutput(style='token', token=token, header=header, query=None, expire=expire,
+                                      username='test', password='password')
+
+
+def cache_add(location: str):
+    return FileBasedCache(location, {}).add('lock', os.getpid(), timeout=30)
+
+
+class FileBasedCacheTests(SimpleTestCase):
+    def test_add(self):
+        with tempfile.TemporaryDirectory() as location:
+            with multiprocessing.get_context('fork').Pool(8) as pool:
+                results = pool.map(cache_add, [location] * 16)
+
+            self.assertEqual(results.count(True), 1)
+            cache = FileBasedCache(location, {})
+            self.assertFalse(cache.add('lock', 0))
+            cache.delete('lock')
+            self.assertTrue(cache.add('lock', 0))
+
+    def test_cull_expired_first(self):
+        with tempfile.TemporaryDirectory() as location:
+            cache = FileBasedCache(location, {'OPTIONS': {'MAX_ENTRIES': 3}})
+            cache.set('version', 'v1', timeout=None)
+            cache.set('expired1', 1, timeout=0.01)
+            cache.set('expired2', 2, timeout=0.01)
+            time.sleep(0.05)
+            cache.set('new1', 1)
+            cache.set('new2', 2)
+            self.assertEqual(cache.get('version'), 'v1')
+            self.assertEqual(cache.get_many(['new1', 'new2']), {'new1': 1, 'new2': 2})
+
+
+class AuthCacheHandlerTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.handler = AuthCacheHandler(cache_alias='default')
+        self.count = 0
+
+    def authenticate(self, expire_seconds=3600):
+        time.sleep(0.2)
+        self.count += 1
+        return build_auth(token=f'token{self.count}', expire_seconds=expire_seconds)
+
+    def get_auth(self, handler=None, refresh=False, expire_seconds=3600):
+        handler = handler if handler else self.handler
+        return handler._get_or_authenticate(
+            key='service_test', username='test', password_func=lambda: 'password',
+            authenticate=lambda: self.authenticate(expire_seconds), refresh=refresh, deadline=None)
+
+    def test_single_flight(self):
+        results = []
+
+        def worker():
+            results.append(self.get_auth().token)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.count, 1)
+        self.assertEqual(results, ['token1'] * 8)
+
+        # 其他进程的handler从共享缓存加载
+        other = AuthCacheHandler(cache_alias='default')
+        auth = self.get_auth(handler=other)
+        self.assertEqual(auth.token, 'token1')
+        self.assertEqual(auth.password, 'password')
+        self.assertEqual(auth.header.header_value, 'Token token1')
+        self.assertEqual(self.count, 1)
+
+        # token失效，强制刷新
+        auth = self.get_auth(refresh=True)
+        self.assertEqual(auth.token, 'token2')
+        # 其他进程的token失效时，使用已刷新的共享token，不重复认证
+        auth = self.get_auth(handler=other, refresh=True)
+        self.assertEqual(auth.token, 'token2')
+        self.assertEqual(self.count, 2)
+
+    def test_refresh_ahead(self):
+        auth = self.get_auth(expire_seconds=30)
+        self.assertEqual(auth.token, 'token1')
+        auth = self.get_auth()
+        self.assertEqual(auth.token, 'token2')
+        auth = self.get_auth()
+        self.assertEqual(auth.token, 'token2')
+        self.assertEqual(self.count, 2)
+
+    def test_wait_bounded_by_deadline(self):
+        t = threading.Thread(target=self.get_auth)
+        t.start()
+        time.sleep(0.05)        # 其他线程正在认证
+
+        start = time.monotonic()
+        with self.assertRaises(errors.ServiceTimeout):
+            self.handler._get_or_authenticate(
+                key='service_test', username='test', password_func=lambda: 'password',
+                authenticate=self.authenticate, refresh=False, deadline=Deadline(timeout=0.05))
+        self.assertLess(time.monotonic() - start, 0.15)
+        t.join()
+        self.assertEqual(self.count, 1)
+
+    def test_unshareable_auth(self):
+        auth = build_auth('token')
+        auth.kwargs['vmconnect'] = object()
+        self.assertIsNone(AuthCacheHandler.auth_to_data(auth))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_coalesce(self):
+        flight = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.3)
+            return 'images'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', func))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, ['images'] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.get_stats(), {'calls': 1, 'shared': 7, 'hit_rate': 7 / 8})
+
+        # 结束后不再共享
+        self.assertEqual(flight.do('key', func), 'images')
+        self.assertEqual(len(calls), 2)
+
+    def test_share_error_and_timeout(self):
+        flight = SingleFlight()
+
+        def func():
+            time.sleep(0.3)
+            raise errors.APIException(message='failed')
+
+        raised = []
+
+        def call(deadline=None):
+            try:
+                flight.do('key', func, deadline=deadline)
+            except errors.Error as exc:
+                raised.append(exc)
+
+        threads = [threading.Thread(target=call), threading.Thread(target=call),
+                   threading.Thread(target=call, kwargs={'deadline': Deadline(0.05)})]
+        for t in threads:
+            t.start()
+            time.sleep(0.01)
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(raised), 3)
+        self.assertEqual(sum(isinstance(e, errors.ServiceTimeout) for e in raised), 1)
+        self.assertEqual(sum(e.message == 'failed' for e in raised), 2)
+
+    def test_key(self):
+        class Service:
+            id = '1'
+
+        k1 = single_flight_key(Service, 'list_images', {'params': inputs.ListImageInput(region_id='1'),
+                                                        'deadline': Deadline(10)})
+        k2 = single_flight_key(Service, 'list_images', {'params': inputs.ListImageInput(region_id='1')})
+        k3 = single_flight_key(Service, 'list_images', {'params': inputs.ListImageInput(region_id='2')})
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, k3)
+
+
+class CatalogCacheTests(SimpleTestCase):
+    class Service:
+        id = 'service1'
+
+    def setUp(self):
+        caches['default'].clear()
+        self.cache = CatalogCache(ttls={'list_networks': 0.2}, stale_ttl=0.5, max_entries=2)
+        self.cache.cache_alias = 'default'
+        self.fetches = []
+
+    def fetch(self, background=False):
+        self.fetches.append(background)
+        network = outputs.ListNetworkOutputNetwork(id=str(len(self.fetches)), name='net', public=False,
+                                                   segment='10.0.0.0')
+        return outputs.ListNetworkOutput(networks=[network])
+
+    def get(self, region_id='1'):
+        return self.cache.get_or_fetch(self.Service, 'list_networks', params=inputs.ListNetworkInput(
+            region_id=region_id), fetch=self.fetch)
+
+    def test_serialize(self):
+        now = datetime.utcnow()
+        image = outputs.ListImageOutputImage(id='1', name='centos', system='CentOS8', system_type='Linux',
+                                             creation_time=now, desc='desc')
+        value = dumps_output('list_images', outputs.ListImageOutput(images=[image]))
+        r = loads_output('list_images', value)
+        self.assertEqual(vars(r.images[0]), vars(image))
+
+    def test_ttl_stale_and_invalidate(self):
+        self.assertEqual(self.get().networks[0].id, '1')
+        self.assertEqual(self.get().networks[0].id, '1')
+        self.assertEqual(self.fetches, [False])
+
+        # 过期后返回旧数据，后台刷新
+        time.sleep(0.25)
+        self.assertEqual(self.get().networks[0].id, '1')
+        time.sleep(0.1)
+        self.assertEqual(self.fetches, [False, True])
+        self.assertEqual(self.get().networks[0].id, '2')
+
+        self.cache.invalidate(self.Service.id)
+        self.assertEqual(self.get().networks[0].id, '3')
+        self.assertEqual(self.cache.stats['stale_hits'], 1)
+
+    def test_lru(self):
+        self.get('1')
+        self.get('2')
+        self.get('1')
+        self.get('3')     # 淘汰2
+        self.assertEqual(self.cache.get_stats()['entries'], 2)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.get('1')
+        self.assertEqual(len(self.fetches), 3)
+        self.get('2')
+        self.assertEqual(len(self.fetches), 4)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def new_breaker(self):
+        breaker = CircuitBreaker('service1', config={'MIN_CALLS': 4, 'FAILURE_RATE': 0.5, 'OPEN_SECONDS': 0.2,
+                                                     'SLOW_CALL_SECONDS': 1, 'SYNC_INTERVAL': 0})
+        breaker.cache_alias = 'default'
+        return breaker
+
+    @staticmethod
+    def fail():
+        raise errors.ServiceTimeout()
+
+    @staticmethod
+    def not_found():
+        raise errors.ServerNotExist()
+
+    def test_open_half_open_close(self):
+        breaker = self.new_breaker()
+        other = self.new_breaker()      # 其他进程的熔断器
+
+        for func in [self.not_found, self.not_found, self.not_found, lambda: 'ok']:
+            self.assertFalse(breaker.allow())
+            try:
+                breaker.call(func)
+            except errors.Error:
+                pass
+        self.assertEqual(breaker.get_state()['state'], 'closed')
+
+        for _ in range(4):
+            with self.assertRaises(errors.ServiceTimeout):
+                breaker.call(self.fail)
+
+        self.assertEqual(breaker.get_state()['state'], 'open')
+        with self.assertRaises(errors.ServiceUnavailable):
+            other.allow()
+
+        # 半开，只有一个探测请求
+        time.sleep(0.25)
+        self.assertEqual(other.get_state()['state'], 'half-open')
+        self.assertTrue(other.allow())
+        with self.assertRaises(errors.ServiceUnavailable):
+            breaker.allow()
+
+        with self.assertRaises(errors.ServiceTimeout):
+            other.call(self.fail, probe=True)
+        self.assertEqual(breaker.get_state()['state'], 'open')
+
+        time.sleep(0.25)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.call(lambda: 'ok', probe=True), 'ok')
+        self.assertEqual(other.get_state()['state'], 'closed')
+        self.assertFalse(other.allow())
+
+    def test_client_errors_not_failure(self):
+        breaker = self.new_breaker()
+        adapter_errors = [
+            evcloud_exceptions.ServerNotExistError(status_code=404),
+            evcloud_exceptions.APIError(message='vm not found', status_code=404),
+            evcloud_exceptions.APIInvalidParam(),
+        ]
+        for adapter_error in adapter_errors * 4:
+            exc = adapter_error_to_exception(adapter_error, prefix='adapter error:')
+            self.assertIn(exc.status_code, [400, 404])
+
+            def func():
+                raise exc
+
+            with self.assertRaises(errors.APIException):
+                breaker.call(func)
+
+        self.assertIsInstance(adapter_error_to_exception(adapter_errors[0]), errors.ServerNotExist)
+        self.assertEqual(breaker.stats['failures'], 0)
+        self.assertEqual(breaker.get_state()['state'], 'closed')
+        self.assertFalse(breaker.allow())
+
+        exc = adapter_error_to_exception(evcloud_exceptions.APIError(status_code=502))
+        self.assertEqual(exc.status_code, 500)
+        self.assertTrue(breaker.is_failure(exc))
+
+
+def breaker_allow(cache_alias: str):
+    breaker = CircuitBreaker('service1', config={'SYNC_INTERVAL': 0})
+    breaker.cache_alias = cache_alias
+    try:
+        return breaker.allow()
+    except errors.ServiceUnavailable:
+        return False
+
+
+class CircuitBreakerProbeTests(SimpleTestCase):
+    def test_one_probe_across_processes(self):
+        with tempfile.TemporaryDirectory() as location:
+            cache_settings = dict(settings.CACHES, probe={'BACKEND': 'utils.cache.FileBasedCache', 'LOCATION': location})
+            with override_settings(CACHES=cache_settings):
+                breaker = CircuitBreaker('service1', config={'OPEN_SECONDS': 0})
+                breaker.cache_alias = 'probe'
+                breaker.open(reason='test')
+                with multiprocessing.get_context('fork').Pool(8) as pool:
+                    results = pool.map(breaker_allow, ['probe'] * 16)
+
+        self.assertEqual(results.count(True), 1)
+
+
+class BuildStatusReconcilerTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        service = get_or_create_service()
+        self.servers = {}
+        for name in ['created', 'failed', 'building', 'error']:
+            server = Server(service=service, instance_id=name, name=name, task_status=Server.TASK_IN_CREATING)
+            server.save()
+            self.servers[name] = server
+
+        self.status_calls = []
+
+    def status_func(self, servers, deadline=None):
+        self.status_calls.append(len(servers))
+        codes = {'created': outputs.ServerStatus.RUNNING, 'failed': outputs.ServerStatus.BUILT_FAILED,
+                 'building': outputs.ServerStatus.NOSTATE}
+        return {s.id: (codes[s.instance_id], '') if s.instance_id in codes else errors.APIException()
+                for s in servers}
+
+    @staticmethod
+    def detail_func(server, deadline=None):
+        server.ipv4 = '127.0.0.1'
+        server.image = 'centos'
+        server.task_status = Server.TASK_CREATED_OK
+        server.save()
+        return True
+
+    def test_reconcile(self):
+        reconciler = BuildStatusReconciler(config={'BATCH_SIZE': 3, 'BACKOFF_BASE': 10},
+                                           status_func=self.status_func, detail_func=self.detail_func,
+                                           cache_alias='default')
+        self.assertTrue(reconciler.acquire_lease())
+        self.assertFalse(BuildStatusReconciler(cache_alias='default').acquire_lease())
+
+        self.assertEqual(reconciler.reconcile_once(), 4)
+        self.assertEqual(sorted(self.status_calls), [1, 3])
+        tasks = {s.instance_id: s.task_status for s in Server.objects.all()}
+        self.assertEqual(tasks, {'created': Server.TASK_CREATED_OK, 'failed': Server.TASK_CREATE_FAILED,
+                                 'building': Server.TASK_IN_CREATING, 'error': Server.TASK_IN_CREATING})
+        self.assertEqual(reconciler.stats['retries'], 2)
+
+        # 退避中，不再查询
+        self.assertEqual(reconciler.reconcile_once(), 2)
+        self.assertEqual(len(self.status_calls), 2)
+
+        # 退避到期，延时翻倍
+        for server_id, (attempts, _) in list(reconciler._backoffs.items()):
+            reconciler._backoffs[server_id] = (attempts, 0)
+        reconciler.reconcile_once()
+        self.assertEqual(self.status_calls[-1], 2)
+        self.assertEqual({a for a, _ in reconciler._backoffs.values()}, {2})
+
+        reconciler.release_lease()
+        self.assertTrue(BuildStatusReconciler(cache_alias='default').acquire_lease())
+
+    def test_expired_and_lease(self):
+        Server.objects.filter(id=self.servers['error'].id).update(creation_time=timezone.now() - timedelta(hours=3))
+        reconciler = BuildStatusReconciler(config={'BATCH_SIZE': 3, 'MAX_AGE': 3600},
+                                           status_func=self.status_func, detail_func=self.detail_func,
+                                           cache_alias='default')
+        self.assertTrue(reconciler.acquire_lease())
+        version = model_version.get(Server._meta.db_table)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(reconciler.reconcile_once(), 3)
+        self.assertNotEqual(model_version.get(Server._meta.db_table), version)
+        self.assertEqual(Server.objects.get(id=self.servers['error'].id).task_status, Server.TASK_CREATE_FAILED)
+        self.assertEqual(reconciler.stats['expired'], 1)
+
+        # 租约被其他协调器持有时中止本轮
+        caches['default'].set(reconciler.lease_key, 'other')
+        with self.assertRaises(LeaseLost):
+            reconciler.reconcile_once()
+
+        # 共享缓存不可用时不持有租约
+        with mock.patch.object(caches['default'], 'add', side_effect=Exception('unavailable')):
+            self.assertFalse(BuildStatusReconciler(cache_alias='default').acquire_lease())
+
+
+class ServerMetadataSyncTests(TestCase):
+    def setUp(self):
+        self.service = get_or_create_service()
+        for name in ['changed', 'unchanged', 'missing', 'creating']:
+            task_status = Server.TASK_IN_CREATING if name == 'creating' else Server.TASK_CREATED_OK
+            Server(service=self.service, instance_id=name, name=name, vcpus=1, ram=1024, ipv4='10.0.0.1',
+                   image='centos', public_ip=False, task_status=task_status).save()
+
+        self.list_calls = []
+
+    def list_func(self, service, server_ids, deadline=None):
+        self.list_calls.append(sorted(server_ids))
+        servers = []
+        for server_id in server_ids:
+            if server_id == 'missing':
+                continue
+
+            vcpu = 2 if server_id == 'changed' else 1
+            servers.append(outputs.ServerDetailOutputServer(
+                uuid=server_id, ram=1024, vcpu=vcpu, image=outputs.ServerImage(name='centos', system='centos'),
+                ip=outputs.ServerIP(ipv4='10.0.0.1', public_ipv4=False), creation_time=None))
+
+        return servers
+
+    def test_sync(self):
+        syncer = ServerMetadataSync(config={'BATCH_SIZE': 2}, list_func=self.list_func)
+        version = model_version.get(Server._meta.db_table)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(syncer.sync_service(self.service), 2)
+        self.assertNotEqual(model_version.get(Server._meta.db_table), version)
+        self.assertEqual(len(self.list_calls), 2)
+        self.assertNotIn('creating', sum(self.list_calls, []))
+
+        servers = {s.instance_id: s for s in Server.objects.all()}
+        self.assertEqual(servers['changed'].vcpus, 2)
+        self.assertIsNotNone(servers['changed'].synced_at)
+        self.assertIsNotNone(servers['unchanged'].synced_at)
+        self.assertIsNone(servers['missing'].synced_at)
+        self.assertEqual(syncer.stats['updated'], 1)
+
+
+class ExpiredServerSweeperTests(TestCase):
+    def setUp(self):
+        self.service = get_or_create_service()
+        now = timezone.now()
+        for name, days in [('expired1', -2), ('expired2', -1), ('error', -1), ('valid', 1)]:
+            Server(service=self.service, instance_id=name, name=name, vcpus=2, ram=1024,
+                   expiration_time=now + timedelta(days=days)).save()
+
+        self.deleted = []
+
+    def delete_func(self, server, deadline=None):
+        if server.instance_id == 'error':
+            raise errors.APIException()
+
+        self.deleted.append(server.instance_id)
+
+    def test_sweep(self):
+        sweeper = ExpiredServerSweeper(delete_func=self.delete_func, dry_run=True)
+        self.assertEqual(sweeper.sweep(), 3)
+        self.assertEqual(Server.objects.count(), 4)
+
+        sweeper = ExpiredServerSweeper(config={'BATCH_SIZE': 2, 'PER_SERVICE': 1}, delete_func=self.delete_func)
+        self.assertEqual(sweeper.sweep(), 2)
+        self.assertEqual(sorted(self.deleted), ['expired1', 'expired2'])
+        self.assertEqual(sorted(Server.objects.values_list('instance_id', flat=True)), ['error', 'valid'])
+        archives = ServerArchive.objects.filter(service=self.service)
+        self.assertEqual(sorted(a.instance_id for a in archives), ['expired1', 'expired2'])
+        self.assertEqual({a.vcpus for a in archives}, {2})
+        self.assertEqual(sweeper.stats['failed'], 1)
+
+    def test_sweep_archived_concurrently(self):
+        servers = list(Server.objects.filter(
+            instance_id__in=['expired1', 'expired2']).select_related('service').order_by('instance_id'))
+        # 用户删除请求同时归档了expired2
+        Server.objects.get(instance_id='expired2').do_archive()
+
+        sweeper = ExpiredServerSweeper(delete_func=self.delete_func)
+        with mock.patch('core.taskqueue.server_expire.QuotaAPI.servers_quota_release') as release, \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(sweeper.sweep_batch(servers, executor=executor), 1)
+
+        self.assertEqual([s.instance_id for s in release.call_args[0][0]], ['expired1'])
+        self.assertEqual(ServerArchive.objects.filter(instance_id='expired2').count(), 1)
+        self.assertEqual(sweeper.stats['archived'], 1)
@@ -1,5 +1,5 @@
 from service.models import ServiceConfig
-from adapters import exceptions, client, inputs
+from adapters import exceptions, client, inputs, aio
 
 
 class InvalidServiceError(exceptions.Error):
@@ -27,25 +27,43 @@ def test_service_ok(service: ServiceConfig):
 
     :raises: InvalidServiceError, InvalidServiceVPNError
     """
-    cli = client.get_service_client(service=service)
+    adapter = client.get_async_service_adapter(service=service)
     params = inputs.AuthenticateInput(username=service.username, password=service.raw_password())
-    r = cli.authenticate(params=params)
+    r = aio.run_coroutine(adapter.authenticate(params=params))
     if not r.ok:
         raise AuthenticationFailed(message=f'测试认证错误，用户名、密码或服务地址有误，{r.error.message}',
                                    code=r.error.code, status_code=r.error.status_code)
 
-    params = inputs.ListImageInput(region_id=service.region_id)
-    r = cli.list_images(params=params)
-    if not r.ok:
-        raise InvalidServiceError(message=f'测试列举系统镜像失败，{r.error.message}',
-                                   code=r.error.code, status_code=r.error.status_code)
+    # 认证后并发测试列举镜像、网络和vpn
+    r_images, r_networks, r_vpn = aio.run_concurrently([
+        adapter.list_images(params=inputs.ListImageInput(region_id=service.region_id)),
+        adapter.list_networks(params=inputs.ListNetworkInput(region_id=service.region_id)),
+        aio.run_in_executor(_test_service_vpn_ok, service)
+    ])
+    for r in (r_images, r_networks):
+        if isinstance(r, Exception):
+            raise r
 
-    params = inputs.ListNetworkInput(region_id=service.region_id)
-    r = cli.list_networks(params=params)
-    if not r.ok:
-        raise InvalidServiceError(message=f'测试列举网络失败，{r.error.message}',
-                                   code=r.error.code, status_code=r.error.status_code)
+    if not r_images.ok:
+        raise InvalidServiceError(message=f'测试列举系统镜像失败，{r_images.error.message}',
+                                  code=r_images.error.code, status_code=r_images.error.status_code)
+
+    if not r_networks.ok:
+        raise InvalidServiceError(message=f'测试列举网络失败，{r_networks.error.message}',
+                                  code=r_networks.error.code, status_code=r_networks.error.status_code)
+
+    if isinstance(r_vpn, Exception):
+        raise r_vpn
 
+    return True
+
+
+def _test_service_vpn_ok(service: ServiceConfig):
+    """
+    检测一下service的vpn配置是否有效、可用
+
+    :raises: VpnAuthenticationFailed
+    """
     if service.is_need_vpn():
         if service.service_type == service.ServiceType.EVCLOUD:
             params = inputs.AuthenticateInput(username=service.username, password=service.raw_password())
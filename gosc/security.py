@@ -0,0 +1,10 @@
+from .settings import SIMPLE_JWT, PASSPORT_JWT
+SECRET_KEY = 'test-secret-key-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/gosc.sqlite3'}}
+THIRD_PARTY_APP_AUTH_SECURITY = {'SCIENCE_CLOUD': {'client_id': 0, 'client_secret': 'xxx'}}
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+SIMPLE_JWT['SIGNING_KEY'] = 'xxx'
+SIMPLE_JWT['VERIFYING_KEY'] = 'xxx'
+PASSPORT_JWT['VERIFYING_KEY'] = 'xxx'
+TEST_CASE = {'SERVICE': {'endpoint_url': 'http://127.0.0.1:1/', 'region_id': 1, 'service_type': 'evcloud',
+             'username': 'xxx', 'password': 'xxx', 'version': 'v3'}}
@@ -54,6 +54,7 @@ INSTALLED_APPS = [
     'activity',
     'storage',
     'docs',
+    'jobs',
 ]
 
 MIDDLEWARE = [
@@ -92,6 +93,18 @@ WSGI_APPLICATION = 'gosc.wsgi.application'
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 多进程共享的缓存，如服务认证token等，add()须是原子的(用作跨进程的锁)；
+    # utils.cache.FileBasedCache只在同一主机的进程间原子，多主机部署时应改为memcached或redis等
+    'shared': {
+        'BACKEND': 'utils.cache.FileBasedCache',
+        'LOCATION': '/var/tmp/gosc_shared_cache',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            # 保存模型版本号、熔断器状态、认证锁、任务租约、目录缓存等协调数据，被删除会使缓存失效判断出错，
+            # 条目数须远大于实际使用；达到时先删除已过期的条目
+            'MAX_ENTRIES': 100000,
+        },
     }
 }
 
@@ -267,6 +280,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': False,
         },
+        'gosc.quota': {
+            'handlers': ['file', 'console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
 
@@ -329,6 +347,111 @@ SWAGGER_SETTINGS = {
     },
 }
 
+# 服务适配器HTTP连接池，每个进程内按服务endpoint复用长连接
+ADAPTER_HTTP_POOL = {
+    'POOL_CONNECTIONS': 4,      # 每个endpoint缓存的连接池数
+    'POOL_MAXSIZE': 8,          # 每个连接池保持的连接数，不小于uwsgi每个进程的线程数
+    'POOL_BLOCK': False,
+    'KEEP_ALIVE': True,         # TCP keep-alive
+    'RETRIES': 1,               # 连接被重置时的重试次数
+    'BACKOFF_FACTOR': 0.1,
+}
+
+# 每个进程对每个vCenter最多的并发会话数，包括虚拟机索引长期占用的1个会话；小于2时不使用虚拟机索引
+VMWARE_MAX_SESSIONS = 4
+
+# 一个API请求请求后端服务可用的总时间(秒)，包括认证和重试，应小于uwsgi的http-timeout
+API_REQUEST_DEADLINE = 15
+
+# 后端服务目录数据(镜像、网络)缓存
+CATALOG_CACHE = {
+    'TTL': {                    # 每个适配器方法的缓存时间(秒)，0不缓存
+        'list_images': 300,
+        'list_networks': 300,
+        'network_detail': 300,
+    },
+    'STALE_TTL': 600,           # 缓存过期后多少秒内仍返回旧数据，同时后台刷新
+    'MAX_ENTRIES': 1024,        # 每个进程最多缓存条目数，超过时淘汰最久未使用的
+}
+
+# 服务熔断器，服务失败率或慢请求率过高时，所有进程对此服务的请求立即失败
+CIRCUIT_BREAKER = {
+    'ENABLE': True,
+    'WINDOW': 60,               # 统计时间窗口(秒)
+    'MIN_CALLS': 10,            # 时间窗口内请求数不少于此值才判断是否打开
+    'FAILURE_RATE': 0.5,        # 失败率阈值
+    'SLOW_CALL_SECONDS': 10,    # 耗时超过此值(秒)为慢请求
+    'SLOW_CALL_RATE': 0.8,      # 慢请求率阈值
+    'OPEN_SECONDS': 30,         # 打开多少秒后所有进程中只允许一个探测请求(半开)，依赖CACHES['shared']的add()是原子的
+    'SYNC_INTERVAL': 1,         # 每个进程读取共享状态的最小间隔(秒)
+}
+
+# 云服务器创建状态协调器，见core.taskqueue.server_build_status；
+# 部署了单独运行的管理命令reconcile_build_status时，IN_PROCESS可设为False
+BUILD_STATUS_RECONCILER = {
+    'IN_PROCESS': True,         # 创建云服务器后是否在web进程中启动协调线程
+    'INTERVAL': 2,              # 每轮查询间隔(秒)
+    'BATCH_SIZE': 100,          # 一次批量查询状态的云服务器数
+    'BACKOFF_BASE': 1,          # 每个云服务器退避初始延时(秒)，之后每次翻倍
+    'BACKOFF_MAX': 60,          # 退避最大延时(秒)
+    'MAX_AGE': 7200,            # 创建超过此时间(秒)仍在创建中的云服务器标记为创建失败
+    'REQUEST_TIMEOUT': 30,      # 每次请求服务的截止时间(秒)
+    'IDLE_EXIT': 60,            # web进程中的协调线程空闲多少秒后退出
+}
+
+# 持久化的异步任务队列，见jobs app，由管理命令run_jobs执行
+JOBS = {
+    'CONCURRENCY': 4,               # 每个worker并发执行的任务数
+    'POLL_INTERVAL': 1,             # 没有可执行任务时的轮询间隔(秒)
+    'VISIBILITY_TIMEOUT': 300,      # 领取任务的租约时间(秒)，超时未完成的任务可被其他worker重新领取
+    'MAX_PER_SERVICE': 2,           # 每个服务同时执行的任务数，0不限制
+    'MAX_ATTEMPTS': 5,              # 默认每个任务最多执行次数，之后进入失败状态
+    'BACKOFF_BASE': 5,              # 重试退避初始延时(秒)，之后每次翻倍
+    'BACKOFF_MAX': 600,             # 重试退避最大延时(秒)
+    'SERVER_DELETE_RETRY': False,   # 删除云服务器请求服务超时或服务不可用时加入任务队列重试，接口返回202；
+                                    # 须运行管理命令run_jobs，否则接受的删除不会执行
+}
+
+# 云服务器元数据定期同步，由管理命令sync_servers执行
+SERVER_SYNC = {
+    'INTERVAL': 600,            # 每轮同步间隔(秒)
+    'BATCH_SIZE': 500,          # 一次列举的云服务器数
+    'REQUEST_TIMEOUT': 60,      # 每次请求服务的截止时间(秒)
+}
+
+# 过期云服务器清理，由管理命令sweep_expired_servers执行
+SERVER_EXPIRE_SWEEPER = {
+    'CONCURRENCY': 16,          # 并发请求服务删除的总数
+    'PER_SERVICE': 4,           # 每个服务并发删除数
+    'BATCH_SIZE': 200,          # 每批归档的云服务器数
+    'REQUEST_TIMEOUT': 60,      # 每次请求服务的截止时间(秒)
+}
+
+# 创建资源时预留的资源配额，超过有效期未确认的预留由管理命令reap_quota_reservations释放
+QUOTA_RESERVATION = {
+    'TTL': 600,                 # 预留的有效期(秒)
+    'REAP_INTERVAL': 60,        # 回收每轮间隔(秒)
+    'REAP_BATCH_SIZE': 100,     # 回收每批处理的预留数
+    'RETENTION': 7 * 24 * 3600,     # 已确认、已释放和过期释放的预留记录保留时间(秒)，之后由回收任务删除，0不删除
+}
+
+# 服务资源配额分片计数，减少创建/删除资源集中更新服务配额一行的争用；分片由管理命令fold_quota_shards定期合并
+SERVICE_QUOTA_SHARDS = {
+    'ENABLED': False,           # 是否使用分片计数模式
+    'SHARDS': 8,                # 每个服务配额的分片数
+    'FOLD_INTERVAL': 60,        # 分片合并间隔(秒)
+}
+
+# 列表分页总数缓存，模型实例保存或删除后失效；数据量大时可返回估算的总数，响应中"approximate"为true
+PAGINATION_COUNT = {
+    'TTL': 30,                      # 总数缓存时间(秒)，0不缓存
+    'APPROXIMATE_THRESHOLD': 0,     # 执行计划估算行数不少于此值时返回估算的总数(MySQL/PostgreSQL)，0不估算
+}
+
+# API条件GET(ETag/If-None-Match)，由数据版本号生成ETag，数据未修改时返回304
+API_ETAG = {
+    'MAX_AGE': 60,      # ETag最长有效时间(秒)，覆盖不发送信号的批量修改，0不限制
+}
 
 # 跨域
 # CORS_ALLOWED_ORIGINS = [
@@ -0,0 +1,23 @@
+from django.contrib import admin
+from django.utils.translation import gettext_lazy, gettext as _
+from django.contrib import messages
+
+from .models import Job
+from .managers import JobManager
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'name', 'status', 'attempts', 'max_attempts', 'service', 'run_after', 'locked_by',
+                    'creation_time', 'finished_time', 'last_error')
+    list_select_related = ('service',)
+    list_filter = ('status', 'name', 'service')
+    search_fields = ('name', 'params')
+    actions = ['requeue']
+
+    def requeue(self, request, queryset):
+        count = JobManager.requeue([j.id for j in queryset])
+        self.message_user(request, _("重新排队的任务数:") + str(count), level=messages.SUCCESS)
+
+    requeue.short_description = gettext_lazy('失败的任务重新排队')
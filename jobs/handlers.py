@@ -0,0 +1,103 @@
+"""
+任务处理函数
+
+处理函数handler(job, params)正常返回表示任务成功；抛出RetryJob或其他错误时任务失败，按退避延时重试
+"""
+from adapters import inputs
+from core import request
+from core import errors as exceptions
+from core.quota import QuotaAPI
+from servers.models import Server
+from .managers import JobManager
+
+
+class RetryJob(Exception):
+    """
+    任务未完成，稍后重试
+
+    :param delay: 重试延时(秒)，默认按执行次数指数退避
+    """
+    def __init__(self, message: str = '', delay: float = None):
+        super().__init__(message)
+        self.delay = delay
+
+
+_handlers = {}
+
+
+def register(name: str):
+    """
+    注册任务处理函数的装饰器
+    """
+    def decorator(func):
+        _handlers[name] = func
+        return func
+
+    return decorator
+
+
+def get_handler(name: str):
+    return _handlers.get(name)
+
+
+JOB_SERVER_DELETE = 'server_delete'
+JOB_SERVER_ARCHIVE = 'server_archive'
+
+
+def archive_server(server):
+    """
+    云服务器归档，释放资源配额
+
+    :raises: RetryJob   # 归档失败
+    """
+    if not server.do_archive():
+        raise RetryJob('Failed to archive server')
+
+    try:
+        QuotaAPI().server_quota_release(service=server.service, vcpu=server.vcpus,
+                                        ram=server.ram, public_ip=server.public_ip)
+    except exceptions.Error as e:
+        pass
+
+
+@register(JOB_SERVER_DELETE)
+def server_delete(job, params: dict):
+    """
+    删除服务中的云服务器，并归档；服务中云服务器不存在(如之前超时的删除请求已完成)时直接归档
+
+    params: {'server_id': 'xxx', 'force': False}
+    """
+    server = Server.objects.select_related('service').filter(id=params.get('server_id')).first()
+    if server is None:      # 已删除
+        return
+
+    p = inputs.ServerDeleteInput(server_id=server.instance_id, force=params.get('force', False))
+    try:
+        request.request_service(server.service, method='server_delete', params=p)
+    except exceptions.NotFound:     # 包括ServerNotExist
+        pass
+
+    archive_server(server)
+
+
+@register(JOB_SERVER_ARCHIVE)
+def server_archive(job, params: dict):
+    """
+    云服务器归档
+
+    params: {'server_id': 'xxx'}
+    """
+    server = Server.objects.select_related('service').filter(id=params.get('server_id')).first()
+    if server is None:
+        return
+
+    archive_server(server)
+
+
+def enqueue_server_delete(server, force: bool = False):
+    return JobManager().enqueue(name=JOB_SERVER_DELETE, params={'server_id': server.id, 'force': force},
+                                service=server.service)
+
+
+def enqueue_server_archive(server):
+    return JobManager().enqueue(name=JOB_SERVER_ARCHIVE, params={'server_id': server.id})
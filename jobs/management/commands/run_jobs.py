@@ -0,0 +1,30 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from jobs.worker import JobWorker
+
+
+class Command(BaseCommand):
+    help = '执行异步任务队列中的任务'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None, help='并发执行的任务数')
+        parser.add_argument('--name', action='append', dest='names', default=None, help='只执行此类型的任务，可多次指定')
+        parser.add_argument('--once', action='store_true', default=False, help='只领取执行一批任务后退出')
+
+    def handle(self, *args, **options):
+        worker = JobWorker(concurrency=options['concurrency'], names=options['names'])
+        if options['once']:
+            count = worker.run_once()
+            self.stdout.write(self.style.SUCCESS(f'{count} jobs executed, {worker.stats}'))
+            return
+
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop_event.set())
+
+        self.stdout.write(f'job worker {worker.worker_id} started, concurrency {worker.concurrency}')
+        worker.run(stop_event=stop_event)
+        self.stdout.write(self.style.SUCCESS(f'job worker stopped, {worker.stats}'))
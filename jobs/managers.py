@@ -0,0 +1,166 @@
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import Job
+
+
+DEFAULT_JOBS = {
+    'CONCURRENCY': 4,               # 每个worker并发执行的任务数
+    'POLL_INTERVAL': 1,             # 没有可执行任务时的轮询间隔，单位秒
+    'VISIBILITY_TIMEOUT': 300,      # 领取任务的租约时间(秒)，超时未完成的任务可被重新领取
+    'MAX_PER_SERVICE': 2,           # 每个服务同时执行的任务数，0不限制
+    'MAX_ATTEMPTS': 5,              # 默认每个任务最多执行次数
+    'BACKOFF_BASE': 5,              # 重试退避初始延时，单位秒
+    'BACKOFF_MAX': 600,             # 重试退避最大延时，单位秒
+    'SERVER_DELETE_RETRY': False,   # 删除云服务器请求服务超时或服务不可用时，是否加入任务队列重试(须运行run_jobs)
+}
+
+
+def get_jobs_config():
+    c = dict(DEFAULT_JOBS)
+    c.update(getattr(settings, 'JOBS', {}))
+    return c
+
+
+class JobManager:
+    """
+    异步任务管理器
+    """
+    def __init__(self, config: dict = None):
+        self.config = get_jobs_config()
+        self.config.update(config or {})
+
+    def enqueue(self, name: str, params: dict = None, service=None, max_attempts: int = None,
+                delay: float = 0) -> Job:
+        """
+        添加一个任务
+
+        :param name: 任务类型，对应的处理函数见handlers
+        :param params: 任务参数，可json序列化
+        :param service: 任务相关的服务，用于限制每个服务的并发任务数
+        :param max_attempts: 最多执行次数
+        :param delay: 多少秒后执行
+        """
+        job = Job(name=name, params=json.dumps(params or {}), service=service,
+                  max_attempts=max_attempts if max_attempts else self.config['MAX_ATTEMPTS'],
+                  run_after=timezone.now() + timedelta(seconds=delay))
+        job.save(force_insert=True)
+        return job
+
+    def lease(self, worker_id: str, limit: int, names: list = None):
+        """
+        领取可执行的任务
+
+        候选任务行在支持的数据库(MySQL 8、PostgreSQL)上用SELECT ... FOR UPDATE SKIP LOCKED加锁，多个worker互不等待；
+        每个任务再用带执行次数条件的UPDATE领取，不支持行锁的数据库(SQLite)也不会重复领取
+
+        :param worker_id: 执行者
+        :param limit: 最多领取任务数
+        :param names: 只领取这些类型的任务，默认所有
+        :return:
+            [Job(), ]
+        """
+        if limit <= 0:
+            return []
+
+        now = timezone.now()
+        visible_until = now + timedelta(seconds=self.config['VISIBILITY_TIMEOUT'])
+        max_per_service = self.config['MAX_PER_SERVICE']
+        leased = []
+        with transaction.atomic():
+            qs = Job.objects.filter(status__in=[Job.Status.QUEUED, Job.Status.RUNNING],
+                                    run_after__lte=now).order_by('run_after')
+            if names:
+                qs = qs.filter(name__in=names)
+            if connection.features.has_select_for_update_skip_locked:
+                qs = qs.select_for_update(skip_locked=True)
+
+            candidates = list(qs[:limit * 4])   # 部分任务可能因服务并发限制跳过
+            running = {}
+            if max_per_service:
+                service_ids = {j.service_id for j in candidates if j.service_id}
+                if service_ids:
+                    running = dict(Job.objects.filter(
+                        status=Job.Status.RUNNING, run_after__gt=now, service_id__in=service_ids
+                    ).values_list('service_id').annotate(count=Count('id')).order_by())
+
+            for job in candidates:
+                if len(leased) >= limit:
+                    break
+
+                if job.status == Job.Status.RUNNING and job.attempts >= job.max_attempts:
+                    # 最后一次执行超时未完成
+                    Job.objects.filter(id=job.id, status=job.status, attempts=job.attempts).update(
+                        status=Job.Status.DEAD, last_error='visibility timeout', finished_time=now,
+                        update_time=now)
+                    continue
+
+                if max_per_service and job.service_id and running.get(job.service_id, 0) >= max_per_service:
+                    continue
+
+                rows = Job.objects.filter(id=job.id, status=job.status, attempts=job.attempts).update(
+                    status=Job.Status.RUNNING, locked_by=worker_id, run_after=visible_until,
+                    attempts=F('attempts') + 1, update_time=now)
+                if rows == 0:   # 已被其他worker领取
+                    continue
+
+                job.status = Job.Status.RUNNING
+                job.locked_by = worker_id
+                job.run_after = visible_until
+                job.attempts += 1
+                leased.append(job)
+                if job.service_id:
+                    running[job.service_id] = running.get(job.service_id, 0) + 1
+
+        return leased
+
+    @staticmethod
+    def complete(job: Job):
+        """
+        任务执行成功
+
+        :return:
+            True
+            False   # 租约已过期，任务已被其他worker领取
+        """
+        now = timezone.now()
+        rows = Job.objects.filter(id=job.id, status=Job.Status.RUNNING, locked_by=job.locked_by,
+                                  attempts=job.attempts).update(
+            status=Job.Status.SUCCEEDED, locked_by='', finished_time=now, update_time=now)
+        return rows > 0
+
+    def fail(self, job: Job, error: str, retry: bool = True, delay: float = None):
+        """
+        任务执行失败，未超过最多执行次数时退避后重试，否则进入失败(死信)状态
+
+        :param retry: False(不再重试)
+        :param delay: 重试延时(秒)，默认按执行次数指数退避
+        :return:
+            True
+            False   # 租约已过期，任务已被其他worker领取
+        """
+        now = timezone.now()
+        values = {'locked_by': '', 'last_error': error[:2000], 'update_time': now}
+        if retry and job.attempts < job.max_attempts:
+            if delay is None:
+                delay = min(self.config['BACKOFF_BASE'] * 2 ** (job.attempts - 1), self.config['BACKOFF_MAX'])
+            values.update(status=Job.Status.QUEUED, run_after=now + timedelta(seconds=delay))
+        else:
+            values.update(status=Job.Status.DEAD, finished_time=now)
+
+        rows = Job.objects.filter(id=job.id, status=Job.Status.RUNNING, locked_by=job.locked_by,
+                                  attempts=job.attempts).update(**values)
+        return rows > 0
+
+    @staticmethod
+    def requeue(job_ids: list):
+        """
+        失败(死信)的任务重新排队
+        """
+        return Job.objects.filter(id__in=job_ids, status=Job.Status.DEAD).update(
+            status=Job.Status.QUEUED, attempts=0, run_after=timezone.now(), finished_time=None)
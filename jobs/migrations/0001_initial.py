@@ -0,0 +1,45 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('service', '0005_alter_serviceconfig_extra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, verbose_name='任务类型')),
+                ('params', models.TextField(blank=True, default='{}', help_text='json格式', verbose_name='参数')),
+                ('status', models.CharField(choices=[('queued', '排队中'), ('running', '执行中'), ('succeeded', '成功'), ('dead', '失败')], default='queued', max_length=16, verbose_name='状态')),
+                ('attempts', models.IntegerField(default=0, verbose_name='已执行次数')),
+                ('max_attempts', models.IntegerField(default=5, verbose_name='最多执行次数')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='可执行时间')),
+                ('locked_by', models.CharField(blank=True, default='', max_length=64, verbose_name='执行者')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='最后的错误')),
+                ('creation_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('finished_time', models.DateTimeField(blank=True, default=None, null=True, verbose_name='完成时间')),
+                ('service', models.ForeignKey(blank=True, help_text='用于限制每个服务的并发任务数', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='service.serviceconfig', verbose_name='服务')),
+            ],
+            options={
+                'verbose_name': '异步任务',
+                'verbose_name_plural': '异步任务',
+                'db_table': 'job',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'run_after'], name='idx_job_status_run_after'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+import json
+
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from service.models import ServiceConfig
+
+
+class Job(models.Model):
+    """
+    持久化的异步任务
+
+    run_after是任务下次可见(可被领取)的时间：排队中的任务到此时间后执行；
+    执行中的任务是领取租约的到期时间(visibility timeout)，到期未完成(如worker进程退出)可被其他worker重新领取
+    """
+    class Status(models.TextChoices):
+        QUEUED = 'queued', _('排队中')
+        RUNNING = 'running', _('执行中')
+        SUCCEEDED = 'succeeded', _('成功')
+        DEAD = 'dead', _('失败')
+
+    name = models.CharField(verbose_name=_('任务类型'), max_length=64)
+    params = models.TextField(verbose_name=_('参数'), blank=True, default='{}', help_text=_('json格式'))
+    service = models.ForeignKey(to=ServiceConfig, null=True, blank=True, on_delete=models.SET_NULL,
+                                related_name='+', verbose_name=_('服务'), help_text=_('用于限制每个服务的并发任务数'))
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.IntegerField(verbose_name=_('已执行次数'), default=0)
+    max_attempts = models.IntegerField(verbose_name=_('最多执行次数'), default=5)
+    run_after = models.DateTimeField(verbose_name=_('可执行时间'), default=timezone.now)
+    locked_by = models.CharField(verbose_name=_('执行者'), max_length=64, blank=True, default='')
+    last_error = models.TextField(verbose_name=_('最后的错误'), blank=True, default='')
+    creation_time = models.DateTimeField(verbose_name=_('创建时间'), auto_now_add=True)
+    update_time = models.DateTimeField(verbose_name=_('更新时间'), auto_now=True)
+    finished_time = models.DateTimeField(verbose_name=_('完成时间'), null=True, blank=True, default=None)
+
+    class Meta:
+        db_table = 'job'
+        ordering = ['-id']
+        verbose_name = _('异步任务')
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='idx_job_status_run_after'),
+        ]
+
+    def __str__(self):
+        return f'{self.name}[{self.id}]'
+
+    def get_params(self) -> dict:
+        try:
+            params = json.loads(self.params)
+        except (json.JSONDecodeError, TypeError):
+            return {}
+
+        return params if isinstance(params, dict) else {}
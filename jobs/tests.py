@@ -0,0 +1,124 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from utils.test import get_or_create_service
+from core import errors
+from servers.models import Server, ServerArchive
+from .models import Job
+from .managers import JobManager
+from .handlers import register, RetryJob, enqueue_server_delete
+from .worker import JobWorker
+
+
+calls = []
+
+
+@register('test_ok')
+def job_ok(job, params):
+    calls.append(params['n'])
+
+
+@register('test_retry')
+def job_retry(job, params):
+    raise RetryJob('not ready')
+
+
+class JobManagerTests(TestCase):
+    def setUp(self):
+        self.service = get_or_create_service()
+        calls.clear()
+
+    def test_lease(self):
+        mgr = JobManager(config={'MAX_PER_SERVICE': 1})
+        j1 = mgr.enqueue(name='test_ok', params={'n': 1}, service=self.service)
+        j2 = mgr.enqueue(name='test_ok', params={'n': 2}, service=self.service)
+        j3 = mgr.enqueue(name='test_ok', params={'n': 3})
+        mgr.enqueue(name='test_ok', params={'n': 4}, delay=60)
+
+        # 每个服务并发1，延时的任务未到执行时间
+        jobs = mgr.lease(worker_id='w1', limit=10)
+        self.assertEqual({j.id for j in jobs}, {j1.id, j3.id})
+        self.assertEqual(mgr.lease(worker_id='w2', limit=10), [])
+
+        self.assertTrue(mgr.complete(jobs[0]))
+        jobs = mgr.lease(worker_id='w2', limit=10)
+        self.assertEqual([j.id for j in jobs], [j2.id])
+        self.assertEqual(Job.objects.get(id=j1.id).status, Job.Status.SUCCEEDED)
+
+    def test_visibility_timeout(self):
+        mgr = JobManager(config={'VISIBILITY_TIMEOUT': 0})
+        job = mgr.enqueue(name='test_ok', params={'n': 1}, max_attempts=2)
+        leased1 = mgr.lease(worker_id='w1', limit=1)[0]
+
+        # 租约到期，被其他worker重新领取，原worker不能再完成任务
+        leased2 = mgr.lease(worker_id='w2', limit=1)[0]
+        self.assertEqual(leased2.attempts, 2)
+        self.assertFalse(mgr.complete(leased1))
+
+        # 最后一次执行也超时，进入失败状态
+        self.assertEqual(mgr.lease(worker_id='w3', limit=1), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.DEAD)
+        self.assertEqual(JobManager.requeue([job.id]), 1)
+
+    def test_worker(self):
+        mgr = JobManager()
+        ok = mgr.enqueue(name='test_ok', params={'n': 1})
+        retry = mgr.enqueue(name='test_retry', max_attempts=2)
+        unknown = mgr.enqueue(name='test_unknown')
+
+        worker = JobWorker(concurrency=10)
+        self.assertEqual(worker.run_once(), 3)
+        self.assertEqual(calls, [1])
+        self.assertEqual(worker.stats, {'succeeded': 1, 'retried': 1, 'dead': 1})
+
+        ok.refresh_from_db()
+        retry.refresh_from_db()
+        unknown.refresh_from_db()
+        self.assertEqual(ok.status, Job.Status.SUCCEEDED)
+        self.assertEqual(retry.status, Job.Status.QUEUED)
+        self.assertGreater(retry.run_after, timezone.now())
+        self.assertEqual(retry.last_error, 'not ready')
+        self.assertEqual(unknown.status, Job.Status.DEAD)
+
+        # 退避到期后重试，超过最多执行次数
+        Job.objects.filter(id=retry.id).update(run_after=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(worker.run_once(), 1)
+        retry.refresh_from_db()
+        self.assertEqual(retry.status, Job.Status.DEAD)
+        self.assertEqual(retry.attempts, 2)
+
+    def test_server_delete(self):
+        server = Server(service=self.service, instance_id='test', vcpus=1, ram=1024)
+        server.save()
+        job = enqueue_server_delete(server)
+
+        # 服务中已不存在(如之前超时的删除请求已完成)，直接归档
+        with mock.patch('core.request.request_service', side_effect=errors.ServerNotExist()):
+            self.assertEqual(JobWorker(concurrency=1).run_once(), 1)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.SUCCEEDED)
+        self.assertFalse(Server.objects.filter(id=server.id).exists())
+        self.assertTrue(ServerArchive.objects.filter(instance_id='test').exists())
+
+
+    def test_archive_failed_retry(self):
+        server = Server(service=self.service, instance_id='test', vcpus=1, ram=1024)
+        server.save()
+        job = enqueue_server_delete(server)
+
+        # 归档失败，任务重试，不释放配额
+        with mock.patch('core.request.request_service'), \
+                mock.patch.object(Server, 'do_archive', return_value=False), \
+                mock.patch('jobs.handlers.QuotaAPI.server_quota_release') as release:
+            self.assertEqual(JobWorker(concurrency=1).run_once(), 1)
+
+        release.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.QUEUED)
+        self.assertEqual(job.last_error, 'Failed to archive server')
+        self.assertTrue(Server.objects.filter(id=server.id).exists())
@@ -0,0 +1,113 @@
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .managers import JobManager
+from .handlers import get_handler, RetryJob
+
+
+class JobWorker:
+    """
+    领取并在线程池中执行任务
+    """
+    def __init__(self, concurrency: int = None, names: list = None, config: dict = None):
+        """
+        :param concurrency: 并发执行的任务数，默认settings.JOBS['CONCURRENCY']
+        :param names: 只执行这些类型的任务，默认所有
+        """
+        self.manager = JobManager(config=config)
+        self.concurrency = concurrency or self.manager.config['CONCURRENCY']
+        self.poll_interval = self.manager.config['POLL_INTERVAL']
+        self.names = names
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{id(self):x}'[:64]
+        self._running = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self.stats = {'succeeded': 0, 'retried': 0, 'dead': 0}
+
+    def execute(self, job):
+        """
+        执行一个任务，并更新任务状态
+        """
+        handler = get_handler(job.name)
+        try:
+            if handler is None:
+                self.manager.fail(job, error=f'no handler for job "{job.name}"', retry=False)
+                self.stats['dead'] += 1
+                return
+
+            try:
+                handler(job, job.get_params())
+            except RetryJob as exc:
+                self._failed(job, error=str(exc), delay=exc.delay)
+            except Exception as exc:
+                self._failed(job, error=f'{type(exc).__name__}: {exc}')
+            else:
+                self.manager.complete(job)
+                self.stats['succeeded'] += 1
+        finally:
+            close_old_connections()
+
+    def _failed(self, job, error: str, delay: float = None):
+        self.manager.fail(job, error=error, delay=delay)
+        if job.attempts < job.max_attempts:
+            self.stats['retried'] += 1
+        else:
+            self.stats['dead'] += 1
+
+    def run_once(self):
+        """
+        领取一批任务，同步执行
+
+        :return:
+            int     # 执行的任务数
+        """
+        jobs = self.manager.lease(worker_id=self.worker_id, limit=self.concurrency, names=self.names)
+        for job in jobs:
+            self.execute(job)
+
+        return len(jobs)
+
+    def run(self, stop_event: threading.Event = None):
+        """
+        循环领取任务，在线程池中执行，直到stop_event被设置；退出前等待执行中的任务完成
+        """
+        stop_event = stop_event or threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            while not stop_event.is_set():
+                close_old_connections()
+                with self._lock:
+                    free = self.concurrency - self._running
+
+                jobs = []
+                if free > 0:
+                    try:
+                        jobs = self.manager.lease(worker_id=self.worker_id, limit=free, names=self.names)
+                    except Exception:
+                        jobs = []
+
+                for job in jobs:
+                    with self._lock:
+                        self._running += 1
+                        self._idle.clear()
+                    executor.submit(self._execute_and_release, job)
+
+                if not jobs:
+                    stop_event.wait(self.poll_interval)
+                elif len(jobs) >= free:     # 没有空闲线程，等待任务完成
+                    self._idle.wait(self.poll_interval)
+        finally:
+            executor.shutdown(wait=True)
+            close_old_connections()
+
+    def _execute_and_release(self, job):
+        try:
+            self.execute(job)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._idle.set()
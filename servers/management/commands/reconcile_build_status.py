@@ -0,0 +1,28 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from core.taskqueue.server_build_status import BuildStatusReconciler
+
+
+class Command(BaseCommand):
+    help = '定期查询创建中的云服务器的状态，更新云服务器信息和创建状态'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False, help='只查询一轮后退出')
+        parser.add_argument('--interval', type=float, default=None, help='每轮查询间隔(秒)')
+
+    def handle(self, *args, **options):
+        config = {}
+        if options['interval']:
+            config['INTERVAL'] = options['interval']
+
+        reconciler = BuildStatusReconciler(config=config)
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop_event.set())
+
+        self.stdout.write('build status reconciler started')
+        reconciler.run(stop_event=stop_event, once=options['once'])
+        self.stdout.write(self.style.SUCCESS(f'build status reconciler stopped, {reconciler.stats}'))
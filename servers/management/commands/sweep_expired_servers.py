@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from core.taskqueue.server_expire import ExpiredServerSweeper
+
+
+class Command(BaseCommand):
+    help = '删除已过期的云服务器，批量归档并释放资源配额'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False, help='只统计过期的云服务器，不删除')
+        parser.add_argument('--force', action='store_true', default=False, help='强制删除')
+        parser.add_argument('--limit', type=int, default=None, help='最多处理的云服务器数')
+        parser.add_argument('--concurrency', type=int, default=None, help='并发请求服务删除的总数')
+        parser.add_argument('--per-service', type=int, default=None, help='每个服务并发删除数')
+
+    def handle(self, *args, **options):
+        config = {}
+        if options['concurrency']:
+            config['CONCURRENCY'] = options['concurrency']
+        if options['per_service']:
+            config['PER_SERVICE'] = options['per_service']
+
+        sweeper = ExpiredServerSweeper(config=config, dry_run=options['dry_run'], force=options['force'])
+        count = sweeper.sweep(limit=options['limit'])
+        stats = sweeper.stats
+        if options['dry_run']:
+            self.stdout.write(f'{count} expired servers found (dry run)')
+            return
+
+        seconds = stats['seconds']
+        rate = stats['archived'] / seconds if seconds > 0 else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['archived']}/{stats['expired']} expired servers archived, {stats['failed']} failed "
+            f"in {seconds:.2f}s, {rate:.1f} servers/s"))
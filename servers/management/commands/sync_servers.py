@@ -0,0 +1,29 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from core.taskqueue.server_sync import ServerMetadataSync
+
+
+class Command(BaseCommand):
+    help = '定期按服务批量同步云服务器的元数据(vcpus、ram、ipv4、image、public_ip)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False, help='只同步一轮后退出')
+        parser.add_argument('--interval', type=float, default=None, help='每轮同步间隔(秒)')
+        parser.add_argument('--service', action='append', default=None, help='只同步指定id的服务，可多次指定')
+
+    def handle(self, *args, **options):
+        config = {}
+        if options['interval']:
+            config['INTERVAL'] = options['interval']
+
+        syncer = ServerMetadataSync(config=config)
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop_event.set())
+
+        self.stdout.write('server metadata sync started')
+        syncer.run(stop_event=stop_event, once=options['once'], service_ids=options['service'])
+        self.stdout.write(self.style.SUCCESS(f'server metadata sync stopped, {syncer.stats}'))
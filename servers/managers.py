@@ -1,7 +1,7 @@
 from django.utils.translation import gettext as _
 
 from core import errors
-from vo.managers import VoManager
+from vo.managers import VoManager, VoMemberManager
 from .models import Server, ServerArchive
 
 
@@ -91,6 +91,53 @@ class ServerManager:
         return self.get_permission_server(server_id=server_id, user=user, related_fields=related_fields,
                                           read_only=True)
 
+    def get_read_perm_servers(self, server_ids: list, user, related_fields: list = None):
+        """
+        批量查询用户有访问权限的虚拟服务器实例，一次查询server，一次查询vo组员关系
+
+        :return:
+            (
+                [Server(), ],               # 有访问权限的server
+                {server_id: Error(), }      # 不存在或无权限的server
+            )
+        """
+        fields = ['service', 'user_quota', 'vo']
+        if related_fields:
+            for f in related_fields:
+                if f not in fields:
+                    fields.append(f)
+
+        servers = {s.id: s for s in Server.objects.filter(id__in=server_ids).select_related(*fields)}
+        vo_ids = {s.vo_id for s in servers.values()
+                  if s.classification == Server.Classification.VO and s.vo is not None and s.vo.owner_id != user.id}
+        member_vo_ids = set()
+        if vo_ids:
+            member_vo_ids = set(VoMemberManager.get_queryset().filter(
+                vo_id__in=vo_ids, user_id=user.id).values_list('vo_id', flat=True))
+
+        allowed = []
+        errs = {}
+        for server_id in server_ids:
+            server = servers.get(server_id)
+            if server is None:
+                errs[server_id] = errors.NotFound(_('服务器实例不存在'))
+            elif server.classification == Server.Classification.PERSONAL:
+                if server.user_has_perms(user):
+                    allowed.append(server)
+                else:
+                    errs[server_id] = errors.AccessDenied(_('无权限访问此服务器实例'))
+            elif server.classification == Server.Classification.VO:
+                if server.vo is None:
+                    errs[server_id] = errors.ConflictError(message=_('vo组信息丢失，无法判断你是否有权限访问'))
+                elif server.vo.owner_id == user.id or server.vo_id in member_vo_ids:
+                    allowed.append(server)
+                else:
+                    errs[server_id] = errors.AccessDenied(message=_('你不属于此项目组，没有访问权限'))
+            else:
+                allowed.append(server)
+
+        return allowed, errs
+
 
 class ServerArchiveManager:
     @staticmethod
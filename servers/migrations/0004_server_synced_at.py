@@ -0,0 +1,18 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servers', '0003_auto_20210629_0911'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='server',
+            name='synced_at',
+            field=models.DateTimeField(blank=True, default=None, null=True, verbose_name='元数据同步时间'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servers', '0004_server_synced_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['expiration_time'], name='idx_server_expiration_time'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servers', '0005_server_expiration_time_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['user', 'creation_time', 'id'], name='idx_server_user_ctime'),
+        ),
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['vo', 'creation_time', 'id'], name='idx_server_vo_ctime'),
+        ),
+        migrations.AddIndex(
+            model_name='serverarchive',
+            index=models.Index(fields=['user', 'deleted_time', 'id'], name='idx_archive_user_dtime'),
+        ),
+        migrations.AddIndex(
+            model_name='serverarchive',
+            index=models.Index(fields=['vo', 'deleted_time', 'id'], name='idx_archive_vo_dtime'),
+        ),
+    ]
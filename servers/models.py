@@ -1,6 +1,6 @@
 from uuid import uuid1
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Count, Sum, Q
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import get_user_model
@@ -8,6 +8,7 @@ from django.utils import timezone
 
 from service.models import ServiceConfig, UserQuota
 from vo.models import VirtualOrganization
+from core.model_version import model_version
 
 User = get_user_model()
 
@@ -88,10 +89,10 @@ class ServerBase(models.Model):
         """是否使用的数据中心私有资源配额"""
         return self.center_quota == self.QUOTA_PRIVATE
 
-    @staticmethod
-    def count_user_quota_used(user_quota):
+    @classmethod
+    def count_user_quota_used(cls, user_quota):
         """
-        用户资源配额已用统计
+        用户资源配额已用统计(Server或ServerArchive各自的记录)
 
         :param user_quota: 用户配额
         :return:
@@ -102,7 +103,7 @@ class ServerBase(models.Model):
                 'private_ip_count': 1
             }
         """
-        stat = Server.objects.filter(user_quota=user_quota).aggregate(
+        stat = cls.objects.filter(user_quota=user_quota).aggregate(
             vcpu_used_count=Sum('vcpus'), ram_used_count=Sum('ram'),
             public_ip_count=Count('id', filter=Q(public_ip=True)),
             private_ip_count=Count('id', filter=Q(public_ip=False))
@@ -128,11 +129,18 @@ class Server(ServerBase):
                                    related_name='quota_servers', verbose_name=_('所属用户配额'))
     vo = models.ForeignKey(to=VirtualOrganization, null=True, on_delete=models.SET_NULL, default=None,
                            related_name='vo_server_set', verbose_name=_('项目组'))
+    synced_at = models.DateTimeField(verbose_name=_('元数据同步时间'), null=True, blank=True, default=None)
 
     class Meta:
         ordering = ['-creation_time']
         verbose_name = _('虚拟服务器')
         verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['expiration_time'], name='idx_server_expiration_time'),
+            # 游标分页
+            models.Index(fields=['user', 'creation_time', 'id'], name='idx_server_user_ctime'),
+            models.Index(fields=['vo', 'creation_time', 'id'], name='idx_server_vo_ctime'),
+        ]
 
     def user_has_perms(self, user):
         """
@@ -191,6 +199,48 @@ class Server(ServerBase):
 
         return True
 
+    def build_archive(self, deleted_time=None):
+        """
+        构建归档记录对象，不保存
+        """
+        return ServerArchive(
+            id=get_uuid1_str(), service_id=self.service_id, name=self.name, instance_id=self.instance_id,
+            vcpus=self.vcpus, ram=self.ram, ipv4=self.ipv4, public_ip=self.public_ip, image=self.image,
+            creation_time=self.creation_time, remarks=self.remarks, user_id=self.user_id, vo_id=self.vo_id,
+            deleted_time=deleted_time if deleted_time else timezone.now(), task_status=self.task_status,
+            center_quota=self.center_quota, user_quota_id=self.user_quota_id,
+            expiration_time=self.expiration_time, classification=self.classification
+        )
+
+    @staticmethod
+    def bulk_archive(servers: list):
+        """
+        批量创建归档记录，并删除云服务器，在一个事务中；
+        锁定仍存在的云服务器记录，只归档和删除这些(已被其他请求删除归档的不重复归档)
+
+        :param servers: 云服务器对象列表
+        :return:
+            list    # 归档(本次删除)的云服务器
+
+        :raises: Exception
+        """
+        if not servers:
+            return []
+
+        now = timezone.now()
+        with transaction.atomic():
+            ids = set(Server.objects.select_for_update().filter(
+                id__in=[s.id for s in servers]).values_list('id', flat=True))
+            servers = [s for s in servers if s.id in ids]
+            if not servers:
+                return []
+
+            ServerArchive.objects.bulk_create([s.build_archive(deleted_time=now) for s in servers])
+            Server.objects.filter(id__in=ids).delete()
+            model_version.bump(ServerArchive._meta.db_table)    # bulk_create()不发送信号
+
+        return servers
+
     @staticmethod
     def count_private_quota_used(service):
         """
@@ -274,6 +324,11 @@ class ServerArchive(ServerBase):
         ordering = ['-deleted_time']
         verbose_name = _('服务器归档记录')
         verbose_name_plural = verbose_name
+        indexes = [
+            # 游标分页
+            models.Index(fields=['user', 'deleted_time', 'id'], name='idx_archive_user_dtime'),
+            models.Index(fields=['vo', 'deleted_time', 'id'], name='idx_archive_vo_dtime'),
+        ]
 
 
 class Flavor(models.Model):
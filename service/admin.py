@@ -1,12 +1,13 @@
 from django.contrib import admin
 from django.utils.translation import gettext_lazy, gettext as _
 from django.contrib import messages
-from django.db import transaction
 
-from servers.models import Server, ServerArchive
+from core.catalog import catalog_cache
+from core.breaker import breakers
+from .reconcile import QuotaReconciler
 from .models import (
     ServiceConfig, DataCenter, ServicePrivateQuota, ApplyQuota,
-    ServiceShareQuota, UserQuota, ApplyVmService, ApplyOrganization
+    ServiceShareQuota, UserQuota, ApplyVmService, ApplyOrganization, QuotaReservation
 )
 
 
@@ -14,7 +15,7 @@ from .models import (
 class ServiceConfigAdmin(admin.ModelAdmin):
     list_display_links = ('id',)
     list_display = ('id', 'name', 'name_en', 'data_center', 'region_id', 'service_type', 'endpoint_url', 'username', 'password',
-                    'add_time', 'status', 'need_vpn', 'vpn_endpoint_url', 'vpn_password', 'remarks')
+                    'add_time', 'status', 'need_vpn', 'vpn_endpoint_url', 'vpn_password', 'remarks', 'show_breaker_state')
     search_fields = ['name', 'name_en', 'endpoint_url', 'remarks']
     list_filter = ['data_center', 'service_type']
     list_select_related = ('data_center',)
@@ -22,7 +23,12 @@ class ServiceConfigAdmin(admin.ModelAdmin):
     filter_horizontal = ('users',)
     readonly_fields = ('password',)
 
-    actions = ['encrypt_password', 'encrypt_vpn_password']
+    actions = ['encrypt_password', 'encrypt_vpn_password', 'invalidate_catalog_cache', 'close_breaker']
+
+    def show_breaker_state(self, obj):
+        return breakers.get(obj.id).get_state()['state']
+
+    show_breaker_state.short_description = gettext_lazy('熔断器状态')
 
     def encrypt_password(self, request, queryset):
         """
@@ -60,6 +66,32 @@ class ServiceConfigAdmin(admin.ModelAdmin):
 
     encrypt_vpn_password.short_description = gettext_lazy("加密vpn用户密码")
 
+    def invalidate_catalog_cache(self, request, queryset):
+        """
+        镜像、网络等缓存数据失效
+        """
+        count = 0
+        for service in queryset:
+            catalog_cache.invalidate(service.id)
+            count += 1
+
+        self.message_user(request, _("缓存失效的服务数量:") + str(count), level=messages.SUCCESS)
+
+    invalidate_catalog_cache.short_description = gettext_lazy("清除镜像和网络缓存")
+
+    def close_breaker(self, request, queryset):
+        """
+        关闭熔断器，恢复请求服务
+        """
+        count = 0
+        for service in queryset:
+            breakers.get(service.id).close()
+            count += 1
+
+        self.message_user(request, _("关闭熔断器的服务数量:") + str(count), level=messages.SUCCESS)
+
+    close_breaker.short_description = gettext_lazy("关闭熔断器")
+
 
 @admin.register(DataCenter)
 class DataCenterAdmin(admin.ModelAdmin):
@@ -78,43 +110,13 @@ class ServicePrivateQuotaAdmin(admin.ModelAdmin):
     actions = ['quota_used_update']
 
     def quota_used_update(self, request, queryset):
-        failed_count = 0
-        for q in queryset:
-            r = Server.count_private_quota_used(q.service_id)
-
-            with transaction.atomic():
-                quota = ServicePrivateQuota.objects.select_for_update().get(id=q.id)
-                update_fields = []
-                vcpu_used_count = r.get('vcpu_used_count', None)
-                if isinstance(vcpu_used_count, int) and quota.vcpu_used != vcpu_used_count:
-                    quota.vcpu_used = vcpu_used_count
-                    update_fields.append('vcpu_used')
-
-                ram_used_count = r.get('ram_used_count', None)
-                if isinstance(ram_used_count, int) and quota.ram_used != ram_used_count:
-                    quota.ram_used = ram_used_count
-                    update_fields.append('ram_used')
-
-                public_ip_count = r.get('public_ip_count', None)
-                if isinstance(public_ip_count, int) and quota.public_ip_used != public_ip_count:
-                    quota.public_ip_used = public_ip_count
-                    update_fields.append('public_ip_used')
-
-                private_ip_used = r.get('private_ip_count', None)
-                if isinstance(private_ip_used, int) and quota.private_ip_used != private_ip_used:
-                    quota.private_ip_used = private_ip_used
-                    update_fields.append('private_ip_used')
-
-                if update_fields:
-                    try:
-                        quota.save(update_fields=update_fields)
-                    except Exception as e:
-                        failed_count += 1
-
-        if failed_count != 0:
-            self.message_user(request, _("统计更新已用配额失败") + f'({failed_count})', level=messages.ERROR)
-        else:
-            self.message_user(request, _("统计更新已用配额成功"), level=messages.SUCCESS)
+        try:
+            drifts = QuotaReconciler().reconcile(QuotaReconciler.KIND_PRIVATE, queryset=queryset)
+        except Exception as e:
+            self.message_user(request, _("统计更新已用配额失败") + f'({str(e)})', level=messages.ERROR)
+            return
+
+        self.message_user(request, _("统计更新已用配额成功") + f'({len(drifts)})', level=messages.SUCCESS)
 
     quota_used_update.short_description = gettext_lazy("已用配额统计更新")
 
@@ -130,43 +132,13 @@ class ServiceShareQuotaAdmin(admin.ModelAdmin):
     actions = ['quota_used_update']
 
     def quota_used_update(self, request, queryset):
-        failed_count = 0
-        for q in queryset:
-            r = Server.count_share_quota_used(q.service_id)
-
-            with transaction.atomic():
-                quota = ServiceShareQuota.objects.select_for_update().get(id=q.id)
-                update_fields = []
-                vcpu_used_count = r.get('vcpu_used_count', None)
-                if isinstance(vcpu_used_count, int) and quota.vcpu_used != vcpu_used_count:
-                    quota.vcpu_used = vcpu_used_count
-                    update_fields.append('vcpu_used')
-
-                ram_used_count = r.get('ram_used_count', None)
-                if isinstance(ram_used_count, int) and quota.ram_used != ram_used_count:
-                    quota.ram_used = ram_used_count
-                    update_fields.append('ram_used')
-
-                public_ip_count = r.get('public_ip_count', None)
-                if isinstance(public_ip_count, int) and quota.public_ip_used != public_ip_count:
-                    quota.public_ip_used = public_ip_count
-                    update_fields.append('public_ip_used')
-
-                private_ip_used = r.get('private_ip_count', None)
-                if isinstance(private_ip_used, int) and quota.private_ip_used != private_ip_used:
-                    quota.private_ip_used = private_ip_used
-                    update_fields.append('private_ip_used')
-
-                if update_fields:
-                    try:
-                        quota.save(update_fields=update_fields)
-                    except Exception as e:
-                        failed_count += 1
-
-        if failed_count != 0:
-            self.message_user(request, _("统计更新已用配额失败") + f'({failed_count})', level=messages.ERROR)
-        else:
-            self.message_user(request, _("统计更新已用配额成功"), level=messages.SUCCESS)
+        try:
+            drifts = QuotaReconciler().reconcile(QuotaReconciler.KIND_SHARE, queryset=queryset)
+        except Exception as e:
+            self.message_user(request, _("统计更新已用配额失败") + f'({str(e)})', level=messages.ERROR)
+            return
+
+        self.message_user(request, _("统计更新已用配额成功") + f'({len(drifts)})', level=messages.SUCCESS)
 
     quota_used_update.short_description = gettext_lazy("已用配额统计更新")
 
@@ -191,45 +163,13 @@ class UserQuotaAdmin(admin.ModelAdmin):
     show_deleted.short_description = gettext_lazy('删除')
 
     def quota_used_update(self, request, queryset):
-        failed_count = 0
-        for q in queryset:
-            # 虚拟服务器和已归档服务器总的已用资源配额
-            r = Server.count_user_quota_used(q)
-            ar = ServerArchive.count_user_quota_used(q)
-            vcpu_used_count = r.get('vcpu_used_count') + ar.get('vcpu_used_count')
-            ram_used_count = r.get('ram_used_count') + ar.get('ram_used_count')
-            public_ip_count = r.get('public_ip_count') + ar.get('public_ip_count')
-            private_ip_used = r.get('private_ip_count') + ar.get('private_ip_count')
-
-            with transaction.atomic():
-                quota = UserQuota.objects.select_for_update().get(id=q.id)
-                update_fields = []
-                if isinstance(vcpu_used_count, int) and quota.vcpu_used != vcpu_used_count:
-                    quota.vcpu_used = vcpu_used_count
-                    update_fields.append('vcpu_used')
-
-                if isinstance(ram_used_count, int) and quota.ram_used != ram_used_count:
-                    quota.ram_used = ram_used_count
-                    update_fields.append('ram_used')
-
-                if isinstance(public_ip_count, int) and quota.public_ip_used != public_ip_count:
-                    quota.public_ip_used = public_ip_count
-                    update_fields.append('public_ip_used')
-
-                if isinstance(private_ip_used, int) and quota.private_ip_used != private_ip_used:
-                    quota.private_ip_used = private_ip_used
-                    update_fields.append('private_ip_used')
-
-                if update_fields:
-                    try:
-                        quota.save(update_fields=update_fields)
-                    except Exception as e:
-                        failed_count += 1
-
-        if failed_count != 0:
-            self.message_user(request, _("统计更新已用配额失败") + f'({failed_count})', level=messages.ERROR)
-        else:
-            self.message_user(request, _("统计更新已用配额成功"), level=messages.SUCCESS)
+        try:
+            drifts = QuotaReconciler().reconcile(QuotaReconciler.KIND_USER, queryset=queryset)
+        except Exception as e:
+            self.message_user(request, _("统计更新已用配额失败") + f'({str(e)})', level=messages.ERROR)
+            return
+
+        self.message_user(request, _("统计更新已用配额成功") + f'({len(drifts)})', level=messages.SUCCESS)
 
     quota_used_update.short_description = gettext_lazy("已用配额统计更新")
 
@@ -253,3 +193,11 @@ class ApplyQuotaAdmin(admin.ModelAdmin):
     list_display_links = ('id',)
     list_display = ('id', 'vcpu', 'ram', 'disk_size', 'public_ip', 'private_ip', 'status', 'user', 'creation_time', 'approve_time')
 
+
+@admin.register(QuotaReservation)
+class QuotaReservationAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'service', 'user_quota', 'vcpus', 'ram', 'public_ip', 'private_ip', 'status', 'server_id',
+                    'expiration_time', 'creation_time')
+    list_select_related = ('service', 'user_quota')
+    list_filter = ('status', 'service')
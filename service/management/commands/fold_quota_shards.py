@@ -0,0 +1,36 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from service.managers import ServicePrivateQuotaManager, ServiceShareQuotaManager, get_service_quota_shards_config
+
+
+class Command(BaseCommand):
+    help = '定期将服务资源配额的分片计数合并回服务配额行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False, help='只合并一轮后退出')
+        parser.add_argument('--interval', type=float, default=None, help='每轮合并间隔(秒)')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or get_service_quota_shards_config()['FOLD_INTERVAL']
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop_event.set())
+
+        managers = [ServicePrivateQuotaManager(sharded=True), ServiceShareQuotaManager(sharded=True)]
+        total = 0
+        self.stdout.write('quota shards folder started')
+        while not stop_event.is_set():
+            close_old_connections()
+            for mgr in managers:
+                total += mgr.fold_shards()
+
+            if options['once']:
+                break
+
+            stop_event.wait(interval)
+
+        self.stdout.write(self.style.SUCCESS(f'quota shards folder stopped, {total} shards folded'))
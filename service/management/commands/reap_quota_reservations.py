@@ -0,0 +1,46 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from service.managers import QuotaReservationManager, get_quota_reservation_config
+
+
+class Command(BaseCommand):
+    help = '定期释放超过有效期仍未确认的资源配额预留，并删除超过保留时间的已结束预留记录'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False, help='只回收一轮后退出')
+        parser.add_argument('--interval', type=float, default=None, help='每轮回收间隔(秒)')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or get_quota_reservation_config()['REAP_INTERVAL']
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop_event.set())
+
+        mgr = QuotaReservationManager()
+        total = 0
+        purged = 0
+        self.stdout.write('quota reservation reaper started')
+        while not stop_event.is_set():
+            close_old_connections()
+            while True:     # 一轮中分批回收所有过期的预留
+                count = mgr.reap_expired()
+                total += count
+                if count == 0 or stop_event.is_set():
+                    break
+
+            while not stop_event.is_set():
+                count = mgr.purge()
+                purged += count
+                if count == 0:
+                    break
+
+            if options['once']:
+                break
+
+            stop_event.wait(interval)
+
+        self.stdout.write(self.style.SUCCESS(f'quota reservation reaper stopped, {total} reservations released, {purged} purged'))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from service.reconcile import QuotaReconciler
+
+
+class Command(BaseCommand):
+    help = '统计所有资源配额的实际用量，修正已用数的偏差'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False, help='只报告偏差，不修正')
+        parser.add_argument('--kind', action='append', choices=QuotaReconciler.KINDS, default=None,
+                            help='只校正指定类型的配额，可多次指定，默认所有')
+        parser.add_argument('--verbose-drifts', action='store_true', default=False, help='输出每个有偏差的配额')
+
+    def handle(self, *args, **options):
+        reconciler = QuotaReconciler(dry_run=options['dry_run'])
+        for kind in (options['kind'] or QuotaReconciler.KINDS):
+            start = time.monotonic()
+            drifts = reconciler.reconcile(kind)
+            seconds = time.monotonic() - start
+            if options['verbose_drifts']:
+                for quota, diff in drifts:
+                    changes = ', '.join(f'{f}: {old} -> {new}' for f, (old, new) in diff.items())
+                    self.stdout.write(f'  {kind} quota {quota.id}: {changes}')
+
+            action = 'found' if options['dry_run'] else 'fixed'
+            self.stdout.write(self.style.SUCCESS(f'{kind} quotas: {len(drifts)} drifts {action} in {seconds:.2f}s'))
+
+        if reconciler.skipped:
+            self.stdout.write(self.style.WARNING(
+                f'{reconciler.skipped} quotas changed during reconciliation were skipped, run again to fix them'))
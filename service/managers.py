@@ -1,21 +1,90 @@
+import os
+import threading
 from datetime import datetime, timedelta
 
-from django.db import transaction
+from django.db import transaction, IntegrityError
 from django.utils.translation import gettext_lazy, gettext as _
-from django.db.models import Q, Subquery
+from django.db.models import Q, Subquery, OuterRef, F, Sum
+from django.db.models.functions import Greatest, Coalesce
 from django.utils import timezone
 from django.core.cache import cache
+from django.conf import settings
 
 from users.models import UserProfile
 from core import errors
 from core.utils import test_service_ok, InvalidServiceError
+from core.model_version import model_version
 from vo.managers import VoManager
 from .models import (
     UserQuota, ServicePrivateQuota, ServiceShareQuota, ServiceConfig, ApplyVmService,
-    DataCenter, ApplyOrganization, ApplyQuota
+    DataCenter, ApplyOrganization, ApplyQuota, QuotaReservation, ServiceQuotaShard
 )
 
 
+DEDUCT_RETRIES = 3      # 扣除资源配额时，并发修改导致条件更新失败的重试次数
+QUOTA_RESOURCES = (     # (参数名, 配额字段前缀)
+    ('vcpus', 'vcpu'),
+    ('ram', 'ram'),
+    ('disk_size', 'disk_size'),
+    ('public_ip', 'public_ip'),
+    ('private_ip', 'private_ip'),
+)
+
+
+def conditional_deduct(queryset, **amounts):
+    """
+    一条条件UPDATE语句扣除资源配额，所有资源都满足时才扣除，不加行锁
+
+        UPDATE ... SET vcpu_used = vcpu_used + n, ... WHERE vcpu_total >= vcpu_used + n AND ...
+
+    :param queryset: 配额查询集
+    :param amounts: 扣除的资源数，参数名见QUOTA_RESOURCES
+    :return:
+        int     # 更新的行数，0表示配额不存在或资源不足
+    """
+    conditions = {}
+    updates = {}
+    for name, prefix in QUOTA_RESOURCES:
+        n = amounts.get(name, 0)
+        if n > 0:
+            conditions[f'{prefix}_total__gte'] = F(f'{prefix}_used') + n
+            updates[f'{prefix}_used'] = F(f'{prefix}_used') + n
+
+    if not updates:
+        return 1 if queryset.exists() else 0
+
+    rows = queryset.filter(**conditions).update(**updates)
+    if rows:
+        model_version.bump(queryset.model._meta.db_table)   # update()不发送信号
+
+    return rows
+
+
+def conditional_release(queryset, **amounts):
+    """
+    一条UPDATE语句释放已用资源配额，已用数不小于0，不加行锁
+
+    :param queryset: 配额查询集
+    :param amounts: 释放的资源数，参数名见QUOTA_RESOURCES
+    :return:
+        int     # 更新的行数
+    """
+    updates = {}
+    for name, prefix in QUOTA_RESOURCES:
+        n = amounts.get(name, 0)
+        if n > 0:
+            updates[f'{prefix}_used'] = Greatest(F(f'{prefix}_used') - n, 0)
+
+    if not updates:
+        return 0
+
+    rows = queryset.update(**updates)
+    if rows:
+        model_version.bump(queryset.model._meta.db_table)
+
+    return rows
+
+
 class UserQuotaManager:
     """
     用户资源配额管理
@@ -178,57 +247,28 @@ class UserQuotaManager:
         if not quota_id:
             raise errors.QuotaError(_('参数无效，无效的资源配额id'))
 
-        with transaction.atomic():
-            update_fields = []
-            quota = self.MODEL.objects.select_for_update().filter(id=quota_id, user=user).first()
-            if not quota:
-                raise errors.NoSuchQuotaError(_('参数无效，用户没有指定的资源配额'))
-
-            if quota.is_expire_now():
-                raise errors.QuotaShortageError(message=_('您的资源配额已过期'))
-
-            if vcpus > 0:
-                if (quota.vcpu_total - quota.vcpu_used) >= vcpus:
-                    quota.vcpu_used = quota.vcpu_used + vcpus
-                    update_fields.append('vcpu_used')
-                else:
-                    raise errors.QuotaShortageError(message=_('您的vCPU资源配额不足'))
-
-            if ram > 0:
-                if (quota.ram_total - quota.ram_used) >= ram:
-                    quota.ram_used = quota.ram_used + ram
-                    update_fields.append('ram_used')
-                else:
-                    raise errors.QuotaShortageError(message=_('您的Ram资源配额不足'))
-
-            if disk_size > 0:
-                if (quota.disk_size_total - quota.disk_size_used) >= disk_size:
-                    quota.disk_size_used = quota.disk_size_used + disk_size
-                    update_fields.append('disk_size_used')
-                else:
-                    raise errors.QuotaShortageError(message=_('您的硬盘资源配额不足'))
+        queryset = self.MODEL.objects.filter(id=quota_id, user=user)
+        for _i in range(DEDUCT_RETRIES):
+            now = timezone.now()
+            try:
+                rows = conditional_deduct(
+                    queryset.filter(Q(expiration_time__isnull=True) | Q(expiration_time__gt=now)),
+                    vcpus=vcpus, ram=ram, disk_size=disk_size, public_ip=public_ip, private_ip=private_ip)
+            except Exception as e:
+                raise errors.QuotaError(message=_('扣除资源配额失败'))
 
-            if public_ip > 0:
-                if (quota.public_ip_total - quota.public_ip_used) >= public_ip:
-                    quota.public_ip_used = quota.public_ip_used + public_ip
-                    update_fields.append('public_ip_used')
-                else:
-                    raise errors.QuotaShortageError(message=_('您的公网IP资源配额不足'))
+            quota = queryset.first()
+            if rows:
+                return quota
 
-            if private_ip > 0:
-                if (quota.private_ip_total - quota.private_ip_used) >= private_ip:
-                    quota.private_ip_used = quota.private_ip_used + private_ip
-                    update_fields.append('private_ip_used')
-                else:
-                    raise errors.QuotaShortageError(message=_('您的私网IP资源配额不足'))
+            if not quota:
+                raise errors.NoSuchQuotaError(_('参数无效，用户没有指定的资源配额'))
 
-            if update_fields:
-                try:
-                    quota.save(update_fields=update_fields)
-                except Exception as e:
-                    raise errors.QuotaError(message=_('扣除资源配额失败'))
+            # 查明不足的资源；都满足时是并发释放或增加了配额，重试
+            self.requires(quota, vcpus=vcpus, ram=ram, disk_size=disk_size, public_ip=public_ip,
+                          private_ip=private_ip)
 
-        return quota
+        raise errors.QuotaError(message=_('扣除资源配额失败'))
 
     def release(self, user, quota_id: str, vcpus: int = 0, ram: int = 0,
                 disk_size: int = 0, public_ip: int = 0, private_ip: int = 0):
@@ -474,18 +514,190 @@ class UserQuotaManager:
         return queryset.order_by('id')
 
 
+DEFAULT_SERVICE_QUOTA_SHARDS = {
+    'ENABLED': False,           # 服务资源配额是否使用分片计数模式
+    'SHARDS': 8,                # 每个服务配额的分片数
+    'FOLD_INTERVAL': 60,        # 分片合并回服务配额行的间隔，单位秒
+}
+
+
+def get_service_quota_shards_config():
+    c = dict(DEFAULT_SERVICE_QUOTA_SHARDS)
+    c.update(getattr(settings, 'SERVICE_QUOTA_SHARDS', {}))
+    return c
+
+
 class ServiceQuotaManagerBase:
     """
     服务资源配额管理基类
+
+    分片计数模式(sharded)下，已用数的扣除和释放只更新按哈希选择的一个分片行(ServiceQuotaShard)，
+    扣除提交后用一条查询读取服务配额行和所有分片之和检查总量，超出时撤销；分片由fold_shards定期合并回服务配额行。
+    分片的扣除必须先提交，其他进程检查总量时才可见，所以不能在事务中扣除(try_deduct)
     """
     MODEL = None
+    SHARD_QUOTA_TYPE = None     # 分片计数的配额类型，ServiceQuotaShard.QuotaType
     ERROR_MSG_PREFIX = gettext_lazy('服务')
 
+    def __init__(self, sharded: bool = None):
+        """
+        :param sharded: 是否使用分片计数模式，默认settings.SERVICE_QUOTA_SHARDS['ENABLED']
+        """
+        c = get_service_quota_shards_config()
+        self.sharded = c['ENABLED'] if sharded is None else sharded
+        self.shards = max(c['SHARDS'], 1)
+
     def _prefix_msg(self, msg: str):
         return self.ERROR_MSG_PREFIX + ',' + msg
 
+    @staticmethod
+    def _service_id(service):
+        return service.id if isinstance(service, ServiceConfig) else service
+
+    def _shard_queryset(self, service=None):
+        qs = ServiceQuotaShard.objects.filter(quota_type=self.SHARD_QUOTA_TYPE)
+        if service is not None:
+            qs = qs.filter(service_id=self._service_id(service))
+
+        return qs
+
+    def _shard_add(self, service, sign: int, **amounts):
+        """
+        按当前进程和线程的哈希选择一个分片，已用数加(sign=1)或减(sign=-1)资源数
+        """
+        updates = {}
+        for name, prefix in QUOTA_RESOURCES:
+            n = amounts.get(name, 0)
+            if n > 0:
+                updates[f'{prefix}_used'] = F(f'{prefix}_used') + sign * n
+
+        if not updates:
+            return
+
+        shard = hash((os.getpid(), threading.get_ident())) % self.shards
+        queryset = self._shard_queryset(service).filter(shard=shard)
+        if queryset.update(**updates):
+            return
+
+        try:
+            with transaction.atomic():
+                ServiceQuotaShard.objects.create(service_id=self._service_id(service),
+                                                 quota_type=self.SHARD_QUOTA_TYPE, shard=shard)
+        except IntegrityError:      # 并发创建
+            pass
+
+        queryset.update(**updates)
+
+    def _add_shards_used(self, quota):
+        """
+        服务配额对象的已用数加上所有分片之和，不保存
+        """
+        names = [f'{prefix}_used' for _name, prefix in QUOTA_RESOURCES]
+        sums = self._shard_queryset(quota.service_id).aggregate(**{f'sum_{n}': Sum(n) for n in names})
+        for n in names:
+            setattr(quota, n, getattr(quota, n) + (sums[f'sum_{n}'] or 0))
+
+        return quota
+
+    def annotate_shards_used(self, queryset):
+        """
+        服务配额查询添加所有分片已用数之和(sum_<已用数字段名>)，在同一条查询中读取，与并发的分片合并(fold_shards)一致
+        """
+        names = [f'{prefix}_used' for _name, prefix in QUOTA_RESOURCES]
+        shards = ServiceQuotaShard.objects.filter(
+            service_id=OuterRef('service_id'), quota_type=self.SHARD_QUOTA_TYPE
+        ).values('service_id').order_by()
+        annotations = {f'sum_{n}': Coalesce(Subquery(shards.annotate(s=Sum(n)).values('s')[:1]), 0)
+                       for n in names}
+        return queryset.annotate(**annotations)
+
+    def _get_quota_with_shards(self, service):
+        """
+        一条查询读取服务配额和所有分片已用数之和
+
+        :return:
+            self.MODEL() or None    # 已用数包括分片
+        """
+        names = [f'{prefix}_used' for _name, prefix in QUOTA_RESOURCES]
+        quota = self.annotate_shards_used(self.MODEL.objects.filter(service=service)).first()
+        if quota is not None:
+            for n in names:
+                setattr(quota, n, getattr(quota, n) + getattr(quota, f'sum_{n}'))
+
+        return quota
+
+    def try_deduct(self, service, **amounts):
+        """
+        尝试扣除资源，不加行锁；分片计数模式下不能在事务中调用
+
+        :param amounts: 扣除的资源数，参数名见QUOTA_RESOURCES
+        :return:
+            True
+            False   # 配额不存在或资源不足
+
+        :raises: QuotaError
+        """
+        if not self.sharded:
+            return conditional_deduct(self.MODEL.objects.filter(service=service), **amounts) > 0
+
+        if transaction.get_connection().in_atomic_block:
+            # 事务中分片的扣除未提交，并发的扣除检查总量时不可见，可能超额
+            raise errors.QuotaError(message=self._prefix_msg(_('分片计数模式下不能在事务中扣除资源配额')))
+
+        self._shard_add(service, 1, **amounts)
+        try:
+            quota = self._get_quota_with_shards(service)
+            ok = quota is not None and all(
+                getattr(quota, f'{prefix}_total') >= getattr(quota, f'{prefix}_used')
+                for name, prefix in QUOTA_RESOURCES if amounts.get(name, 0) > 0)
+        except Exception:
+            ok = None
+
+        if not ok:
+            self._shard_add(service, -1, **amounts)     # 撤销
+            if ok is None:
+                raise errors.QuotaError(message=self._prefix_msg(_('扣除资源配额失败')))
+
+        return bool(ok)
+
+    def release_used(self, service, **amounts):
+        """
+        释放已用资源，不加行锁
+
+        :param amounts: 释放的资源数，参数名见QUOTA_RESOURCES
+        """
+        if self.sharded:
+            self._shard_add(service, -1, **amounts)
+        else:
+            conditional_release(self.MODEL.objects.filter(service=service), **amounts)
+
+    def fold_shards(self, service=None):
+        """
+        分片计数合并回服务配额行
+
+        :param service: 只合并此服务的分片，默认所有
+        :return:
+            int     # 合并的分片数
+        """
+        names = [f'{prefix}_used' for _name, prefix in QUOTA_RESOURCES]
+        shards = self._shard_queryset(service).exclude(**{n: 0 for n in names})
+        count = 0
+        for shard in shards:
+            values = {n: getattr(shard, n) for n in names if getattr(shard, n)}
+            with transaction.atomic():
+                # 相对更新，合并期间的并发计数不会丢失
+                ServiceQuotaShard.objects.filter(id=shard.id).update(**{n: F(n) - v for n, v in values.items()})
+                updates = {n: Greatest(F(n) + v, 0) for n, v in values.items()}
+                if not self.MODEL.objects.filter(service_id=shard.service_id).update(**updates):
+                    self._create_quota(service=shard.service_id)
+                    self.MODEL.objects.filter(service_id=shard.service_id).update(**updates)
+
+            count += 1
+
+        return count
+
     def _create_quota(self, service):
-        quota = self.MODEL(service=service)
+        quota = self.MODEL(service_id=self._service_id(service))
         try:
             quota.save()
         except Exception as e:
@@ -504,6 +716,9 @@ class ServiceQuotaManagerBase:
         if not quota:
             quota = self._create_quota(service=service)
 
+        if quota and self.sharded:
+            self._add_shards_used(quota)
+
         return quota
 
     def deduct(self, service, vcpus: int = 0, ram: int = 0, disk_size: int = 0,
@@ -525,58 +740,30 @@ class ServiceQuotaManagerBase:
         if vcpus < 0 or ram < 0 or disk_size < 0 or public_ip < 0 or private_ip < 0:
             raise errors.QuotaError(_('参数无效，扣除资源配额不得小于0'))
 
-        with transaction.atomic():
-            update_fields = []
-            quota = self.MODEL.objects.select_for_update().filter(service=service).first()
+        queryset = self.MODEL.objects.filter(service=service)
+        for _i in range(DEDUCT_RETRIES):
+            try:
+                ok = self.try_deduct(service, vcpus=vcpus, ram=ram, disk_size=disk_size,
+                                     public_ip=public_ip, private_ip=private_ip)
+            except Exception as e:
+                raise errors.QuotaError(message=self._prefix_msg(_('扣除资源配额失败')))
+
+            quota = queryset.first()
+            if quota and self.sharded:
+                self._add_shards_used(quota)
+            if ok:
+                return quota
+
             if not quota:
                 quota = self._create_quota(service=service)
                 if not quota:
                     raise errors.QuotaError(message=self._prefix_msg(_('创建资源配额失败')))
 
-                quota = self.MODEL.objects.select_for_update().filter(service=service).first()
+            # 查明不足的资源；都满足时是新创建的配额或并发释放、增加了配额，重试
+            self.requires(quota, vcpus=vcpus, ram=ram, disk_size=disk_size, public_ip=public_ip,
+                          private_ip=private_ip)
 
-            if vcpus > 0:
-                if (quota.vcpu_total - quota.vcpu_used) >= vcpus:
-                    quota.vcpu_used = quota.vcpu_used + vcpus
-                    update_fields.append('vcpu_used')
-                else:
-                    raise errors.QuotaShortageError(message=self._prefix_msg(_('vCPU资源配额不足')))
-
-            if ram > 0:
-                if (quota.ram_total - quota.ram_used) >= ram:
-                    quota.ram_used = quota.ram_used + ram
-                    update_fields.append('ram_used')
-                else:
-                    raise errors.QuotaShortageError(message=self._prefix_msg(_('Ram资源配额不足')))
-
-            if disk_size > 0:
-                if (quota.disk_size_total - quota.disk_size_used) >= disk_size:
-                    quota.disk_size_used = quota.disk_size_used + disk_size
-                    update_fields.append('disk_size_used')
-                else:
-                    raise errors.QuotaShortageError(message=self._prefix_msg(_('硬盘资源配额不足')))
-
-            if public_ip > 0:
-                if (quota.public_ip_total - quota.public_ip_used) >= public_ip:
-                    quota.public_ip_used = quota.public_ip_used + public_ip
-                    update_fields.append('public_ip_used')
-                else:
-                    raise errors.QuotaShortageError(message=self._prefix_msg(_('公网IP资源配额不足')))
-
-            if private_ip > 0:
-                if (quota.private_ip_total - quota.private_ip_used) >= private_ip:
-                    quota.private_ip_used = quota.private_ip_used + private_ip
-                    update_fields.append('private_ip_used')
-                else:
-                    raise errors.QuotaShortageError(message=self._prefix_msg(_('私网IP资源配额不足')))
-
-            if update_fields:
-                try:
-                    quota.save(update_fields=update_fields)
-                except Exception as e:
-                    raise errors.QuotaError(message=self._prefix_msg(_('扣除资源配额失败')))
-
-        return quota
+        raise errors.QuotaError(message=self._prefix_msg(_('扣除资源配额失败')))
 
     def release(self, service, vcpus: int = 0, ram: int = 0, disk_size: int = 0,
                 public_ip: int = 0, private_ip: int = 0):
@@ -597,6 +784,11 @@ class ServiceQuotaManagerBase:
         if vcpus < 0 or ram < 0 or disk_size < 0 or public_ip < 0 or private_ip < 0:
             raise errors.QuotaError(_('参数无效，释放资源配额不得小于0'))
 
+        if self.sharded:
+            self._shard_add(service, -1, vcpus=vcpus, ram=ram, disk_size=disk_size, public_ip=public_ip,
+                            private_ip=private_ip)
+            return self.get_quota(service=service)
+
         with transaction.atomic():
             update_fields = []
             quota = self.MODEL.objects.select_for_update().filter(service=service).first()
@@ -860,6 +1052,7 @@ class ServicePrivateQuotaManager(ServiceQuotaManagerBase):
     接入服务的私有资源配额管理
     """
     MODEL = ServicePrivateQuota
+    SHARD_QUOTA_TYPE = ServiceQuotaShard.QuotaType.PRIVATE
     ERROR_MSG_PREFIX = gettext_lazy('服务的私有资源配额')
 
     def get_user_private_queryset(self, user):
@@ -875,9 +1068,156 @@ class ServiceShareQuotaManager(ServiceQuotaManagerBase):
     接入服务的共享资源配额管理
     """
     MODEL = ServiceShareQuota
+    SHARD_QUOTA_TYPE = ServiceQuotaShard.QuotaType.SHARE
     ERROR_MSG_PREFIX = gettext_lazy('服务的共享资源配额')
 
 
+DEFAULT_QUOTA_RESERVATION = {
+    'TTL': 600,                 # 预留的有效期(秒)，超时未确认的预留被回收释放
+    'REAP_INTERVAL': 60,        # 回收任务每轮间隔，单位秒
+    'REAP_BATCH_SIZE': 100,     # 回收任务每批处理的预留数
+    'RETENTION': 7 * 24 * 3600,     # 已确认、已释放和过期释放的预留记录保留时间(秒)，之后由回收任务删除，0不删除
+}
+
+
+def get_quota_reservation_config():
+    c = dict(DEFAULT_QUOTA_RESERVATION)
+    c.update(getattr(settings, 'QUOTA_RESERVATION', {}))
+    return c
+
+
+class QuotaReservationManager:
+    """
+    资源配额预留管理
+    """
+    MODEL = QuotaReservation
+
+    def create(self, service, user_quota=None, ttl: int = None, vcpus: int = 0, ram: int = 0,
+               disk_size: int = 0, public_ip: int = 0, private_ip: int = 0):
+        """
+        创建预留记录，资源配额由调用者在同一事务中扣除
+
+        :param service: 接入服务
+        :param user_quota: 用户资源配额
+        :param ttl: 预留有效期(秒)，默认settings.QUOTA_RESERVATION['TTL']
+        :return:
+            self.MODEL()
+        """
+        if ttl is None:
+            ttl = get_quota_reservation_config()['TTL']
+
+        reservation = self.MODEL(service=service, user_quota=user_quota, vcpus=vcpus, ram=ram, disk_size=disk_size,
+                                 public_ip=public_ip, private_ip=private_ip,
+                                 expiration_time=timezone.now() + timedelta(seconds=ttl))
+        reservation.save(force_insert=True)
+        return reservation
+
+    def confirm(self, reservation, server_id: str = ''):
+        """
+        资源创建成功，确认预留，资源配额转为已用
+
+        :return:
+            True
+            False   # 预留已过期被释放
+        """
+        rows = self.MODEL.objects.filter(id=reservation.id, status=self.MODEL.Status.RESERVED).update(
+            status=self.MODEL.Status.CONFIRMED, server_id=server_id, update_time=timezone.now())
+        if rows:
+            reservation.status = self.MODEL.Status.CONFIRMED
+            reservation.server_id = server_id
+
+        return rows > 0
+
+    def _release(self, reservation_id: str, status: str):
+        with transaction.atomic():
+            rows = self.MODEL.objects.filter(id=reservation_id, status=self.MODEL.Status.RESERVED).update(
+                status=status, update_time=timezone.now())
+            if not rows:
+                return False
+
+            reservation = self.MODEL.objects.get(id=reservation_id)
+            amounts = reservation.get_amounts()
+            if reservation.service_id:
+                ServicePrivateQuotaManager().release_used(reservation.service_id, **amounts)
+            if reservation.user_quota_id:
+                conditional_release(UserQuota.objects.filter(id=reservation.user_quota_id), **amounts)
+
+        return True
+
+    def release(self, reservation):
+        """
+        资源创建失败，释放预留的资源配额
+
+        :return:
+            True
+            False   # 预留已确认或已释放
+        """
+        return self._release(reservation.id, status=self.MODEL.Status.RELEASED)
+
+    def reap_expired(self, now=None, limit: int = None):
+        """
+        释放已过期仍未确认的预留
+
+        :param limit: 最多处理的预留数，默认settings.QUOTA_RESERVATION['REAP_BATCH_SIZE']
+        :return:
+            int     # 释放的预留数
+        """
+        now = now if now else timezone.now()
+        limit = limit if limit else get_quota_reservation_config()['REAP_BATCH_SIZE']
+        ids = self.MODEL.objects.filter(
+            status=self.MODEL.Status.RESERVED, expiration_time__lt=now
+        ).order_by('expiration_time').values_list('id', flat=True)[:limit]
+        count = 0
+        for reservation_id in list(ids):
+            if self._release(reservation_id, status=self.MODEL.Status.EXPIRED):
+                count += 1
+
+        return count
+
+    def purge(self, now=None, limit: int = None):
+        """
+        删除过期时间超过保留时间(settings.QUOTA_RESERVATION['RETENTION'])的已确认、已释放和过期释放的预留记录
+
+        :param limit: 最多删除的记录数，默认settings.QUOTA_RESERVATION['REAP_BATCH_SIZE']
+        :return:
+            int     # 删除的记录数
+        """
+        config = get_quota_reservation_config()
+        if not config['RETENTION']:
+            return 0
+
+        now = now if now else timezone.now()
+        limit = limit if limit else config['REAP_BATCH_SIZE']
+        ids = self.MODEL.objects.filter(
+            status__in=[self.MODEL.Status.CONFIRMED, self.MODEL.Status.RELEASED, self.MODEL.Status.EXPIRED],
+            expiration_time__lt=now - timedelta(seconds=config['RETENTION'])
+        ).order_by('expiration_time').values_list('id', flat=True)[:limit]
+        ids = list(ids)
+        if not ids:
+            return 0
+
+        count, _rows = self.MODEL.objects.filter(id__in=ids).delete()
+        return count
+
+    def get_reserved_map(self, user_quota_ids: list):
+        """
+        用户配额预留中(未确认)的资源数
+
+        :return:
+            {
+                user_quota_id: {'vcpus': 1, 'ram': 1024, 'disk_size': 0, 'public_ip': 0, 'private_ip': 1}
+            }
+        """
+        if not user_quota_ids:
+            return {}
+
+        names = [name for name, _prefix in QUOTA_RESOURCES]
+        rows = self.MODEL.objects.filter(
+            user_quota_id__in=user_quota_ids, status=self.MODEL.Status.RESERVED
+        ).values('user_quota_id').annotate(**{f'sum_{name}': Sum(name) for name in names}).order_by()
+        return {r['user_quota_id']: {name: r[f'sum_{name}'] or 0 for name in names} for r in rows}
+
+
 class ServiceManager:
     @staticmethod
     def get_service_by_id(_id):
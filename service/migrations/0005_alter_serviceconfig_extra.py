@@ -0,0 +1,18 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0004_auto_20210625_0249'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='serviceconfig',
+            name='extra',
+            field=models.CharField(blank=True, default='', help_text='json格式，如请求超时时间(秒)：{"timeout": {"connect": 5, "read": 30}}', max_length=1024, verbose_name='其他配置'),
+        ),
+    ]
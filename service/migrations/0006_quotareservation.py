@@ -0,0 +1,42 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0005_alter_serviceconfig_extra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuotaReservation',
+            fields=[
+                ('id', models.CharField(blank=True, editable=False, max_length=36, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vcpus', models.IntegerField(default=0, verbose_name='CPU核数')),
+                ('ram', models.IntegerField(default=0, verbose_name='内存大小(MB)')),
+                ('disk_size', models.IntegerField(default=0, verbose_name='硬盘大小(GB)')),
+                ('public_ip', models.IntegerField(default=0, verbose_name='公网IP数')),
+                ('private_ip', models.IntegerField(default=0, verbose_name='私网IP数')),
+                ('status', models.CharField(choices=[('reserved', '预留中'), ('confirmed', '已确认'), ('released', '已释放'), ('expired', '过期释放')], default='reserved', max_length=16, verbose_name='状态')),
+                ('server_id', models.CharField(blank=True, default='', max_length=36, verbose_name='云服务器ID')),
+                ('expiration_time', models.DateTimeField(verbose_name='预留过期时间')),
+                ('creation_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('service', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='quota_reservation_set', to='service.serviceconfig', verbose_name='接入服务')),
+                ('user_quota', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reservation_set', to='service.userquota', verbose_name='用户资源配额')),
+            ],
+            options={
+                'verbose_name': '资源配额预留',
+                'verbose_name_plural': '资源配额预留',
+                'db_table': 'quota_reservation',
+                'ordering': ['-creation_time'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='quotareservation',
+            index=models.Index(fields=['status', 'expiration_time'], name='idx_reservation_status_expire'),
+        ),
+    ]
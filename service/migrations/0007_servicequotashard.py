@@ -0,0 +1,38 @@
+# Generated by Django 3.2.5 on 2026-10-18 06:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service', '0006_quotareservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceQuotaShard',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('quota_type', models.CharField(choices=[('private', '私有资源配额'), ('share', '分享资源配额')], max_length=16, verbose_name='配额类型')),
+                ('shard', models.SmallIntegerField(verbose_name='分片号')),
+                ('private_ip_used', models.IntegerField(default=0, verbose_name='已用私网IP数')),
+                ('public_ip_used', models.IntegerField(default=0, verbose_name='已用公网IP数')),
+                ('vcpu_used', models.IntegerField(default=0, verbose_name='已用CPU核数')),
+                ('ram_used', models.IntegerField(default=0, verbose_name='已用内存大小(MB)')),
+                ('disk_size_used', models.IntegerField(default=0, verbose_name='已用硬盘大小(GB)')),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quota_shard_set', to='service.serviceconfig', verbose_name='接入服务')),
+            ],
+            options={
+                'verbose_name': '服务资源配额分片计数',
+                'verbose_name_plural': '服务资源配额分片计数',
+                'db_table': 'service_quota_shard',
+                'ordering': ['service', 'quota_type', 'shard'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='servicequotashard',
+            constraint=models.UniqueConstraint(fields=('service', 'quota_type', 'shard'), name='unique_service_quota_shard'),
+        ),
+    ]
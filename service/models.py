@@ -1,3 +1,4 @@
+import json
 from datetime import timedelta
 
 from django.db import models
@@ -102,7 +103,8 @@ class ServiceConfig(UuidModel):
     vpn_username = models.CharField(max_length=128, blank=True, default='', verbose_name=_('VPN服务用户名'),
                                     help_text=_('用于此服务认证的用户名'))
     vpn_password = models.CharField(max_length=255, blank=True, default='', verbose_name=_('VPN服务密码'))
-    extra = models.CharField(max_length=1024, blank=True, default='', verbose_name=_('其他配置'), help_text=_('json格式'))
+    extra = models.CharField(max_length=1024, blank=True, default='', verbose_name=_('其他配置'),
+                             help_text=_('json格式，如请求超时时间(秒)：{"timeout": {"connect": 5, "read": 30}}'))
     users = models.ManyToManyField(to=User, verbose_name=_('用户'), blank=True, related_name='service_set')
 
     contact_person = models.CharField(verbose_name=_('联系人名称'), max_length=128,
@@ -157,6 +159,41 @@ class ServiceConfig(UuidModel):
         encryptor = get_encryptor()
         self.vpn_password = encryptor.encrypt(raw_password)
 
+    def extra_params(self):
+        """
+        其他配置extra解析为字典
+
+        :return:
+            dict    # json格式无效时返回空字典
+        """
+        if not self.extra:
+            return {}
+
+        try:
+            params = json.loads(self.extra)
+        except (TypeError, ValueError):
+            return {}
+
+        return params if isinstance(params, dict) else {}
+
+    def adapter_timeout(self):
+        """
+        请求服务的超时时间，在extra中配置，如：{"timeout": {"connect": 5, "read": 30}}
+
+        :return:
+            (connect_timeout, read_timeout)     # 未配置的值为None
+        """
+        timeout = self.extra_params().get('timeout')
+        if not isinstance(timeout, dict):
+            return None, None
+
+        def to_timeout(val):
+            if isinstance(val, bool) or not isinstance(val, (int, float)) or val <= 0:
+                return None
+            return val
+
+        return to_timeout(timeout.get('connect')), to_timeout(timeout.get('read'))
+
     def is_need_vpn(self):
         return self.need_vpn
 
@@ -241,6 +278,38 @@ class ServiceShareQuota(ServiceQuotaBase):
         verbose_name_plural = verbose_name
 
 
+class ServiceQuotaShard(models.Model):
+    """
+    服务资源配额已用数的分片计数
+
+    分片计数模式下，扣除和释放只更新按哈希选择的一个分片行，不再集中更新服务配额一行；
+    已用数 = 服务配额行的已用数 + 所有分片之和，分片定期合并回服务配额行
+    """
+    class QuotaType(models.TextChoices):
+        PRIVATE = 'private', _('私有资源配额')
+        SHARE = 'share', _('分享资源配额')
+
+    id = models.AutoField(primary_key=True, verbose_name='ID')
+    service = models.ForeignKey(to=ServiceConfig, on_delete=models.CASCADE, related_name='quota_shard_set',
+                                verbose_name=_('接入服务'))
+    quota_type = models.CharField(verbose_name=_('配额类型'), max_length=16, choices=QuotaType.choices)
+    shard = models.SmallIntegerField(verbose_name=_('分片号'))
+    private_ip_used = models.IntegerField(verbose_name=_('已用私网IP数'), default=0)
+    public_ip_used = models.IntegerField(verbose_name=_('已用公网IP数'), default=0)
+    vcpu_used = models.IntegerField(verbose_name=_('已用CPU核数'), default=0)
+    ram_used = models.IntegerField(verbose_name=_('已用内存大小(MB)'), default=0)
+    disk_size_used = models.IntegerField(verbose_name=_('已用硬盘大小(GB)'), default=0)
+
+    class Meta:
+        db_table = 'service_quota_shard'
+        ordering = ['service', 'quota_type', 'shard']
+        verbose_name = _('服务资源配额分片计数')
+        verbose_name_plural = verbose_name
+        constraints = [
+            models.UniqueConstraint(fields=['service', 'quota_type', 'shard'], name='unique_service_quota_shard'),
+        ]
+
+
 class UserQuota(UuidModel):
     """
     用户资源配额限制
@@ -295,26 +364,37 @@ class UserQuota(UuidModel):
         verbose_name_plural = verbose_name
 
     def __str__(self):
+        return self.build_display(
+            tag_display=self.get_tag_display(), vcpu_total=self.vcpu_total, ram_total=self.ram_total,
+            disk_size_total=self.disk_size_total, public_ip_total=self.public_ip_total,
+            private_ip_total=self.private_ip_total, duration_days=self.duration_days)
+
+    @staticmethod
+    def build_display(tag_display, vcpu_total: int, ram_total: int, disk_size_total: int,
+                      public_ip_total: int, private_ip_total: int, duration_days: int):
+        """
+        配额的描述，不需要模型实例，如由values()查询的字段值构建
+        """
         values = []
-        if self.vcpu_total > 0:
-            values.append(f'vCPU: {self.vcpu_total}')
-        if self.ram_total > 0:
-            values.append(f'RAM: {self.ram_total}Mb')
-        if self.disk_size_total > 0:
-            values.append(f'Disk: {self.disk_size_total}Gb')
-        if self.public_ip_total > 0:
-            values.append(f'PublicIP: {self.public_ip_total}')
-        if self.private_ip_total > 0:
-            values.append(f'PrivateIP: {self.private_ip_total}')
-        if self.duration_days > 0:
-            values.append(f'Days: {self.duration_days}')
+        if vcpu_total > 0:
+            values.append(f'vCPU: {vcpu_total}')
+        if ram_total > 0:
+            values.append(f'RAM: {ram_total}Mb')
+        if disk_size_total > 0:
+            values.append(f'Disk: {disk_size_total}Gb')
+        if public_ip_total > 0:
+            values.append(f'PublicIP: {public_ip_total}')
+        if private_ip_total > 0:
+            values.append(f'PrivateIP: {private_ip_total}')
+        if duration_days > 0:
+            values.append(f'Days: {duration_days}')
 
         if values:
             s = ', '.join(values)
         else:
             s = 'vCPU: 0, RAM:0 Mb, 0, 0, 0'
 
-        return f'[{self.get_tag_display()}]({s})'
+        return f'[{tag_display}]({s})'
 
     @property
     def display(self):
@@ -363,6 +443,50 @@ class UserQuota(UuidModel):
         return False
 
 
+class QuotaReservation(UuidModel):
+    """
+    创建资源时预留(已扣除)的资源配额
+
+    资源创建成功后确认；创建失败时释放；超过预留有效期仍未确认(如进程异常退出)时由回收任务释放
+    """
+    class Status(models.TextChoices):
+        RESERVED = 'reserved', _('预留中')
+        CONFIRMED = 'confirmed', _('已确认')
+        RELEASED = 'released', _('已释放')
+        EXPIRED = 'expired', _('过期释放')
+
+    service = models.ForeignKey(to=ServiceConfig, null=True, on_delete=models.SET_NULL,
+                                related_name='quota_reservation_set', verbose_name=_('接入服务'))
+    user_quota = models.ForeignKey(to=UserQuota, null=True, blank=True, on_delete=models.SET_NULL,
+                                   related_name='reservation_set', verbose_name=_('用户资源配额'))
+    vcpus = models.IntegerField(verbose_name=_('CPU核数'), default=0)
+    ram = models.IntegerField(verbose_name=_('内存大小(MB)'), default=0)
+    disk_size = models.IntegerField(verbose_name=_('硬盘大小(GB)'), default=0)
+    public_ip = models.IntegerField(verbose_name=_('公网IP数'), default=0)
+    private_ip = models.IntegerField(verbose_name=_('私网IP数'), default=0)
+    status = models.CharField(verbose_name=_('状态'), max_length=16, choices=Status.choices, default=Status.RESERVED)
+    server_id = models.CharField(verbose_name=_('云服务器ID'), max_length=36, blank=True, default='')
+    expiration_time = models.DateTimeField(verbose_name=_('预留过期时间'))
+    creation_time = models.DateTimeField(verbose_name=_('创建时间'), auto_now_add=True)
+    update_time = models.DateTimeField(verbose_name=_('更新时间'), auto_now=True)
+
+    class Meta:
+        db_table = 'quota_reservation'
+        ordering = ['-creation_time']
+        verbose_name = _('资源配额预留')
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['status', 'expiration_time'], name='idx_reservation_status_expire'),
+        ]
+
+    def get_amounts(self):
+        """
+        预留的资源数，可做为配额扣除/释放的参数
+        """
+        return {'vcpus': self.vcpus, 'ram': self.ram, 'disk_size': self.disk_size,
+                'public_ip': self.public_ip, 'private_ip': self.private_ip}
+
+
 class ApplyOrganization(UuidModel):
     """
     数据中心/机构申请
@@ -0,0 +1,180 @@
+"""
+资源配额已用数统计校正
+
+每类配额只用一条GROUP BY聚合查询统计所有配额的实际用量，和保存的已用数(*_used，服务配额包括分片计数)比较，修正偏差：
+
+    * 用户配额：Server + ServerArchive(用户配额删除资源后不返还) + 预留中的资源配额；
+    * 服务私有配额：使用私有配额的Server + 预留中的资源配额；
+    * 服务共享配额：使用共享配额的Server。
+
+先读取已用数再统计实际用量，修正时按差值条件更新(配额行和分片的已用数在读取后未变化)，不覆盖并发的扣除和释放，
+已用数已变化的配额跳过(skipped)，下次校正时修正；统计期间新创建或删除的资源可能导致个别配额的短暂偏差，下次校正时修正
+"""
+from django.db.models import Sum, Count, Q, F
+
+from servers.models import Server, ServerArchive
+from core.model_version import model_version
+from .models import UserQuota, ServicePrivateQuota, ServiceShareQuota, QuotaReservation
+from .managers import ServicePrivateQuotaManager, ServiceShareQuotaManager
+
+
+USED_FIELDS = ('vcpu_used', 'ram_used', 'public_ip_used', 'private_ip_used')
+
+
+def _aggregate_servers(queryset, key: str):
+    """
+    :return:
+        {key_value: {'vcpu_used': 1, 'ram_used': 1024, 'public_ip_used': 0, 'private_ip_used': 1}}
+    """
+    rows = queryset.filter(**{f'{key}__isnull': False}).values(key).annotate(
+        sum_vcpu=Sum('vcpus'), sum_ram=Sum('ram'),
+        count_public_ip=Count('id', filter=Q(public_ip=True)),
+        count_private_ip=Count('id', filter=Q(public_ip=False))
+    ).order_by()
+    return {r[key]: {'vcpu_used': r['sum_vcpu'] or 0, 'ram_used': r['sum_ram'] or 0,
+                     'public_ip_used': r['count_public_ip'], 'private_ip_used': r['count_private_ip']}
+            for r in rows}
+
+
+def _aggregate_reservations(key: str):
+    rows = QuotaReservation.objects.filter(
+        status=QuotaReservation.Status.RESERVED, **{f'{key}__isnull': False}
+    ).values(key).annotate(
+        sum_vcpu=Sum('vcpus'), sum_ram=Sum('ram'), sum_public_ip=Sum('public_ip'), sum_private_ip=Sum('private_ip')
+    ).order_by()
+    return {r[key]: {'vcpu_used': r['sum_vcpu'] or 0, 'ram_used': r['sum_ram'] or 0,
+                     'public_ip_used': r['sum_public_ip'] or 0, 'private_ip_used': r['sum_private_ip'] or 0}
+            for r in rows}
+
+
+def _merge(*usages):
+    merged = {}
+    for usage in usages:
+        for k, stat in usage.items():
+            m = merged.setdefault(k, dict.fromkeys(USED_FIELDS, 0))
+            for f in USED_FIELDS:
+                m[f] += stat[f]
+
+    return merged
+
+
+class QuotaReconciler:
+    """
+    资源配额已用数统计校正
+    """
+    KIND_USER = 'user'
+    KIND_PRIVATE = 'private'
+    KIND_SHARE = 'share'
+    KINDS = (KIND_USER, KIND_PRIVATE, KIND_SHARE)
+
+    def __init__(self, dry_run: bool = False):
+        """
+        :param dry_run: True只统计偏差，不修正
+        """
+        self.dry_run = dry_run
+        self.skipped = 0        # 读取后已用数已变化，未修正的配额数
+
+    @staticmethod
+    def compute_usage(kind: str):
+        """
+        统计一类配额所有配额的实际用量
+
+        :return:
+            (
+                model,
+                key,        # 配额关联的字段，'id' or 'service_id'
+                {key_value: {'vcpu_used': 1, 'ram_used': 1024, 'public_ip_used': 0, 'private_ip_used': 1}}
+            )
+        """
+        if kind == QuotaReconciler.KIND_USER:
+            usage = _merge(_aggregate_servers(Server.objects.all(), key='user_quota_id'),
+                           _aggregate_servers(ServerArchive.objects.all(), key='user_quota_id'),
+                           _aggregate_reservations(key='user_quota_id'))
+            return UserQuota, 'id', usage
+        elif kind == QuotaReconciler.KIND_PRIVATE:
+            usage = _merge(_aggregate_servers(Server.objects.filter(center_quota=Server.QUOTA_PRIVATE),
+                                              key='service_id'),
+                           _aggregate_reservations(key='service_id'))
+            return ServicePrivateQuota, 'service_id', usage
+        elif kind == QuotaReconciler.KIND_SHARE:
+            usage = _aggregate_servers(Server.objects.filter(center_quota=Server.QUOTA_SHARED), key='service_id')
+            return ServiceShareQuota, 'service_id', usage
+
+        raise ValueError(f'invalid quota kind "{kind}"')
+
+    def reconcile(self, kind: str, queryset=None):
+        """
+        校正一类配额的已用数
+
+        :param kind: 配额类型，KINDS
+        :param queryset: 只校正这些配额，默认所有
+        :return:
+            [
+                (quota, {'vcpu_used': (old, new), ...}),     # 有偏差的配额
+            ]
+        """
+        # 分片计数先合并回服务配额行，不改变实际已用数；合并后新的分片计数在读取已用数时加上
+        shard_mgr = None
+        if kind == self.KIND_PRIVATE:
+            shard_mgr = ServicePrivateQuotaManager(sharded=True)
+        elif kind == self.KIND_SHARE:
+            shard_mgr = ServiceShareQuotaManager(sharded=True)
+
+        if shard_mgr is not None:
+            shard_mgr.fold_shards()
+            model = shard_mgr.MODEL
+        elif kind == self.KIND_USER:
+            model = UserQuota
+        else:
+            raise ValueError(f'invalid quota kind "{kind}"')
+
+        if queryset is None:
+            queryset = model.objects.all()
+
+        queryset = queryset.only('id', 'service_id', *USED_FIELDS).order_by()
+        if shard_mgr is not None:
+            queryset = shard_mgr.annotate_shards_used(queryset)
+
+        quotas = list(queryset)     # 先读取已用数，再统计实际用量
+        model, key, usage = self.compute_usage(kind)
+        drifts = []
+        for quota in quotas:
+            actual = usage.get(getattr(quota, key), {})
+            diff = {}
+            for f in USED_FIELDS:
+                new = actual.get(f, 0)
+                old = getattr(quota, f) + (getattr(quota, f'sum_{f}') if shard_mgr is not None else 0)
+                if old != new:
+                    diff[f] = (old, new)
+
+            if not diff:
+                continue
+
+            drifts.append((quota, diff))
+            if self.dry_run:
+                continue
+
+            # 按差值更新配额行，分片计数不变；已用数在读取后已变化(并发的扣除、释放或分片合并)时不更新
+            unchanged = model.objects.filter(id=quota.id, **{f: getattr(quota, f) for f in diff})
+            if shard_mgr is not None:
+                unchanged = shard_mgr.annotate_shards_used(unchanged).filter(
+                    **{f'sum_{f}': getattr(quota, f'sum_{f}') for f in diff})
+
+            updated = unchanged.update(**{f: F(f) + (new - old) for f, (old, new) in diff.items()})
+            if updated:
+                for f, (old, new) in diff.items():
+                    setattr(quota, f, getattr(quota, f) + new - old)
+            else:
+                self.skipped += 1
+
+        if drifts and not self.dry_run:
+            model_version.bump(model._meta.db_table)    # update()不发送信号
+
+        return drifts
+
+    def reconcile_all(self, kinds: list = None):
+        """
+        :return:
+            {kind: drifts}
+        """
+        return {kind: self.reconcile(kind) for kind in (kinds or self.KINDS)}
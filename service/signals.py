@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from adapters.registry import adapter_registry
+from .models import ServiceConfig
+
+
+@receiver(post_save, sender=ServiceConfig)
+@receiver(post_delete, sender=ServiceConfig)
+def invalidate_service_adapter(sender, instance, **kwargs):
+    """
+    服务配置修改或删除后，移除本进程中服务的适配器实例
+    """
+    adapter_registry.invalidate(instance.id)
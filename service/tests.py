@@ -1,11 +1,25 @@
-from django.test import TransactionTestCase, SimpleTestCase
+import threading
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TransactionTestCase, SimpleTestCase, override_settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
-from core.errors import QuotaShortageError, QuotaOnlyIncreaseError
+from core.errors import Error, QuotaError, QuotaShortageError, QuotaOnlyIncreaseError
 from core.quota import QuotaAPI
+from adapters.registry import AdapterRegistry, adapter_registry
 from utils.test import get_or_create_user, get_or_create_service
 from utils.crypto import Encryptor
-from .managers import UserQuotaManager, ServicePrivateQuotaManager, ServiceShareQuotaManager
+from servers.models import Server, ServerArchive
+from .managers import (
+    UserQuotaManager, ServicePrivateQuotaManager, ServiceShareQuotaManager, QuotaReservationManager, conditional_deduct,
+    get_quota_reservation_config
+)
+from .models import ServiceConfig, UserQuota, ServicePrivateQuota, ServiceQuotaShard, QuotaReservation
+from .reconcile import QuotaReconciler
 
 User = get_user_model()
 
@@ -269,6 +283,112 @@ class TestServiceQuotaManager(TransactionTestCase):
     def test_private_update(self):
         self.update_case(ServicePrivateQuotaManager)
 
+    def test_deduct_shortage(self):
+        mgr = ServicePrivateQuotaManager()
+        mgr.increase(service=self.service, vcpus=4, ram=1024)
+        with self.assertRaises(QuotaShortageError) as cm:
+            mgr.deduct(service=self.service, vcpus=2, ram=2048)
+        self.assertIn('Ram', cm.exception.message)
+
+        # 资源不足时都不扣除
+        quota = mgr.get_quota(service=self.service)
+        self.assertEqual((quota.vcpu_used, quota.ram_used), (0, 0))
+
+        quota = mgr.deduct(service=self.service, vcpus=4, ram=1024)
+        self.assertEqual((quota.vcpu_used, quota.ram_used), (4, 1024))
+        with self.assertRaises(QuotaShortageError) as cm:
+            mgr.deduct(service=self.service, vcpus=1)
+        self.assertIn('vCPU', cm.exception.message)
+
+    def test_sharded_deduct(self):
+        mgr = ServicePrivateQuotaManager(sharded=True)
+        mgr.increase(service=self.service, vcpus=4, ram=1024)
+        quota = mgr.deduct(service=self.service, vcpus=3, ram=512)
+        self.assertEqual((quota.vcpu_used, quota.ram_used), (3, 512))
+        # 扣除记在分片上，服务配额行未更新
+        self.assertEqual(ServicePrivateQuota.objects.get(service=self.service).vcpu_used, 0)
+
+        with self.assertRaises(QuotaShortageError):
+            mgr.deduct(service=self.service, vcpus=2)
+        quota = mgr.get_quota(service=self.service)
+        self.assertEqual((quota.vcpu_used, quota.ram_used), (3, 512))
+
+        mgr.release(service=self.service, vcpus=1, ram=512)
+        self.assertEqual(mgr.fold_shards(service=self.service), 1)
+        quota = ServicePrivateQuota.objects.get(service=self.service)
+        self.assertEqual((quota.vcpu_used, quota.ram_used), (2, 0))
+        self.assertFalse(ServiceQuotaShard.objects.filter(service=self.service).exclude(vcpu_used=0).exists())
+        quota = mgr.get_quota(service=self.service)
+        self.assertEqual((quota.vcpu_used, quota.ram_used), (2, 0))
+
+
+class QuotaReconcilerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = get_or_create_user()
+        self.service = get_or_create_service()
+        self.user_quota = UserQuotaManager().create_quota(user=self.user, service=self.service)
+        for public_ip in [True, False]:
+            Server(service=self.service, instance_id='test', vcpus=2, ram=1024, public_ip=public_ip,
+                   user_quota=self.user_quota, center_quota=Server.QUOTA_PRIVATE).save()
+
+        ServerArchive(service=self.service, instance_id='test', vcpus=1, ram=512, public_ip=False,
+                      user_quota=self.user_quota).save()
+        self.pri_quota = ServicePrivateQuotaManager().get_quota(service=self.service)
+
+    def test_reconcile(self):
+        UserQuota.objects.filter(id=self.user_quota.id).update(vcpu_used=100)
+        drifts = QuotaReconciler(dry_run=True).reconcile(QuotaReconciler.KIND_USER)
+        self.assertEqual(drifts[0][1]['vcpu_used'], (100, 5))
+        self.user_quota.refresh_from_db()
+        self.assertEqual(self.user_quota.vcpu_used, 100)
+
+        result = QuotaReconciler().reconcile_all()
+        self.assertEqual(len(result[QuotaReconciler.KIND_USER]), 1)
+        self.user_quota.refresh_from_db()
+        self.assertEqual((self.user_quota.vcpu_used, self.user_quota.ram_used, self.user_quota.public_ip_used,
+                          self.user_quota.private_ip_used), (5, 2560, 1, 2))
+        self.pri_quota.refresh_from_db()
+        self.assertEqual((self.pri_quota.vcpu_used, self.pri_quota.ram_used, self.pri_quota.public_ip_used,
+                          self.pri_quota.private_ip_used), (4, 2048, 1, 1))
+
+        # 没有偏差
+        self.assertEqual(QuotaReconciler().reconcile_all(), {k: [] for k in QuotaReconciler.KINDS})
+        self.assertEqual(ServerArchive.count_user_quota_used(self.user_quota)['vcpu_used_count'], 1)
+
+    def test_reconcile_concurrent(self):
+        QuotaReconciler().reconcile_all()
+        mgr = ServicePrivateQuotaManager(sharded=True)
+        # 分片计数包括在已用数中，不重复计算
+        Server(service=self.service, instance_id='test', vcpus=2, ram=0, public_ip=False,
+               center_quota=Server.QUOTA_PRIVATE).save()
+        mgr._shard_add(self.service, 1, vcpus=2, private_ip=1)
+        self.assertEqual(QuotaReconciler().reconcile(QuotaReconciler.KIND_PRIVATE), [])
+
+        UserQuota.objects.filter(id=self.user_quota.id).update(ram_used=0)
+        ServicePrivateQuota.objects.filter(service=self.service).update(ram_used=0)
+        compute_usage = QuotaReconciler.compute_usage
+
+        def concurrent_compute_usage(kind):
+            # 读取已用数后并发的扣除和释放
+            if kind == QuotaReconciler.KIND_USER:
+                UserQuota.objects.filter(id=self.user_quota.id).update(ram_used=F('ram_used') + 512)
+            else:
+                mgr.release_used(self.service, ram=512)
+            return compute_usage(kind)
+
+        reconciler = QuotaReconciler()
+        with mock.patch.object(QuotaReconciler, 'compute_usage', side_effect=concurrent_compute_usage):
+            reconciler.reconcile_all(kinds=[QuotaReconciler.KIND_USER, QuotaReconciler.KIND_PRIVATE])
+        self.assertEqual(reconciler.skipped, 2)
+        self.user_quota.refresh_from_db()
+        self.assertEqual((self.user_quota.vcpu_used, self.user_quota.ram_used), (5, 512))
+
+        QuotaReconciler().reconcile_all()
+        self.user_quota.refresh_from_db()
+        self.assertEqual((self.user_quota.vcpu_used, self.user_quota.ram_used), (5, 2560))
+        quota = mgr.get_quota(service=self.service)
+        self.assertEqual((quota.vcpu_used, quota.ram_used, quota.private_ip_used), (6, 2048, 2))
+
 
 class QuotaAPITests(TransactionTestCase):
     def setUp(self):
@@ -281,6 +401,139 @@ class QuotaAPITests(TransactionTestCase):
         service = self.service
         self.pri_quota = mgr.get_quota(service=service)
 
+    def test_quota_apply_rollback(self):
+        ServicePrivateQuotaManager().increase(service=self.service, vcpus=4, ram=2048, public_ip=1)
+        UserQuotaManager().increase(user=self.user, quota_id=self.user_quota.id, vcpus=4, ram=1024, public_ip=1)
+
+        # 用户配额不足，已扣除的服务配额在同一事务中回滚
+        with self.assertRaises(QuotaShortageError) as cm:
+            QuotaAPI.server_create_quota_apply(service=self.service, user=self.user, vcpu=2, ram=2048,
+                                               public_ip=True, user_quota_id=self.user_quota.id)
+        self.assertIn('Ram', cm.exception.message)
+        self.pri_quota.refresh_from_db()
+        self.assertEqual((self.pri_quota.vcpu_used, self.pri_quota.ram_used, self.pri_quota.public_ip_used),
+                         (0, 0, 0))
+
+        QuotaAPI.server_create_quota_apply(service=self.service, user=self.user, vcpu=2, ram=1024,
+                                           public_ip=True, user_quota_id=self.user_quota.id)
+        self.pri_quota.refresh_from_db()
+        self.user_quota.refresh_from_db()
+        self.assertEqual((self.pri_quota.vcpu_used, self.pri_quota.ram_used), (2, 1024))
+        self.assertEqual((self.user_quota.vcpu_used, self.user_quota.public_ip_used), (2, 1))
+
+    @override_settings(SERVICE_QUOTA_SHARDS={'ENABLED': True, 'SHARDS': 4})
+    def test_sharded_reserve_concurrent(self):
+        ServicePrivateQuotaManager().increase(service=self.service, vcpus=1, ram=1024, private_ip=10)
+        UserQuotaManager().increase(user=self.user, quota_id=self.user_quota.id, vcpus=10, ram=10240,
+                                    private_ip=10)
+        paused = threading.Event()
+        resume = threading.Event()
+        results = []
+
+        def pause_deduct(queryset, **amounts):
+            # 线程1扣除服务配额分片后，在扣除用户配额的事务中暂停
+            if threading.current_thread().name == 'reserve-1':
+                paused.set()
+                resume.wait(10)
+            return conditional_deduct(queryset, **amounts)
+
+        def reserve():
+            try:
+                results.append(QuotaAPI.server_quota_reserve(
+                    service=self.service, user_quota=self.user_quota, vcpu=1, ram=1024, public_ip=False,
+                    lease=True))
+            except Error as exc:
+                results.append(exc)
+            finally:
+                connection.close()
+
+        with mock.patch('core.quota.conditional_deduct', pause_deduct):
+            t = threading.Thread(target=reserve, name='reserve-1')
+            t.start()
+            self.assertTrue(paused.wait(10))
+            # 线程1的分片扣除已提交，并发的预留检查总量时可见
+            t2 = threading.Thread(target=reserve, name='reserve-2')
+            t2.start()
+            t2.join()
+            resume.set()
+            t.join()
+
+        self.assertIsInstance(results[0], QuotaShortageError)
+        self.assertIsInstance(results[1], QuotaReservation)
+        quota = ServicePrivateQuotaManager(sharded=True).get_quota(service=self.service)
+        self.assertEqual((quota.vcpu_used, quota.ram_used, quota.private_ip_used), (1, 1024, 1))
+        self.user_quota.refresh_from_db()
+        self.assertEqual(self.user_quota.vcpu_used, 1)
+
+        # 分片计数模式不能在事务中扣除
+        with self.assertRaises(QuotaError):
+            with transaction.atomic():
+                ServicePrivateQuotaManager(sharded=True).try_deduct(self.service, vcpus=1)
+
+    def test_quota_lease(self):
+        ServicePrivateQuotaManager().increase(service=self.service, vcpus=4, ram=2048, private_ip=2)
+        UserQuotaManager().increase(user=self.user, quota_id=self.user_quota.id, vcpus=4, ram=2048, private_ip=2)
+        r_mgr = QuotaReservationManager()
+
+        # 创建失败，释放预留
+        user_quota, reservation = QuotaAPI.server_create_quota_lease(
+            service=self.service, user=self.user, vcpu=2, ram=1024, public_ip=False, user_quota_id=self.user_quota.id)
+        self.assertEqual(r_mgr.get_reserved_map([user_quota.id])[user_quota.id]['vcpus'], 2)
+        self.assertTrue(QuotaAPI.server_quota_cancel(reservation))
+        self.assertFalse(QuotaAPI.server_quota_cancel(reservation))
+        self.user_quota.refresh_from_db()
+        self.assertEqual((self.user_quota.vcpu_used, self.user_quota.private_ip_used), (0, 0))
+        self.assertEqual(r_mgr.get_reserved_map([user_quota.id]), {})
+
+        # 超时未确认，回收释放；之后确认时重新扣除
+        user_quota, reservation = QuotaAPI.server_create_quota_lease(
+            service=self.service, user=self.user, vcpu=2, ram=1024, public_ip=False,
+            user_quota_id=self.user_quota.id, ttl=0)
+        self.assertEqual(r_mgr.reap_expired(now=timezone.now() + timedelta(seconds=1)), 1)
+        self.pri_quota.refresh_from_db()
+        self.assertEqual((self.pri_quota.vcpu_used, self.pri_quota.ram_used), (0, 0))
+
+        server = Server(service=self.service, instance_id='test', vcpus=2, ram=1024, public_ip=False,
+                        user_quota=user_quota)
+        server.save()
+        self.assertTrue(QuotaAPI.server_quota_confirm(reservation, server=server))
+        self.pri_quota.refresh_from_db()
+        self.user_quota.refresh_from_db()
+        self.assertEqual((self.pri_quota.vcpu_used, self.pri_quota.private_ip_used), (2, 1))
+        self.assertEqual((self.user_quota.vcpu_used, self.user_quota.private_ip_used), (2, 1))
+
+        # 确认后不再被回收
+        user_quota, reservation = QuotaAPI.server_create_quota_lease(
+            service=self.service, user=self.user, vcpu=2, ram=1024, public_ip=False,
+            user_quota_id=self.user_quota.id, ttl=0)
+        self.assertTrue(QuotaAPI.server_quota_confirm(reservation, server=server))
+        self.assertEqual(r_mgr.reap_expired(now=timezone.now() + timedelta(seconds=1)), 0)
+        self.user_quota.refresh_from_db()
+        self.assertEqual(self.user_quota.vcpu_used, 4)
+
+        # 回收后配额已被其他创建使用，重新扣除失败，记录日志和云服务器id
+        ServicePrivateQuotaManager().increase(service=self.service, vcpus=2, ram=1024, private_ip=1)
+        UserQuotaManager().increase(user=self.user, quota_id=self.user_quota.id, vcpus=2, ram=1024, private_ip=1)
+        user_quota, reservation = QuotaAPI.server_create_quota_lease(
+            service=self.service, user=self.user, vcpu=2, ram=1024, public_ip=False,
+            user_quota_id=self.user_quota.id, ttl=0)
+        self.assertEqual(r_mgr.reap_expired(now=timezone.now() + timedelta(seconds=1)), 1)
+        QuotaAPI.server_create_quota_lease(service=self.service, user=self.user, vcpu=2, ram=1024, public_ip=False,
+                                           user_quota_id=self.user_quota.id)
+        with self.assertLogs('gosc.quota', level='WARNING'):
+            self.assertFalse(QuotaAPI.server_quota_confirm(reservation, server=server))
+        reservation.refresh_from_db()
+        self.assertEqual((reservation.status, reservation.server_id), (QuotaReservation.Status.EXPIRED, server.id))
+
+        # 超过保留时间的已结束预留记录被删除，预留中的保留
+        finished = QuotaReservation.objects.exclude(status=QuotaReservation.Status.RESERVED).count()
+        config = get_quota_reservation_config()
+        now = timezone.now() + timedelta(seconds=config['RETENTION'] + config['TTL'])
+        self.assertEqual(r_mgr.purge(now=now, limit=2), 2)
+        self.assertEqual(r_mgr.purge(now=now), finished - 2)
+        self.assertEqual(list(QuotaReservation.objects.values_list('status', flat=True)),
+                         [QuotaReservation.Status.RESERVED])
+
     def test_quota_apply_and_release(self):
         vcpus_add = 6
         ram_add = 1024
@@ -444,3 +697,54 @@ class TestEncryptor(SimpleTestCase):
 
         with self.assertRaises(encryptor.InvalidEncrypted):
             encryptor.decrypt('xsdf')
+
+
+class ServiceConfigTests(SimpleTestCase):
+    def test_adapter_timeout(self):
+        service = ServiceConfig(extra='')
+        self.assertEqual(service.extra_params(), {})
+        self.assertEqual(service.adapter_timeout(), (None, None))
+
+        service.extra = 'invalid json'
+        self.assertEqual(service.adapter_timeout(), (None, None))
+
+        service.extra = '{"timeout": {"connect": 3, "read": 20.5}}'
+        self.assertEqual(service.adapter_timeout(), (3, 20.5))
+
+        service.extra = '{"timeout": {"connect": -1, "read": "10"}}'
+        self.assertEqual(service.adapter_timeout(), (None, None))
+
+
+class AdapterRegistryTests(TransactionTestCase):
+    def setUp(self):
+        self.service = get_or_create_service()
+
+    def test_registry(self):
+        registry = AdapterRegistry()
+        adapter = registry.get(self.service)
+        self.assertIs(registry.get(self.service), adapter)
+        # 方法绑定在浅拷贝上，认证信息不修改共用的实例
+        auth = object()
+        bound = registry.get_method(self.service, 'server_status', auth=auth).__self__
+        self.assertIsNot(bound, adapter)
+        self.assertIs(bound.auth, auth)
+        self.assertIsNone(adapter.auth)
+        self.assertIs(bound.api_builder, adapter.api_builder)
+        self.assertIsNot(registry.get(self.service, vpn=True), adapter)
+        self.assertEqual(registry.get_stats()['hits'], 2)
+
+        # 配置改变，重新创建适配器
+        self.service.extra = '{"timeout": {"connect": 3, "read": 20}}'
+        new_adapter = registry.get(self.service)
+        self.assertIsNot(new_adapter, adapter)
+        self.assertEqual(new_adapter.get_timeout(), (3, 20))
+
+        registry.invalidate(self.service.id)
+        self.assertIsNot(registry.get(self.service), new_adapter)
+        self.assertEqual(registry.get_stats()['misses'], 4)
+
+    def test_invalidate_on_save(self):
+        adapter = adapter_registry.get(self.service)
+        self.assertIs(adapter_registry.get(self.service), adapter)
+        self.service.save()
+        self.assertIsNot(adapter_registry.get(self.service), adapter)
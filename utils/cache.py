@@ -0,0 +1,42 @@
+import os
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache as DjangoFileBasedCache
+from django.core.files import locks
+
+
+class FileBasedCache(DjangoFileBasedCache):
+    """
+    文件缓存，add()在同一主机的多个进程间是原子的
+
+    django的FileBasedCache.add()先检查键是否存在再写入，多个进程并发时可能都成功；
+    这里用缓存目录中的一个文件锁串行化add()，可以用作同一主机上多个进程间的锁；
+    缓存条目数达到MAX_ENTRIES时先删除已过期的条目，未过期的条目(模型版本号、熔断器状态、锁等)仍超过时才随机删除
+    """
+    lock_filename = 'add.lock'
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._createdir()
+        with open(os.path.join(self._dir, self.lock_filename), 'ab') as f:
+            locks.lock(f, locks.LOCK_EX)
+            try:
+                return super().add(key, value, timeout=timeout, version=version)
+            finally:
+                locks.unlock(f)
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        if len(filelist) < self._max_entries:
+            return
+
+        alive = 0
+        for fname in filelist:
+            try:
+                with open(fname, 'rb') as f:
+                    if not self._is_expired(f):
+                        alive += 1
+            except FileNotFoundError:
+                pass
+
+        if alive >= self._max_entries:
+            super()._cull()